@@ -0,0 +1,272 @@
+"""
+Admission control for the inference endpoints
+Limits how much work is accepted so a spike cannot stall calls that are already in progress:
+
+- token-bucket rate limiting per API key
+- global and per-key concurrency limits (a streamed response holds its slot until the last frame)
+- a bounded FIFO wait queue with a deadline for requests that arrive while all slots are busy
+
+Requests over a limit are rejected immediately with HTTP 429, a Retry-After header and the
+OpenAI-style error envelope. A limit of 0 disables it; admission control is off unless at least
+one limit is set here or on a key in the key store (keystore.py), whose per-key max_concurrent,
+rate and burst override the defaults below.
+
+Configuration (environment variables):
+    ADMISSION_MAX_CONCURRENT          - in-flight requests per worker (default: 0)
+    ADMISSION_MAX_CONCURRENT_PER_KEY  - in-flight requests per API key per worker (default: 0)
+    ADMISSION_RATE                    - sustained requests per second per API key (default: 0)
+    ADMISSION_BURST                   - token bucket size (default: max(1, 2 x ADMISSION_RATE))
+    ADMISSION_QUEUE_SIZE              - requests that may wait for a slot (default: 0, reject at once)
+    ADMISSION_QUEUE_TIMEOUT_MS        - longest wait for a slot before rejecting (default: 1000)
+"""
+
+import asyncio
+import math
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from metrics import ADMISSION_REJECTED, ADMISSION_QUEUE_WAIT
+from service import APIError
+
+
+def _rejected(reason: str, message: str, code: str, retry_after: float) -> APIError:
+    ADMISSION_REJECTED.inc((reason,))
+    return APIError(
+        message, code, type='rate_limit_error', status=429,
+        headers={'Retry-After': str(max(1, math.ceil(retry_after)))}
+    )
+
+
+class _Waiter:
+    """A request queued for a slot; granted is only changed under the controller lock"""
+
+    __slots__ = ('key', 'granted', 'event', 'loop', 'future')
+
+    def __init__(self, key: str):
+        self.key = key
+        self.granted = False
+        self.event: Optional[threading.Event] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.future: Optional[asyncio.Future] = None
+
+    def wake(self) -> None:
+        if self.event is not None:
+            self.event.set()
+        else:
+            try:
+                self.loop.call_soon_threadsafe(self._resolve)
+            except RuntimeError:
+                pass  # the waiting request's event loop has shut down
+
+    def _resolve(self) -> None:
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class Ticket:
+    """An admitted request's slot; release() is idempotent"""
+
+    __slots__ = ('_controller', 'key', '_released')
+
+    def __init__(self, controller: 'AdmissionController', key: str):
+        self._controller = controller
+        self.key = key
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._controller._release(self.key)
+
+
+class AdmissionController:
+    """Thread-safe limits shared by the sync (Flask) and async (ASGI) servers of a worker"""
+
+    def __init__(
+        self,
+        max_concurrent: int = 0,
+        max_per_key: int = 0,
+        rate: float = 0.0,
+        burst: Optional[float] = None,
+        queue_size: int = 0,
+        queue_timeout: float = 1.0
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_per_key = max_per_key
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, 2 * rate)
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        self._active = 0
+        self._active_by_key: Dict[str, int] = {}
+        self._buckets: Dict[str, List[float]] = {}  # key -> [tokens, last refill]
+        self._overrides: Dict[str, Tuple[Optional[int], Optional[float], Optional[float]]] = {}
+        self._waiters: List[_Waiter] = []
+        self.admitted = 0
+        self.rejected = 0
+
+    # ----- limits (call with the lock held) -----
+
+    def _take_token(self, key: str, now: float) -> float:
+        """Consume one token from key's bucket; returns seconds until one is available if empty"""
+        rate, burst = self.rate, self.burst
+        override = self._overrides.get(key)
+        if override and override[1]:
+            rate, burst = override[1], override[2] or max(1.0, 2 * override[1])
+        if not rate:
+            return 0.0
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [burst, now]
+        tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            return (1 - tokens) / rate
+        bucket[0] = tokens - 1
+        return 0.0
+
+    def _has_room(self, key: str) -> bool:
+        if self.max_concurrent and self._active >= self.max_concurrent:
+            return False
+        override = self._overrides.get(key)
+        max_per_key = override[0] if override and override[0] else self.max_per_key
+        return not max_per_key or self._active_by_key.get(key, 0) < max_per_key
+
+    def _occupy(self, key: str) -> None:
+        self._active += 1
+        self._active_by_key[key] = self._active_by_key.get(key, 0) + 1
+        self.admitted += 1
+
+    def _try_admit(self, key: str, limits: Optional[Tuple[Optional[int], Optional[float], Optional[float]]]) -> Optional[_Waiter]:
+        """Admit at once (returns None), queue (returns the waiter) or raise a 429"""
+        if limits and any(limits):
+            self._overrides[key] = limits
+        elif key in self._overrides:
+            del self._overrides[key]
+        wait = self._take_token(key, time.monotonic())
+        if wait:
+            self.rejected += 1
+            raise _rejected('rate', 'Rate limit exceeded for this API key. Please retry later.', 'rate_limit_exceeded', wait)
+        # Releases hand slots to waiters directly, so any request still queued is blocked on its
+        # own key's limit and a newcomer that fits does not overtake anyone
+        if self._has_room(key):
+            self._occupy(key)
+            return None
+        if len(self._waiters) >= self.queue_size:
+            self.rejected += 1
+            raise _rejected('queue_full', 'Server is at capacity. Please retry later.', 'concurrency_limit_exceeded', self.queue_timeout)
+        waiter = _Waiter(key)
+        self._waiters.append(waiter)
+        return waiter
+
+    def _give_up(self, waiter: _Waiter) -> bool:
+        """Called when a waiter stops waiting; returns True if it was granted a slot meanwhile"""
+        if waiter.granted:
+            return True
+        self._waiters.remove(waiter)
+        return False
+
+    def _deadline_error(self) -> APIError:
+        self.rejected += 1
+        return _rejected('deadline', 'Timed out waiting for capacity. Please retry later.', 'concurrency_limit_exceeded', self.queue_timeout)
+
+    def _release(self, key: str) -> None:
+        with self._lock:
+            self._active -= 1
+            count = self._active_by_key.get(key, 1) - 1
+            if count:
+                self._active_by_key[key] = count
+            else:
+                self._active_by_key.pop(key, None)
+            # Hand the freed slot straight to the oldest waiter that fits
+            for waiter in self._waiters:
+                if self._has_room(waiter.key):
+                    self._waiters.remove(waiter)
+                    self._occupy(waiter.key)
+                    waiter.granted = True
+                    waiter.wake()
+                    break
+
+    # ----- public API -----
+
+    def acquire(self, key: str, limits: Optional[Tuple[Optional[int], Optional[float], Optional[float]]] = None) -> Ticket:
+        """
+        Admit a request from a worker thread, waiting in the queue if needed.
+        limits is the key's own (max_concurrent, rate, burst), overriding the defaults where set.
+        """
+        with self._lock:
+            waiter = self._try_admit(key, limits)
+            if waiter is None:
+                return Ticket(self, key)
+            waiter.event = threading.Event()
+        started = time.monotonic()
+        waiter.event.wait(self.queue_timeout)
+        with self._lock:
+            if not self._give_up(waiter):
+                raise self._deadline_error()
+        ADMISSION_QUEUE_WAIT.observe(time.monotonic() - started)
+        return Ticket(self, key)
+
+    async def aacquire(self, key: str, limits: Optional[Tuple[Optional[int], Optional[float], Optional[float]]] = None) -> Ticket:
+        """Admit a request on the event loop without blocking it"""
+        with self._lock:
+            waiter = self._try_admit(key, limits)
+            if waiter is None:
+                return Ticket(self, key)
+            waiter.loop = asyncio.get_running_loop()
+            waiter.future = waiter.loop.create_future()
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # Client went away while queued: return a slot granted in the meantime
+            with self._lock:
+                granted = self._give_up(waiter)
+            if granted:
+                self._release(key)
+            raise
+        with self._lock:
+            if not self._give_up(waiter):
+                raise self._deadline_error()
+        ADMISSION_QUEUE_WAIT.observe(time.monotonic() - started)
+        return Ticket(self, key)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'active': self._active,
+                'queued': len(self._waiters),
+                'keys_active': len(self._active_by_key),
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'max_concurrent': self.max_concurrent,
+                'max_concurrent_per_key': self.max_per_key,
+                'rate_per_key': self.rate,
+                'burst': self.burst,
+                'queue_size': self.queue_size,
+                'queue_timeout_seconds': self.queue_timeout
+            }
+
+
+def build_admission_from_env(key_limits: bool = False) -> Optional[AdmissionController]:
+    """None unless at least one limit is configured here or (key_limits) on an API key"""
+    max_concurrent = int(os.getenv('ADMISSION_MAX_CONCURRENT', 0))
+    max_per_key = int(os.getenv('ADMISSION_MAX_CONCURRENT_PER_KEY', 0))
+    rate = float(os.getenv('ADMISSION_RATE', 0))
+    if not (max_concurrent or max_per_key or rate or key_limits):
+        return None
+    burst = os.getenv('ADMISSION_BURST')
+    return AdmissionController(
+        max_concurrent=max_concurrent,
+        max_per_key=max_per_key,
+        rate=rate,
+        burst=float(burst) if burst else None,
+        queue_size=int(os.getenv('ADMISSION_QUEUE_SIZE', 0)),
+        queue_timeout=float(os.getenv('ADMISSION_QUEUE_TIMEOUT_MS', 1000)) / 1000
+    )
@@ -3,58 +3,139 @@ Flask Backend Server for Custom LLM Integration with Vapi
 This server provides HTTP endpoints that Vapi can connect to as a Custom LLM source.
 """
 
-from flask import Flask, request, jsonify, Response
+from flask import Flask, Request, request, jsonify, Response, g, make_response
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from functools import wraps
-import json
+import asyncio
 import logging
 import os
-from typing import Dict, List, Any
+import re
+from typing import Dict, List, Any, Optional, Tuple, Iterator, AsyncIterator, Callable
 import time
 from dotenv import load_dotenv
 
+from service import (
+    APIError, SSE_HEADERS, HEALTH_BODY,
+    completion_body, vapi_body, models_body, internal_error
+)
+from validation import (
+    MAX_REQUEST_BYTES, OutputLimits, check_content_length, output_limits_from, parse_chat_request, parse_vapi_request,
+    validate_messages
+)
+from serialization import ChunkRenderer, JSON_BACKEND, dumps, loads, sse_frame
+from providers import ProviderError, build_router_from_env
+from batching import build_batching_from_env
+from routing import build_routing_from_env
+from admission import build_admission_from_env
+from request_log import build_request_recorder_from_env
+from batch_jobs import MAX_BATCH_BYTES, batches_disabled, build_batch_jobs_from_env
+from logging_setup import log_body, logging_stats, set_request_id, setup_logging
+from keystore import KeyRecord, authorize_model, build_keystore_from_env
+from metrics import (
+    StreamTimer, latency_snapshot, render_prometheus, error_code_from, PROMETHEUS_CONTENT_TYPE,
+    HTTP_REQUESTS, HTTP_ERRORS, HTTP_LATENCY, HTTP_REQUEST_BYTES, HTTP_RESPONSE_BYTES,
+    STREAMS_IN_FLIGHT, GENERATION_LATENCY, model_label
+)
+from cache import build_cache_from_env, make_key, replay, areplay
+from semantic_cache import SemanticLookup, build_semantic_cache_from_env
+from sessions import Session, build_session_store_from_env, scoped_session_id, session_id_from
+from tokenizer import TOKENS_PER_REPLY, build_tokenizers_from_env
+from context_window import build_context_manager_from_env
+from speculation import build_speculator_from_env
+from chunking import build_chunking_from_env
+from shared_store import build_shared_store_from_env
+from cancellation import CancellationStats, ClientDisconnected, awatch, socket_probe, watch
+from tools import ToolCalls, ToolOptions, ToolReply, build_tools_from_env, call_text, tool_options_from
+
 # Load environment variables from .env file
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# Configure logging (LOG_LEVEL, LOG_FORMAT, ... see logging_setup.py)
+setup_logging()
 logger = logging.getLogger(__name__)
 
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Parse request bodies and render jsonify() responses with the serialization module's backend"""
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return dumps(obj)
+
+    def loads(self, s: Any, **kwargs: Any) -> Any:
+        return loads(s)
+
+
+class AppRequest(Request):
+    """Caps request bodies, including chunked ones without a Content-Length"""
+
+    @property
+    def max_content_length(self) -> Optional[int]:
+        # Batch input files may be much larger than a chat request
+        return MAX_BATCH_BYTES if self.path == '/v1/batches' else MAX_REQUEST_BYTES
+
+
 app = Flask(__name__)
+app.json = FastJSONProvider(app)
+app.request_class = AppRequest
 CORS(app)  # Enable CORS for Vapi connections
 
 # Configuration
 PORT = int(os.getenv('PORT', 8000))
 HOST = os.getenv('HOST', '0.0.0.0')
 DEBUG = os.getenv('DEBUG', 'False').lower() == 'true'
-API_KEY = os.getenv('API_KEY', None)  # API Key for authentication
+STREAM_DELAY = float(os.getenv('STREAM_DELAY', 0.05))  # Seconds between streamed demo tokens
+
+# Accepted API keys: API_KEYS_FILE / API_KEYS_DB and the single API_KEY (see keystore.py)
+keystore = build_keystore_from_env()
 
 # Validate API Key is set
-if not API_KEY:
+if keystore is None:
     logger.warning("⚠️  API_KEY not set in .env file. API authentication will be disabled.")
-    logger.warning("⚠️  For production use, please set API_KEY in .env file for security.")
+    logger.warning("⚠️  For production use, please set API_KEY (or API_KEYS_FILE / API_KEYS_DB) in .env file for security.")
 else:
-    logger.info("✅ API Key authentication enabled")
+    logger.info(f"✅ API Key authentication enabled ({keystore.stats()['keys']} keys from {keystore.source})")
+
+logger.info(f"JSON backend: {JSON_BACKEND}")
 
 
 class CustomLLM:
     """
     Custom LLM handler class
-    You can integrate your own LLM logic here (OpenAI, Anthropic, local models, etc.)
+    Requests are routed by model name to a provider backend (OpenAI-compatible, Anthropic,
+    Ollama) configured in providers.py; unmatched models use the demo echo backend.
     """
     
     def __init__(self):
         self.default_model = os.getenv('MODEL_NAME', 'custom-llm')
+        model_label.reserve(self.default_model)
+        self.router = build_router_from_env(stream_delay=STREAM_DELAY)
+        self.batching = build_batching_from_env()  # None when BATCH_MAX_SIZE <= 1
+        self.routing = build_routing_from_env()  # None unless PROVIDER_FALLBACKS is set
+        self.shared = build_shared_store_from_env()  # None unless SHARED_STORE_URL is set
+        self.cache = build_cache_from_env(self.shared)  # None unless RESPONSE_CACHE_ENABLED=true
+        self.semantic_cache = build_semantic_cache_from_env()  # None unless SEMANTIC_CACHE_ENABLED=true
+        self.sessions = build_session_store_from_env(self.shared)
+        self.tokenizers = build_tokenizers_from_env()
+        self.context = build_context_manager_from_env(self._summarize)  # None unless CONTEXT_WINDOW_* is set
+        self.speculator = build_speculator_from_env(  # None unless SPECULATION_ENABLED=true
+            self._generate, lambda model, text: self.tokenizers.for_model(model).count_text(text)
+        )
+        self.chunking = build_chunking_from_env()  # None unless STREAM_CHUNKING is phrase or sentence
+        self.cancellations = CancellationStats()
+        self.tools = build_tools_from_env()  # None unless TOOLS_MODULE is set
     
     def generate_response(
         self, 
         messages: List[Dict[str, str]], 
         model: str = None,
         temperature: float = 0.7,
-        stream: bool = False
+        stream: bool = False,
+        session_id: str = None,
+        disconnected: Callable[[], bool] = None,
+        tools: ToolOptions = None,
+        limits: OutputLimits = None
     ) -> Any:
         """
         Generate a response based on the conversation messages.
@@ -64,9 +145,372 @@ class CustomLLM:
             model: Model name to use for generation
             temperature: Temperature parameter for response generation (0.0 to 2.0)
             stream: Whether to stream the response
+            session_id: Call/conversation id; earlier turns of the same call are not re-processed
+            disconnected: Non-blocking check whether the client went away (see cancellation.py);
+                a stream stops pulling from the upstream once it is true
+            tools: The request's tool definitions and choice (see tools.py)
+            limits: The request's max_tokens / max_completion_tokens and stop (see validation.py)
             
         Returns:
-            Response text or generator for streaming
+            Response text or generator for streaming; a ToolReply when the client has tool calls to run
+        """
+        started = time.perf_counter()
+        session = self.sessions.get(session_id) if session_id else None
+        model_name, temperature = self._validate(messages, model, temperature, session)
+        if tools is not None or (self.tools is not None and self.tools.offers(model_name)):
+            return self._respond_with_tools(messages, model_name, temperature, stream, session, started, tools, limits, disconnected)
+        
+        cache_key = self._cache_key(model_name, temperature, messages, limits)
+        cached = self.speculator.take(session, messages, model_name, temperature, limits) if self.speculator and session else None
+        if cached is None and cache_key:
+            cached = self.cache.get(cache_key)
+        semantic = None
+        if cached is None and self.semantic_cache is not None and self.semantic_cache.cacheable(temperature):
+            semantic = self.semantic_cache.lookup(model_name, messages, limits)
+            cached = semantic.answer if semantic else None
+        if cached is not None:
+            if session:
+                self.sessions.save(session)
+            if self.speculator and session:
+                self.speculator.after_response(session, messages, model_name, temperature, cached, limits)
+            if stream:
+                return self._stream_response(
+                    replay(cached), model_name, started, usage_fn=self._usage_fn(messages, model_name, session), disconnected=disconnected
+                )
+            self._observe_generation(model_name, started, stream)
+            return cached
+        
+        backend, upstream_model = self._select(model_name)
+        store = self._store_fn(cache_key, semantic, self._speculate_fn(session, messages, model_name, temperature, limits))
+        prompt = self._fit(messages, model_name, session)
+        if session:
+            self.sessions.save(session)
+        
+        if stream:
+            # Return a generator for streaming responses
+            return self._stream_response(
+                backend.stream(prompt, upstream_model, temperature, session, limits=limits), model_name, started,
+                store, self._usage_fn(messages, model_name, session), disconnected
+            )
+        
+        response_text = backend.complete(prompt, upstream_model, temperature, session, limits)
+        self._observe_generation(model_name, started, stream)
+        if store:
+            store(response_text)
+        return response_text
+    
+    async def agenerate_response(
+        self,
+        messages: List[Dict[str, str]],
+        model: str = None,
+        temperature: float = 0.7,
+        stream: bool = False,
+        session_id: str = None,
+        tools: ToolOptions = None,
+        limits: OutputLimits = None
+    ) -> Any:
+        """
+        Async variant of generate_response used by the ASGI server.
+        
+        Returns:
+            Response text or async generator for streaming; a ToolReply when the client has tool calls to run
+        """
+        started = time.perf_counter()
+        session = await self._aread(self.sessions.get, session_id) if session_id else None
+        model_name, temperature = self._validate(messages, model, temperature, session)
+        if tools is not None or (self.tools is not None and self.tools.offers(model_name)):
+            return await self._arespond_with_tools(messages, model_name, temperature, stream, session, started, tools, limits)
+        
+        cache_key = self._cache_key(model_name, temperature, messages, limits)
+        cached = self.speculator.take(session, messages, model_name, temperature, limits) if self.speculator and session else None
+        if cached is None and cache_key:
+            cached = await self._aread(self.cache.get, cache_key)
+        semantic = None
+        if cached is None and self.semantic_cache is not None and self.semantic_cache.cacheable(temperature):
+            # Embedding and the index search run off the event loop
+            semantic = await asyncio.get_running_loop().run_in_executor(None, self.semantic_cache.lookup, model_name, messages, limits)
+            cached = semantic.answer if semantic else None
+        if cached is not None:
+            if session:
+                self.sessions.save(session)
+            if self.speculator and session:
+                self.speculator.after_response(session, messages, model_name, temperature, cached, limits)
+            if stream:
+                return self._astream_response(areplay(cached), model_name, started, usage_fn=self._usage_fn(messages, model_name, session))
+            self._observe_generation(model_name, started, stream)
+            return cached
+        
+        backend, upstream_model = self._select(model_name)
+        store = self._store_fn(cache_key, semantic, self._speculate_fn(session, messages, model_name, temperature, limits))
+        prompt = self._fit(messages, model_name, session)
+        if session:
+            self.sessions.save(session)
+        
+        if stream:
+            return self._astream_response(
+                backend.astream(prompt, upstream_model, temperature, session, limits=limits), model_name, started,
+                store, self._usage_fn(messages, model_name, session)
+            )
+        
+        response_text = await backend.acomplete(prompt, upstream_model, temperature, session, limits)
+        self._observe_generation(model_name, started, stream)
+        if store:
+            store(response_text)
+        return response_text
+    
+    def _respond_with_tools(
+        self,
+        messages: List[Dict[str, str]],
+        model_name: str,
+        temperature: float,
+        stream: bool,
+        session: Optional[Session],
+        started: float,
+        tools: Optional[ToolOptions],
+        limits: Optional[OutputLimits],
+        disconnected: Callable[[], bool] = None
+    ) -> Any:
+        """
+        A turn offering tools. The answer depends on tool results, so the response caches and
+        speculation are bypassed.
+        """
+        backend, upstream_model = self._select(model_name)
+        prompt = self._fit(messages, model_name, session)
+        if session:
+            self.sessions.save(session)
+        deltas = self._tool_rounds(backend, prompt, upstream_model, temperature, session, tools, limits)
+        if stream:
+            return self._stream_response(
+                deltas, model_name, started, usage_fn=self._usage_fn(messages, model_name, session), disconnected=disconnected
+            )
+        parts, calls = [], ToolCalls()
+        for delta in deltas:
+            if type(delta) is str:
+                parts.append(delta)
+            else:
+                calls.add(delta)
+        self._observe_generation(model_name, started, stream)
+        return ToolReply(''.join(parts), calls.complete()) if calls.calls else ''.join(parts)
+    
+    async def _arespond_with_tools(
+        self,
+        messages: List[Dict[str, str]],
+        model_name: str,
+        temperature: float,
+        stream: bool,
+        session: Optional[Session],
+        started: float,
+        tools: Optional[ToolOptions],
+        limits: Optional[OutputLimits]
+    ) -> Any:
+        """Async version of _respond_with_tools"""
+        backend, upstream_model = self._select(model_name)
+        prompt = self._fit(messages, model_name, session)
+        if session:
+            self.sessions.save(session)
+        deltas = self._atool_rounds(backend, prompt, upstream_model, temperature, session, tools, limits)
+        if stream:
+            return self._astream_response(deltas, model_name, started, usage_fn=self._usage_fn(messages, model_name, session))
+        parts, calls = [], ToolCalls()
+        async for delta in deltas:
+            if type(delta) is str:
+                parts.append(delta)
+            else:
+                calls.add(delta)
+        self._observe_generation(model_name, started, stream)
+        return ToolReply(''.join(parts), calls.complete()) if calls.calls else ''.join(parts)
+    
+    def _tool_rounds(
+        self,
+        backend: Any,
+        prompt: List[Dict[str, Any]],
+        upstream_model: str,
+        temperature: float,
+        session: Optional[Session],
+        tools: Optional[ToolOptions],
+        limits: Optional[OutputLimits]
+    ) -> Iterator[Any]:
+        """
+        Text and ToolCallDelta items of a turn with tools. Without local tools the calls stream
+        through to the client. With them, a round's calls are held back; when all of them are
+        local they run here and the model is asked again with the results, otherwise they are
+        handed to the client.
+        """
+        runtime = self.tools
+        options = runtime.offer(tools) if runtime else tools
+        rounds = 0
+        while True:
+            if runtime and rounds == runtime.max_rounds:
+                options = options.answer_only()
+            calls, text = ToolCalls(), []
+            deltas = backend.stream(prompt, upstream_model, temperature, session, options, limits)
+            try:
+                for delta in deltas:
+                    if type(delta) is str:
+                        text.append(delta)
+                        yield delta
+                    elif runtime is None:
+                        yield calls.add(delta)
+                    else:
+                        calls.add(delta)
+            finally:
+                deltas.close()
+            if runtime is None or not calls.calls:
+                return
+            requested = calls.complete()
+            if not self._run_locally(runtime, requested, tools, rounds):
+                if tools is not None:
+                    yield from calls.deltas()
+                return
+            prompt = prompt + [{'role': 'assistant', 'content': ''.join(text) or None, 'tool_calls': requested}]
+            prompt += runtime.run(requested)
+            rounds += 1
+    
+    async def _atool_rounds(
+        self,
+        backend: Any,
+        prompt: List[Dict[str, Any]],
+        upstream_model: str,
+        temperature: float,
+        session: Optional[Session],
+        tools: Optional[ToolOptions],
+        limits: Optional[OutputLimits]
+    ) -> AsyncIterator[Any]:
+        """Async version of _tool_rounds"""
+        runtime = self.tools
+        options = runtime.offer(tools) if runtime else tools
+        rounds = 0
+        while True:
+            if runtime and rounds == runtime.max_rounds:
+                options = options.answer_only()
+            calls, text = ToolCalls(), []
+            deltas = backend.astream(prompt, upstream_model, temperature, session, options, limits)
+            try:
+                async for delta in deltas:
+                    if type(delta) is str:
+                        text.append(delta)
+                        yield delta
+                    elif runtime is None:
+                        yield calls.add(delta)
+                    else:
+                        calls.add(delta)
+            finally:
+                await deltas.aclose()
+            if runtime is None or not calls.calls:
+                return
+            requested = calls.complete()
+            if not self._run_locally(runtime, requested, tools, rounds):
+                if tools is not None:
+                    for delta in calls.deltas():
+                        yield delta
+                return
+            prompt = prompt + [{'role': 'assistant', 'content': ''.join(text) or None, 'tool_calls': requested}]
+            prompt += await runtime.arun(requested)
+            rounds += 1
+    
+    @staticmethod
+    def _run_locally(runtime: Any, requested: List[Dict[str, Any]], tools: Optional[ToolOptions], rounds: int) -> bool:
+        """Whether a round's calls run here; the others go to the client, or are dropped when it sent no tools"""
+        if not runtime.handles(requested):
+            if tools is None:
+                logger.warning(f"Model called unknown tools: {', '.join(call['function']['name'] for call in requested)}")
+            return False
+        if rounds >= runtime.max_rounds:
+            # tool_choice was 'none' and the model called tools anyway
+            logger.warning(f"Model still calling tools after {rounds} rounds, calls dropped")
+            return False
+        return True
+    
+    def reply_body(self, messages: List[Dict[str, str]], model_name: str, reply: Any, session_id: str = None) -> Dict[str, Any]:
+        """Chat Completions body of a non-streamed reply: text, or a ToolReply with calls for the client"""
+        if isinstance(reply, ToolReply):
+            usage = self.usage(messages, model_name, reply.text + call_text(reply.tool_calls), session_id)
+            return completion_body(model_name, reply.text, usage, reply.tool_calls)
+        return completion_body(model_name, reply, self.usage(messages, model_name, reply, session_id))
+    
+    def _select(self, model_name: str) -> Tuple[Any, str]:
+        """Route to a backend, or to the model's fallback chain when one is configured"""
+        backend, upstream_model = self._resolve(model_name)
+        if self.routing is not None:
+            return self.routing.wrap(model_name, backend, upstream_model, self._resolve)
+        return backend, upstream_model
+    
+    def _resolve(self, model_name: str) -> Tuple[Any, str]:
+        """Single backend for a model; batch-capable backends are reached through their batch scheduler"""
+        backend, upstream_model = self.router.select(model_name)
+        if self.batching is not None:
+            backend = self.batching.wrap(backend)
+        return backend, upstream_model
+    
+    def _fit(self, messages: List[Dict[str, str]], model_name: str, session: Session = None) -> List[Dict[str, str]]:
+        """Messages to send upstream: the history cut to the model's context budget when one is configured"""
+        if self.context is None:
+            return messages
+        return self.context.fit(messages, model_name, self.tokenizers.for_model(model_name), session)[0]
+    
+    def _summarize(self, model_name: str, messages: List[Dict[str, str]]) -> str:
+        """Summary of dropped turns for the context manager; runs on its background thread"""
+        backend, upstream_model = self._select(model_name)
+        return backend.complete(messages, upstream_model, 0.0)
+    
+    def _cache_key(self, model_name: str, temperature: float, messages: List[Dict[str, str]], limits: OutputLimits = None) -> str:
+        """Response cache key, or None when caching is disabled or bypassed for this request"""
+        if self.cache is None or not self.cache.cacheable(temperature):
+            return None
+        return make_key(model_name, temperature, messages, limits)
+    
+    async def _aread(self, read: Callable[..., Any], *args: Any) -> Any:
+        """read(*args) of the session store or response cache; off the event loop when a miss goes to the shared store"""
+        if self.shared is None:
+            return read(*args)
+        return await asyncio.get_running_loop().run_in_executor(None, read, *args)
+    
+    def _store_fn(
+        self,
+        cache_key: Optional[str],
+        semantic: Optional[SemanticLookup],
+        speculate: Optional[Callable[[str], None]] = None
+    ) -> Optional[Callable[[str], None]]:
+        """
+        Stores a completed response in the exact and/or semantic cache and passes it to speculate;
+        None when none of them applies
+        """
+        if not cache_key and semantic is None and speculate is None:
+            return None
+        
+        def store(response_text: str) -> None:
+            if cache_key:
+                self.cache.put(cache_key, response_text)
+            if semantic is not None:
+                self.semantic_cache.put(semantic, response_text)
+            if speculate is not None:
+                speculate(response_text)
+        
+        return store
+    
+    def _speculate_fn(
+        self, session: Session, messages: List[Dict[str, str]], model_name: str, temperature: float, limits: OutputLimits = None
+    ) -> Optional[Callable[[str], None]]:
+        """Starts speculative generations for the call's next turn once the response is complete"""
+        if self.speculator is None or session is None:
+            return None
+        return lambda response_text: self.speculator.after_response(session, messages, model_name, temperature, response_text, limits)
+    
+    def _generate(self, model_name: str, messages: List[Dict[str, str]], temperature: float, limits: OutputLimits = None) -> str:
+        """Complete response outside of a request, for speculation; runs on a background thread"""
+        backend, upstream_model = self._select(model_name)
+        return backend.complete(self._fit(messages, model_name), upstream_model, temperature, limits=limits)
+    
+    def _validate(
+        self,
+        messages: List[Dict[str, str]],
+        model: str = None,
+        temperature: float = 0.7,
+        session: Session = None
+    ) -> Tuple[str, float]:
+        """
+        Validate the request and return (model_name, clamped temperature).
+        With a session, messages already validated on an earlier turn are skipped.
         """
         # Use provided model or default
         model_name = model or self.default_model
@@ -74,77 +518,239 @@ class CustomLLM:
         # Validate and clamp temperature
         temperature = max(0.0, min(2.0, float(temperature)))
         
-        # Validate messages format
+        # Only the tail after the session's known prefix needs validating
         if not isinstance(messages, list) or len(messages) == 0:
-            raise ValueError("Messages must be a non-empty list")
+            raise APIError("Messages must be a non-empty list", 'invalid_messages')
+        start = session.matched_prefix(messages) if session and session.model == model_name else 0
+        validate_messages(messages, start)
         
-        # Validate each message has required fields
-        for i, msg in enumerate(messages):
-            if not isinstance(msg, dict):
-                raise ValueError(f"Message {i} must be a dictionary")
-            if 'role' not in msg or 'content' not in msg:
-                raise ValueError(f"Message {i} must have 'role' and 'content' fields")
-            if msg['role'] not in ['user', 'system', 'assistant']:
-                raise ValueError(f"Message {i} has invalid role: {msg['role']}. Must be 'user', 'system', or 'assistant'")
+        if session:
+            session.model = model_name
+            session.extend(messages, start, self.tokenizers.for_model(model_name).count_message)
+            session.turns += 1
         
-        # Extract the last user message for demo purposes
-        user_message = None
-        system_message = None
+        return model_name, temperature
+    
+    def usage(self, messages: List[Dict[str, str]], model_name: str, response_text: str, session_id: str = None) -> Dict[str, int]:
+        """Token usage for a completed response"""
+        session = self.sessions.peek(session_id) if session_id else None
+        return self._usage(messages, model_name, response_text, session)
+    
+    def _usage(self, messages: List[Dict[str, str]], model_name: str, response_text: str, session: Session = None) -> Dict[str, int]:
+        tokenizer = self.tokenizers.for_model(model_name)
+        if self.context is not None:
+            # Tokens of the prompt actually sent, after context window trimming
+            prompt_tokens = self.context.prompt_tokens(messages, model_name, tokenizer, session)
+        elif session and session.model == model_name and len(session.prefix) == len(messages) and session.prefix[-1] is messages[-1]:
+            # The session already counted these messages incrementally
+            prompt_tokens = session.prompt_tokens + TOKENS_PER_REPLY
+        else:
+            prompt_tokens = tokenizer.count_messages(messages)
+        completion_tokens = tokenizer.count_text(response_text)
+        return {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens
+        }
+    
+    def _usage_fn(self, messages: List[Dict[str, str]], model_name: str, session: Session = None):
+        """Deferred usage computation for streams, run after the last token so it stays off the TTFT path"""
+        return lambda response_text: self._usage(messages, model_name, response_text, session)
+    
+    def _stream_response(
+        self,
+        deltas: Iterator[str],
+        model_name: str,
+        started: float = None,
+        store: Callable[[str], None] = None,
+        usage_fn: Callable[[str], Dict[str, int]] = None,
+        disconnected: Callable[[], bool] = None
+    ):
+        """
+        Forward backend text deltas as chat.completion.chunk frames the moment they arrive
+        (or, with STREAM_CHUNKING, as speakable segments), recording time-to-first-token and
+        inter-token gaps.
+        If store is given, it receives the completed response text for caching;
+        usage_fn(response_text) supplies the usage reported in the final chunk.
+        The stream is cancelled, closing the upstream, when it is closed early or disconnected()
+        turns true.
+        """
+        timer = StreamTimer(started)
+        renderer = ChunkRenderer(model_name)
+        generated = []
+        upstream = deltas = watch(deltas, generated, disconnected)
+        timer.upstream_opened()
+        if self.chunking:
+            deltas = self.chunking.wrap(deltas, timer.upstream_delta)
+        parts = []
+        calls = None
+        try:
+            for delta in deltas:
+                received = time.perf_counter()
+                if type(delta) is str:
+                    frame = renderer.content(delta)
+                    parts.append(delta)
+                else:
+                    # Tool call of a request with tools
+                    frame = renderer.tool_call(delta)
+                    if calls is None:
+                        calls = ToolCalls()
+                    calls.add(delta)
+                timer.frame(received)
+                yield frame
+        except ProviderError as e:
+            # Headers are already sent, so report upstream failures in-band
+            logger.error(f"Upstream error while streaming: {e.message}")
+            yield sse_frame(e.to_dict())
+            return
+        except (GeneratorExit, ClientDisconnected):
+            self._cancelled(model_name, generated, parts)
+            return
+        finally:
+            deltas.close()
+            upstream.close()
         
-        for msg in messages:
-            if msg.get('role') == 'system':
-                system_message = msg.get('content', '')
-            elif msg.get('role') == 'user':
-                user_message = msg.get('content', '')
+        self._log_stream(model_name, timer)
+        self._observe_generation(model_name, timer.started, True)
+        response_text = ''.join(parts)
+        if store:
+            store(response_text)
         
-        # TODO: Replace this with your actual LLM inference logic
-        # Example response - Replace this with your actual LLM integration
-        response_text = f"هذه استجابة تجريبية من Custom LLM (Model: {model_name}, Temperature: {temperature}). الرسالة المستلمة: {user_message}"
+        # Final chunk
+        yield self._final_chunk(renderer, response_text, calls, usage_fn)
+        yield "data: [DONE]\n\n"
+    
+    async def _astream_response(
+        self,
+        deltas: AsyncIterator[str],
+        model_name: str,
+        started: float = None,
+        store: Callable[[str], None] = None,
+        usage_fn: Callable[[str], Dict[str, int]] = None
+    ):
+        """Async version of _stream_response, cancelled by closing it or cancelling its task"""
+        timer = StreamTimer(started)
+        renderer = ChunkRenderer(model_name)
+        generated = []
+        upstream = deltas = awatch(deltas, generated)
+        timer.upstream_opened()
+        if self.chunking:
+            deltas = self.chunking.awrap(deltas, timer.upstream_delta)
+        parts = []
+        calls = None
+        try:
+            async for delta in deltas:
+                received = time.perf_counter()
+                if type(delta) is str:
+                    frame = renderer.content(delta)
+                    parts.append(delta)
+                else:
+                    frame = renderer.tool_call(delta)
+                    if calls is None:
+                        calls = ToolCalls()
+                    calls.add(delta)
+                timer.frame(received)
+                yield frame
+        except ProviderError as e:
+            logger.error(f"Upstream error while streaming: {e.message}")
+            yield sse_frame(e.to_dict())
+            return
+        except (GeneratorExit, asyncio.CancelledError):
+            self._cancelled(model_name, generated, parts)
+            raise
+        finally:
+            await deltas.aclose()
+            await upstream.aclose()
         
-        if stream:
-            # Return a generator for streaming responses
-            return self._stream_response(response_text, model_name)
-        else:
-            return response_text
-    
-    def _stream_response(self, text: str, model_name: str):
-        """Generate streaming response tokens in OpenAI format"""
-        words = text.split()
-        for word in words:
-            chunk_data = {
-                'id': f"chatcmpl-{int(time.time())}",
-                'object': 'chat.completion.chunk',
-                'created': int(time.time()),
-                'model': model_name,
-                'choices': [{
-                    'index': 0,
-                    'delta': {'content': word + ' '},
-                    'finish_reason': None
-                }]
-            }
-            yield f"data: {json.dumps(chunk_data, ensure_ascii=False)}\n\n"
-            time.sleep(0.05)  # Simulate streaming delay
+        self._log_stream(model_name, timer)
+        self._observe_generation(model_name, timer.started, True)
+        response_text = ''.join(parts)
+        if store:
+            store(response_text)
         
         # Final chunk
-        final_chunk = {
-            'id': f"chatcmpl-{int(time.time())}",
-            'object': 'chat.completion.chunk',
-            'created': int(time.time()),
-            'model': model_name,
-            'choices': [{
-                'index': 0,
-                'delta': {},
-                'finish_reason': 'stop'
-            }]
-        }
-        yield f"data: {json.dumps(final_chunk, ensure_ascii=False)}\n\n"
+        yield self._final_chunk(renderer, response_text, calls, usage_fn)
         yield "data: [DONE]\n\n"
+    
+    @staticmethod
+    def _final_chunk(
+        renderer: ChunkRenderer,
+        response_text: str,
+        calls: Optional[ToolCalls],
+        usage_fn: Callable[[str], Dict[str, int]] = None
+    ) -> str:
+        """Closing chunk of a stream: finish reason, and usage counting tool call arguments as completion"""
+        if calls is None:
+            return renderer.chunk({}, 'stop', usage_fn(response_text) if usage_fn else None)
+        completion = response_text + call_text(calls.complete())
+        return renderer.chunk({}, 'tool_calls', usage_fn(completion) if usage_fn else None)
+    
+    def _cancelled(self, model_name: str, generated: List[Any], parts: List[str]) -> None:
+        """Record a stream whose client disconnected: completion tokens sent, and generated but not sent"""
+        count_text = self.tokenizers.for_model(model_name).count_text
+        sent = count_text(''.join(parts)) if parts else 0
+        # Tool call deltas are left out
+        text = ''.join(delta for delta in generated if type(delta) is str)
+        unsent = max(0, count_text(text) - sent) if text else 0
+        self.cancellations.record(model_name, sent, unsent, bool(generated))
+        logger.info("Client disconnected, stream cancelled - Model: %s, Tokens sent: %d, Unsent: %d", model_name, sent, unsent)
+    
+    @staticmethod
+    def _observe_generation(model_name: str, started: float, stream: bool) -> None:
+        """Record the time from request handling until the full response was produced"""
+        GENERATION_LATENCY.observe(time.perf_counter() - started, (model_label(model_name), 'true' if stream else 'false'))
+    
+    @staticmethod
+    def _log_stream(model_name: str, timer: StreamTimer) -> None:
+        if timer.ttft is not None:
+            logger.debug("Stream finished - Model: %s, Frames: %d, TTFT: %.1fms, Max gap: %.1fms", model_name, timer.frames, timer.ttft * 1000, timer.max_gap * 1000)
 
 
 # Initialize LLM handler
 llm = CustomLLM()
 
 
+def check_api_key(auth_header: str) -> Optional[KeyRecord]:
+    """
+    Validate an Authorization header value against the key store.
+    Format: Authorization: Bearer <API_KEY>
+    
+    Returns:
+        The key's record (tenant, allowed models, limits), or None when authentication is disabled
+    
+    Raises:
+        APIError: with a 401 status if the header is missing, malformed or the key is wrong
+    """
+    # If no keys are configured, skip authentication (for development)
+    if keystore is None:
+        return None
+    
+    if not auth_header:
+        logger.warning("API request rejected: Missing Authorization header")
+        raise APIError(
+            'Missing Authorization header. Please provide API key in Authorization: Bearer <key> format.',
+            'missing_authorization', type='authentication_error', status=401
+        )
+    
+    # Check if header starts with "Bearer "
+    if not auth_header.startswith('Bearer '):
+        logger.warning("API request rejected: Invalid Authorization header format")
+        raise APIError(
+            'Invalid Authorization header format. Expected: Bearer <key>',
+            'invalid_authorization_format', type='authentication_error', status=401
+        )
+    
+    # Validate API key (hashed lookup; key material is never logged)
+    record = keystore.verify(auth_header[7:])  # Remove "Bearer " prefix
+    if record is None:
+        logger.warning("API request rejected: Invalid API key")
+        raise APIError('Invalid API key', 'invalid_api_key', type='authentication_error', status=401)
+    
+    # API key is valid, proceed with the request
+    logger.debug("API request authenticated - Key: %s, Tenant: %s", record.key_id, record.tenant)
+    return record
+
+
 def require_api_key(f):
     """
     Decorator to require API Key authentication via Authorization header
@@ -152,55 +758,140 @@ def require_api_key(f):
     """
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        # If API_KEY is not set, skip authentication (for development)
-        if not API_KEY:
-            return f(*args, **kwargs)
-        
-        # Get Authorization header
-        auth_header = request.headers.get('Authorization', '')
-        
-        if not auth_header:
-            logger.warning("API request rejected: Missing Authorization header")
-            return jsonify({
-                'error': {
-                    'message': 'Missing Authorization header. Please provide API key in Authorization: Bearer <key> format.',
-                    'type': 'authentication_error',
-                    'code': 'missing_authorization'
-                }
-            }), 401
-        
-        # Check if header starts with "Bearer "
-        if not auth_header.startswith('Bearer '):
-            logger.warning("API request rejected: Invalid Authorization header format")
-            return jsonify({
-                'error': {
-                    'message': 'Invalid Authorization header format. Expected: Bearer <key>',
-                    'type': 'authentication_error',
-                    'code': 'invalid_authorization_format'
-                }
-            }), 401
-        
-        # Extract the API key
-        provided_key = auth_header[7:]  # Remove "Bearer " prefix
-        
-        # Validate API key
-        if provided_key != API_KEY:
-            logger.warning(f"API request rejected: Invalid API key (attempted: {provided_key[:10]}...)")
-            return jsonify({
-                'error': {
-                    'message': 'Invalid API key',
-                    'type': 'authentication_error',
-                    'code': 'invalid_api_key'
-                }
-            }), 401
-        
-        # API key is valid, proceed with the request
-        logger.debug("API request authenticated successfully")
+        try:
+            g.api_key = check_api_key(request.headers.get('Authorization', ''))
+        except APIError as e:
+            return jsonify(e.to_dict()), e.status, e.headers
         return f(*args, **kwargs)
     
     return decorated_function
 
 
+# Admission control for the inference endpoints (None unless a limit is configured;
+# a reloadable key store may add per-key limits at any time)
+admission = build_admission_from_env(key_limits=keystore is not None and keystore.reloadable)
+
+# Captures incoming requests for replay_requests.py when REQUEST_LOG_PATH is set
+request_log = build_request_recorder_from_env()
+
+
+def run_batch_request(body: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+    """One request of an offline batch, as /v1/chat/completions would answer it without streaming"""
+    try:
+        messages, model, temperature, _ = parse_chat_request(body)
+        model_name = model or llm.default_model
+        try:
+            reply = llm.generate_response(
+                messages=messages, model=model, temperature=temperature, tools=tool_options_from(body), limits=output_limits_from(body)
+            )
+        except ValueError as ve:
+            raise APIError(str(ve), 'invalid_messages')
+        return 200, llm.reply_body(messages, model_name, reply)
+    except APIError as e:
+        return e.status, e.to_dict()
+
+
+# Offline batch completions (None unless BATCH_JOBS_DIR is set); batch work holds back while
+# interactive streams are in flight
+batch_jobs = build_batch_jobs_from_env(
+    run_batch_request, llm.default_model, lambda: STREAMS_IN_FLIGHT.values().get((), 0)
+)
+
+
+def admission_control(f):
+    """
+    Decorator applying concurrency and rate limits; place it below @require_api_key so only
+    authenticated requests are counted. The slot is held until the response (including a
+    streamed one) has been fully sent.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if admission is None:
+            return f(*args, **kwargs)
+        record = g.get('api_key')
+        try:
+            ticket = admission.acquire(record.key_id, record.limits) if record else admission.acquire('')
+        except APIError as e:
+            return jsonify(e.to_dict()), e.status, e.headers
+        try:
+            response = make_response(f(*args, **kwargs))
+        except BaseException:
+            ticket.release()
+            raise
+        response.call_on_close(ticket.release)
+        return response
+    
+    return decorated_function
+
+
+def _route_label() -> str:
+    """URL rule of the current request in the ASGI path syntax, e.g. /v1/sessions/{call_id}"""
+    if request.url_rule is None:
+        return 'unmatched'
+    return re.sub(r'<(?:[^:>]+:)?([^>]+)>', r'{\1}', request.url_rule.rule)
+
+
+def _count_bytes(body, sizes: Dict[str, int]):
+    """
+    Pass a streamed response body through, encoding it once and counting the bytes sent.
+    Closing it closes body, so a client disconnect cancels the generation at once.
+    """
+    try:
+        for chunk in body:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            sizes['sent'] += len(chunk)
+            yield chunk
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_started = time.perf_counter()
+    g.arrived = time.time()
+    g.request_id = set_request_id(request.headers.get('X-Request-Id'))
+    if batch_jobs is not None:
+        # Flask has no per-process startup hook: resume unfinished batches on the first request
+        batch_jobs.start()
+
+
+@app.after_request
+def record_request_metrics(response):
+    """
+    Count the request and its error code, and time it per route. Streamed responses are
+    timed and sized when the last frame has been sent.
+    """
+    started = g.get('metrics_started', time.perf_counter())
+    route = (_route_label(),)
+    if 'request_id' in g:
+        response.headers['X-Request-Id'] = g.request_id
+    if request_log is not None:
+        request_log.record(g.get('arrived', time.time()), request.method, request.path, request.headers, request.get_data() if response.status_code != 413 else b'', response.status_code)
+    HTTP_REQUESTS.inc((route[0], request.method, str(response.status_code)))
+    HTTP_REQUEST_BYTES.observe(request.content_length or 0, route)
+    if response.status_code >= 400:
+        HTTP_ERRORS.inc((route[0], error_code_from(response.get_json(silent=True), response.status_code)))
+    
+    if not response.is_streamed:
+        HTTP_LATENCY.observe(time.perf_counter() - started, route)
+        HTTP_RESPONSE_BYTES.observe(response.calculate_content_length() or 0, route)
+        return response
+    
+    sizes = {'sent': 0}
+    STREAMS_IN_FLIGHT.inc()
+    response.response = _count_bytes(response.response, sizes)
+    
+    @response.call_on_close
+    def finish():
+        STREAMS_IN_FLIGHT.dec()
+        HTTP_LATENCY.observe(time.perf_counter() - started, route)
+        HTTP_RESPONSE_BYTES.observe(sizes['sent'], route)
+    
+    return response
+
+
 @app.route("/", methods=["GET"])
 def home():
     return jsonify({"status": "ok"}), 200
@@ -209,15 +900,12 @@ def home():
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    return jsonify({
-        'status': 'healthy',
-        'service': 'custom-llm-server',
-        'version': '1.0.0'
-    }), 200
+    return jsonify(HEALTH_BODY), 200
 
 
 @app.route('/v1/chat/completions', methods=['POST'])
 @require_api_key
+@admission_control
 def chat_completions():
     """
     Main endpoint for chat completions (OpenAI-compatible format)
@@ -237,55 +925,14 @@ def chat_completions():
     }
     """
     try:
-        data = request.get_json()
-        
-        if not data:
-            return jsonify({
-                'error': {
-                    'message': 'No JSON data provided',
-                    'type': 'invalid_request_error',
-                    'code': 'missing_json'
-                }
-            }), 400
-        
-        # Extract and validate required fields
-        messages = data.get('messages', [])
-        if not messages:
-            return jsonify({
-                'error': {
-                    'message': 'No messages provided. Messages must be a non-empty array.',
-                    'type': 'invalid_request_error',
-                    'code': 'missing_messages'
-                }
-            }), 400
-        
-        # Extract optional fields with defaults
-        model = data.get('model', None)  # Will use default if not provided
-        temperature = data.get('temperature', 0.7)  # Default temperature
-        stream = data.get('stream', False)
-        
-        # Validate temperature range
-        try:
-            temperature = float(temperature)
-            if not (0.0 <= temperature <= 2.0):
-                return jsonify({
-                    'error': {
-                        'message': f'Temperature must be between 0.0 and 2.0, got {temperature}',
-                        'type': 'invalid_request_error',
-                        'code': 'invalid_temperature'
-                    }
-                }), 400
-        except (ValueError, TypeError):
-            return jsonify({
-                'error': {
-                    'message': f'Invalid temperature value: {temperature}',
-                    'type': 'invalid_request_error',
-                    'code': 'invalid_temperature'
-                }
-            }), 400
+        check_content_length(request.content_length)
+        data = request.get_json(silent=True)
+        messages, model, temperature, stream = parse_chat_request(data)
+        session_id = session_id_from(data, request.headers, g.get('api_key'))
         
         # Determine model name for response
         model_name = model or llm.default_model
+        authorize_model(g.get('api_key'), model_name)
         
         logger.info(f"Received chat request - Model: {model_name}, Messages: {len(messages)}, Temperature: {temperature}, Stream: {stream}")
         
@@ -295,98 +942,51 @@ def chat_completions():
                 messages=messages,
                 model=model,
                 temperature=temperature,
-                stream=stream
+                stream=stream,
+                session_id=session_id,
+                disconnected=socket_probe(request.environ) if stream else None,
+                tools=tool_options_from(data),
+                limits=output_limits_from(data)
             )
         except ValueError as ve:
-            return jsonify({
-                'error': {
-                    'message': str(ve),
-                    'type': 'invalid_request_error',
-                    'code': 'invalid_messages'
-                }
-            }), 400
+            raise APIError(str(ve), 'invalid_messages')
         
         if stream:
             # Return streaming response in Server-Sent Events format
             return Response(
                 response_text,
                 mimetype='text/event-stream',
-                headers={
-                    'Cache-Control': 'no-cache',
-                    'Connection': 'keep-alive',
-                    'X-Accel-Buffering': 'no'
-                }
+                headers=SSE_HEADERS
             )
         else:
             # Return non-streaming response in Chat Completions format
-            # Calculate token usage (simplified - replace with actual tokenizer if needed)
-            prompt_tokens = sum(len(str(msg).split()) for msg in messages)
-            completion_tokens = len(response_text.split())
-            
-            return jsonify({
-                'id': f"chatcmpl-{int(time.time() * 1000)}",
-                'object': 'chat.completion',
-                'created': int(time.time()),
-                'model': model_name,
-                'choices': [{
-                    'index': 0,
-                    'message': {
-                        'role': 'assistant',
-                        'content': response_text
-                    },
-                    'finish_reason': 'stop'
-                }],
-                'usage': {
-                    'prompt_tokens': prompt_tokens,
-                    'completion_tokens': completion_tokens,
-                    'total_tokens': prompt_tokens + completion_tokens
-                }
-            }), 200
-            
+            return jsonify(llm.reply_body(messages, model_name, response_text, session_id)), 200
+    
+    except APIError as e:
+        return jsonify(e.to_dict()), e.status, e.headers
     except Exception as e:
         logger.error(f"Error in chat_completions: {str(e)}", exc_info=True)
-        return jsonify({
-            'error': {
-                'message': f'Internal server error: {str(e)}',
-                'type': 'server_error',
-                'code': 'internal_error'
-            }
-        }), 500
+        error = internal_error(e)
+        return jsonify(error.to_dict()), error.status
 
 
 @app.route('/vapi/custom-llm', methods=['POST'])
 @require_api_key
+@admission_control
 def vapi_custom_llm():
     """
     Vapi-specific custom LLM endpoint
     Supports the same parameters as /v1/chat/completions but returns Vapi-compatible format
     """
     try:
-        data = request.get_json()
-        
-        if not data:
-            return jsonify({'error': 'No JSON data provided'}), 400
-        
-        logger.info(f"Received Vapi request: {json.dumps(data, ensure_ascii=False)}")
+        check_content_length(request.content_length)
+        data = request.get_json(silent=True)
         
-        # Extract conversation data (supports both formats)
-        messages = data.get('messages', [])
-        if not messages:
-            messages = data.get('conversation', [])
+        if data:
+            log_body(logger, "Received Vapi request", data)
         
-        if not messages:
-            return jsonify({'error': 'No messages or conversation found'}), 400
-        
-        # Extract optional parameters
-        model = data.get('model', None)
-        temperature = data.get('temperature', 0.7)
-        
-        # Validate temperature
-        try:
-            temperature = float(temperature)
-            temperature = max(0.0, min(2.0, temperature))
-        except (ValueError, TypeError):
-            temperature = 0.7
+        messages, model, temperature = parse_vapi_request(data)
+        authorize_model(g.get('api_key'), model or llm.default_model)
         
         # Generate response
         try:
@@ -394,20 +994,19 @@ def vapi_custom_llm():
                 messages=messages,
                 model=model,
                 temperature=temperature,
-                stream=False
+                stream=False,
+                session_id=session_id_from(data, request.headers, g.get('api_key')),
+                limits=output_limits_from(data)
             )
         except ValueError as ve:
             return jsonify({'error': str(ve)}), 400
         
         model_name = model or llm.default_model
         
-        return jsonify({
-            'response': response_text,
-            'model': model_name,
-            'temperature': temperature,
-            'timestamp': int(time.time())
-        }), 200
-        
+        return jsonify(vapi_body(model_name, response_text, temperature)), 200
+    
+    except APIError as e:
+        return jsonify({'error': e.message}), e.status, e.headers
     except Exception as e:
         logger.error(f"Error in vapi_custom_llm: {str(e)}", exc_info=True)
         return jsonify({'error': f'Internal server error: {str(e)}'}), 500
@@ -416,15 +1015,206 @@ def vapi_custom_llm():
 @app.route('/v1/models', methods=['GET'])
 def list_models():
     """List available models (OpenAI-compatible)"""
-    return jsonify({
-        'object': 'list',
-        'data': [{
-            'id': llm.model_name,
-            'object': 'model',
-            'created': int(time.time()),
-            'owned_by': 'custom-llm'
-        }]
-    }), 200
+    return jsonify(models_body(llm.default_model)), 200
+
+
+@app.route('/stats/latency', methods=['GET'])
+def latency_stats():
+    """Streaming latency histograms (TTFT, inter-token gaps, per-frame server overhead)"""
+    return jsonify(latency_snapshot()), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics: request counts, error codes, in-flight streams, sizes and latencies"""
+    return Response(render_prometheus(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+
+@app.route('/v1/sessions/<call_id>', methods=['DELETE'])
+@require_api_key
+def end_session(call_id):
+    """Drop the per-call session state when a call ends; only sessions of the caller's tenant"""
+    if not llm.sessions.end(scoped_session_id(call_id, g.get('api_key'))):
+        return jsonify({'error': 'Session not found'}), 404
+    return jsonify({'id': call_id, 'deleted': True}), 200
+
+
+@app.route('/vapi/webhook', methods=['POST'])
+@require_api_key
+def vapi_webhook():
+    """
+    Vapi server-message webhook. Ends the call's session on an end-of-call-report
+    or an 'ended' status-update; other message types are acknowledged and ignored.
+    """
+    message = (request.get_json(silent=True) or {}).get('message') or {}
+    if message.get('type') == 'end-of-call-report' or (message.get('type') == 'status-update' and message.get('status') == 'ended'):
+        call_id = (message.get('call') or {}).get('id')
+        if call_id:
+            llm.sessions.end(scoped_session_id(str(call_id), g.get('api_key')))
+    return jsonify({'ok': True}), 200
+
+
+@app.route('/v1/batches', methods=['POST'])
+@require_api_key
+def create_batch():
+    """
+    Submit an offline batch: the request body is a JSONL file of chat requests, one per line
+    ({"custom_id": ..., "method": "POST", "url": "/v1/chat/completions", "body": {...}}).
+    Returns the batch object; poll GET /v1/batches/<batch_id> and fetch the results from
+    GET /v1/batches/<batch_id>/output.
+    """
+    try:
+        if batch_jobs is None:
+            raise batches_disabled()
+        check_content_length(request.content_length, MAX_BATCH_BYTES)
+        return jsonify(batch_jobs.submit(request.get_data(), g.get('api_key'))), 200
+    except APIError as e:
+        return jsonify(e.to_dict()), e.status, e.headers
+
+
+@app.route('/v1/batches', methods=['GET'])
+@require_api_key
+def list_batches():
+    """The API key's batches, most recent first (?limit=, default 20)"""
+    if batch_jobs is None:
+        error = batches_disabled()
+        return jsonify(error.to_dict()), error.status
+    batches = batch_jobs.list(g.get('api_key'), request.args.get('limit', 20, type=int))
+    return jsonify({'object': 'list', 'data': batches}), 200
+
+
+@app.route('/v1/batches/<batch_id>', methods=['GET'])
+@require_api_key
+def get_batch(batch_id):
+    """Batch status and request counts"""
+    try:
+        if batch_jobs is None:
+            raise batches_disabled()
+        return jsonify(batch_jobs.get(batch_id, g.get('api_key'))), 200
+    except APIError as e:
+        return jsonify(e.to_dict()), e.status
+
+
+@app.route('/v1/batches/<batch_id>/cancel', methods=['POST'])
+@require_api_key
+def cancel_batch(batch_id):
+    """Stop starting requests of the batch; those already running finish and are written out"""
+    try:
+        if batch_jobs is None:
+            raise batches_disabled()
+        return jsonify(batch_jobs.cancel(batch_id, g.get('api_key'))), 200
+    except APIError as e:
+        return jsonify(e.to_dict()), e.status
+
+
+@app.route('/v1/batches/<batch_id>/output', methods=['GET'])
+@require_api_key
+def batch_output(batch_id):
+    """Results written so far as JSONL, one line per finished request, in completion order"""
+    try:
+        if batch_jobs is None:
+            raise batches_disabled()
+        return Response(batch_jobs.output(batch_id, g.get('api_key')), mimetype='application/jsonl')
+    except APIError as e:
+        return jsonify(e.to_dict()), e.status
+
+
+@app.route('/stats/batch-jobs', methods=['GET'])
+def batch_job_stats():
+    """Offline batch worker pool: running batch, requests in flight and time yielded to streams"""
+    return jsonify(batch_jobs.stats() if batch_jobs else {'enabled': False}), 200
+
+
+@app.route('/stats/sessions', methods=['GET'])
+def session_stats():
+    """Per-call session store size and eviction counters"""
+    return jsonify(llm.sessions.stats()), 200
+
+
+@app.route('/stats/shared-store', methods=['GET'])
+def shared_store_stats():
+    """Shared store tier: round trips, batch sizes and errors"""
+    return jsonify(llm.shared.stats() if llm.shared else {'enabled': False}), 200
+
+
+@app.route('/stats/cancellations', methods=['GET'])
+def cancellation_stats():
+    """Responses cancelled by client disconnects and their completion tokens"""
+    return jsonify(llm.cancellations.stats()), 200
+
+
+@app.route('/stats/tools', methods=['GET'])
+def tool_stats():
+    """Local tool calls: rounds run, cache hits, errors and timeouts"""
+    if llm.tools is None:
+        return jsonify({'enabled': False}), 200
+    return jsonify(llm.tools.stats()), 200
+
+
+@app.route('/stats/context', methods=['GET'])
+def context_stats():
+    """Context window trimming: tokens saved, time spent per turn and summary counters"""
+    return jsonify(llm.context.stats() if llm.context else {'enabled': False}), 200
+
+
+@app.route('/stats/speculation', methods=['GET'])
+def speculation_stats():
+    """Speculative pre-generation hit rate and compute spent on discarded responses"""
+    return jsonify(llm.speculator.stats() if llm.speculator else {'enabled': False}), 200
+
+
+@app.route('/stats/tokenizers', methods=['GET'])
+def tokenizer_stats():
+    """Memoized token count cache hits/misses per tokenizer"""
+    return jsonify(llm.tokenizers.stats()), 200
+
+
+@app.route('/stats/keys', methods=['GET'])
+def key_stats():
+    """API key store size and reload counters"""
+    return jsonify(keystore.stats() if keystore else {'enabled': False}), 200
+
+
+@app.route('/stats/admission', methods=['GET'])
+def admission_stats():
+    """Admission control slots in use, queue length and admitted/rejected counters"""
+    return jsonify(admission.stats() if admission else {'enabled': False}), 200
+
+
+@app.route('/stats/request-log', methods=['GET'])
+def request_log_stats():
+    """Request capture counters: recorded, queued and dropped records, file rotations"""
+    return jsonify(request_log.stats() if request_log else {'enabled': False}), 200
+
+
+@app.route('/stats/logging', methods=['GET'])
+def log_stats():
+    """Log queue length and records dropped because the queue was full"""
+    return jsonify(logging_stats()), 200
+
+
+@app.route('/stats/routing', methods=['GET'])
+def routing_stats():
+    """Circuit breaker state, error counts and first-token p95 per backend of the fallback chains"""
+    return jsonify(llm.routing.stats() if llm.routing else {'enabled': False}), 200
+
+
+@app.route('/stats/batching', methods=['GET'])
+def batching_stats():
+    """Batch scheduler request/batch counters per batch-capable backend"""
+    return jsonify(llm.batching.stats() if llm.batching else {'enabled': False}), 200
+
+
+@app.route('/stats/cache', methods=['GET'])
+def cache_stats():
+    """Response cache hit/miss counters and size"""
+    return jsonify(llm.cache.stats() if llm.cache else {'enabled': False}), 200
+
+
+@app.route('/stats/semantic-cache', methods=['GET'])
+def semantic_cache_stats():
+    """Semantic cache hit/miss counters, size and eviction counters"""
+    return jsonify(llm.semantic_cache.stats() if llm.semantic_cache else {'enabled': False}), 200
 
 
 @app.errorhandler(404)
@@ -432,8 +1222,14 @@ def not_found(error):
     return jsonify({'error': 'Endpoint not found'}), 404
 
 
+@app.errorhandler(413)
+def request_too_large(error):
+    error = APIError(f'Request body too large (limit {request.max_content_length} bytes)', 'request_too_large', status=413)
+    return jsonify(error.to_dict()), error.status
+
+
 @app.errorhandler(500)
-def internal_error(error):
+def server_error(error):
     return jsonify({'error': 'Internal server error'}), 500
 
 
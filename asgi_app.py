@@ -0,0 +1,619 @@
+"""
+ASGI Server for Custom LLM Integration with Vapi
+Asyncio-native serving mode exposing the same routes as app.py. Streaming responses are
+async generators, so one worker can multiplex many concurrent SSE streams.
+
+Run with:
+    uvicorn asgi_app:app --host 0.0.0.0 --port 8000 --workers 2
+"""
+
+import asyncio
+import contextlib
+import functools
+import logging
+import time
+from typing import Any, Awaitable
+
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.datastructures import Headers
+from starlette.requests import Request
+from starlette.responses import JSONResponse as StarletteJSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from app import llm, admission, keystore, request_log, batch_jobs, check_api_key, HOST, PORT
+from batch_jobs import MAX_BATCH_BYTES, batches_disabled
+from cancellation import ClientDisconnected
+from keystore import authorize_model
+from logging_setup import log_body, logging_stats, set_request_id
+from request_log import RECORDED_METHODS
+from metrics import (
+    latency_snapshot, render_prometheus, error_code_from, PROMETHEUS_CONTENT_TYPE,
+    HTTP_REQUESTS, HTTP_ERRORS, HTTP_LATENCY, HTTP_REQUEST_BYTES, HTTP_RESPONSE_BYTES,
+    STREAMS_IN_FLIGHT
+)
+from serialization import dumpb, loads
+from sessions import scoped_session_id, session_id_from
+from tools import tool_options_from
+from service import (
+    APIError, SSE_HEADERS, HEALTH_BODY,
+    vapi_body, models_body, internal_error
+)
+from validation import MAX_REQUEST_BYTES, check_content_length, output_limits_from, parse_chat_request, parse_vapi_request
+
+logger = logging.getLogger(__name__)
+
+# Status recorded for requests whose client disconnected before the response (as nginx logs them)
+CLIENT_CLOSED_REQUEST = 499
+
+
+class JSONResponse(StarletteJSONResponse):
+    """JSON response rendered with the serialization module's backend (orjson when installed)"""
+
+    def render(self, content) -> bytes:
+        return dumpb(content)
+
+
+async def _disconnect(receive) -> None:
+    """Return once the client has disconnected; the request body must have been read"""
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def _unless_disconnected(receive, work: Awaitable) -> Any:
+    """Await work, cancelling it and raising ClientDisconnected if the client disconnects first"""
+    task = asyncio.ensure_future(work)
+    listener = asyncio.ensure_future(_disconnect(receive))
+    try:
+        done, _ = await asyncio.wait((task, listener), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        listener.cancel()
+        if not task.done():
+            task.cancel()
+            await asyncio.wait((task,))
+    if task not in done:
+        raise ClientDisconnected()
+    return task.result()
+
+
+class EventStreamResponse(StreamingResponse):
+    """
+    SSE response cancelled as soon as the client disconnects. Starlette only listens for
+    http.disconnect on servers older than ASGI 2.4 and leaves the body iterator open; here the
+    disconnect is always watched and the body closed, which cancels the generation upstream.
+    """
+
+    media_type = 'text/event-stream'
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await _unless_disconnected(receive, self.stream_response(send))
+        except (ClientDisconnected, OSError):
+            return  # the body is closed below; nothing more can be sent
+        finally:
+            await self.body_iterator.aclose()
+        if self.background is not None:
+            await self.background()
+
+
+async def _read_body(request: Request, limit: int = MAX_REQUEST_BYTES) -> bytes:
+    """
+    Read the request body. Raises APIError 413 for a body over limit, from Content-Length when
+    it is sent, else as soon as the chunks read exceed the limit.
+    """
+    length = request.headers.get('content-length')
+    check_content_length(int(length) if length and length.isdigit() else None, limit)
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        check_content_length(size, limit)
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+async def _read_json(request: Request):
+    """Parse the request body, returning None for empty or malformed JSON (like Flask's get_json)"""
+    body = await _read_body(request)
+    if not body:
+        return None
+    try:
+        return loads(body)
+    except ValueError:
+        return None
+
+
+def admission_control(handler):
+    """
+    Authenticate, then apply concurrency and rate limits. The slot is held until the response
+    (including a streamed one) has been fully sent or the client disconnects.
+    """
+    @functools.wraps(handler)
+    async def wrapper(request: Request):
+        try:
+            record = request.state.api_key = check_api_key(request.headers.get('Authorization', ''))
+            if admission is None:
+                return await handler(request)
+            ticket = await (admission.aacquire(record.key_id, record.limits) if record else admission.aacquire(''))
+        except APIError as e:
+            return JSONResponse(e.to_dict(), status_code=e.status, headers=e.headers)
+        try:
+            response = await handler(request)
+        except BaseException:
+            ticket.release()
+            raise
+        if isinstance(response, StreamingResponse):
+            response.body_iterator = _release_after(response.body_iterator, ticket)
+        else:
+            ticket.release()
+        return response
+
+    return wrapper
+
+
+async def _release_after(body, ticket):
+    try:
+        async for chunk in body:
+            yield chunk
+    finally:
+        ticket.release()
+        await body.aclose()
+
+
+async def home(request: Request):
+    return JSONResponse({"status": "ok"})
+
+
+async def health_check(request: Request):
+    """Health check endpoint"""
+    return JSONResponse(HEALTH_BODY)
+
+
+@admission_control
+async def chat_completions(request: Request):
+    """Main endpoint for chat completions (OpenAI-compatible format)"""
+    try:
+        data = await _read_json(request)
+        messages, model, temperature, stream = parse_chat_request(data)
+        session_id = session_id_from(data, request.headers, request.state.api_key)
+
+        model_name = model or llm.default_model
+        authorize_model(request.state.api_key, model_name)
+
+        logger.info(f"Received chat request - Model: {model_name}, Messages: {len(messages)}, Temperature: {temperature}, Stream: {stream}")
+
+        try:
+            response_text = await _unless_disconnected(request.receive, llm.agenerate_response(
+                messages=messages,
+                model=model,
+                temperature=temperature,
+                stream=stream,
+                session_id=session_id,
+                tools=tool_options_from(data),
+                limits=output_limits_from(data)
+            ))
+        except ValueError as ve:
+            raise APIError(str(ve), 'invalid_messages')
+
+        if stream:
+            return EventStreamResponse(response_text, headers=SSE_HEADERS)
+        return JSONResponse(llm.reply_body(messages, model_name, response_text, session_id))
+
+    except ClientDisconnected:
+        llm.cancellations.record(model_name)
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
+    except APIError as e:
+        return JSONResponse(e.to_dict(), status_code=e.status, headers=e.headers)
+    except Exception as e:
+        logger.error(f"Error in chat_completions: {str(e)}", exc_info=True)
+        error = internal_error(e)
+        return JSONResponse(error.to_dict(), status_code=error.status)
+
+
+@admission_control
+async def vapi_custom_llm(request: Request):
+    """Vapi-specific custom LLM endpoint"""
+    try:
+        data = await _read_json(request)
+
+        if data:
+            log_body(logger, "Received Vapi request", data)
+
+        messages, model, temperature = parse_vapi_request(data)
+        authorize_model(request.state.api_key, model or llm.default_model)
+
+        try:
+            response_text = await _unless_disconnected(request.receive, llm.agenerate_response(
+                messages=messages,
+                model=model,
+                temperature=temperature,
+                stream=False,
+                session_id=session_id_from(data, request.headers, request.state.api_key),
+                limits=output_limits_from(data)
+            ))
+        except ValueError as ve:
+            return JSONResponse({'error': str(ve)}, status_code=400)
+
+        model_name = model or llm.default_model
+
+        return JSONResponse(vapi_body(model_name, response_text, temperature))
+
+    except ClientDisconnected:
+        llm.cancellations.record(model or llm.default_model)
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
+    except APIError as e:
+        return JSONResponse({'error': e.message}, status_code=e.status, headers=e.headers)
+    except Exception as e:
+        logger.error(f"Error in vapi_custom_llm: {str(e)}", exc_info=True)
+        return JSONResponse({'error': f'Internal server error: {str(e)}'}, status_code=500)
+
+
+async def list_models(request: Request):
+    """List available models (OpenAI-compatible)"""
+    return JSONResponse(models_body(llm.default_model))
+
+
+async def latency_stats(request: Request):
+    """Streaming latency histograms (TTFT, inter-token gaps, per-frame server overhead)"""
+    return JSONResponse(latency_snapshot())
+
+
+async def metrics(request: Request):
+    """Prometheus metrics: request counts, error codes, in-flight streams, sizes and latencies"""
+    return Response(render_prometheus(), media_type=PROMETHEUS_CONTENT_TYPE)
+
+
+async def end_session(request: Request):
+    """Drop the per-call session state when a call ends; only sessions of the caller's tenant"""
+    try:
+        record = check_api_key(request.headers.get('Authorization', ''))
+    except APIError as e:
+        return JSONResponse(e.to_dict(), status_code=e.status)
+    call_id = request.path_params['call_id']
+    # Ending may be a round trip to the shared store
+    if not await run_in_threadpool(llm.sessions.end, scoped_session_id(call_id, record)):
+        return JSONResponse({'error': 'Session not found'}, status_code=404)
+    return JSONResponse({'id': call_id, 'deleted': True})
+
+
+async def vapi_webhook(request: Request):
+    """Vapi server-message webhook; ends the call's session when the call is over"""
+    try:
+        record = check_api_key(request.headers.get('Authorization', ''))
+        message = (await _read_json(request) or {}).get('message') or {}
+    except APIError as e:
+        return JSONResponse(e.to_dict(), status_code=e.status)
+    if message.get('type') == 'end-of-call-report' or (message.get('type') == 'status-update' and message.get('status') == 'ended'):
+        call_id = (message.get('call') or {}).get('id')
+        if call_id:
+            await run_in_threadpool(llm.sessions.end, scoped_session_id(str(call_id), record))
+    return JSONResponse({'ok': True})
+
+
+def _authorized_batch_jobs(request: Request):
+    """The batch store and the caller's key record; raises APIError if unauthenticated or disabled"""
+    record = check_api_key(request.headers.get('Authorization', ''))
+    if batch_jobs is None:
+        raise batches_disabled()
+    return batch_jobs, record
+
+
+async def create_batch(request: Request):
+    """Submit an offline batch: the request body is a JSONL file of chat requests (see batch_jobs.py)"""
+    try:
+        jobs, record = _authorized_batch_jobs(request)
+        raw = await _read_body(request, MAX_BATCH_BYTES)
+        # Validating a large file takes a while; keep it off the event loop
+        return JSONResponse(await run_in_threadpool(jobs.submit, raw, record))
+    except APIError as e:
+        return JSONResponse(e.to_dict(), status_code=e.status, headers=e.headers)
+
+
+async def list_batches(request: Request):
+    """The API key's batches, most recent first (?limit=, default 20)"""
+    try:
+        jobs, record = _authorized_batch_jobs(request)
+        limit = int(request.query_params.get('limit', 20))
+    except APIError as e:
+        return JSONResponse(e.to_dict(), status_code=e.status)
+    except ValueError:
+        limit = 20
+    return JSONResponse({'object': 'list', 'data': jobs.list(record, limit)})
+
+
+async def get_batch(request: Request):
+    """Batch status and request counts"""
+    try:
+        jobs, record = _authorized_batch_jobs(request)
+        return JSONResponse(jobs.get(request.path_params['batch_id'], record))
+    except APIError as e:
+        return JSONResponse(e.to_dict(), status_code=e.status)
+
+
+async def cancel_batch(request: Request):
+    """Stop starting requests of the batch; those already running finish and are written out"""
+    try:
+        jobs, record = _authorized_batch_jobs(request)
+        return JSONResponse(jobs.cancel(request.path_params['batch_id'], record))
+    except APIError as e:
+        return JSONResponse(e.to_dict(), status_code=e.status)
+
+
+async def batch_output(request: Request):
+    """Results written so far as JSONL, one line per finished request, in completion order"""
+    try:
+        jobs, record = _authorized_batch_jobs(request)
+        return StreamingResponse(jobs.output(request.path_params['batch_id'], record), media_type='application/jsonl')
+    except APIError as e:
+        return JSONResponse(e.to_dict(), status_code=e.status)
+
+
+async def batch_job_stats(request: Request):
+    """Offline batch worker pool: running batch, requests in flight and time yielded to streams"""
+    return JSONResponse(batch_jobs.stats() if batch_jobs else {'enabled': False})
+
+
+async def cancellation_stats(request: Request):
+    """Responses cancelled by client disconnects and their completion tokens"""
+    return JSONResponse(llm.cancellations.stats())
+
+
+async def tool_stats(request: Request):
+    """Local tool calls: rounds run, cache hits, errors and timeouts"""
+    if llm.tools is None:
+        return JSONResponse({'enabled': False})
+    return JSONResponse(llm.tools.stats())
+
+
+async def session_stats(request: Request):
+    """Per-call session store size and eviction counters"""
+    return JSONResponse(llm.sessions.stats())
+
+
+async def shared_store_stats(request: Request):
+    """Shared store tier: round trips, batch sizes and errors"""
+    return JSONResponse(llm.shared.stats() if llm.shared else {'enabled': False})
+
+
+async def context_stats(request: Request):
+    """Context window trimming: tokens saved, time spent per turn and summary counters"""
+    return JSONResponse(llm.context.stats() if llm.context else {'enabled': False})
+
+
+async def speculation_stats(request: Request):
+    """Speculative pre-generation hit rate and compute spent on discarded responses"""
+    return JSONResponse(llm.speculator.stats() if llm.speculator else {'enabled': False})
+
+
+async def tokenizer_stats(request: Request):
+    """Memoized token count cache hits/misses per tokenizer"""
+    return JSONResponse(llm.tokenizers.stats())
+
+
+async def key_stats(request: Request):
+    """API key store size and reload counters"""
+    return JSONResponse(keystore.stats() if keystore else {'enabled': False})
+
+
+async def admission_stats(request: Request):
+    """Admission control slots in use, queue length and admitted/rejected counters"""
+    return JSONResponse(admission.stats() if admission else {'enabled': False})
+
+
+async def request_log_stats(request: Request):
+    """Request capture counters: recorded, queued and dropped records, file rotations"""
+    return JSONResponse(request_log.stats() if request_log else {'enabled': False})
+
+
+async def log_stats(request: Request):
+    """Log queue length and records dropped because the queue was full"""
+    return JSONResponse(logging_stats())
+
+
+async def routing_stats(request: Request):
+    """Circuit breaker state, error counts and first-token p95 per backend of the fallback chains"""
+    return JSONResponse(llm.routing.stats() if llm.routing else {'enabled': False})
+
+
+async def batching_stats(request: Request):
+    """Batch scheduler request/batch counters per batch-capable backend"""
+    return JSONResponse(llm.batching.stats() if llm.batching else {'enabled': False})
+
+
+async def cache_stats(request: Request):
+    """Response cache hit/miss counters and size"""
+    return JSONResponse(llm.cache.stats() if llm.cache else {'enabled': False})
+
+
+async def semantic_cache_stats(request: Request):
+    """Semantic cache hit/miss counters, size and eviction counters"""
+    return JSONResponse(llm.semantic_cache.stats() if llm.semantic_cache else {'enabled': False})
+
+
+async def not_found(request: Request, exc):
+    return JSONResponse({'error': 'Endpoint not found'}, status_code=404)
+
+
+async def server_error(request: Request, exc):
+    return JSONResponse({'error': 'Internal server error'}, status_code=500)
+
+
+class MetricsMiddleware:
+    """
+    Count requests and error codes, and time and size them per route. Timing ends when the
+    last body chunk has been sent, so streamed responses are measured to completion.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        state = {'status': 500, 'received': 0, 'sent': 0, 'stream': False, 'error_body': None}
+
+        async def counting_receive():
+            message = await receive()
+            state['received'] += len(message.get('body', b''))
+            return message
+
+        async def counting_send(message):
+            if message['type'] == 'http.response.start':
+                state['status'] = message['status']
+                headers = dict(message.get('headers', []))
+                state['stream'] = headers.get(b'content-type', b'').startswith(b'text/event-stream')
+                if state['stream']:
+                    STREAMS_IN_FLIGHT.inc()
+                if state['status'] >= 400:
+                    state['error_body'] = []
+            elif message['type'] == 'http.response.body':
+                body = message.get('body', b'')
+                state['sent'] += len(body)
+                if state['error_body'] is not None:
+                    state['error_body'].append(body)
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            if state['stream']:
+                STREAMS_IN_FLIGHT.dec()
+            route = scope.get('route')
+            label = route.path if route is not None else 'unmatched'
+            status = state['status']
+            HTTP_REQUESTS.inc((label, scope['method'], str(status)))
+            HTTP_LATENCY.observe(time.perf_counter() - started, (label,))
+            HTTP_REQUEST_BYTES.observe(state['received'], (label,))
+            HTTP_RESPONSE_BYTES.observe(state['sent'], (label,))
+            if status >= 400:
+                try:
+                    body = loads(b''.join(state['error_body'] or []))
+                except ValueError:
+                    body = None
+                HTTP_ERRORS.inc((label, error_code_from(body, status)))
+
+
+class RequestIdMiddleware:
+    """Tag log records with the request's X-Request-Id (or a new id) and echo it in the response"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        request_id = set_request_id(Headers(scope=scope).get('x-request-id'))
+
+        async def tagging_send(message):
+            if message['type'] == 'http.response.start':
+                message['headers'] = [*message.get('headers', []), (b'x-request-id', request_id.encode('latin-1'))]
+            await send(message)
+
+        await self.app(scope, receive, tagging_send)
+
+
+class RequestLogMiddleware:
+    """
+    Hand each request's arrival time, headers, body and status to the request recorder once
+    the response is done. Only added when REQUEST_LOG_PATH is set. A request rejected before
+    its body was read (401, 429) is recorded with the part that was read, usually none.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] not in RECORDED_METHODS:
+            await self.app(scope, receive, send)
+            return
+
+        arrived = time.time()
+        body = []
+        status = [500]
+
+        async def capturing_receive():
+            message = await receive()
+            if message['type'] == 'http.request':
+                body.append(message.get('body', b''))
+            return message
+
+        async def capturing_send(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, capturing_receive, capturing_send)
+        finally:
+            request_log.record(arrived, scope['method'], scope['path'], Headers(scope=scope), b''.join(body), status[0])
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    if batch_jobs is not None:
+        # Resume unfinished batches in this worker
+        batch_jobs.start()
+    yield
+    # Close pooled upstream connections owned by this worker's event loop
+    for backend in llm.router.backends:
+        await backend.aclose()
+
+
+routes = [
+    Route('/', home, methods=['GET']),
+    Route('/health', health_check, methods=['GET']),
+    Route('/v1/chat/completions', chat_completions, methods=['POST']),
+    Route('/vapi/custom-llm', vapi_custom_llm, methods=['POST']),
+    Route('/v1/models', list_models, methods=['GET']),
+    Route('/stats/latency', latency_stats, methods=['GET']),
+    Route('/metrics', metrics, methods=['GET']),
+    Route('/stats/cache', cache_stats, methods=['GET']),
+    Route('/stats/semantic-cache', semantic_cache_stats, methods=['GET']),
+    Route('/stats/batching', batching_stats, methods=['GET']),
+    Route('/stats/routing', routing_stats, methods=['GET']),
+    Route('/stats/admission', admission_stats, methods=['GET']),
+    Route('/stats/request-log', request_log_stats, methods=['GET']),
+    Route('/stats/logging', log_stats, methods=['GET']),
+    Route('/stats/keys', key_stats, methods=['GET']),
+    Route('/stats/tokenizers', tokenizer_stats, methods=['GET']),
+    Route('/stats/context', context_stats, methods=['GET']),
+    Route('/stats/speculation', speculation_stats, methods=['GET']),
+    Route('/v1/sessions/{call_id}', end_session, methods=['DELETE']),
+    Route('/vapi/webhook', vapi_webhook, methods=['POST']),
+    Route('/v1/batches', create_batch, methods=['POST']),
+    Route('/v1/batches', list_batches, methods=['GET']),
+    Route('/v1/batches/{batch_id}', get_batch, methods=['GET']),
+    Route('/v1/batches/{batch_id}/cancel', cancel_batch, methods=['POST']),
+    Route('/v1/batches/{batch_id}/output', batch_output, methods=['GET']),
+    Route('/stats/batch-jobs', batch_job_stats, methods=['GET']),
+    Route('/stats/sessions', session_stats, methods=['GET']),
+    Route('/stats/shared-store', shared_store_stats, methods=['GET']),
+    Route('/stats/cancellations', cancellation_stats, methods=['GET']),
+    Route('/stats/tools', tool_stats, methods=['GET']),
+]
+
+app = Starlette(
+    routes=routes,
+    lifespan=lifespan,
+    middleware=[
+        Middleware(MetricsMiddleware),
+        Middleware(RequestIdMiddleware),
+        *([Middleware(RequestLogMiddleware)] if request_log is not None else []),
+        Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])  # Enable CORS for Vapi connections
+    ],
+    exception_handlers={404: not_found, 500: server_error}
+)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    logger.info(f"Starting Custom LLM ASGI Server on {HOST}:{PORT}")
+    uvicorn.run(app, host=HOST, port=PORT)
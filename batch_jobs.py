@@ -0,0 +1,536 @@
+"""
+Offline batch completions for CustomLLM
+Bulk jobs (post-call summaries, transcript QA) are submitted as one JSONL file of chat requests
+instead of a loop of /v1/chat/completions calls. POST /v1/batches takes the file as the request
+body, one request per line in the OpenAI batch input format:
+
+    {"custom_id": "call-1", "method": "POST", "url": "/v1/chat/completions", "body": {"model": ..., "messages": [...]}}
+
+A line may also be just the chat request body; its custom_id is then "line-<n>". The whole file
+is validated (and the models checked against the API key) before the batch is accepted.
+
+Requests run through CustomLLM.generate_response (not streamed, no session) on a pool of
+BATCH_JOBS_WORKERS threads. Lines are read from the stored input only as workers free up, so
+a large file is never held in memory, and each result is appended to the batch's output JSONL
+as soon as it completes (in completion order):
+
+    {"id": "batch_req_...", "custom_id": "call-1", "response": {"status_code": 200, "request_id": "...", "body": {...}}, "error": null}
+
+Interactive calls come first: the pool is small and fixed, batch requests bypass admission
+control instead of taking its slots, and while BATCH_JOBS_YIELD_STREAMS or more SSE responses
+are in flight in this process no new batch request is started.
+
+Batches live in BATCH_JOBS_DIR/<batch id>/ (input.jsonl, output.jsonl, batch.json) and run in
+submission order, one at a time per process. A process works on a batch while holding a lock on
+its directory, so after a restart (or with several gunicorn workers sharing the directory)
+unfinished batches are picked up again; requests whose custom_id is already in output.jsonl are
+not run twice. Status can be polled from any worker.
+
+Configuration (environment variables):
+    BATCH_JOBS_DIR            - directory for batch state (unset: batch API disabled)
+    BATCH_JOBS_WORKERS        - concurrent batch requests per process (default: 2)
+    BATCH_JOBS_YIELD_STREAMS  - pause batch work while this many streams are in flight, 0 = never (default: 0)
+    BATCH_JOBS_MAX_BYTES      - largest accepted input file (default: 100 MB)
+    BATCH_JOBS_MAX_REQUESTS   - most requests per batch (default: 50000)
+"""
+
+import logging
+import os
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+try:
+    import fcntl
+except ImportError:  # no cross-process locking (Windows); one process per BATCH_JOBS_DIR
+    fcntl = None
+
+from keystore import KeyRecord, authorize_model
+from logging_setup import set_request_id
+from metrics import BATCH_JOB_REQUESTS
+from serialization import dumpb, loads
+from service import APIError, internal_error
+from validation import parse_chat_request, validate_messages
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH_BYTES = int(os.getenv('BATCH_JOBS_MAX_BYTES', 100 * 1024 * 1024))
+
+BATCH_ENDPOINT = '/v1/chat/completions'
+
+FINAL_STATUSES = ('completed', 'failed', 'cancelled')
+
+# chat request body -> (HTTP status, response body)
+Processor = Callable[[Dict[str, Any]], Tuple[int, Dict[str, Any]]]
+
+# Interactive requests in flight in this process
+LoadProbe = Callable[[], float]
+
+# Persist request counts at most this often while a batch runs
+_STATE_INTERVAL = 0.5
+
+# batch.json fields not shown to clients
+_PRIVATE = ('owner', 'submitted')
+
+
+def _invalid(line: int, problem: str) -> APIError:
+    return APIError(f'Line {line}: {problem}', 'invalid_batch')
+
+
+def parse_line(item: Any, line: int) -> Tuple[str, Dict[str, Any]]:
+    """(custom_id, chat request body) of one input line, in the OpenAI batch format or a bare body"""
+    if type(item) is not dict:
+        raise _invalid(line, 'must be a JSON object')
+    if 'body' not in item:
+        return f'line-{line}', item
+    custom_id = item.get('custom_id')
+    if type(custom_id) is not str or not custom_id:
+        raise _invalid(line, "'custom_id' must be a non-empty string")
+    if item.get('method', 'POST') != 'POST':
+        raise _invalid(line, "'method' must be 'POST'")
+    if item.get('url', BATCH_ENDPOINT) != BATCH_ENDPOINT:
+        raise _invalid(line, f"'url' must be '{BATCH_ENDPOINT}'")
+    if type(item['body']) is not dict:
+        raise _invalid(line, "'body' must be a JSON object")
+    return custom_id, item['body']
+
+
+class _Job:
+    """A batch claimed by this process; lock is the open lock file while it is being worked on"""
+
+    __slots__ = ('id', 'path', 'state', 'lock', 'done', 'in_flight', 'persisted')
+
+    def __init__(self, batch_id: str, path: str, state: Dict[str, Any], lock: Any):
+        self.id = batch_id
+        self.path = path
+        self.state = state
+        self.lock = lock
+        self.done: Set[str] = set()
+        self.in_flight = 0
+        self.persisted = 0.0
+
+
+class BatchJobs:
+    """Stores submitted batches and works through them on a bounded thread pool"""
+
+    def __init__(
+        self,
+        directory: str,
+        process: Processor,
+        default_model: str,
+        interactive_load: Optional[LoadProbe] = None,
+        workers: int = 2,
+        yield_streams: int = 0,
+        max_requests: int = 50000,
+        poll_interval: float = 1.0
+    ):
+        self.directory = directory
+        self.process = process
+        self.default_model = default_model
+        self.interactive_load = interactive_load
+        self.workers = workers
+        self.yield_streams = yield_streams
+        self.max_requests = max_requests
+        self.poll_interval = poll_interval
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._pid: Optional[int] = None
+        self._wake = threading.Event()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._finished: Set[str] = set()
+        self._job: Optional[_Job] = None
+        self.submitted = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.yielded_seconds = 0.0
+
+    # ----- API -----
+
+    def submit(self, raw: bytes, record: Optional[KeyRecord] = None) -> Dict[str, Any]:
+        """Validate a JSONL input file and queue it; returns the batch object"""
+        seen: Set[str] = set()
+        for line, item in self._lines(raw.split(b'\n')):
+            if item is None:
+                raise _invalid(line, 'invalid JSON')
+            custom_id, body = parse_line(item, line)
+            if custom_id in seen:
+                raise _invalid(line, f'duplicate custom_id {custom_id!r}')
+            seen.add(custom_id)
+            if len(seen) > self.max_requests:
+                raise APIError(f'A batch may hold at most {self.max_requests} requests', 'batch_too_large')
+            try:
+                messages, model, _, _ = parse_chat_request(body)
+                validate_messages(messages)
+                authorize_model(record, model or self.default_model)
+            except APIError as e:
+                raise APIError(f'Line {line}: {e.message}', e.code, type=e.type, status=e.status)
+        if not seen:
+            raise APIError('The batch input file has no requests', 'invalid_batch')
+
+        batch_id = f'batch_{secrets.token_hex(12)}'
+        path = os.path.join(self.directory, batch_id)
+        os.makedirs(path)
+        with open(os.path.join(path, 'input.jsonl'), 'wb') as f:
+            f.write(raw)
+        now = int(time.time())
+        state = {
+            'id': batch_id,
+            'object': 'batch',
+            'endpoint': BATCH_ENDPOINT,
+            'status': 'in_progress',
+            'created_at': now,
+            'in_progress_at': now,
+            'completed_at': None,
+            'cancelled_at': None,
+            'failed_at': None,
+            'errors': None,
+            'request_counts': {'total': len(seen), 'completed': 0, 'failed': 0},
+            'metadata': None,
+            'output_url': f'/v1/batches/{batch_id}/output',
+            'owner': record.key_id if record else None,
+            'submitted': time.time(),
+        }
+        self._save(path, state)
+        with self._lock:
+            self.submitted += 1
+        logger.info(f"Batch {batch_id} queued with {len(seen)} requests")
+        self.start()
+        self._wake.set()
+        return self._public(state, path)
+
+    def get(self, batch_id: str, record: Optional[KeyRecord] = None) -> Dict[str, Any]:
+        """The batch object; raises a 404 for unknown batches and batches of other keys"""
+        path = self._path(batch_id)
+        state = self._visible(self._read(path, batch_id), record, batch_id)
+        return self._public(state, path)
+
+    def list(self, record: Optional[KeyRecord] = None, limit: int = 20) -> List[Dict[str, Any]]:
+        """Most recent batches first"""
+        batches = []
+        for batch_id in self._batch_ids():
+            path = os.path.join(self.directory, batch_id)
+            try:
+                state = self._read(path, batch_id)
+            except APIError:
+                continue
+            if record is None or state.get('owner') == record.key_id:
+                batches.append((state, path))
+        batches.sort(key=lambda batch: batch[0]['submitted'], reverse=True)
+        return [self._public(state, path) for state, path in batches[:limit]]
+
+    def cancel(self, batch_id: str, record: Optional[KeyRecord] = None) -> Dict[str, Any]:
+        """Stop starting new requests of the batch; requests already running still finish"""
+        path = self._path(batch_id)
+        state = self._visible(self._read(path, batch_id), record, batch_id)
+        if state['status'] not in FINAL_STATUSES:
+            # Whichever process is working on the batch sees the marker before its next request
+            open(os.path.join(path, 'cancel'), 'a').close()
+            self._wake.set()
+        return self._public(self._read(path, batch_id), path)
+
+    def output(self, batch_id: str, record: Optional[KeyRecord] = None) -> Iterator[bytes]:
+        """
+        The results written so far, as chunks of whole JSONL lines; raises a 404 like get().
+        Can be read while the batch runs: results appended meanwhile are not included.
+        """
+        path = self._path(batch_id)
+        self._visible(self._read(path, batch_id), record, batch_id)
+        output = os.path.join(path, 'output.jsonl')
+        if not os.path.exists(output):
+            return iter(())
+        with open(output, 'rb') as f:
+            # End at the last complete line (a result may be half written)
+            end = f.seek(0, os.SEEK_END)
+            while end > 0:
+                start = max(0, end - 65536)
+                f.seek(start)
+                newline = f.read(end - start).rfind(b'\n')
+                if newline >= 0:
+                    end = start + newline + 1
+                    break
+                end = start
+        return self._chunks(output, end)
+
+    @staticmethod
+    def _chunks(path: str, end: int) -> Iterator[bytes]:
+        with open(path, 'rb') as f:
+            while end > 0:
+                chunk = f.read(min(65536, end))
+                if not chunk:
+                    return
+                end -= len(chunk)
+                yield chunk
+
+    # ----- storage -----
+
+    def _path(self, batch_id: str) -> str:
+        if not batch_id.startswith('batch_') or not batch_id[6:].isalnum():
+            raise self._not_found(batch_id)
+        return os.path.join(self.directory, batch_id)
+
+    @staticmethod
+    def _not_found(batch_id: str) -> APIError:
+        return APIError(f'No batch found with id {batch_id!r}', 'batch_not_found', status=404)
+
+    def _read(self, path: str, batch_id: str) -> Dict[str, Any]:
+        try:
+            with open(os.path.join(path, 'batch.json'), 'rb') as f:
+                return loads(f.read())
+        except (OSError, ValueError):
+            raise self._not_found(batch_id)
+
+    @staticmethod
+    def _save(path: str, state: Dict[str, Any]) -> None:
+        # Write then rename, so a status poll never reads a half-written file
+        tmp = os.path.join(path, f'batch.json.{os.getpid()}')
+        with open(tmp, 'wb') as f:
+            f.write(dumpb(state))
+        os.replace(tmp, os.path.join(path, 'batch.json'))
+
+    def _visible(self, state: Dict[str, Any], record: Optional[KeyRecord], batch_id: str) -> Dict[str, Any]:
+        if record is not None and state.get('owner') != record.key_id:
+            raise self._not_found(batch_id)
+        return state
+
+    @staticmethod
+    def _public(state: Dict[str, Any], path: str) -> Dict[str, Any]:
+        public = {key: value for key, value in state.items() if key not in _PRIVATE}
+        if public['status'] not in FINAL_STATUSES and os.path.exists(os.path.join(path, 'cancel')):
+            public['status'] = 'cancelling'
+        return public
+
+    def _batch_ids(self) -> List[str]:
+        return [name for name in os.listdir(self.directory) if name.startswith('batch_')]
+
+    @staticmethod
+    def _lines(lines: Any) -> Iterator[Tuple[int, Optional[Any]]]:
+        """(1-based line number, parsed JSON or None if malformed) of the non-blank lines"""
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                yield number, loads(line)
+            except ValueError:
+                yield number, None
+
+    # ----- processing -----
+
+    def start(self) -> None:
+        """Start the dispatcher thread of this process (again after a fork); cheap when running"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._wake = threading.Event()
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='batch-job')
+            self._job = None
+            threading.Thread(target=self._run, name='batch-jobs', daemon=True).start()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                job = self._claim()
+                if job is None:
+                    self._wake.wait(self.poll_interval)
+                    self._wake.clear()
+                    continue
+                try:
+                    self._work(job)
+                finally:
+                    self._job = None
+                    job.lock.close()
+            except Exception as e:
+                logger.error(f"Batch dispatcher error: {e}", exc_info=True)
+                time.sleep(self.poll_interval)
+
+    def _claim(self) -> Optional[_Job]:
+        """Lock the oldest unfinished batch no other process is working on"""
+        pending = []
+        for batch_id in self._batch_ids():
+            if batch_id in self._finished:
+                continue
+            path = os.path.join(self.directory, batch_id)
+            try:
+                state = self._read(path, batch_id)
+            except APIError:
+                continue
+            if state['status'] in FINAL_STATUSES:
+                self._finished.add(batch_id)
+            else:
+                pending.append((state['submitted'], batch_id, path))
+        for _, batch_id, path in sorted(pending):
+            lock = open(os.path.join(path, 'lock'), 'a')
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    lock.close()
+                    continue
+            # Re-read under the lock: another process may have finished it meanwhile
+            state = self._read(path, batch_id)
+            if state['status'] in FINAL_STATUSES:
+                self._finished.add(batch_id)
+                lock.close()
+                continue
+            return _Job(batch_id, path, state, lock)
+        return None
+
+    def _resume(self, job: _Job) -> None:
+        """Count the results already written, dropping a line cut short by a crash"""
+        output = os.path.join(job.path, 'output.jsonl')
+        if not os.path.exists(output):
+            return
+        with open(output, 'rb+') as f:
+            data = f.read()
+            end = data.rfind(b'\n') + 1
+            if end < len(data):
+                f.truncate(end)
+        counts = job.state['request_counts']
+        counts['completed'] = counts['failed'] = 0
+        for _, item in self._lines(data[:end].split(b'\n')):
+            if item is None:
+                continue
+            job.done.add(item['custom_id'])
+            if (item.get('response') or {}).get('status_code') == 200:
+                counts['completed'] += 1
+            else:
+                counts['failed'] += 1
+        if job.done:
+            logger.info(f"Resuming batch {job.id}: {len(job.done)} of {counts['total']} requests already done")
+
+    def _work(self, job: _Job) -> None:
+        self._job = job
+        self._resume(job)
+        cancel_marker = os.path.join(job.path, 'cancel')
+        slots = threading.Semaphore(self.workers)
+        write_lock = threading.Lock()
+        with open(os.path.join(job.path, 'input.jsonl'), 'rb') as source, \
+                open(os.path.join(job.path, 'output.jsonl'), 'ab') as output:
+            for line, item in self._lines(source):
+                try:
+                    custom_id, body = parse_line(item, line)
+                except APIError as e:
+                    # Validated on submit; only a file edited since can get here
+                    logger.warning(f"Batch {job.id} skipped: {e.message}")
+                    continue
+                if custom_id in job.done:
+                    continue
+                # Backpressure: the next line is read only when a worker is free
+                slots.acquire()
+                self._wait_for_quiet(cancel_marker)
+                if os.path.exists(cancel_marker):
+                    slots.release()
+                    break
+                with write_lock:
+                    job.in_flight += 1
+                self._executor.submit(self._one, job, custom_id, body, output, write_lock, slots)
+            for _ in range(self.workers):
+                slots.acquire()
+
+        now = int(time.time())
+        if os.path.exists(cancel_marker):
+            job.state.update(status='cancelled', cancelled_at=now)
+        else:
+            job.state.update(status='completed', completed_at=now)
+        self._save(job.path, job.state)
+        self._finished.add(job.id)
+        counts = job.state['request_counts']
+        logger.info(f"Batch {job.id} {job.state['status']}: {counts['completed']} completed, {counts['failed']} failed")
+
+    def _wait_for_quiet(self, cancel_marker: str) -> None:
+        """Hold back batch work while interactive streams are busy"""
+        if not self.yield_streams or self.interactive_load is None:
+            return
+        started = time.perf_counter()
+        while self.interactive_load() >= self.yield_streams and not os.path.exists(cancel_marker):
+            time.sleep(0.05)
+        waited = time.perf_counter() - started
+        if waited > 0.001:
+            with self._lock:
+                self.yielded_seconds += waited
+
+    def _one(
+        self,
+        job: _Job,
+        custom_id: str,
+        body: Dict[str, Any],
+        output: Any,
+        write_lock: threading.Lock,
+        slots: threading.Semaphore
+    ) -> None:
+        try:
+            request_id = set_request_id(None)
+            try:
+                status, response = self.process(body)
+            except Exception as e:
+                logger.error(f"Batch {job.id} request {custom_id!r} failed: {e}", exc_info=True)
+                error = internal_error(e)
+                status, response = error.status, error.to_dict()
+            result = dumpb({
+                'id': f'batch_req_{secrets.token_hex(12)}',
+                'custom_id': custom_id,
+                'response': {'status_code': status, 'request_id': request_id, 'body': response},
+                'error': None
+            }) + b'\n'
+            outcome = 'completed' if status == 200 else 'failed'
+            BATCH_JOB_REQUESTS.inc((outcome,))
+            with write_lock:
+                output.write(result)
+                output.flush()
+                job.done.add(custom_id)
+                job.in_flight -= 1
+                job.state['request_counts'][outcome] += 1
+                with self._lock:
+                    if status == 200:
+                        self.succeeded += 1
+                    else:
+                        self.failed += 1
+                now = time.monotonic()
+                if now - job.persisted >= _STATE_INTERVAL:
+                    job.persisted = now
+                    self._save(job.path, job.state)
+        finally:
+            slots.release()
+
+    def stats(self) -> Dict[str, Any]:
+        job = self._job
+        return {
+            'enabled': True,
+            'directory': self.directory,
+            'workers': self.workers,
+            'yield_streams': self.yield_streams,
+            'running': job.id if job else None,
+            'in_flight': job.in_flight if job else 0,
+            'submitted': self.submitted,
+            'succeeded': self.succeeded,
+            'failed': self.failed,
+            'yielded_seconds': round(self.yielded_seconds, 3)
+        }
+
+
+def batches_disabled() -> APIError:
+    return APIError('Batch jobs are disabled; set BATCH_JOBS_DIR to enable them', 'batch_jobs_disabled', status=404)
+
+
+def build_batch_jobs_from_env(
+    process: Processor,
+    default_model: str,
+    interactive_load: Optional[LoadProbe] = None
+) -> Optional[BatchJobs]:
+    """Return BatchJobs if BATCH_JOBS_DIR is set, otherwise None"""
+    directory = os.getenv('BATCH_JOBS_DIR')
+    if not directory:
+        return None
+    return BatchJobs(
+        directory,
+        process,
+        default_model,
+        interactive_load=interactive_load,
+        workers=int(os.getenv('BATCH_JOBS_WORKERS', 2)),
+        yield_streams=int(os.getenv('BATCH_JOBS_YIELD_STREAMS', 0)),
+        max_requests=int(os.getenv('BATCH_JOBS_MAX_REQUESTS', 50000))
+    )
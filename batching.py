@@ -0,0 +1,293 @@
+"""
+Batched inference scheduler
+Coalesces concurrent requests for a batch-capable backend (see providers.BatchBackend) into
+one upstream call. The first request of a batch opens a window of BATCH_MAX_WAIT_MS; the
+batch is dispatched when the window closes or BATCH_MAX_SIZE requests have joined, and the
+results and stream deltas are fanned back out to the original callers.
+
+Requests only share a batch when they target the same upstream model and are both streaming
+or both non-streaming. While BATCH_MAX_CONCURRENT batches are running, new requests keep
+queueing, so batches grow under load instead of piling up on the upstream.
+
+Configuration (environment variables):
+    BATCH_MAX_SIZE        - requests per batch; 1 disables batching (default: 8)
+    BATCH_MAX_WAIT_MS     - how long the first request of a batch waits for company (default: 10)
+    BATCH_MAX_CONCURRENT  - batches in flight per backend (default: 2)
+"""
+
+import asyncio
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+
+from metrics import BATCH_SIZE, BATCH_QUEUE_WAIT
+from providers import ProviderBackend, ProviderError
+
+logger = logging.getLogger(__name__)
+
+# Items delivered to a waiting caller
+_DELTA, _DONE, _ERROR = 'delta', 'done', 'error'
+
+
+class _Request:
+    """One caller waiting on a batch; deliver() is safe to call from scheduler threads"""
+
+    __slots__ = ('messages', 'temperature', 'limits', 'deliver', 'enqueued', 'finished')
+
+    def __init__(self, messages: List[Dict[str, Any]], temperature: float, limits: Any, deliver: Callable[[Tuple[str, Any]], None]):
+        self.messages = messages
+        self.temperature = temperature
+        self.limits = limits
+        self.deliver = deliver
+        self.enqueued = time.monotonic()
+        self.finished = False
+
+    def finish(self, kind: str, value: Any = None) -> None:
+        if not self.finished:
+            self.finished = True
+            self.deliver((kind, value))
+
+
+def _async_deliver() -> Tuple[asyncio.Queue, Callable[[Tuple[str, Any]], None]]:
+    """An asyncio.Queue for the running loop and a thread-safe function that feeds it"""
+    loop = asyncio.get_running_loop()
+    items: asyncio.Queue = asyncio.Queue()
+
+    def deliver(item: Tuple[str, Any]) -> None:
+        try:
+            loop.call_soon_threadsafe(items.put_nowait, item)
+        except RuntimeError:
+            pass  # the caller's event loop has shut down
+
+    return items, deliver
+
+
+class BatchScheduler:
+    """
+    Stands in for a batch-capable backend: complete/stream/acomplete/astream enqueue the
+    request and wait for their share of a batched upstream call.
+    """
+
+    def __init__(self, backend: ProviderBackend, max_batch_size: int = 8, max_wait: float = 0.01, max_concurrent: int = 2):
+        self.backend = backend
+        self.name = backend.name
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._pending: Dict[Tuple[str, bool], List[_Request]] = {}
+        self._cond = threading.Condition()
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._workers = ThreadPoolExecutor(max_concurrent, thread_name_prefix=f'batch-{backend.name}')
+        self._thread: Optional[threading.Thread] = None
+        self.batches = 0
+        self.requests = 0
+        self.withdrawn = 0
+
+    def matches(self, model: str) -> bool:
+        return self.backend.matches(model)
+
+    # ----- backend interface -----
+
+    def complete(self, messages, model, temperature, session=None, limits=None) -> str:
+        results: queue.SimpleQueue = queue.SimpleQueue()
+        self._submit(model, False, _Request(messages, temperature, limits, results.put))
+        kind, value = results.get()
+        if kind == _ERROR:
+            raise value
+        return value
+
+    def stream(self, messages, model, temperature, session=None, tools=None, limits=None) -> Iterator[str]:
+        items: queue.SimpleQueue = queue.SimpleQueue()
+        request = _Request(messages, temperature, limits, items.put)
+        self._submit(model, True, request)
+        try:
+            while True:
+                kind, value = items.get()
+                if kind == _DELTA:
+                    yield value
+                elif kind == _ERROR:
+                    raise value
+                else:
+                    return
+        finally:
+            self._withdraw(model, request)
+
+    async def acomplete(self, messages, model, temperature, session=None, limits=None) -> str:
+        results, deliver = _async_deliver()
+        self._submit(model, False, _Request(messages, temperature, limits, deliver))
+        kind, value = await results.get()
+        if kind == _ERROR:
+            raise value
+        return value
+
+    async def astream(self, messages, model, temperature, session=None, tools=None, limits=None) -> AsyncIterator[str]:
+        items, deliver = _async_deliver()
+        request = _Request(messages, temperature, limits, deliver)
+        self._submit(model, True, request)
+        try:
+            while True:
+                kind, value = await items.get()
+                if kind == _DELTA:
+                    yield value
+                elif kind == _ERROR:
+                    raise value
+                else:
+                    return
+        finally:
+            self._withdraw(model, request)
+
+    def close(self) -> None:
+        self.backend.close()
+
+    async def aclose(self) -> None:
+        await self.backend.aclose()
+
+    # ----- scheduling -----
+
+    def _submit(self, model: str, stream: bool, request: '_Request') -> None:
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f'batch-scheduler-{self.name}', daemon=True)
+                self._thread.start()
+            self._pending.setdefault((model, stream), []).append(request)
+            self.requests += 1
+            self._cond.notify()
+
+    def _withdraw(self, model: str, request: '_Request') -> None:
+        """
+        The caller of a streamed request stopped reading: drop it from its queue if it has not
+        been dispatched yet, else stop delivering to it (the batch stops once all have gone)
+        """
+        if request.finished:
+            return
+        request.finished = True
+        with self._cond:
+            group = self._pending.get((model, True))
+            if group and request in group:
+                group.remove(request)
+                self.withdrawn += 1
+                if not group:
+                    del self._pending[(model, True)]
+    
+    def _next_batch(self) -> Tuple[Tuple[str, bool], List[_Request]]:
+        """Wait for the oldest group's window to close or fill up, then take up to max_batch_size requests"""
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            key = min(self._pending, key=lambda k: self._pending[k][0].enqueued)
+            deadline = self._pending[key][0].enqueued + self.max_wait
+            while len(self._pending[key]) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            group = self._pending[key]
+            batch, rest = group[:self.max_batch_size], group[self.max_batch_size:]
+            if rest:
+                self._pending[key] = rest
+            else:
+                del self._pending[key]
+            return key, batch
+
+    def _run(self) -> None:
+        while True:
+            # Take a slot first: while all slots are busy, requests keep joining the next batch
+            self._slots.acquire()
+            try:
+                key, batch = self._next_batch()
+                self._workers.submit(self._dispatch, key, batch)
+            except Exception:
+                self._slots.release()
+                logger.exception("Batch scheduler failed to dispatch a batch")
+
+    def _dispatch(self, key: Tuple[str, bool], batch: List[_Request]) -> None:
+        model, stream = key
+        now = time.monotonic()
+        self.batches += 1
+        BATCH_SIZE.observe(len(batch), (self.name,))
+        for request in batch:
+            BATCH_QUEUE_WAIT.observe(now - request.enqueued, (self.name,))
+        items = [(request.messages, request.temperature, request.limits) for request in batch]
+        try:
+            if stream:
+                deltas = self.backend.stream_batch(model, items)
+                try:
+                    for index, kind, value in deltas:
+                        request = batch[index]
+                        if request.finished:
+                            if all(other.finished for other in batch):
+                                break  # every caller went away: close the upstream stream
+                        elif kind == _DELTA:
+                            request.deliver((_DELTA, value))
+                        else:
+                            request.finish(kind, value)
+                finally:
+                    deltas.close()
+                for request in batch:
+                    request.finish(_DONE)
+            else:
+                for request, result in zip(batch, self.backend.complete_batch(model, items)):
+                    request.finish(_ERROR if isinstance(result, Exception) else _DONE, result)
+        except Exception as e:
+            error = e if isinstance(e, ProviderError) else ProviderError(f'{self.name} batch failed: {e}')
+            for request in batch:
+                request.finish(_ERROR, error)
+        finally:
+            self._slots.release()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            queued = sum(len(group) for group in self._pending.values())
+        return {
+            'backend': self.name,
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1000,
+            'requests': self.requests,
+            'batches': self.batches,
+            'withdrawn': self.withdrawn,
+            'mean_batch_size': self.requests / self.batches if self.batches else None,
+            'queued': queued
+        }
+
+
+class BatchSchedulers:
+    """Puts one BatchScheduler in front of every batch-capable backend"""
+
+    def __init__(self, max_batch_size: int = 8, max_wait: float = 0.01, max_concurrent: int = 2):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_concurrent = max_concurrent
+        self._schedulers: Dict[int, BatchScheduler] = {}
+        self._lock = threading.Lock()
+
+    def wrap(self, backend: ProviderBackend) -> Any:
+        """The backend's scheduler, or the backend itself if it cannot batch"""
+        if not backend.supports_batching:
+            return backend
+        scheduler = self._schedulers.get(id(backend))
+        if scheduler is None:
+            with self._lock:
+                scheduler = self._schedulers.get(id(backend))
+                if scheduler is None:
+                    scheduler = self._schedulers[id(backend)] = BatchScheduler(
+                        backend, self.max_batch_size, self.max_wait, self.max_concurrent
+                    )
+        return scheduler
+
+    def stats(self) -> Dict[str, Any]:
+        return {scheduler.name: scheduler.stats() for scheduler in self._schedulers.values()}
+
+
+def build_batching_from_env() -> Optional[BatchSchedulers]:
+    """None when batching is disabled (BATCH_MAX_SIZE <= 1)"""
+    max_batch_size = int(os.getenv('BATCH_MAX_SIZE', 8))
+    if max_batch_size <= 1:
+        return None
+    return BatchSchedulers(
+        max_batch_size=max_batch_size,
+        max_wait=float(os.getenv('BATCH_MAX_WAIT_MS', 10)) / 1000,
+        max_concurrent=int(os.getenv('BATCH_MAX_CONCURRENT', 2))
+    )
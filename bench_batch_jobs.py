@@ -0,0 +1,158 @@
+"""
+بنشمارك لمعالجة الدفعات (batch) وأثرها على المكالمات التفاعلية
+Benchmark: offline batch throughput per worker count, and its effect on interactive streams
+
+Starts fake_upstream.py (every completion takes about --ttft + --tokens x --token-delay
+seconds) and the ASGI server with BATCH_JOBS_DIR set, submits a batch of --requests chat
+requests to POST /v1/batches and polls it until completed, once per --workers value
+(BATCH_JOBS_WORKERS). Reports wall time and requests per second.
+
+For the largest worker count it also streams interactive completions one after another, before
+the batch (idle) and while it runs, with and without BATCH_JOBS_YIELD_STREAMS=1, and reports
+their time to first token.
+
+Usage:
+    python bench_batch_jobs.py --requests 100 --workers 1 2 4 8
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List
+
+import httpx
+
+from bench_providers import _wait_ready
+
+MODEL = 'gpt-fake'
+
+
+def _batch_file(requests: int) -> bytes:
+    lines = [
+        json.dumps({'custom_id': f'summary-{i}', 'method': 'POST', 'url': '/v1/chat/completions', 'body': {
+            'model': MODEL,
+            'messages': [{'role': 'system', 'content': 'لخص المكالمة التالية في جملتين.'},
+                         {'role': 'user', 'content': f'نص المكالمة رقم {i}: العميل يسأل عن موعد الحجز وتفاصيل الدفع.'}]
+        }}, ensure_ascii=False)
+        for i in range(requests)
+    ]
+    return '\n'.join(lines).encode('utf-8')
+
+
+def _stream_ttft(client: httpx.Client, base_url: str) -> float:
+    payload = {'model': MODEL, 'stream': True, 'messages': [{'role': 'user', 'content': 'مرحباً'}]}
+    start = time.perf_counter()
+    ttft = None
+    with client.stream('POST', f'{base_url}/v1/chat/completions', json=payload) as response:
+        for line in response.iter_lines():
+            if line.startswith('data: ') and ttft is None:
+                ttft = time.perf_counter() - start
+    if ttft is None:
+        raise RuntimeError('stream without data')
+    return ttft
+
+
+def _interactive(base_url: str, stop: threading.Event, ttfts: List[float]) -> None:
+    with httpx.Client(timeout=60) as client:
+        while not stop.is_set():
+            ttfts.append(_stream_ttft(client, base_url))
+
+
+def _ms(samples: List[float]) -> Dict[str, Any]:
+    if not samples:
+        return {'streams': 0}
+    samples = sorted(samples)
+    return {
+        'streams': len(samples),
+        'ttft_p50_ms': round(statistics.median(samples) * 1000, 1),
+        'ttft_p95_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000, 1),
+    }
+
+
+def _run(env: Dict[str, str], base_url: str, raw: bytes, interactive: bool) -> Dict[str, Any]:
+    server = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'asgi_app:app', '--port', env['PORT'], '--log-level', 'warning'],
+                              env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        _wait_ready(base_url)
+        result: Dict[str, Any] = {}
+        stop = threading.Event()
+        ttfts: List[float] = []
+        if interactive:
+            idle: List[float] = []
+            with httpx.Client(timeout=60) as client:
+                for _ in range(20):
+                    idle.append(_stream_ttft(client, base_url))
+            result['interactive_idle'] = _ms(idle)
+            thread = threading.Thread(target=_interactive, args=(base_url, stop, ttfts))
+            thread.start()
+        start = time.perf_counter()
+        batch = httpx.post(f'{base_url}/v1/batches', content=raw, timeout=60).json()
+        while batch['status'] not in ('completed', 'failed', 'cancelled'):
+            time.sleep(0.05)
+            batch = httpx.get(f"{base_url}/v1/batches/{batch['id']}").json()
+        wall = time.perf_counter() - start
+        stop.set()
+        if interactive:
+            thread.join()
+            result['interactive_during_batch'] = _ms(ttfts)
+        counts = batch['request_counts']
+        result.update({
+            'wall_seconds': round(wall, 2),
+            'requests_per_second': round(counts['completed'] / wall, 1),
+            'completed': counts['completed'],
+            'failed': counts['failed'],
+            'yielded_seconds': httpx.get(f'{base_url}/stats/batch-jobs').json()['yielded_seconds'],
+        })
+        return result
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--ttft', type=float, default=0.05)
+    parser.add_argument('--token-delay', type=float, default=0.005)
+    parser.add_argument('--tokens', type=int, default=10)
+    parser.add_argument('--port', type=int, default=8767, help='server port; the upstream uses the next one')
+    args = parser.parse_args()
+
+    base_url = f'http://127.0.0.1:{args.port}'
+    upstream_url = f'http://127.0.0.1:{args.port + 1}'
+    upstream = subprocess.Popen([
+        sys.executable, 'fake_upstream.py', '--port', str(args.port + 1),
+        '--ttft', str(args.ttft), '--token-delay', str(args.token_delay), '--tokens', str(args.tokens)
+    ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    raw = _batch_file(args.requests)
+    results = {}
+    try:
+        _wait_ready(upstream_url)
+        with tempfile.TemporaryDirectory() as directory:
+            env = dict(os.environ, PORT=str(args.port), API_KEY='', LOG_LEVEL='WARNING', STREAM_DELAY='0',
+                       OPENAI_BASE_URL=f'{upstream_url}/v1', OPENAI_API_KEY='fake', MODEL_NAME=MODEL,
+                       BATCH_JOBS_DIR=directory)
+            for workers in args.workers:
+                results[f'workers_{workers}'] = _run(dict(env, BATCH_JOBS_WORKERS=str(workers)), base_url, raw, False)
+            most = str(max(args.workers))
+            results[f'workers_{most}_with_interactive'] = _run(dict(env, BATCH_JOBS_WORKERS=most), base_url, raw, True)
+            results[f'workers_{most}_with_interactive_yield'] = _run(
+                dict(env, BATCH_JOBS_WORKERS=most, BATCH_JOBS_YIELD_STREAMS='1'), base_url, raw, True
+            )
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+    print(json.dumps({'requests': args.requests, 'upstream_seconds_per_request': round(args.ttft + args.tokens * args.token_delay, 3),
+                      'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+بنشمارك لقياس أثر تجميع الطلبات المتزامنة
+Benchmark: concurrent streams against a local batch backend, unbatched vs the batch scheduler
+
+Starts fake_upstream.py, whose /v1/batch endpoint simulates one accelerator: batches run one
+at a time and a batch costs the same as a single conversation. Each of --concurrency client
+threads streams --requests completions back to back, once straight through BatchBackend
+(every request is a batch of one) and once through BatchScheduler for each --batch-size.
+
+Usage:
+    python bench_batching.py --concurrency 8 32 --batch-size 8 32
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+from batching import BatchScheduler
+from bench_providers import _wait_ready
+from providers import BatchBackend
+
+MESSAGES = [
+    {'role': 'system', 'content': 'أنت مساعد ذكي ومفيد. تحدث بالعربية.'},
+    {'role': 'user', 'content': 'مرحباً، كيف حالك؟'}
+]
+
+
+def _percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def _run(backend, concurrency: int, requests: int):
+    ttfts, totals, tokens = [], [], []
+    lock = threading.Lock()
+
+    def client():
+        for _ in range(requests):
+            start = time.perf_counter()
+            first = None
+            count = 0
+            for _delta in backend.stream(MESSAGES, 'local-bench', 0.7):
+                if first is None:
+                    first = time.perf_counter() - start
+                count += 1
+            with lock:
+                ttfts.append(first)
+                totals.append(time.perf_counter() - start)
+                tokens.append(count)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return {
+        'completions_per_sec': round(len(totals) / elapsed, 1),
+        'tokens_per_sec': round(sum(tokens) / elapsed, 1),
+        'ttft_p50_ms': round(statistics.median(ttfts) * 1000, 1),
+        'ttft_p95_ms': round(_percentile(ttfts, 0.95) * 1000, 1),
+        'latency_p50_ms': round(statistics.median(totals) * 1000, 1),
+        'latency_p95_ms': round(_percentile(totals, 0.95) * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[8, 32])
+    parser.add_argument('--requests', type=int, default=5, help='streams per client thread')
+    parser.add_argument('--batch-size', type=int, nargs='+', default=[8, 32])
+    parser.add_argument('--max-wait-ms', type=float, default=10)
+    parser.add_argument('--ttft', type=float, default=0.05, help='fake prefill time per batch')
+    parser.add_argument('--token-delay', type=float, default=0.01, help='fake decode step per token')
+    parser.add_argument('--tokens', type=int, default=20)
+    parser.add_argument('--port', type=int, default=9101)
+    args = parser.parse_args()
+
+    base_url = f'http://127.0.0.1:{args.port}'
+    upstream = subprocess.Popen([
+        sys.executable, 'fake_upstream.py', '--port', str(args.port), '--ttft', str(args.ttft),
+        '--token-delay', str(args.token_delay), '--tokens', str(args.tokens)
+    ])
+    results = {}
+    try:
+        _wait_ready(base_url)
+        backend = BatchBackend(base_url, pool_size=max(args.concurrency))
+        for concurrency in args.concurrency:
+            row = {'unbatched': _run(backend, concurrency, args.requests)}
+            for batch_size in args.batch_size:
+                scheduler = BatchScheduler(backend, batch_size, args.max_wait_ms / 1000)
+                row[f'batched_{batch_size}'] = _run(scheduler, concurrency, args.requests)
+                row[f'batched_{batch_size}']['mean_batch_size'] = round(scheduler.stats()['mean_batch_size'], 1)
+            results[f'concurrency_{concurrency}'] = row
+        backend.close()
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""
+بنشمارك لإلغاء التوليد عند مقاطعة المتصل
+Benchmark: upstream work saved by cancelling generations when the caller barges in
+
+Starts fake_upstream.py and the server (--server asgi under uvicorn, or flask under its own
+threaded server) and runs --calls concurrent calls of --turns streamed turns. In the barge_in
+run every turn is interrupted with probability --barge-in: the client closes the connection
+after --listen-frames content frames, as Vapi does when the caller starts talking. The listen
+run hears every response to the end. Per run it reports:
+
+    turns_per_second       turns completed or interrupted per second
+    upstream_tokens        tokens the upstream generated per turn
+    heard_tokens           content frames the clients received per turn
+    wasted_tokens          generated but never heard, per turn (what disconnect detection bounds)
+    upstream_abandoned     upstream streams closed before their last token
+    server_cancelled       /stats/cancellations of the server
+
+Without cancellation a barged-in turn costs as many upstream tokens as a heard one. With
+--backend batch the upstream is one simulated accelerator that runs a batch at a time; a batch
+only stops early once all of its callers have gone (a caller that leaves while queued never
+reaches it), so with mixed batches wasted_tokens stays high.
+
+Usage:
+    python bench_cancellation.py --server asgi --backend openai --calls 8 --turns 5
+    python bench_cancellation.py --server flask --backend batch --barge-in 0.8
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from typing import Any, Dict, List
+
+import httpx
+
+
+def _wait(url: str, timeout: float = 20.0) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            httpx.get(url, timeout=1.0)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    raise RuntimeError(f'{url} did not come up')
+
+
+def _turn(client: httpx.Client, url: str, model: str, text: str, leave_after: int) -> int:
+    """Stream one turn; close the connection after leave_after content frames (0: listen to the end)"""
+    body = {'model': model, 'stream': True, 'messages': [{'role': 'user', 'content': text}]}
+    frames = 0
+    with client.stream('POST', url, json=body) as response:
+        for line in response.iter_lines():
+            if line.startswith('data: {') and '"content"' in line:
+                frames += 1
+                if frames == leave_after:
+                    break
+    return frames
+
+
+def run(base: str, upstream: str, model: str, barge_in: float, args: argparse.Namespace) -> Dict[str, Any]:
+    rng = random.Random(args.seed)
+    plans = [[args.listen_frames if rng.random() < barge_in else 0 for _ in range(args.turns)] for _ in range(args.calls)]
+    heard: List[int] = []
+    before_up = httpx.get(upstream + '/stats').json()
+    before_server = httpx.get(base + '/stats/cancellations').json()
+
+    def call(index: int):
+        with httpx.Client(timeout=60) as client:
+            for turn, leave_after in enumerate(plans[index]):
+                text = f'call {index} turn {turn} please confirm the booking'
+                heard.append(_turn(client, base + '/v1/chat/completions', model, text, leave_after))
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(args.calls)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+    # Let the server notice the last disconnects before reading the counters
+    time.sleep(0.5)
+    up = httpx.get(upstream + '/stats').json()
+    server = httpx.get(base + '/stats/cancellations').json()
+    turns = len(heard)
+    generated = up['tokens_generated'] - before_up['tokens_generated']
+    return {
+        'turns': turns,
+        'interrupted_turns': sum(1 for plan in plans for leave_after in plan if leave_after),
+        'turns_per_second': round(turns / wall, 2),
+        'upstream_tokens': round(generated / turns, 1),
+        'heard_tokens': round(sum(heard) / turns, 1),
+        'wasted_tokens': round((generated - sum(heard)) / turns, 1),
+        'upstream_abandoned': up['streams_abandoned'] - before_up['streams_abandoned'],
+        'server_cancelled': {key: value - before_server[key] for key, value in server.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--server', choices=('asgi', 'flask'), default='asgi')
+    parser.add_argument('--backend', choices=('openai', 'batch'), default='openai')
+    parser.add_argument('--calls', type=int, default=8)
+    parser.add_argument('--turns', type=int, default=5)
+    parser.add_argument('--barge-in', type=float, default=0.6, help='share of turns the caller interrupts')
+    parser.add_argument('--listen-frames', type=int, default=6, help='content frames heard before interrupting')
+    parser.add_argument('--tokens', type=int, default=60, help='tokens per full response')
+    parser.add_argument('--ttft', type=float, default=0.1)
+    parser.add_argument('--token-delay', type=float, default=0.02)
+    parser.add_argument('--port', type=int, default=8300)
+    parser.add_argument('--upstream-port', type=int, default=9300)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    upstream = f'http://127.0.0.1:{args.upstream_port}'
+    base = f'http://127.0.0.1:{args.port}'
+    env = dict(os.environ, API_KEY='', PORT=str(args.port), LOG_LEVEL='WARNING', OPENAI_API_KEY='bench')
+    if args.backend == 'batch':
+        model = 'local-bench'
+        env.update(BATCH_BACKEND_URL=upstream, BATCH_MAX_SIZE='8', BATCH_MAX_WAIT_MS='20', BATCH_MAX_CONCURRENT='1')
+    else:
+        model = 'gpt-bench'
+        env.update(OPENAI_BASE_URL=upstream + '/v1', BATCH_MAX_SIZE='1')
+    command = [sys.executable, '-m', 'uvicorn', 'asgi_app:app', '--port', str(args.port)] if args.server == 'asgi' else [sys.executable, 'app.py']
+
+    processes = [subprocess.Popen([
+        sys.executable, 'fake_upstream.py', '--port', str(args.upstream_port), '--ttft', str(args.ttft),
+        '--token-delay', str(args.token_delay), '--tokens', str(args.tokens)
+    ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)]
+    try:
+        _wait(upstream + '/stats')
+        processes.append(subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        _wait(base + '/health')
+        results = {
+            'listen': run(base, upstream, model, 0.0, args),
+            'barge_in': run(base, upstream, model, args.barge_in, args),
+        }
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait()
+    print(json.dumps({'server': args.server, 'backend': args.backend, 'tokens_per_response': args.tokens,
+                      'listen_frames': args.listen_frames, 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+بنشمارك لتقطيع الـ streaming إلى عبارات قابلة للنطق
+Benchmark: SSE frames per response and time to the first speakable segment, per chunking mode
+
+Streams simulated upstream responses (English, Arabic, Chinese; --token-chars characters per
+token, the first after --ttft seconds, then one every --token-delay seconds) through
+CustomLLM._astream_response with each STREAM_CHUNKING setting:
+
+    word      - whitespace-separated words, as cached and echoed responses are replayed
+    token     - one frame per upstream delta (STREAM_CHUNKING=token, the default)
+    phrase    - speakable phrases with the flush timer (STREAM_CHUNK_MAX_DELAY_MS)
+    phrase_no_timer, sentence
+
+and reports, averaged over the texts:
+
+    frames            content frames per response
+    first_frame_ms    until the first content frame
+    first_audio_ms    until the client holds a first segment a TTS would speak: the first frame
+                      for the chunked modes, and for word/token mode the frame that completes
+                      the first phrase (a TTS client has to buffer up to the punctuation itself)
+
+The "late" texts only reach their first punctuation after a long clause, which shows the
+flush timer.
+
+Usage:
+    python bench_chunking.py --token-delay 0.03 --max-delay-ms 300
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import statistics
+import time
+from typing import Any, AsyncIterator, Dict
+
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ['API_KEY'] = ''
+
+from app import llm  # noqa: E402
+from chunking import Chunker, StreamChunking  # noqa: E402
+
+TEXTS = {
+    'english': 'Sure, I can help with that. Your appointment is booked for tomorrow at 10:30. '
+               'Is there anything else I can do for you today?',
+    'arabic': 'بالتأكيد، يمكنني مساعدتك في ذلك. تم حجز موعدك غداً الساعة العاشرة والنصف. '
+              'هل هناك أي شيء آخر يمكنني مساعدتك به اليوم؟',
+    'chinese': '好的，我可以帮您处理。您的预约已经安排在明天上午十点半。今天还有什么可以帮您的吗？',
+    'english_late': 'Let me quickly check the available appointment slots for the clinic next week before '
+                    'I confirm anything, so please hold on. I found three options for you.',
+    'arabic_late': 'دعني أتحقق بسرعة من المواعيد المتاحة في العيادة خلال الأسبوع القادم قبل أن أؤكد أي شيء '
+                   'لذا يرجى الانتظار قليلاً. وجدت لك ثلاثة خيارات.',
+}
+
+
+async def _upstream(text: str, token_chars: int, ttft: float, token_delay: float) -> AsyncIterator[str]:
+    await asyncio.sleep(ttft)
+    for i in range(0, len(text), token_chars):
+        if i:
+            await asyncio.sleep(token_delay)
+        yield text[i:i + token_chars]
+
+
+async def _words(deltas: AsyncIterator[str]) -> AsyncIterator[str]:
+    # Word-by-word frames: each word is sent once the whitespace after it has arrived
+    buffer = ''
+    async for delta in deltas:
+        buffer += delta
+        words = re.findall(r'\s*\S+\s+', buffer)
+        for word in words:
+            yield word
+        buffer = buffer[sum(len(word) for word in words):]
+    if buffer:
+        yield buffer
+
+
+def _first_phrase_end(text: str) -> int:
+    # Where the first speakable phrase of text ends, as phrase mode would cut it
+    chunker = Chunker('phrase', 12, 10 ** 6, 0)
+    for end, char in enumerate(text, 1):
+        segments = chunker.feed(char, 0.0)
+        if segments:
+            return end - len(chunker.buffer)
+    return len(text)
+
+
+async def _measure(text: str, mode: str, chunking: Any, args: argparse.Namespace) -> Dict[str, float]:
+    llm.chunking = chunking
+    deltas = _upstream(text, args.token_chars, args.ttft, args.token_delay)
+    if mode == 'word':
+        deltas = _words(deltas)
+    phrase_end = _first_phrase_end(text)
+    received = ''
+    frames = 0
+    first_frame = first_audio = None
+    started = time.perf_counter()
+    async for frame in llm._astream_response(deltas, 'custom-llm', started):
+        payload = json.loads(frame[6:]) if frame.startswith('data: {') else None
+        content = payload['choices'][0]['delta'].get('content') if payload and payload.get('choices') else None
+        if not content:
+            continue
+        now = time.perf_counter() - started
+        frames += 1
+        received += content
+        if first_frame is None:
+            first_frame = now
+        if first_audio is None and (chunking is not None or len(received) >= phrase_end):
+            first_audio = now
+    assert received == text
+    return {'frames': frames, 'first_frame_ms': first_frame * 1000, 'first_audio_ms': first_audio * 1000}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--token-chars', type=int, default=4)
+    parser.add_argument('--ttft', type=float, default=0.2)
+    parser.add_argument('--token-delay', type=float, default=0.03)
+    parser.add_argument('--max-delay-ms', type=float, default=300)
+    parser.add_argument('--min-chars', type=int, default=12)
+    args = parser.parse_args()
+
+    modes = {
+        'word': None,
+        'token': None,
+        'phrase': StreamChunking('phrase', args.min_chars, 160, args.max_delay_ms / 1000),
+        'phrase_no_timer': StreamChunking('phrase', args.min_chars, 160, 0),
+        'sentence': StreamChunking('sentence', args.min_chars, 160, args.max_delay_ms / 1000),
+    }
+    results: Dict[str, Any] = {}
+    for mode, chunking in modes.items():
+        per_text: Dict[str, Any] = {}
+        for name, text in TEXTS.items():
+            per_text[name] = {k: round(v, 1) for k, v in (await _measure(text, mode, chunking, args)).items()}
+        results[mode] = {
+            'frames_avg': round(statistics.mean(r['frames'] for r in per_text.values()), 1),
+            'first_audio_ms_avg': round(statistics.mean(r['first_audio_ms'] for r in per_text.values()), 1),
+            'texts': per_text,
+        }
+    llm.chunking = None
+    print(json.dumps({'token_chars': args.token_chars, 'ttft_ms': args.ttft * 1000,
+                      'token_delay_ms': args.token_delay * 1000, 'results': results}, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,125 @@
+"""
+بنشمارك لقياس عدد الـ streams المتزامنة
+Load benchmark: concurrent SSE stream capacity of the Flask server (app.py) vs the ASGI server (asgi_app.py)
+
+Each server is started in a subprocess, then N concurrent streaming /v1/chat/completions
+requests are opened at once. For every level of concurrency the script reports wall time,
+completed/failed streams, p50/p99 time-to-first-chunk and the server's peak thread count.
+
+Usage:
+    python bench_concurrency.py --levels 50 200 1000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+SERVERS = {
+    'flask': [sys.executable, 'app.py'],
+    'asgi': [sys.executable, '-m', 'uvicorn', 'asgi_app:app', '--log-level', 'warning'],
+}
+
+PAYLOAD = {
+    'model': 'custom-llm-v1',
+    'messages': [{'role': 'user', 'content': 'مرحباً، كيف حالك؟'}],
+    'stream': True
+}
+
+
+def _thread_count(pid: int) -> int:
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('Threads:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+async def _one_stream(client: httpx.AsyncClient, url: str):
+    start = time.perf_counter()
+    ttfc = None
+    async with client.stream('POST', url, json=PAYLOAD) as response:
+        if response.status_code != 200:
+            raise RuntimeError(f'HTTP {response.status_code}')
+        async for line in response.aiter_lines():
+            if line.startswith('data: ') and ttfc is None:
+                ttfc = time.perf_counter() - start
+            if line == 'data: [DONE]':
+                break
+    return ttfc
+
+
+async def _run_level(url: str, concurrency: int, pid: int):
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    peak_threads = 0
+    async with httpx.AsyncClient(limits=limits, timeout=120) as client:
+        start = time.perf_counter()
+        tasks = [asyncio.create_task(_one_stream(client, url)) for _ in range(concurrency)]
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=0.1)
+            peak_threads = max(peak_threads, _thread_count(pid))
+        wall = time.perf_counter() - start
+
+    ttfcs = sorted(t.result() for t in tasks if not t.exception() and t.result() is not None)
+    failed = sum(1 for t in tasks if t.exception())
+    return {
+        'concurrency': concurrency,
+        'wall_seconds': round(wall, 3),
+        'completed': len(ttfcs),
+        'failed': failed,
+        'ttfc_p50_ms': round(statistics.median(ttfcs) * 1000, 1) if ttfcs else None,
+        'ttfc_p99_ms': round(ttfcs[int(len(ttfcs) * 0.99) - 1] * 1000, 1) if ttfcs else None,
+        'peak_server_threads': peak_threads,
+    }
+
+
+def _wait_ready(base_url: str, timeout: float = 15.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if httpx.get(f'{base_url}/health').status_code == 200:
+                return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f'Server at {base_url} did not become ready')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--levels', type=int, nargs='+', default=[50, 200, 500])
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--servers', nargs='+', default=list(SERVERS), choices=list(SERVERS))
+    args = parser.parse_args()
+
+    base_url = f'http://127.0.0.1:{args.port}'
+    env = dict(os.environ, PORT=str(args.port), HOST='127.0.0.1', API_KEY='')
+    results = {}
+
+    for name in args.servers:
+        cmd = SERVERS[name] + (['--port', str(args.port)] if name == 'asgi' else [])
+        proc = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            _wait_ready(base_url)
+            results[name] = [
+                asyncio.run(_run_level(f'{base_url}/v1/chat/completions', level, proc.pid))
+                for level in args.levels
+            ]
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+بنشمارك لإدارة نافذة السياق في المكالمات الطويلة
+Benchmark: prompt tokens and per-turn overhead of context window management over a long call
+
+Simulates one call of --turns turns through CustomLLM.generate_response (demo echo backend, no
+network) three times: without a context budget, with a budget of --limit tokens (older turns
+dropped) and with the same budget plus rolling summaries. Per turn it records the prompt tokens
+of the full history, the tokens actually sent and the time generate_response took, and prints
+a few sample turns and the totals. Turns are spaced by --gap seconds so background summaries
+can finish, as they would between the turns of a real call.
+
+The echo backend answers instantly, so the timings show the cost this server adds per turn;
+the upstream time saved by the shorter prompts depends on the model (prefill is roughly
+linear in prompt tokens) and is not simulated.
+
+Usage:
+    python bench_context.py --turns 200 --limit 4000
+"""
+
+import argparse
+import json
+import os
+import statistics
+import time
+from typing import Any, Dict, List
+
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ['STREAM_DELAY'] = '0'
+os.environ['API_KEY'] = ''
+
+from app import llm  # noqa: E402
+from context_window import ContextManager  # noqa: E402
+
+USER_TURN = 'المستخدم يسأل عن موعد الحجز رقم {i} وعن تفاصيل الدفع والعنوان. '
+SYSTEM = 'أنت مساعد صوتي ذكي لشركة حجوزات. أجب باختصار وبالعربية.'
+
+
+def run(turns: int, manager: Any, gap: float) -> List[Dict[str, float]]:
+    llm.context = manager
+    call_id = f'bench-{id(manager)}'
+    messages: List[Dict[str, Any]] = [{'role': 'system', 'content': SYSTEM}]
+    rows = []
+    for i in range(turns):
+        messages = messages + [{'role': 'user', 'content': USER_TURN.format(i=i) * 2}]
+        start = time.perf_counter()
+        reply = llm.generate_response(messages, stream=False, session_id=call_id)
+        elapsed = time.perf_counter() - start
+        usage = llm.usage(messages, llm.default_model, reply, call_id)
+        full = llm.tokenizers.for_model(llm.default_model).count_messages(messages)
+        rows.append({'turn': i + 1, 'messages': len(messages), 'full_tokens': full,
+                     'sent_tokens': usage['prompt_tokens'], 'turn_us': elapsed * 1e6})
+        messages = messages + [{'role': 'assistant', 'content': reply}]
+        if gap:
+            time.sleep(gap)
+    llm.sessions.end(call_id)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--turns', type=int, default=200)
+    parser.add_argument('--limit', type=int, default=4000, help='context limit in tokens')
+    parser.add_argument('--reserve', type=int, default=1024)
+    parser.add_argument('--gap', type=float, default=0.005, help='seconds between turns')
+    args = parser.parse_args()
+
+    configs = {
+        'unlimited': None,
+        'trim': ContextManager([], default_limit=args.limit, reserve=args.reserve),
+        'summarize': ContextManager([], default_limit=args.limit, reserve=args.reserve, summarizer=llm._summarize),
+    }
+    results = {}
+    for name, manager in configs.items():
+        rows = run(args.turns, manager, args.gap)
+        late = rows[len(rows) // 2:]
+        results[name] = {
+            'sample_turns': [rows[i] for i in sorted({0, 9, 49, len(rows) // 2, len(rows) - 1}) if i < len(rows)],
+            'full_tokens_total': sum(r['full_tokens'] for r in rows),
+            'sent_tokens_total': sum(r['sent_tokens'] for r in rows),
+            'tokens_saved_per_turn': round(sum(r['full_tokens'] - r['sent_tokens'] for r in rows) / len(rows), 1),
+            'turn_us_median': round(statistics.median(r['turn_us'] for r in rows), 1),
+            'turn_us_median_second_half': round(statistics.median(r['turn_us'] for r in late), 1),
+            'context_stats': manager.stats() if manager else None,
+        }
+        for row in results[name]['sample_turns']:
+            row['turn_us'] = round(row['turn_us'], 1)
+    print(json.dumps({'turns': args.turns, 'limit': args.limit, 'reserve': args.reserve, 'results': results},
+                     indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,366 @@
+"""
+أداة اختبار الحمل والأداء
+Load-testing harness for /v1/chat/completions (streaming and non-streaming) and /vapi/custom-llm
+
+Simulates callers as closed-loop workers: each worker runs conversations of --turns turns, one
+request at a time, against a running server (--url) or one started here (--server flask|asgi).
+Every conversation sends its own X-Call-Id, and after each turn the reply and a next user
+utterance are appended, so later turns carry the growing history like a real call.
+
+Requests are drawn from --mix (scenario weights) and payloads from --payloads: JSON files
+holding one chat request body, or JSONL files with one body per line (lines without a
+"messages" list are skipped). For each --concurrency level the report gives throughput,
+p50/p95/p99 latency, time-to-first-token for streams, and error rates by code, as JSON.
+
+Regression comparison across commits:
+    python bench_load.py --server asgi --output baseline.json
+    git checkout <other commit>
+    python bench_load.py --server asgi --compare baseline.json --max-regression 10
+
+--compare prints the change of every metric and exits with status 1 when a latency grew, the
+throughput fell, or the error rate rose by more than --max-regression percent.
+
+Usage:
+    python bench_load.py --url http://localhost:8000 --concurrency 1 8 32 --duration 20
+    python bench_load.py --server flask --mix chat=1,chat-stream=3,vapi=1 --turns 6
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+from dotenv import load_dotenv
+
+from bench_concurrency import SERVERS, _wait_ready
+
+SCENARIOS = {
+    # name -> (path, stream)
+    'chat': ('/v1/chat/completions', False),
+    'chat-stream': ('/v1/chat/completions', True),
+    'vapi': ('/vapi/custom-llm', False),
+}
+
+FOLLOW_UPS = ['نعم، من فضلك.', 'وماذا بعد ذلك؟', 'Can you repeat that?', 'شكراً جزيلاً']
+
+
+def _percentile(samples: List[float], q: float) -> Optional[float]:
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def _ms(value: Optional[float]) -> Optional[float]:
+    return round(value * 1000, 1) if value is not None else None
+
+
+def load_payloads(paths: List[str]) -> List[Dict[str, Any]]:
+    """Chat request bodies from .json (one body) and .jsonl (one body per line) files"""
+    payloads = []
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            if path.endswith('.jsonl'):
+                bodies = [json.loads(line) for line in f if line.strip()]
+            else:
+                bodies = [json.load(f)]
+        usable = [body for body in bodies if isinstance(body.get('messages'), list) and body['messages']]
+        if len(usable) < len(bodies):
+            print(f"Skipped {len(bodies) - len(usable)} entries without messages in {path}", file=sys.stderr)
+        payloads.extend(usable)
+    if not payloads:
+        raise SystemExit('No usable payloads (each needs a non-empty "messages" list)')
+    return payloads
+
+
+def parse_mix(spec: str) -> List[Tuple[str, float]]:
+    """"chat=1,chat-stream=3" -> [(scenario, weight)]"""
+    mix = []
+    for part in spec.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise SystemExit(f'Unknown scenario {name!r}; choose from {", ".join(SCENARIOS)}')
+        mix.append((name, float(weight or 1)))
+    return mix
+
+
+class _Stats:
+    """Samples of one scenario at one concurrency level"""
+
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.ttfts: List[float] = []
+        self.errors: Dict[str, int] = {}
+        self.requests = 0
+
+    def error(self, code: str) -> None:
+        self.errors[code] = self.errors.get(code, 0) + 1
+
+    def report(self, elapsed: float) -> Dict[str, Any]:
+        failed = sum(self.errors.values())
+        return {
+            'requests': self.requests,
+            'errors': failed,
+            'error_rate': round(failed / self.requests, 4) if self.requests else None,
+            'errors_by_code': dict(sorted(self.errors.items())),
+            'throughput_rps': round((self.requests - failed) / elapsed, 2),
+            'latency_p50_ms': _ms(_percentile(self.latencies, 0.50)),
+            'latency_p95_ms': _ms(_percentile(self.latencies, 0.95)),
+            'latency_p99_ms': _ms(_percentile(self.latencies, 0.99)),
+            'latency_mean_ms': _ms(statistics.mean(self.latencies)) if self.latencies else None,
+            'ttft_p50_ms': _ms(_percentile(self.ttfts, 0.50)),
+            'ttft_p95_ms': _ms(_percentile(self.ttfts, 0.95)),
+            'ttft_p99_ms': _ms(_percentile(self.ttfts, 0.99)),
+        }
+
+
+def _error_code(response: httpx.Response) -> str:
+    try:
+        error = response.json().get('error')
+    except ValueError:
+        error = None
+    code = error.get('code') if isinstance(error, dict) else None
+    return f'http_{response.status_code}' + (f'_{code}' if code else '')
+
+
+async def _request(client: httpx.AsyncClient, scenario: str, body: Dict[str, Any], headers: Dict[str, str], stats: _Stats) -> Optional[str]:
+    """Send one request and record it; returns the reply text, or None on error"""
+    path, stream = SCENARIOS[scenario]
+    body = dict(body, stream=stream)
+    stats.requests += 1
+    start = time.perf_counter()
+    try:
+        if not stream:
+            response = await client.post(path, json=body, headers=headers)
+            if response.status_code != 200:
+                stats.error(_error_code(response))
+                return None
+            data = response.json()
+            stats.latencies.append(time.perf_counter() - start)
+            return data['response'] if scenario == 'vapi' else data['choices'][0]['message']['content']
+        parts = []
+        async with client.stream('POST', path, json=body, headers=headers) as response:
+            if response.status_code != 200:
+                await response.aread()
+                stats.error(_error_code(response))
+                return None
+            async for line in response.aiter_lines():
+                if not line.startswith('data: '):
+                    continue
+                if line == 'data: [DONE]':
+                    break
+                chunk = json.loads(line[6:])
+                if 'error' in chunk:
+                    stats.error(f"stream_{chunk['error'].get('code') or 'error'}")
+                    return None
+                content = chunk['choices'][0]['delta'].get('content') if chunk.get('choices') else None
+                if content:
+                    if not parts:
+                        stats.ttfts.append(time.perf_counter() - start)
+                    parts.append(content)
+        stats.latencies.append(time.perf_counter() - start)
+        return ''.join(parts)
+    except httpx.TimeoutException:
+        stats.error('timeout')
+    except httpx.HTTPError:
+        stats.error('connection_error')
+    except (ValueError, KeyError, IndexError, TypeError):
+        stats.error('invalid_response')
+    return None
+
+
+async def _caller(
+    client: httpx.AsyncClient,
+    rng: random.Random,
+    args: argparse.Namespace,
+    payloads: List[Dict[str, Any]],
+    mix: List[Tuple[str, float]],
+    stats: Dict[str, _Stats],
+    deadline: float,
+    budget: itertools.count
+) -> None:
+    names, weights = zip(*mix)
+    utterances = [m['content'] for p in payloads for m in p['messages'] if m.get('role') == 'user'] or FOLLOW_UPS
+    while time.perf_counter() < deadline:
+        base = rng.choice(payloads)
+        body = {key: value for key, value in base.items() if key != 'stream'}
+        messages = list(base['messages'])
+        headers = {'X-Call-Id': f'load-{uuid.uuid4().hex}', **args.headers}
+        for _ in range(args.turns):
+            if next(budget) >= args.requests or time.perf_counter() >= deadline:
+                return
+            scenario = rng.choices(names, weights)[0]
+            reply = await _request(client, scenario, dict(body, messages=messages), headers, stats[scenario])
+            if reply is None:
+                break  # a failed turn ends the call
+            messages = messages + [
+                {'role': 'assistant', 'content': reply},
+                {'role': 'user', 'content': rng.choice(utterances)}
+            ]
+        if args.think_time:
+            await asyncio.sleep(args.think_time)
+
+
+async def run_level(base_url: str, concurrency: int, args: argparse.Namespace, payloads, mix) -> Dict[str, Any]:
+    rng = random.Random(args.seed)
+    stats = {name: _Stats() for name, _ in mix}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=args.timeout) as client:
+        # Warm-up requests are not recorded
+        warmup = {name: _Stats() for name, _ in mix}
+        for _ in range(args.warmup):
+            await _request(client, mix[0][0], payloads[0], args.headers, warmup[mix[0][0]])
+        budget = itertools.count()
+        start = time.perf_counter()
+        deadline = start + args.duration
+        await asyncio.gather(*(
+            _caller(client, random.Random(rng.random()), args, payloads, mix, stats, deadline, budget)
+            for _ in range(concurrency)
+        ))
+        elapsed = time.perf_counter() - start
+
+    total = _Stats()
+    for s in stats.values():
+        total.requests += s.requests
+        total.latencies += s.latencies
+        total.ttfts += s.ttfts
+        for code, count in s.errors.items():
+            total.errors[code] = total.errors.get(code, 0) + count
+    report = {'elapsed_seconds': round(elapsed, 2), 'all': total.report(elapsed)}
+    report.update((name, s.report(elapsed)) for name, s in stats.items())
+    return report
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Metric -> direction in which it gets worse
+_COMPARED = {
+    'latency_p50_ms': 1, 'latency_p95_ms': 1, 'latency_p99_ms': 1,
+    'ttft_p50_ms': 1, 'ttft_p95_ms': 1, 'ttft_p99_ms': 1,
+    'throughput_rps': -1, 'error_rate': 1,
+}
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], max_regression: float) -> List[str]:
+    """Print metric changes against a baseline report; returns the regressions"""
+    regressions = []
+    for level, scenarios in current['results'].items():
+        for scenario, metrics in scenarios.items():
+            if not isinstance(metrics, dict):
+                continue
+            before = baseline.get('results', {}).get(level, {}).get(scenario)
+            if not isinstance(before, dict):
+                continue
+            for metric, worse in _COMPARED.items():
+                old, new = before.get(metric), metrics.get(metric)
+                if old is None or new is None:
+                    continue
+                if metric == 'error_rate':
+                    # Percentage points, so a baseline of 0 errors still compares
+                    change = (new - old) * 100
+                    label = f'{change:+.2f} pp'
+                elif old:
+                    change = (new - old) / old * 100
+                    label = f'{change:+.1f}%'
+                else:
+                    continue
+                flag = ''
+                if change * worse > max_regression:
+                    flag = '  <-- REGRESSION'
+                    regressions.append(f'{level} {scenario} {metric}')
+                print(f'{level:>16} {scenario:<12} {metric:<16} {old:>10} -> {new:<10} {label}{flag}', file=sys.stderr)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument('--url', default=None, help='running server (default: http://localhost:8000)')
+    target.add_argument('--server', choices=list(SERVERS), help='start this server locally for the run')
+    parser.add_argument('--port', type=int, default=8766, help='port for --server')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32], help='concurrent callers per level')
+    parser.add_argument('--duration', type=float, default=15, help='seconds per level')
+    parser.add_argument('--requests', type=int, default=10 ** 9, help='stop a level after this many requests')
+    parser.add_argument('--turns', type=int, default=4, help='requests per conversation')
+    parser.add_argument('--mix', default='chat=1,chat-stream=2,vapi=1', help='scenario weights')
+    parser.add_argument('--payloads', nargs='+', default=['example_request.json'], help='.json / .jsonl request bodies')
+    parser.add_argument('--api-key', default=None, help='default: API_KEY from .env')
+    parser.add_argument('--think-time', type=float, default=0.0, help='pause between conversations (seconds)')
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the JSON report here as well')
+    parser.add_argument('--compare', help='baseline report to compare against')
+    parser.add_argument('--max-regression', type=float, default=10, help='allowed regression in percent')
+    args = parser.parse_args()
+
+    load_dotenv()
+    api_key = args.api_key if args.api_key is not None else os.getenv('API_KEY', '')
+    args.headers = {'Authorization': f'Bearer {api_key}'} if api_key else {}
+    payloads = load_payloads(args.payloads)
+    mix = parse_mix(args.mix)
+
+    proc = None
+    base_url = args.url or 'http://localhost:8000'
+    if args.server:
+        base_url = f'http://127.0.0.1:{args.port}'
+        env = dict(os.environ, PORT=str(args.port), HOST='127.0.0.1', API_KEY=api_key)
+        cmd = SERVERS[args.server] + (['--port', str(args.port)] if args.server == 'asgi' else [])
+        proc = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        _wait_ready(base_url)
+        results = {
+            f'concurrency_{level}': asyncio.run(run_level(base_url, level, args, payloads, mix))
+            for level in args.concurrency
+        }
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+    report = {
+        'meta': {
+            'commit': _git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'target': args.server or base_url,
+            'python': platform.python_version(),
+            'mix': args.mix,
+            'turns': args.turns,
+            'duration_seconds': args.duration,
+            'payloads': args.payloads,
+        },
+        'results': results,
+    }
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        print(f"\nCompared with {args.compare} (commit {baseline.get('meta', {}).get('commit')}):", file=sys.stderr)
+        regressions = compare(baseline, report, args.max_regression)
+        if regressions:
+            print(f'{len(regressions)} regressions over {args.max_regression}%', file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
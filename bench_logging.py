@@ -0,0 +1,130 @@
+"""
+بنشمارك لقياس تكلفة الـ logging على زمن الطلب
+Benchmark: request overhead of logging on vs off for long Vapi conversations
+
+Sends --requests /vapi/custom-llm requests, each carrying a conversation of --messages
+messages, through Flask's test client (no network) under several logging configurations.
+Each configuration runs in its own process, because logging is configured when app.py is
+imported. Logs go to a temporary file, so the writes are real.
+
+log_call_us is the time the request thread spends in the body log call itself. request_cpu_us
+is the CPU time of the request thread per request, i.e. the cost on the request path, and
+total_cpu_us adds the log writer thread; CPU times are steadier than wall-clock latency on a
+shared machine, but full-request figures still vary by about 10% between runs.
+
+    off           LOG_LEVEL=WARNING: no request logging at all
+    sync-full     the previous behaviour: synchronous writes, whole body serialized per request
+    sync-text     synchronous writes, body truncated to LOG_BODY_MAX_CHARS
+    async-text    the default: queued records, truncated body serialized on the writer thread
+    async-json    JSON lines, 10% of bodies sampled
+
+Async writing moves formatting and I/O off the request path but not off the machine: on a
+single core the writer thread still competes for the same CPU. Truncation and sampling
+reduce the work itself.
+
+Usage:
+    python bench_logging.py --messages 200 --requests 2000
+"""
+
+import argparse
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+CONFIGS = {
+    'off': {'LOG_LEVEL': 'WARNING'},
+    'sync-full': {'LOG_ASYNC': 'false', 'LOG_BODY_MAX_CHARS': '0'},
+    'sync-text': {'LOG_ASYNC': 'false'},
+    'async-text': {},
+    'async-json': {'LOG_FORMAT': 'json', 'LOG_BODY_SAMPLE': '0.1'},
+}
+
+
+def _worker(messages: int, requests: int) -> None:
+    from app import app, logger
+    from logging_setup import log_body
+
+    conversation = [{'role': 'system', 'content': 'أنت مساعد ذكي ومفيد. تحدث بالعربية.'}]
+    for i in range(messages - 1):
+        role = 'user' if i % 2 == 0 else 'assistant'
+        conversation.append({'role': role, 'content': f'رسالة رقم {i}: ' + 'هذا نص تجريبي لمحادثة طويلة. ' * 4})
+    body = {'messages': conversation}
+
+    # The body log call alone, as made on the request path
+    log_start = time.perf_counter()
+    for _ in range(requests):
+        log_body(logger, 'Received Vapi request', body)
+    log_call = time.perf_counter() - log_start
+
+    client = app.test_client()
+    for _ in range(50):
+        client.post('/vapi/custom-llm', json=body)
+    time.sleep(1)  # let the writer thread catch up before measuring
+    log_size = os.path.getsize(os.environ['LOG_FILE'])
+    samples = []
+    thread_cpu = time.thread_time()
+    process_cpu = time.process_time()
+    for _ in range(requests):
+        start = time.perf_counter()
+        client.post('/vapi/custom-llm', json=body)
+        samples.append(time.perf_counter() - start)
+    thread_cpu = time.thread_time() - thread_cpu
+    logging.shutdown()  # the writer thread's remaining work counts towards process CPU
+    process_cpu = time.process_time() - process_cpu
+    samples.sort()
+    print(json.dumps({
+        'log_call_us': round(log_call / requests * 1e6, 2),
+        'request_cpu_us': round(thread_cpu / requests * 1e6, 1),
+        'total_cpu_us': round(process_cpu / requests * 1e6, 1),
+        'p50_us': round(samples[len(samples) // 2] * 1e6, 1),
+        'p99_us': round(samples[int(len(samples) * 0.99)] * 1e6, 1),
+        'log_mb': round((os.path.getsize(os.environ['LOG_FILE']) - log_size) / 1e6, 2),
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=200, help='messages per conversation')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        _worker(args.messages, args.requests)
+        return
+
+    runs: Dict[str, List[Dict[str, float]]] = {name: [] for name in CONFIGS}
+    with tempfile.TemporaryDirectory() as tmp:
+        # Configurations take turns, so drift in machine load spreads over all of them
+        for _ in range(args.rounds):
+            for name, config in CONFIGS.items():
+                log_file = os.path.join(tmp, f'{name}.log')
+                env = dict(os.environ, API_KEY='', STREAM_DELAY='0', LOG_FILE=log_file, **config)
+                out = subprocess.run(
+                    [sys.executable, __file__, '--worker', '--messages', str(args.messages), '--requests', str(args.requests)],
+                    env=env, capture_output=True, text=True, check=True
+                ).stdout
+                runs[name].append(json.loads(out.strip().splitlines()[-1]))
+                os.remove(log_file)
+
+    # Median over rounds of each figure
+    results = {
+        name: {key: statistics.median(run[key] for run in rows) for key in rows[0]}
+        for name, rows in runs.items()
+    }
+    off = results['off']
+    for row in results.values():
+        row['request_overhead_us'] = round(row['request_cpu_us'] - off['request_cpu_us'], 1)
+        row['total_overhead_us'] = round(row['total_cpu_us'] - off['total_cpu_us'], 1)
+    print(json.dumps({'messages': args.messages, 'requests': args.requests, 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
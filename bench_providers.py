@@ -0,0 +1,100 @@
+"""
+بنشمارك لقياس تكلفة الاتصال لكل طلب
+Benchmark: per-turn latency with a fresh HTTP client per call vs the pooled provider backends
+
+Starts fake_upstream.py locally and runs sequential turns against each adapter, once building
+a new client for every call (what example_integrations.py does) and once through the pooled
+keep-alive client in providers.py.
+
+Usage:
+    python bench_providers.py --turns 200
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+from providers import AnthropicBackend, OllamaBackend, OpenAIBackend
+
+MESSAGES = [
+    {'role': 'system', 'content': 'أنت مساعد ذكي ومفيد. تحدث بالعربية.'},
+    {'role': 'user', 'content': 'مرحباً، كيف حالك؟'}
+]
+
+
+def _wait_ready(base_url: str, timeout: float = 15.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            httpx.get(f'{base_url}/stats')
+            return
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    raise RuntimeError('fake upstream did not start')
+
+
+def _summary(samples):
+    samples = sorted(samples)
+    return {
+        'p50_ms': round(statistics.median(samples) * 1000, 3),
+        'p99_ms': round(samples[int(len(samples) * 0.99) - 1] * 1000, 3),
+        'mean_ms': round(statistics.mean(samples) * 1000, 3),
+    }
+
+
+def _time_turns(fn, turns):
+    samples = []
+    for _ in range(turns):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return _summary(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--turns', type=int, default=200)
+    parser.add_argument('--port', type=int, default=9100)
+    args = parser.parse_args()
+
+    base_url = f'http://127.0.0.1:{args.port}'
+    upstream = subprocess.Popen([sys.executable, 'fake_upstream.py', '--port', str(args.port)])
+    results = {}
+    try:
+        _wait_ready(base_url)
+        adapters = [
+            OpenAIBackend(f'{base_url}/v1', api_key='fake'),
+            AnthropicBackend(base_url, api_key='fake'),
+            OllamaBackend(base_url),
+        ]
+        for backend in adapters:
+            path, body = backend._build_request(MESSAGES, 'bench-model', 0.0, stream=False)
+
+            def fresh_client():
+                # New connection (and on HTTPS, a new TLS handshake) every turn
+                with httpx.Client(base_url=backend.base_url, headers=backend._headers()) as client:
+                    client.post(path, json=body).json()
+
+            def pooled():
+                backend.complete(MESSAGES, 'bench-model', 0.0)
+
+            pooled()  # warm the pool
+            results[backend.name] = {
+                'fresh_client': _time_turns(fresh_client, args.turns),
+                'pooled': _time_turns(pooled, args.turns),
+            }
+            backend.close()
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""
+بنشمارك لقياس أثر الـ fallback والـ hedged requests على زمن أول token
+Benchmark: first-token tail latency and error rate with a single backend vs a fallback chain vs hedging
+
+Starts two fake_upstream.py servers: a primary whose first token is slow (--slow-ttft) for a
+--slow-fraction of requests and which fails --fail-fraction of them, and a steady secondary.
+--concurrency client threads stream --requests completions each, straight to the primary, then
+through a FallbackRoute (sequential fallback) and a hedged FallbackRoute. Extra upstream calls
+are the secondary's request count relative to the number of completions.
+
+Usage:
+    python bench_routing.py --requests 50 --slow-fraction 0.1 --slow-ttft 1.5 --fail-fraction 0.05
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+import httpx
+
+from bench_providers import _wait_ready
+from providers import OpenAIBackend, ProviderError
+from routing import FallbackRoutes, HedgePolicy
+
+MESSAGES = [
+    {'role': 'system', 'content': 'أنت مساعد ذكي ومفيد. تحدث بالعربية.'},
+    {'role': 'user', 'content': 'مرحباً، كيف حالك؟'}
+]
+
+
+def _percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def _run(backend, concurrency: int, requests: int):
+    ttfts, errors = [], [0]
+    lock = threading.Lock()
+
+    def client():
+        for _ in range(requests):
+            start = time.perf_counter()
+            first = None
+            try:
+                for _delta in backend.stream(MESSAGES, 'bench', 0.7):
+                    if first is None:
+                        first = time.perf_counter() - start
+            except ProviderError:
+                with lock:
+                    errors[0] += 1
+                continue
+            with lock:
+                ttfts.append(first)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {
+        'errors': errors[0],
+        'ttft_p50_ms': round(statistics.median(ttfts) * 1000, 1),
+        'ttft_p95_ms': round(_percentile(ttfts, 0.95) * 1000, 1),
+        'ttft_p99_ms': round(_percentile(ttfts, 0.99) * 1000, 1),
+        'ttft_max_ms': round(max(ttfts) * 1000, 1),
+    }
+
+
+def _upstream_requests(base_url: str) -> int:
+    return httpx.get(f'{base_url}/stats').json()['requests']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=50, help='streams per client thread')
+    parser.add_argument('--ttft', type=float, default=0.05, help='usual first-token time of both upstreams')
+    parser.add_argument('--slow-fraction', type=float, default=0.1)
+    parser.add_argument('--slow-ttft', type=float, default=1.5)
+    parser.add_argument('--fail-fraction', type=float, default=0.05)
+    parser.add_argument('--hedge-quantile', type=float, default=0.95)
+    parser.add_argument('--port', type=int, default=9102, help='primary port; the secondary uses the next one')
+    args = parser.parse_args()
+
+    primary_url = f'http://127.0.0.1:{args.port}'
+    secondary_url = f'http://127.0.0.1:{args.port + 1}'
+    common = ['--ttft', str(args.ttft), '--token-delay', '0.005', '--tokens', '10', '--seed', '1']
+    upstreams = [
+        subprocess.Popen([
+            sys.executable, 'fake_upstream.py', '--port', str(args.port), *common,
+            '--slow-fraction', str(args.slow_fraction), '--slow-ttft', str(args.slow_ttft),
+            '--fail-fraction', str(args.fail_fraction)
+        ]),
+        subprocess.Popen([sys.executable, 'fake_upstream.py', '--port', str(args.port + 1), *common]),
+    ]
+    results = {}
+    completions = args.concurrency * args.requests
+    try:
+        _wait_ready(primary_url)
+        _wait_ready(secondary_url)
+        primary = OpenAIBackend(f'{primary_url}/v1', api_key='fake', pool_size=2 * args.concurrency)
+        secondary = OpenAIBackend(f'{secondary_url}/v1', api_key='fake', pool_size=2 * args.concurrency)
+
+        results['single_backend'] = _run(primary, args.concurrency, args.requests)
+        for name, hedge in [('fallback', None), ('hedged', HedgePolicy(args.hedge_quantile, 0.02, 1.0))]:
+            # Breakers stay closed: the primary's failures are spread out, not consecutive
+            routes = FallbackRoutes([('bench', ('secondary',))], failures=10, hedge=hedge)
+            route, _ = routes.wrap('bench', primary, 'bench', lambda model: (secondary, 'bench'))
+            before = _upstream_requests(secondary_url)
+            results[name] = _run(route, args.concurrency, args.requests)
+            results[name]['extra_upstream_calls_pct'] = round(100 * (_upstream_requests(secondary_url) - before) / completions, 1)
+            results[name]['backends'] = routes.stats()['backends']
+        primary.close()
+        secondary.close()
+    finally:
+        for upstream in upstreams:
+            upstream.terminate()
+            upstream.wait()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+بنشمارك لقياس زمن البحث في الـ semantic cache
+Benchmark: semantic cache lookup latency with 100k cached questions
+
+Fills a SemanticCache with --entries synthetic questions (random word sequences) and times
+lookups: the full lookup (embedding the question + index search) and the index search alone,
+with all entries under one system prompt (the worst case: one big matrix) and spread over
+--scopes system prompts. The last run inserts past the size bound to time LRU eviction.
+
+Usage:
+    python bench_semantic_cache.py --entries 100000 --scopes 100
+"""
+
+import argparse
+import json
+import random
+import statistics
+import time
+
+import numpy as np
+
+from semantic_cache import SemanticCache, SemanticLookup, build_embedder, scope_of
+
+WORDS = (
+    'hours open close appointment doctor clinic price cost insurance booking cancel today tomorrow '
+    'weekend address parking phone email refund order delivery status account password reset help '
+    'موعد الطبيب العيادة السعر التأمين حجز إلغاء اليوم غدا العنوان الهاتف الطلب التوصيل الحساب مساعدة'
+).split()
+
+
+def _question(rng: random.Random) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(4, 10))) + '?'
+
+
+def _summary(samples):
+    samples = sorted(samples)
+    return {
+        'p50_us': round(statistics.median(samples) * 1e6, 1),
+        'p99_us': round(samples[int(len(samples) * 0.99) - 1] * 1e6, 1),
+        'mean_us': round(statistics.mean(samples) * 1e6, 1),
+    }
+
+
+def _fill(cache: SemanticCache, entries: int, scopes: int, rng: random.Random) -> float:
+    scope_ids = [scope_of('bench', [{'role': 'system', 'content': f'prompt {i}'}]) for i in range(scopes)]
+    start = time.perf_counter()
+    for i in range(entries):
+        cache.put(SemanticLookup(scope_ids[i % scopes], cache.embed(_question(rng))), f'answer {i}')
+    return entries / (time.perf_counter() - start)
+
+
+def _time_lookups(cache: SemanticCache, scopes: int, lookups: int, rng: random.Random):
+    full, search = [], []
+    for i in range(lookups):
+        messages = [{'role': 'system', 'content': f'prompt {i % scopes}'}, {'role': 'user', 'content': _question(rng)}]
+        start = time.perf_counter()
+        result = cache.lookup('bench', messages)
+        full.append(time.perf_counter() - start)
+        index = cache._scopes[result.scope]
+        start = time.perf_counter()
+        index.best(result.vector)
+        search.append(time.perf_counter() - start)
+    return {'lookup': _summary(full), 'search_only': _summary(search)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=100000)
+    parser.add_argument('--scopes', type=int, default=100)
+    parser.add_argument('--lookups', type=int, default=2000)
+    parser.add_argument('--embedder', default='hashing', help='embedder spec, see semantic_cache.py')
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    embedder = build_embedder(args.embedder)
+    dim = np.asarray(embedder(['probe'])).shape[1]
+    results = {'embedder': getattr(embedder, 'name', args.embedder), 'dim': int(dim)}
+
+    start = time.perf_counter()
+    for _ in range(args.lookups):
+        embedder([_question(rng)])
+    results['embed_only_us'] = round((time.perf_counter() - start) / args.lookups * 1e6, 1)
+
+    for scopes in (1, args.scopes):
+        # Threshold above 1: every lookup scans its whole scope and misses
+        cache = SemanticCache(embedder, threshold=1.01, max_entries=args.entries)
+        inserts_per_sec = _fill(cache, args.entries, scopes, rng)
+        row = _time_lookups(cache, scopes, args.lookups, rng)
+        row['inserts_per_sec'] = round(inserts_per_sec)
+        row['index_mb'] = round(sum(index.vectors.nbytes for index in cache._scopes.values()) / 1e6, 1)
+        results[f'{args.entries}_entries_{scopes}_scopes'] = row
+
+    # At the size bound every insert evicts the least recently used entry
+    start = time.perf_counter()
+    for i in range(args.lookups):
+        vector = cache.embed(_question(rng))
+        cache.put(SemanticLookup(cache._entries[next(reversed(cache._entries))][0], vector), f'new {i}')
+    results['insert_with_eviction_us'] = round((time.perf_counter() - start) / args.lookups * 1e6, 1)
+    results['evictions'] = cache.evictions
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
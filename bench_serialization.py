@@ -0,0 +1,111 @@
+"""
+بنشمارك لقياس سرعة تحويل الـ chunks إلى JSON
+Benchmark: SSE chunk rendering and request body parsing throughput
+
+"per_chunk_dict" is the previous rendering: a full chunk dict per token, two time.time()
+calls and json.dumps(ensure_ascii=False). "template" splices the escaped delta into the
+pre-rendered ChunkRenderer template. Request parsing compares json.loads with the
+serialization backend (orjson when installed) on a Vapi-sized conversation.
+
+Usage:
+    python bench_serialization.py --chunks 200000 --messages 100
+"""
+
+import argparse
+import json
+import time
+
+from serialization import ChunkRenderer, JSON_BACKEND, loads
+
+WORDS = ['مرحباً', 'كيف', 'يمكنني', 'مساعدتك', 'اليوم؟', 'Your', 'appointment', 'is', 'on', 'Tuesday', 'at', '10:30.']
+
+
+def per_chunk_dict(model_name: str, delta: str) -> str:
+    chunk_data = {
+        'id': f"chatcmpl-{int(time.time())}",
+        'object': 'chat.completion.chunk',
+        'created': int(time.time()),
+        'model': model_name,
+        'choices': [{
+            'index': 0,
+            'delta': {'content': delta},
+            'finish_reason': None
+        }]
+    }
+    return f"data: {json.dumps(chunk_data, ensure_ascii=False)}\n\n"
+
+
+def _rate(fn, n: int, repeat: int) -> float:
+    """Best-of-repeat calls per second"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(n)
+        best = min(best, time.perf_counter() - start)
+    return n / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chunks', type=int, default=200000)
+    parser.add_argument('--messages', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    deltas = [f'{WORDS[i % len(WORDS)]} ' for i in range(args.chunks)]
+    model = 'custom-llm'
+
+    def legacy(n):
+        for delta in deltas[:n]:
+            per_chunk_dict(model, delta)
+
+    def full_dumps(n):
+        renderer = ChunkRenderer(model)
+        for delta in deltas[:n]:
+            renderer.chunk({'content': delta})
+
+    def template(n):
+        renderer = ChunkRenderer(model)
+        for delta in deltas[:n]:
+            renderer.content(delta)
+
+    messages = [
+        {'role': 'user' if i % 2 else 'assistant', 'content': f'{" ".join(WORDS)} رقم {i}'}
+        for i in range(args.messages)
+    ]
+    body = json.dumps({'model': model, 'messages': messages, 'stream': True}, ensure_ascii=False).encode('utf-8')
+    parse_rounds = max(1, args.chunks // 100)
+
+    def parse_stdlib(n):
+        for _ in range(n):
+            json.loads(body)
+
+    def parse_backend(n):
+        for _ in range(n):
+            loads(body)
+
+    chunk_rates = {
+        'per_chunk_dict': _rate(legacy, args.chunks, args.repeat),
+        'chunk_dict_backend': _rate(full_dumps, args.chunks, args.repeat),
+        'template': _rate(template, args.chunks, args.repeat),
+    }
+    parse_rates = {
+        'json_loads': _rate(parse_stdlib, parse_rounds, args.repeat),
+        JSON_BACKEND: _rate(parse_backend, parse_rounds, args.repeat),
+    }
+
+    results = {
+        'json_backend': JSON_BACKEND,
+        'chunks_per_sec': {name: round(rate) for name, rate in chunk_rates.items()},
+        'chunk_speedup': round(chunk_rates['template'] / chunk_rates['per_chunk_dict'], 1),
+        'request_parse': {
+            'body_bytes': len(body),
+            'parses_per_sec': {name: round(rate) for name, rate in parse_rates.items()},
+            'speedup': round(parse_rates[JSON_BACKEND] / parse_rates['json_loads'], 1),
+        },
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
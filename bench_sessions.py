@@ -0,0 +1,73 @@
+"""
+بنشمارك لقياس تكلفة معالجة المحادثات الطويلة
+Benchmark: per-turn validation + prompt token accounting with and without the session store
+
+Replays conversations of N turns. Each turn's history is freshly decoded from JSON, as it
+would be from a real request, so no message objects are shared between turns. Reports the
+time spent in CustomLLM._validate and usage accounting per turn (JSON decoding excluded).
+
+Usage:
+    python bench_sessions.py --turns 50 100 200
+"""
+
+import argparse
+import json
+import os
+import statistics
+import time
+
+os.environ.setdefault('API_KEY', 'bench')
+
+from app import CustomLLM  # noqa: E402
+
+SYSTEM = 'أنت مساعد ذكي ومفيد لخدمة العملاء. تحدث بالعربية وكن مختصراً وودوداً في جميع الردود.'
+
+
+def _conversation(turns: int):
+    messages = [{'role': 'system', 'content': SYSTEM}]
+    for i in range(turns):
+        messages.append({'role': 'user', 'content': f'سؤال رقم {i}: هل يمكنك مساعدتي في حجز موعد يوم الثلاثاء القادم؟'})
+        yield json.dumps(messages, ensure_ascii=False)
+        messages.append({'role': 'assistant', 'content': f'بالتأكيد، هذا الرد رقم {i}. سأقوم بحجز الموعد لك الآن، هل تفضل الصباح أم المساء؟'})
+
+
+def _run(llm: CustomLLM, turns: int, session_id):
+    samples = []
+    for payload in _conversation(turns):
+        messages = json.loads(payload)
+        start = time.perf_counter()
+        session = llm.sessions.get(session_id) if session_id else None
+        llm._validate(messages, None, 0.7, session)
+        llm._usage(messages, llm.default_model, '', session)
+        samples.append(time.perf_counter() - start)
+    if session_id:
+        llm.sessions.end(session_id)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--turns', type=int, nargs='+', default=[50, 100, 200])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    llm = CustomLLM()
+    results = {}
+    for turns in args.turns:
+        row = {}
+        for mode, session_id in (('full_history', None), ('session', 'bench-call')):
+            runs = [_run(llm, turns, session_id) for _ in range(args.repeat)]
+            per_turn = [statistics.median(col) for col in zip(*runs)]
+            row[mode] = {
+                'total_ms': round(sum(per_turn) * 1000, 3),
+                'last_turn_us': round(per_turn[-1] * 1e6, 1),
+                'mean_turn_us': round(statistics.mean(per_turn) * 1e6, 1),
+            }
+        row['speedup'] = round(row['full_history']['total_ms'] / row['session']['total_ms'], 1)
+        results[f'{turns}_turns'] = row
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""
+بنشمارك للتخزين المشترك بين أكثر من نسخة من السيرفر
+Benchmark: shared cache and session tier across replicas, and what batching saves in round trips
+
+Starts fake_redis.py with --latency-ms per round trip (a network hop to the store) and runs two
+parts:
+
+replicas   Two CustomLLM instances in this process stand in for two replicas behind a round-robin
+           load balancer (each has its own in-process cache and session store). --calls calls
+           of --turns turns alternate between them, then the same calls are repeated (as
+           scripted calls do). Per store configuration it reports the per-turn time of
+           generate_response, response cache hit rate on the repeat, sessions continued from
+           the store and the store round trips per turn:
+               none            - no shared store: every replica on its own
+               redis           - SHARED_STORE_NEAR_TTL=0, every turn checks the store
+               redis_near_ttl  - SHARED_STORE_NEAR_TTL=60, a replica trusts its own copy
+
+batching   --threads threads each do --ops turns of one read and two writes against the store:
+           directly (one round trip per read and per write, as a plain client would) and
+           through SharedTier (write-behind pipelined batches, concurrent reads sent together).
+           Reports round trips and the time the calling threads spent per operation.
+
+Usage:
+    python bench_shared_store.py --latency-ms 1 --calls 20 --turns 8
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from typing import Any, Dict, List
+
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ.update(API_KEY='', STREAM_DELAY='0', RESPONSE_CACHE_ENABLED='true')
+
+from app import CustomLLM  # noqa: E402
+from shared_store import RedisStore, SharedTier  # noqa: E402
+
+
+def _wait_store(store: RedisStore, timeout: float = 10.0) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            store.pipeline([['PING']])
+            return
+        except Exception:
+            time.sleep(0.05)
+    raise RuntimeError('fake_redis did not start')
+
+
+def _server_round_trips(store: RedisStore) -> int:
+    return json.loads(store.pipeline([['STATS']])[0])['round_trips']
+
+
+def replicas(store: RedisStore, env: Dict[str, str], args: argparse.Namespace) -> Dict[str, Any]:
+    store.pipeline([['FLUSHDB']])
+    for name in ('SHARED_STORE_URL', 'SHARED_STORE_NEAR_TTL'):
+        os.environ.pop(name, None)
+    os.environ.update(env)
+    pair = [CustomLLM(), CustomLLM()]
+    turn_times: List[float] = []
+    for repeat in range(2):
+        for call in range(args.calls):
+            messages = [{'role': 'system', 'content': 'أنت مساعد حجوزات لعيادة أسنان.'}]
+            for turn in range(args.turns):
+                messages.append({'role': 'user', 'content': f'سؤال رقم {turn} في المكالمة {call}: هل يوجد موعد متاح؟'})
+                # The repeat lands every turn on the other replica
+                llm = pair[(call + turn + repeat) % 2]
+                start = time.perf_counter()
+                reply = llm.generate_response(messages, temperature=0, session_id=f'call-{repeat}-{call}')
+                turn_times.append(time.perf_counter() - start)
+                messages.append({'role': 'assistant', 'content': reply})
+                if llm.shared:
+                    # Turns of a call are seconds apart: the previous turn's writes have landed
+                    llm.shared.flush()
+        if repeat == 0:
+            first_hits = sum(llm.cache.hits for llm in pair)
+            first_lookups = sum(llm.cache.hits + llm.cache.misses for llm in pair)
+    lookups = sum(llm.cache.hits + llm.cache.misses for llm in pair) - first_lookups
+    turns = len(turn_times)
+    result = {
+        'turn_p50_us': round(statistics.median(turn_times) * 1e6, 1),
+        'turn_mean_us': round(statistics.mean(turn_times) * 1e6, 1),
+        'repeat_cache_hit_rate': round((sum(llm.cache.hits for llm in pair) - first_hits) / lookups, 3),
+        'sessions_loaded_from_store': sum(llm.sessions.loaded for llm in pair),
+    }
+    if pair[0].shared:
+        result['store_round_trips_per_turn'] = round(sum(
+            llm.shared.read_round_trips + llm.shared.write_round_trips for llm in pair) / turns, 2)
+    return result
+
+
+def batching(store: RedisStore, args: argparse.Namespace) -> Dict[str, Any]:
+    results = {}
+    for mode in ('direct', 'shared_tier'):
+        tier = SharedTier(store, prefix='bench:') if mode == 'shared_tier' else None
+        before = _server_round_trips(store)
+        spent: List[float] = []
+
+        def worker(thread: int):
+            for op in range(args.ops):
+                key = f'{thread}-{op}'
+                start = time.perf_counter()
+                if tier:
+                    tier.get('session:' + key)
+                    tier.set('session:' + key, b'x' * 200, 60)
+                    tier.set('cache:' + key, b'y' * 500, 60)
+                else:
+                    store.get_many(['bench:session:' + key])
+                    store.write([('bench:session:' + key, b'x' * 200, 60)], [])
+                    store.write([('bench:cache:' + key, b'y' * 500, 60)], [])
+                spent.append(time.perf_counter() - start)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if tier:
+            tier.flush()
+        wall = time.perf_counter() - start
+        operations = args.threads * args.ops * 3
+        results[mode] = {
+            'store_round_trips': _server_round_trips(store) - before - 1,
+            'operations': operations,
+            'caller_us_per_turn': round(statistics.mean(spent) * 1e6, 1),
+            'turns_per_second': round(args.threads * args.ops / wall, 1),
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--latency-ms', type=float, default=1.0)
+    parser.add_argument('--calls', type=int, default=20)
+    parser.add_argument('--turns', type=int, default=8)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--ops', type=int, default=50)
+    parser.add_argument('--port', type=int, default=6390)
+    args = parser.parse_args()
+
+    server = subprocess.Popen([sys.executable, 'fake_redis.py', '--port', str(args.port), '--latency-ms', str(args.latency_ms)])
+    url = f'redis://127.0.0.1:{args.port}/0'
+    try:
+        store = RedisStore(port=args.port, pool_size=args.threads)
+        _wait_store(store)
+        results = {
+            'replicas': {
+                'none': replicas(store, {}, args),
+                'redis': replicas(store, {'SHARED_STORE_URL': url, 'SHARED_STORE_NEAR_TTL': '0'}, args),
+                'redis_near_ttl': replicas(store, {'SHARED_STORE_URL': url, 'SHARED_STORE_NEAR_TTL': '60'}, args),
+            },
+            'batching': batching(store, args),
+        }
+    finally:
+        server.terminate()
+        server.wait()
+    print(json.dumps({'store_latency_ms': args.latency_ms, 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
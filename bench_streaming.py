@@ -0,0 +1,102 @@
+"""
+بنشمارك لقياس زمن أول token في الـ streaming
+Benchmark: end-to-end time-to-first-token through the server vs the upstream's own TTFT
+
+Starts fake_upstream.py with a fixed TTFT, points the server (Flask or ASGI) at it via
+OPENAI_BASE_URL, streams requests and compares the client-observed TTFT with the upstream's.
+The server's /stats/latency histograms are printed alongside.
+
+Usage:
+    python bench_streaming.py --server asgi --requests 100 --ttft 0.1
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+PAYLOAD = {
+    'model': 'gpt-fake',
+    'messages': [{'role': 'user', 'content': 'مرحباً، كيف حالك اليوم؟'}],
+    'stream': True
+}
+
+
+def _wait_ready(url: str, timeout: float = 15.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            httpx.get(url)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    raise RuntimeError(f'{url} did not become ready')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--server', choices=['flask', 'asgi'], default='asgi')
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--ttft', type=float, default=0.1, help='upstream time-to-first-token in seconds')
+    parser.add_argument('--token-delay', type=float, default=0.01)
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--upstream-port', type=int, default=9101)
+    args = parser.parse_args()
+
+    upstream_url = f'http://127.0.0.1:{args.upstream_port}'
+    base_url = f'http://127.0.0.1:{args.port}'
+    env = dict(os.environ, PORT=str(args.port), HOST='127.0.0.1', API_KEY='', OPENAI_BASE_URL=f'{upstream_url}/v1')
+    server_cmd = {
+        'flask': [sys.executable, 'app.py'],
+        'asgi': [sys.executable, '-m', 'uvicorn', 'asgi_app:app', '--port', str(args.port), '--log-level', 'warning'],
+    }[args.server]
+
+    upstream = subprocess.Popen([
+        sys.executable, 'fake_upstream.py', '--port', str(args.upstream_port),
+        '--ttft', str(args.ttft), '--token-delay', str(args.token_delay)
+    ])
+    server = subprocess.Popen(server_cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        _wait_ready(f'{upstream_url}/stats')
+        _wait_ready(f'{base_url}/health')
+
+        ttfts = []
+        with httpx.Client(base_url=base_url, timeout=60) as client:
+            for _ in range(args.requests):
+                start = time.perf_counter()
+                first = None
+                with client.stream('POST', '/v1/chat/completions', json=PAYLOAD) as response:
+                    for line in response.iter_lines():
+                        if first is None and '"content"' in line:
+                            first = time.perf_counter() - start
+                        if line == 'data: [DONE]':
+                            break
+                ttfts.append(first)
+            stats = client.get('/stats/latency').json()
+    finally:
+        server.terminate()
+        upstream.terminate()
+        server.wait()
+        upstream.wait()
+
+    ttfts.sort()
+    result = {
+        'server': args.server,
+        'upstream_ttft_ms': args.ttft * 1000,
+        'client_ttft_p50_ms': round(statistics.median(ttfts) * 1000, 2),
+        'client_ttft_p99_ms': round(ttfts[int(len(ttfts) * 0.99) - 1] * 1000, 2),
+        'added_ttft_p50_ms': round((statistics.median(ttfts) - args.ttft) * 1000, 2),
+        'server_histograms': {
+            name: {k: h[k] for k in ('count', 'p50', 'p95', 'p99')} for name, h in stats.items()
+        }
+    }
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+بنشمارك لقياس سرعة حساب الـ tokens
+Benchmark: usage accounting cost for a 100-message history, cold vs warm tokenizer cache
+
+"cold" counts every message with an empty memo cache; "warm" recounts the same history
+after a fresh JSON decode (new message objects, same texts), which is what every later turn
+of a call looks like. The old str(msg).split() estimate is included for reference.
+
+Usage:
+    python bench_tokenizer.py --messages 100 --tokenizer regex
+"""
+
+import argparse
+import json
+import statistics
+import time
+
+from tokenizer import create_tokenizer
+
+
+def _history(n: int):
+    messages = [{'role': 'system', 'content': 'أنت مساعد ذكي ومفيد لخدمة العملاء. You are a helpful bilingual support agent.'}]
+    for i in range(n - 1):
+        if i % 2 == 0:
+            messages.append({'role': 'user', 'content': f'سؤال رقم {i}: can I move my appointment to Tuesday at 10:30 please?'})
+        else:
+            messages.append({'role': 'assistant', 'content': f'بالتأكيد! Your appointment #{i} is now on Tuesday at 10:30. هل تحتاج أي شيء آخر؟'})
+    return json.dumps(messages, ensure_ascii=False)
+
+
+def _time(fn, repeat: int):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return round(statistics.median(samples) * 1e6, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=100)
+    parser.add_argument('--tokenizer', default='regex', help='tokenizer spec, e.g. regex, tiktoken:cl100k_base, vocab:/path')
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    payload = _history(args.messages)
+    messages = json.loads(payload)
+
+    def cold():
+        create_tokenizer(args.tokenizer).count_messages(messages)
+
+    warm_tokenizer = create_tokenizer(args.tokenizer)
+    warm_tokenizer.count_messages(messages)
+    fresh = json.loads(payload)
+
+    def warm():
+        warm_tokenizer.count_messages(fresh)
+
+    def split_estimate():
+        sum(len(str(msg).split()) for msg in messages)
+
+    print(json.dumps({
+        'tokenizer': warm_tokenizer.name,
+        'messages': args.messages,
+        'prompt_tokens': warm_tokenizer.count_messages(messages),
+        'cold_us': _time(cold, max(1, args.repeat // 10)),
+        'warm_us': _time(warm, args.repeat),
+        'str_split_estimate_us': _time(split_estimate, args.repeat),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+بنشمارك لتنفيذ الأدوات محلياً على التوازي مع التخزين المؤقت للنتائج
+Benchmark: turns that call local tools, run one at a time, in parallel, and with the result cache
+
+Starts fake_upstream.py as an OpenAI-compatible upstream that calls the tools named in the
+caller's message, and runs CustomLLM in this process with TOOLS_MODULE=example_tools offered
+on every request (TOOLS_MODELS=gpt-bench; lookups of --tool-ms each). Every turn asks for both check_availability and clinic_hours, so the model
+calls two tools, gets their results and answers. --calls callers each take --turns turns,
+--concurrency of them at a time (with more than one, TOOL_WORKERS=1 also queues the calls of
+different callers behind each other, and timeouts count that wait). Per configuration it
+reports the per-turn time of generate_response (streamed to the end), upstream requests per
+turn and /stats/tools:
+
+    sequential  - TOOL_WORKERS=1, TOOL_CACHE_SIZE=0: the calls of a round run one after another
+    parallel    - TOOL_WORKERS=8, TOOL_CACHE_SIZE=0: the calls of a round run together
+    cached      - TOOL_WORKERS=8 with the result cache: repeated lookups are answered at once
+
+Usage:
+    python bench_tools.py --calls 8 --turns 4 --tool-ms 300
+    python bench_tools.py --concurrency 4
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+import httpx
+
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ.update(API_KEY='', STREAM_DELAY='0', OPENAI_API_KEY='bench', TOOLS_MODULE='example_tools',
+                  TOOLS_MODELS='gpt-bench')
+
+import example_tools  # noqa: E402
+from app import CustomLLM  # noqa: E402
+
+CONFIGS = {
+    'sequential': {'TOOL_WORKERS': '1', 'TOOL_CACHE_SIZE': '0'},
+    'parallel': {'TOOL_WORKERS': '8', 'TOOL_CACHE_SIZE': '0'},
+    'cached': {'TOOL_WORKERS': '8', 'TOOL_CACHE_SIZE': '1024'},
+}
+
+
+def _wait(url: str, timeout: float = 20.0) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            httpx.get(url, timeout=1.0)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    raise RuntimeError(f'{url} did not come up')
+
+
+def run(upstream: str, settings: Dict[str, str], args: argparse.Namespace) -> Dict[str, Any]:
+    os.environ.update(settings)
+    llm = CustomLLM()
+    turn_times: List[float] = []
+    lock = threading.Lock()
+    before = httpx.get(upstream + '/stats').json()['requests']
+
+    def call(index: int):
+        messages = [{'role': 'system', 'content': 'أنت مساعد حجوزات لعيادة أسنان.'}]
+        for turn in range(args.turns):
+            messages.append({'role': 'user', 'content': f'turn {turn}: please check_availability and clinic_hours'})
+            start = time.perf_counter()
+            for _ in llm.generate_response(messages, model='gpt-bench', temperature=0, stream=True):
+                pass
+            with lock:
+                turn_times.append(time.perf_counter() - start)
+            messages.append({'role': 'assistant', 'content': 'ok'})
+
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(call, range(args.calls)))
+    turns = len(turn_times)
+    stats = llm.tools.stats()
+    return {
+        'turn_p50_ms': round(statistics.median(turn_times) * 1000, 1),
+        'turn_mean_ms': round(statistics.mean(turn_times) * 1000, 1),
+        'upstream_requests_per_turn': round((httpx.get(upstream + '/stats').json()['requests'] - before) / turns, 2),
+        'tools': {key: stats[key] for key in ('rounds', 'calls', 'cache_hits', 'errors', 'timeouts')},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=8)
+    parser.add_argument('--turns', type=int, default=4)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--tool-ms', type=float, default=300)
+    parser.add_argument('--ttft', type=float, default=0.1)
+    parser.add_argument('--token-delay', type=float, default=0.005)
+    parser.add_argument('--upstream-port', type=int, default=9310)
+    args = parser.parse_args()
+
+    example_tools.LOOKUP_SECONDS = args.tool_ms / 1000
+    upstream = f'http://127.0.0.1:{args.upstream_port}'
+    os.environ['OPENAI_BASE_URL'] = upstream + '/v1'
+    server = subprocess.Popen([
+        sys.executable, 'fake_upstream.py', '--port', str(args.upstream_port), '--ttft', str(args.ttft),
+        '--token-delay', str(args.token_delay), '--tokens', '20'
+    ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        _wait(upstream + '/stats')
+        results = {name: run(upstream, settings, args) for name, settings in CONFIGS.items()}
+    finally:
+        server.terminate()
+        server.wait()
+    print(json.dumps({'tool_ms': args.tool_ms, 'ttft': args.ttft, 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+بنشمارك لقياس تكلفة التحقق من الطلبات
+Benchmark: request validation cost for long conversation histories
+
+Times, per request body of --messages messages (text-only history, the common Vapi case, and a
+mixed history with multi-part content and tool calls):
+
+    parse_json    parsing the body, for scale
+    legacy        the previous per-message loop (dict check, role/content presence, role in a list)
+    validate      validation.parse_chat_request + validate_messages on the whole history
+    incremental   validate_messages on the last two messages only, as on a later turn of a session
+
+legacy checked less than validate does (no content types, no tool calls, no top-level fields),
+so it is a floor rather than a like-for-like comparison.
+
+Usage:
+    python bench_validation.py --messages 10 200 1000
+"""
+
+import argparse
+import json
+import timeit
+from typing import Any, Dict, List
+
+from serialization import dumps, loads
+from validation import parse_chat_request, validate_messages
+
+
+def legacy_validate(messages: List[Dict[str, Any]]) -> None:
+    """The per-message loop CustomLLM._validate ran before validation.py"""
+    if not isinstance(messages, list) or len(messages) == 0:
+        raise ValueError("Messages must be a non-empty list")
+    for i, msg in enumerate(messages):
+        if not isinstance(msg, dict):
+            raise ValueError(f"Message {i} must be a dictionary")
+        if 'role' not in msg or 'content' not in msg:
+            raise ValueError(f"Message {i} must have 'role' and 'content' fields")
+        if msg['role'] not in ['user', 'system', 'assistant']:
+            raise ValueError(f"Message {i} has invalid role: {msg['role']}. Must be 'user', 'system', or 'assistant'")
+
+
+def text_history(n: int) -> List[Dict[str, Any]]:
+    messages = [{'role': 'system', 'content': 'أنت مساعد ذكي ومفيد. تحدث بالعربية.'}]
+    for i in range(n - 1):
+        messages.append({'role': 'user' if i % 2 == 0 else 'assistant', 'content': f'رسالة رقم {i}: هذا نص تجريبي.'})
+    return messages
+
+
+def mixed_history(n: int) -> List[Dict[str, Any]]:
+    messages = [{'role': 'system', 'content': 'You are a helpful assistant.'}]
+    i = 0
+    while len(messages) < n:
+        messages.append({'role': 'user', 'content': [{'type': 'text', 'text': f'question {i}'}]})
+        messages.append({'role': 'assistant', 'content': None, 'tool_calls': [
+            {'id': f'call_{i}', 'type': 'function', 'function': {'name': 'lookup', 'arguments': '{"q": "x"}'}}
+        ]})
+        messages.append({'role': 'tool', 'tool_call_id': f'call_{i}', 'content': 'result'})
+        messages.append({'role': 'assistant', 'content': f'answer {i}'})
+        i += 1
+    return messages[:n]
+
+
+def _us(fn, number: int) -> float:
+    return round(min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6, 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, nargs='+', default=[10, 200, 1000])
+    parser.add_argument('--number', type=int, default=None, help='calls per timing (default: scaled to the history length)')
+    args = parser.parse_args()
+
+    results = {}
+    for n in args.messages:
+        number = args.number or max(20, 20000 // n)
+        for shape, build in (('text', text_history), ('mixed', mixed_history)):
+            body = {'model': 'custom-llm', 'messages': build(n), 'temperature': 0.7, 'max_tokens': 256, 'stream': False}
+            raw = dumps(body)
+            messages = body['messages']
+            row = {
+                'body_kb': round(len(raw.encode('utf-8')) / 1024, 1),
+                'parse_json_us': _us(lambda: loads(raw), number),
+                'validate_us': _us(lambda: validate_messages(parse_chat_request(body)[0]), number),
+                'incremental_us': _us(lambda: validate_messages(messages, len(messages) - 2), number),
+            }
+            if shape == 'text':
+                row['legacy_us'] = _us(lambda: legacy_validate(messages), number)
+            results[f'{shape}_{n}'] = row
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
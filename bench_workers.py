@@ -0,0 +1,174 @@
+"""
+بنشمارك لقياس زمن الإقلاع والذاكرة لكل worker
+Benchmark: startup time and memory per worker of the gunicorn launcher (gunicorn.conf.py)
+
+Starts `gunicorn -c gunicorn.conf.py` with --workers workers, with and without PRELOAD_APP,
+for each server mode, and reports:
+
+    master_ready_s       until the master is listening (includes importing the app when preloading)
+    all_workers_ready_s  until every worker has logged that it is ready
+    first_response_s     until GET /health first answered
+    per worker           RSS, PSS (shared pages split between the processes sharing them) and
+                         private memory (USS), after --warmup requests
+    total_pss_mb         what master + workers really use together
+
+With preloading the workers share the app's pages with the master, so their private memory
+and the total PSS are lower; without it every worker imports and initializes the app itself.
+
+With --drain it also checks graceful draining: a slow SSE stream is started, the master is
+sent SIGHUP (worker restart) and the stream must still end with [DONE].
+
+Usage:
+    python bench_workers.py --workers 4 --modes asgi flask --drain
+"""
+
+import argparse
+import json
+import os
+import signal
+import subprocess
+import threading
+import time
+from typing import Any, Dict, List
+
+import httpx
+
+PAYLOAD = {
+    'model': 'custom-llm-v1',
+    'messages': [{'role': 'user', 'content': 'مرحباً، كيف حالك؟'}],
+    'stream': True
+}
+
+
+def memory(pid: int) -> Dict[str, float]:
+    """RSS, PSS and private memory (USS) of a process in MB"""
+    fields = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1])
+    return {
+        'rss_mb': round(fields['Rss'] / 1024, 1),
+        'pss_mb': round(fields['Pss'] / 1024, 1),
+        'private_mb': round((fields['Private_Clean'] + fields['Private_Dirty']) / 1024, 1),
+    }
+
+
+def children(pid: int) -> List[int]:
+    with open(f'/proc/{pid}/task/{pid}/children') as f:
+        return [int(child) for child in f.read().split()]
+
+
+class Server:
+    """gunicorn subprocess whose log lines are collected with their arrival time"""
+
+    def __init__(self, env: Dict[str, str]):
+        self.started = time.perf_counter()
+        self.proc = subprocess.Popen(
+            ['gunicorn', '-c', 'gunicorn.conf.py'], env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+        )
+        self.lines: List[Any] = []
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self) -> None:
+        for line in self.proc.stderr:
+            self.lines.append((time.perf_counter() - self.started, line))
+
+    def wait_for(self, text: str, count: int = 1, timeout: float = 60.0) -> float:
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            seen = [at for at, line in list(self.lines) if text in line]
+            if len(seen) >= count:
+                return seen[count - 1]
+            time.sleep(0.01)
+        raise RuntimeError(f'Timed out waiting for {count} x {text!r}')
+
+    def stop(self) -> None:
+        self.proc.terminate()
+        self.proc.wait()
+
+
+def _first_response(base_url: str, started: float, timeout: float = 60.0) -> float:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if httpx.get(f'{base_url}/health').status_code == 200:
+                return time.perf_counter() - started
+        except httpx.HTTPError:
+            time.sleep(0.01)
+    raise RuntimeError(f'Server at {base_url} did not become ready')
+
+
+def measure(env: Dict[str, str], base_url: str, workers: int, warmup: int) -> Dict[str, Any]:
+    server = Server(env)
+    try:
+        first = _first_response(base_url, server.started)
+        master_ready = server.wait_for('Master ready')
+        all_ready = server.wait_for('ready in', count=workers)
+        with httpx.Client(timeout=30) as client:
+            for _ in range(warmup):
+                client.post(f'{base_url}/v1/chat/completions', json=dict(PAYLOAD, stream=False))
+        master = memory(server.proc.pid)
+        per_worker = [memory(pid) for pid in children(server.proc.pid)]
+        return {
+            'master_ready_s': round(master_ready, 3),
+            'all_workers_ready_s': round(all_ready, 3),
+            'first_response_s': round(first, 3),
+            'master': master,
+            'worker_private_mb_avg': round(sum(w['private_mb'] for w in per_worker) / len(per_worker), 1),
+            'worker_pss_mb_avg': round(sum(w['pss_mb'] for w in per_worker) / len(per_worker), 1),
+            'workers': per_worker,
+            'total_pss_mb': round(master['pss_mb'] + sum(w['pss_mb'] for w in per_worker), 1),
+        }
+    finally:
+        server.stop()
+
+
+def drain(env: Dict[str, str], base_url: str) -> Dict[str, Any]:
+    """Restart the workers (SIGHUP) while a slow stream is in flight; it must still complete"""
+    server = Server(dict(env, STREAM_DELAY='0.2'))
+    try:
+        _first_response(base_url, server.started)
+        chunks = 0
+        done = False
+        start = time.perf_counter()
+        with httpx.Client(timeout=60) as client:
+            with client.stream('POST', f'{base_url}/v1/chat/completions', json=PAYLOAD) as response:
+                for line in response.iter_lines():
+                    if line.startswith('data: '):
+                        chunks += 1
+                        if chunks == 2:
+                            os.kill(server.proc.pid, signal.SIGHUP)
+                    if line == 'data: [DONE]':
+                        done = True
+        return {'stream_completed': done, 'chunks': chunks, 'stream_seconds': round(time.perf_counter() - start, 2)}
+    finally:
+        server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--modes', nargs='+', default=['asgi', 'flask'], choices=['asgi', 'flask'])
+    parser.add_argument('--warmup', type=int, default=20, help='requests sent before measuring memory')
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--drain', action='store_true', help='also check draining of a stream on SIGHUP')
+    args = parser.parse_args()
+
+    base_url = f'http://127.0.0.1:{args.port}'
+    base_env = dict(os.environ, HOST='127.0.0.1', PORT=str(args.port), API_KEY='', STREAM_DELAY='0',
+                    LOG_LEVEL='WARNING', WEB_CONCURRENCY=str(args.workers))
+    results: Dict[str, Any] = {}
+    for mode in args.modes:
+        for preload in ('true', 'false'):
+            env = dict(base_env, SERVER_MODE=mode, PRELOAD_APP=preload)
+            results[f'{mode}_preload_{preload}'] = measure(env, base_url, args.workers, args.warmup)
+        if args.drain:
+            results[f'{mode}_drain_on_sighup'] = drain(dict(base_env, SERVER_MODE=mode), base_url)
+    print(json.dumps({'workers': args.workers, 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+"""
+Response cache for CustomLLM
+Opt-in exact-match cache for repeated turns, keyed on a canonical hash of
+(model, temperature, normalized messages including their tool calls, and the request's
+max_tokens / stop), with LRU + TTL eviction and a memory bound.
+With a shared store (shared_store.py) entries are also written there, and a miss in this
+process is looked up in the store, so a turn answered on one replica is a hit on the others.
+
+Configuration (environment variables):
+    RESPONSE_CACHE_ENABLED        - "true" to enable (default: false)
+    RESPONSE_CACHE_MAX_ENTRIES    - maximum cached responses (default: 1024)
+    RESPONSE_CACHE_MAX_BYTES      - maximum total size of cached text in bytes (default: 16 MB)
+    RESPONSE_CACHE_TTL            - seconds before an entry expires (default: 300)
+    RESPONSE_CACHE_ALLOW_SAMPLED  - "true" to also cache requests with temperature > 0 (default: false)
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+from serialization import dumpb, loads
+
+_REPLAY_PIECE = re.compile(r'\s*\S+\s*')
+
+
+def _normalize_content(content: Any) -> Any:
+    """Collapse whitespace so trivially different transcripts share a cache entry"""
+    if isinstance(content, str):
+        return ' '.join(content.split())
+    return content
+
+
+def make_key(model: str, temperature: float, messages: List[Dict[str, Any]], limits: Any = None) -> str:
+    """Canonical SHA-256 key for a request; limits is its validation.OutputLimits, if any"""
+    normalized = []
+    for msg in messages:
+        entry = [msg.get('role'), _normalize_content(msg.get('content')), msg.get('name')]
+        if msg.get('tool_calls') or msg.get('tool_call_id'):
+            # Appended only when present, so keys of plain histories stay as they were
+            entry += [msg.get('tool_calls'), msg.get('tool_call_id')]
+        normalized.append(entry)
+    fields = [model, round(float(temperature), 4), normalized]
+    if limits is not None:
+        # Appended only when set, so keys of requests without limits stay as they were
+        fields.append(limits.key())
+    canonical = json.dumps(fields, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def replay(text: str) -> Iterator[str]:
+    """Split a cached response into word-sized deltas for replay through the SSE path"""
+    return iter(_REPLAY_PIECE.findall(text))
+
+
+async def areplay(text: str) -> AsyncIterator[str]:
+    """Async version of replay"""
+    for piece in _REPLAY_PIECE.findall(text):
+        yield piece
+
+
+class ResponseCache:
+    """Thread-safe LRU/TTL cache of response texts with hit/miss counters"""
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        max_bytes: int = 16 * 1024 * 1024,
+        ttl: float = 300.0,
+        allow_sampled: bool = False,
+        shared: Any = None
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.allow_sampled = allow_sampled
+        self.shared = shared  # shared_store.SharedTier; this cache is its near-cache
+        self._entries: 'OrderedDict[str, Tuple[str, float, int]]' = OrderedDict()  # key -> (text, expires_at, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def cacheable(self, temperature: float) -> bool:
+        """Sampled (temperature > 0) responses are not deterministic, so skip them unless allowed"""
+        if temperature > 0 and not self.allow_sampled:
+            with self._lock:
+                self.bypassed += 1
+            return False
+        return True
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                text, expires_at, size = entry
+                if expires_at >= time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return text
+                del self._entries[key]
+                self._bytes -= size
+                self.expirations += 1
+            if self.shared is None:
+                self.misses += 1
+                return None
+        return self._get_shared(key)
+
+    def _get_shared(self, key: str) -> Optional[str]:
+        data = self.shared.get('cache:' + key)
+        try:
+            expires_at, text = loads(data) if data is not None else (0, None)
+        except (ValueError, TypeError):
+            text = None
+        ttl = expires_at - time.time() if text is not None else 0
+        if ttl <= 0:
+            with self._lock:
+                self.misses += 1
+            return None
+        self._put_local(key, text, ttl)
+        with self._lock:
+            self.hits += 1
+            self.shared_hits += 1
+        return text
+
+    def put(self, key: str, text: str) -> None:
+        if self._put_local(key, text, self.ttl) and self.shared is not None:
+            # Wall-clock expiry goes along, so a replica that picks the entry up keeps its TTL
+            self.shared.set('cache:' + key, dumpb([time.time() + self.ttl, text]), self.ttl)
+
+    def _put_local(self, key: str, text: str, ttl: float) -> bool:
+        size = len(text.encode('utf-8'))
+        if size > self.max_bytes:
+            return False
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._entries[key] = (text, time.monotonic() + ttl, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+        return True
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'enabled': True,
+            'entries': len(self._entries),
+            'bytes': self._bytes,
+            'max_entries': self.max_entries,
+            'max_bytes': self.max_bytes,
+            'ttl_seconds': self.ttl,
+            'hits': self.hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else None,
+            'bypassed': self.bypassed,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
+
+
+def build_cache_from_env(shared: Any = None) -> Optional[ResponseCache]:
+    """Return a ResponseCache if RESPONSE_CACHE_ENABLED is set, otherwise None; shared is the SharedTier, if any"""
+    if os.getenv('RESPONSE_CACHE_ENABLED', 'False').lower() != 'true':
+        return None
+    return ResponseCache(
+        max_entries=int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 1024)),
+        max_bytes=int(os.getenv('RESPONSE_CACHE_MAX_BYTES', 16 * 1024 * 1024)),
+        ttl=float(os.getenv('RESPONSE_CACHE_TTL', 300)),
+        allow_sampled=os.getenv('RESPONSE_CACHE_ALLOW_SAMPLED', 'False').lower() == 'true',
+        shared=shared
+    )
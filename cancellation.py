@@ -0,0 +1,143 @@
+"""
+Client disconnect handling for streamed responses
+When a caller barges in, Vapi drops the SSE connection of the turn being spoken. Without
+noticing, the server would keep pulling the rest of the response from the upstream (billed
+tokens and GPU time nobody hears) and hold a worker and an admission slot until it finished.
+
+Disconnects are detected and turned into cancellation of the generation:
+    WSGI (app.py)       - socket_probe() polls the client socket as each upstream delta
+                          arrives; a write to a closed connection also closes the response
+    ASGI (asgi_app.py)  - the response listens for http.disconnect while it streams (or, for
+                          non-streamed requests, while the response is generated) and cancels
+                          the task, whatever ASGI spec version the server speaks
+
+Either way the chain of generators is closed from the outside in (chunking, fallback route,
+batch scheduler, provider stream), so the upstream HTTP request is closed and a batched request
+leaves its batch. CancellationStats records the cancelled streams and their completion tokens:
+sent before the disconnect, and generated but never sent.
+"""
+
+import select
+import socket
+import threading
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional
+
+from metrics import STREAMS_CANCELLED, STREAM_CANCELLED_TOKENS, model_label
+
+# Poll events meaning the peer closed or reset the connection; POLLRDHUP is Linux-only
+_HANGUP = select.POLLHUP | select.POLLERR | getattr(select, 'POLLRDHUP', 0)
+
+
+class ClientDisconnected(Exception):
+    """The client went away before its response was complete"""
+
+
+def socket_probe(environ: Dict[str, Any]) -> Optional[Callable[[], bool]]:
+    """
+    A non-blocking check whether the client of a WSGI request has disconnected, or None when
+    the server does not expose the connection (gunicorn and the werkzeug server do)
+    """
+    sock = environ.get('gunicorn.socket') or environ.get('werkzeug.socket')
+    if sock is None or not hasattr(select, 'poll'):
+        return None
+    try:
+        poller = select.poll()
+        poller.register(sock, select.POLLIN | _HANGUP)
+    except (OSError, ValueError, TypeError):
+        return None
+
+    def disconnected() -> bool:
+        events = poller.poll(0)
+        if not events:
+            return False
+        if events[0][1] & _HANGUP:
+            return True
+        # Readable: either the next pipelined request or end of file
+        try:
+            return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b''
+        except (BlockingIOError, InterruptedError):
+            return False
+        except OSError:
+            return True
+
+    return disconnected
+
+
+def _close(deltas: Any) -> None:
+    close = getattr(deltas, 'close', None)
+    if close is not None:
+        close()
+
+
+async def _aclose(deltas: Any) -> None:
+    aclose = getattr(deltas, 'aclose', None)
+    if aclose is not None:
+        await aclose()
+
+
+def watch(deltas: Iterator[str], generated: List[str], disconnected: Callable[[], bool] = None) -> Iterator[str]:
+    """
+    Upstream deltas, appended to generated as they arrive. Raises ClientDisconnected when
+    disconnected() turns true; closing this generator closes deltas, and so the upstream.
+    """
+    try:
+        for delta in deltas:
+            generated.append(delta)
+            if disconnected is not None and disconnected():
+                raise ClientDisconnected()
+            yield delta
+    finally:
+        _close(deltas)
+
+
+async def awatch(deltas: AsyncIterator[str], generated: List[str]) -> AsyncIterator[str]:
+    """Async version of watch; disconnects cancel the consuming task instead of being polled"""
+    try:
+        async for delta in deltas:
+            generated.append(delta)
+            yield delta
+    finally:
+        await _aclose(deltas)
+
+
+class CancellationStats:
+    """Thread-safe counters of responses cancelled by a client disconnect"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.cancelled = 0
+        self.waiting = 0
+        self.streaming = 0
+        self.sent_tokens = 0
+        self.unsent_tokens = 0
+
+    def record(self, model_name: str, sent_tokens: int = 0, unsent_tokens: int = 0, started: bool = False) -> None:
+        """
+        One cancelled response: started is whether the upstream had produced output; tokens are
+        completion tokens sent to the client before the disconnect, and generated but not sent
+        """
+        stage = 'streaming' if started else 'waiting'
+        label = model_label(model_name)
+        STREAMS_CANCELLED.inc((label, stage))
+        if sent_tokens:
+            STREAM_CANCELLED_TOKENS.inc((label, 'sent'), sent_tokens)
+        if unsent_tokens:
+            STREAM_CANCELLED_TOKENS.inc((label, 'unsent'), unsent_tokens)
+        with self._lock:
+            self.cancelled += 1
+            if started:
+                self.streaming += 1
+            else:
+                self.waiting += 1
+            self.sent_tokens += sent_tokens
+            self.unsent_tokens += unsent_tokens
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'cancelled': self.cancelled,
+                'cancelled_waiting': self.waiting,
+                'cancelled_streaming': self.streaming,
+                'sent_tokens': self.sent_tokens,
+                'unsent_tokens': self.unsent_tokens
+            }
@@ -0,0 +1,219 @@
+"""
+Speakable stream chunking for CustomLLM
+Upstream deltas are tokens (often a fraction of a word), and cached or echoed responses are
+replayed word by word: every one of them becomes an SSE frame. A TTS engine can only start
+speaking a phrase once it is complete, so most of those frames are overhead, and scripts
+without spaces (Chinese, Japanese, Thai) have no word boundaries at all.
+
+With chunking enabled, deltas are coalesced into speakable segments before they are framed:
+
+    phrase    - cut after clause and sentence punctuation (, ; : . ! ? … and the Arabic
+                ، ؛ ؟ ۔ and CJK ，、；：。！？ marks) and line breaks
+    sentence  - cut after sentence punctuation and line breaks only
+
+ASCII marks only count when followed by whitespace (so 3.5, 10:30 and URLs are not cut);
+Arabic and CJK marks count at once. Clause cuts wait for STREAM_CHUNK_MIN_CHARS characters,
+sentence cuts never wait. A segment longer than STREAM_CHUNK_MAX_CHARS is cut at its last space.
+
+A flush timer bounds the latency a segment adds: when text has been held for
+STREAM_CHUNK_MAX_DELAY_MS without reaching a boundary, what is there is sent up to its last
+space, so a slow first phrase still starts the TTS early. Under ASGI the timer fires while
+the upstream is silent; under Flask it is checked whenever a delta arrives.
+
+The concatenated segments are always exactly the upstream text. Tool call deltas are passed
+through as they are, after the text held before them.
+
+Configuration (environment variables):
+    STREAM_CHUNKING           - "token" (one frame per delta, default), "phrase" or "sentence"
+    STREAM_CHUNK_MIN_CHARS    - shortest segment cut at clause punctuation (default: 12)
+    STREAM_CHUNK_MAX_CHARS    - longest segment before it is cut at a space (default: 160)
+    STREAM_CHUNK_MAX_DELAY_MS - longest time text is held back, 0 = no timer (default: 300)
+"""
+
+import asyncio
+import os
+import re
+import time
+from typing import AsyncIterator, Callable, Iterator, List, Optional
+
+from metrics import STREAM_SEGMENTS
+
+_CLOSERS = '"\'”’»)\\]'
+
+# Sentence-final marks; ASCII ones need whitespace after them
+_SENTENCE_END = re.compile(
+    rf'[.!?…][{_CLOSERS}]*(?=\s)\s*|[؟۔。！？\n][{_CLOSERS}]*\s*'
+)
+# Sentence-final and clause marks
+_CLAUSE_END = re.compile(
+    rf'[.!?…,;:][{_CLOSERS}]*(?=\s)\s*|[؟۔。！？\n،؛，、；：][{_CLOSERS}]*\s*'
+)
+_LAST_SPACE = re.compile(r'.*\s', re.DOTALL)
+
+MODES = ('token', 'phrase', 'sentence')
+
+
+class Chunker:
+    """Coalescing state of one stream: feed() deltas, expire() on the timer, flush() at the end"""
+
+    def __init__(self, mode: str, min_chars: int, max_chars: int, max_delay: float):
+        self.pattern = _CLAUSE_END if mode == 'phrase' else _SENTENCE_END
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.max_delay = max_delay
+        self.buffer = ''
+        self.deadline: Optional[float] = None
+        self.overdue = False
+
+    def feed(self, delta: str, now: float) -> List[str]:
+        """Segments completed by this delta"""
+        if not self.buffer and self.max_delay:
+            self.deadline = now + self.max_delay
+        self.buffer += delta
+        segments = []
+        cut = self._boundary()
+        if cut:
+            segments.append(self._take(cut, 'punctuation'))
+        while len(self.buffer) > self.max_chars:
+            segments.append(self._take(self._space(self.max_chars) or self.max_chars, 'length'))
+        if self.buffer and (self.overdue or (self.deadline is not None and now >= self.deadline)):
+            segments.extend(self.expire())
+        return segments
+
+    def expire(self) -> List[str]:
+        """Segment held past the deadline, cut at the last space (none if there is no space yet)"""
+        cut = self._space()
+        if not cut:
+            # Wait for the end of the word, then send it at once
+            self.deadline = None
+            self.overdue = True
+            return []
+        return [self._take(cut, 'timer')]
+
+    def flush(self) -> Optional[str]:
+        """The rest of the text at the end of the stream"""
+        if not self.buffer:
+            return None
+        return self._take(len(self.buffer), 'end')
+
+    def time_left(self, now: float) -> Optional[float]:
+        """Seconds until expire() is due, or None when no timer is running"""
+        if self.deadline is None or not self.buffer:
+            return None
+        return max(0.0, self.deadline - now)
+
+    def _boundary(self) -> int:
+        # End of the last boundary that leaves a long enough segment (sentence ends always do)
+        cut = 0
+        for match in self.pattern.finditer(self.buffer):
+            end = match.end()
+            if end >= self.min_chars or _SENTENCE_END.fullmatch(match.group()):
+                cut = end
+        return cut
+
+    def _space(self, limit: Optional[int] = None) -> int:
+        # End of the last whitespace within the first limit characters
+        match = _LAST_SPACE.match(self.buffer, 0, limit or len(self.buffer))
+        return match.end() if match else 0
+
+    def _take(self, cut: int, reason: str) -> str:
+        segment, self.buffer = self.buffer[:cut], self.buffer[cut:]
+        STREAM_SEGMENTS.inc((reason,))
+        self.overdue = False
+        self.deadline = time.perf_counter() + self.max_delay if self.buffer and self.max_delay else None
+        return segment
+
+
+class StreamChunking:
+    """Chunking settings; wrap() / awrap() turn a delta iterator into a segment iterator"""
+
+    def __init__(self, mode: str = 'phrase', min_chars: int = 12, max_chars: int = 160, max_delay: float = 0.3):
+        if mode not in MODES:
+            raise ValueError(f"STREAM_CHUNKING must be one of {', '.join(MODES)}, got {mode!r}")
+        self.mode = mode
+        self.min_chars = min_chars
+        self.max_chars = max(1, max_chars)
+        self.max_delay = max_delay
+
+    def chunker(self) -> Chunker:
+        return Chunker(self.mode, self.min_chars, self.max_chars, self.max_delay)
+
+    def wrap(self, deltas: Iterator[str], on_delta: Callable[[float], None] = None) -> Iterator[str]:
+        """Segments of deltas; on_delta(received) is called as each delta arrives"""
+        chunker = self.chunker()
+        for delta in deltas:
+            received = time.perf_counter()
+            if on_delta:
+                on_delta(received)
+            if type(delta) is not str:
+                tail = chunker.flush()
+                if tail:
+                    yield tail
+                yield delta
+                continue
+            yield from chunker.feed(delta, received)
+        tail = chunker.flush()
+        if tail:
+            yield tail
+
+    async def awrap(self, deltas: AsyncIterator[str], on_delta: Callable[[float], None] = None) -> AsyncIterator[str]:
+        """Async version of wrap, whose timer also fires while no delta arrives"""
+        chunker = self.chunker()
+        iterator = deltas.__aiter__()
+        pending: Optional[asyncio.Future] = None
+        try:
+            while True:
+                timeout = chunker.time_left(time.perf_counter())
+                if timeout is None and pending is None:
+                    try:
+                        delta = await iterator.__anext__()
+                    except StopAsyncIteration:
+                        break
+                else:
+                    # Wait for the next delta without cancelling it when the timer fires first,
+                    # cancelling would close the upstream generator
+                    if pending is None:
+                        pending = asyncio.ensure_future(iterator.__anext__())
+                    done, _ = await asyncio.wait((pending,), timeout=timeout)
+                    if not done:
+                        for segment in chunker.expire():
+                            yield segment
+                        continue
+                    try:
+                        delta = pending.result()
+                    except StopAsyncIteration:
+                        break
+                    finally:
+                        pending = None
+                received = time.perf_counter()
+                if on_delta:
+                    on_delta(received)
+                if type(delta) is not str:
+                    tail = chunker.flush()
+                    if tail:
+                        yield tail
+                    yield delta
+                    continue
+                for segment in chunker.feed(delta, received):
+                    yield segment
+        finally:
+            if pending is not None:
+                # Let the cancelled read finish so deltas can be closed after this generator
+                pending.cancel()
+                await asyncio.wait((pending,))
+        tail = chunker.flush()
+        if tail:
+            yield tail
+
+
+def build_chunking_from_env() -> Optional[StreamChunking]:
+    """Return StreamChunking if STREAM_CHUNKING is phrase or sentence, None for token mode"""
+    mode = os.getenv('STREAM_CHUNKING', 'token').lower()
+    if mode == 'token':
+        return None
+    return StreamChunking(
+        mode,
+        min_chars=int(os.getenv('STREAM_CHUNK_MIN_CHARS', 12)),
+        max_chars=int(os.getenv('STREAM_CHUNK_MAX_CHARS', 160)),
+        max_delay=float(os.getenv('STREAM_CHUNK_MAX_DELAY_MS', 300)) / 1000
+    )
@@ -0,0 +1,362 @@
+"""
+Context window management for CustomLLM
+Vapi resends the whole call history on every turn, so prompts of a long call keep growing. Per
+model, the prompt sent upstream is kept within a token budget (the model's context limit minus
+CONTEXT_RESERVE_TOKENS for the reply): the leading system messages and the most recent turns
+are kept and older turns are left out. The kept turns start at a user message, since several
+chat templates (Anthropic, many Ollama and vLLM models) require user/assistant alternation
+starting with the user, and a tool result is never sent without the assistant message that
+requested it: when the current turn's tool rounds alone exceed the budget, that turn is sent
+whole.
+
+When the budget is exceeded the history is cut down to CONTEXT_TRIM_TARGET of the budget, and
+with a session (call id) that cut point is kept on later turns until the budget is exceeded
+again. The prompt prefix therefore stays identical for several turns, which keeps upstream
+prompt caches (Anthropic cache_control, vLLM prefix caching) effective.
+
+With CONTEXT_SUMMARIZE=true the turns left out of a call are replaced by a rolling summary,
+sent as a system message after the system prompt. Summaries are generated on a background
+thread after a cut, never on the request path: until one is ready the turns are dropped
+without a summary, and each new summary extends the previous one.
+
+Token counts come from tokenizer.py and are reused from the session, so a turn that fits costs
+one comparison. GET /stats/context reports tokens saved and the time spent per turn.
+
+Configuration (environment variables):
+    CONTEXT_WINDOW_LIMITS       - comma-separated "<model prefix>=<tokens>" rules, first match
+                                  wins, e.g. "gpt-4o=128000,llama3=8192"
+    CONTEXT_WINDOW_DEFAULT      - limit for unmatched models, 0 = unlimited (default: 0)
+    CONTEXT_RESERVE_TOKENS      - tokens left free for the reply (default: 1024)
+    CONTEXT_TRIM_TARGET         - fraction of the budget a cut trims down to (default: 0.75)
+    CONTEXT_SUMMARIZE           - "true" to summarize the turns left out (default: false)
+    CONTEXT_SUMMARY_MODEL       - model that writes summaries (default: the request's model)
+    CONTEXT_SUMMARY_MAX_TOKENS  - summaries longer than this are cut (default: 300)
+"""
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from metrics import CONTEXT_TOKENS_TRIMMED, model_label
+from tokenizer import TOKENS_PER_REPLY, Tokenizer
+
+logger = logging.getLogger(__name__)
+
+# (model name, prompt messages) -> summary text
+Summarizer = Callable[[str, List[Dict[str, Any]]], str]
+
+SUMMARY_PROMPT = (
+    "Summarize the conversation below for the assistant's own memory. Keep names, numbers, "
+    "decisions, commitments and open questions; leave out greetings and small talk. Write in the "
+    "language of the conversation, in at most {words} words. Reply with the summary only."
+)
+SUMMARY_PREFIX = 'Summary of the earlier part of this conversation: '
+
+
+def _text(content: Any) -> str:
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return ' '.join(part.get('text', '') for part in content if isinstance(part, dict))
+    return '' if content is None else str(content)
+
+
+def summary_request(previous: Optional[str], messages: List[Dict[str, Any]], max_tokens: int) -> List[Dict[str, Any]]:
+    """Prompt asking for a summary of messages that extends the previous summary"""
+    lines = [f"{msg.get('role')}: {_text(msg.get('content'))}" for msg in messages]
+    transcript = '\n'.join(lines)
+    if previous:
+        transcript = f'Summary so far:\n{previous}\n\nConversation since:\n{transcript}'
+    return [
+        {'role': 'system', 'content': SUMMARY_PROMPT.format(words=max(20, max_tokens * 2 // 3))},
+        {'role': 'user', 'content': transcript}
+    ]
+
+
+class Summary:
+    """Summary of messages[head:upto] of a call; last is messages[upto - 1], to detect a rewritten history"""
+
+    __slots__ = ('upto', 'last', 'text', 'message', 'tokens')
+
+    def __init__(self, upto: int, last: Dict[str, Any], text: str, tokenizer: Optional[Tokenizer] = None,
+                 tokens: Optional[int] = None):
+        self.upto = upto
+        self.last = last
+        self.text = text
+        self.message = {'role': 'system', 'content': SUMMARY_PREFIX + text}
+        self.tokens = tokens if tokens is not None else tokenizer.count_message(self.message)
+
+
+class ContextState:
+    """Per-session state, kept on Session.context"""
+
+    __slots__ = ('model', 'cut', 'summary', 'pending', 'sent_for', 'sent_tokens')
+
+    def __init__(self, model: str):
+        self.model = model
+        self.cut = 0  # index of the first recent message sent; 0 = nothing left out
+        self.summary: Optional[Summary] = None
+        self.pending = False  # a summary is being generated
+        self.sent_for: Optional[Tuple[int, int]] = None  # (len, id of last message) of the last fitted history
+        self.sent_tokens = 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Part of the state other replicas can use (see Session.snapshot)"""
+        summary = self.summary
+        return {
+            'model': self.model,
+            'cut': self.cut,
+            'summary': [summary.upto, summary.last, summary.text, summary.tokens] if summary else None
+        }
+
+    @classmethod
+    def restore(cls, data: Dict[str, Any]) -> 'ContextState':
+        state = cls(data['model'])
+        state.cut = data['cut']
+        if data.get('summary'):
+            upto, last, text, tokens = data['summary']
+            state.summary = Summary(upto, last, text, tokens=tokens)
+        return state
+
+    def usable_summary(self, messages: List[Dict[str, Any]]) -> Optional[Summary]:
+        summary = self.summary
+        if summary is None or summary.upto > len(messages) or messages[summary.upto - 1] != summary.last:
+            return None
+        return summary
+
+
+class ContextManager:
+    """Fits prompts into per-model token budgets; see the module docstring"""
+
+    def __init__(
+        self,
+        limits: List[Tuple[str, int]],
+        default_limit: int = 0,
+        reserve: int = 1024,
+        trim_target: float = 0.75,
+        summarizer: Optional[Summarizer] = None,
+        summary_model: Optional[str] = None,
+        summary_max_tokens: int = 300
+    ):
+        self.limits = limits
+        self.default_limit = default_limit
+        self.reserve = reserve
+        self.trim_target = trim_target
+        self.summarizer = summarizer
+        self.summary_model = summary_model
+        self.summary_max_tokens = summary_max_tokens
+        self._budgets: Dict[str, Optional[int]] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_lock = threading.Lock()
+        self.turns = 0
+        self.trimmed_turns = 0
+        self.tokens_in = 0
+        self.tokens_sent = 0
+        self.messages_dropped = 0
+        self.fit_seconds = 0.0
+        self.summaries_created = 0
+        self.summaries_failed = 0
+        self.summaries_used = 0
+        self.summary_seconds = 0.0
+
+    def budget_for(self, model: str) -> Optional[int]:
+        """Prompt token budget of a model, None when unlimited"""
+        if model in self._budgets:
+            return self._budgets[model]
+        limit = self.default_limit
+        for prefix, tokens in self.limits:
+            if model.startswith(prefix):
+                limit = tokens
+                break
+        budget = max(limit - self.reserve, 1) if limit > 0 else None
+        if len(self._budgets) < 1024:
+            self._budgets[model] = budget
+        return budget
+
+    def fit(
+        self,
+        messages: List[Dict[str, Any]],
+        model: str,
+        tokenizer: Tokenizer,
+        session: Any = None
+    ) -> Tuple[List[Dict[str, Any]], int]:
+        """
+        Messages to send for this turn and their prompt token count. The list is returned
+        unchanged when it fits. session is the call's Session, already extended with messages.
+        """
+        started = time.perf_counter()
+        state = self._state(session, model)
+        if session is not None and len(session.token_counts) == len(messages):
+            counts = session.token_counts
+            total = session.prompt_tokens + TOKENS_PER_REPLY
+        else:
+            counts = [tokenizer.count_message(msg) for msg in messages]
+            total = sum(counts) + TOKENS_PER_REPLY
+
+        budget = self.budget_for(model)
+        if budget is None or total <= budget:
+            sent, sent_tokens, cut, summary = messages, total, 0, None
+        else:
+            head = 0
+            while head < len(messages) - 1 and messages[head].get('role') == 'system':
+                head += 1
+            fixed = sum(counts[:head]) + TOKENS_PER_REPLY
+            summary = state.usable_summary(messages) if state else None
+            cut = state.cut if state else 0
+            # Keep the previous cut, and with it a stable prompt prefix, while it still fits
+            if not (head < cut < len(messages) and messages[cut].get('role') == 'user'
+                    and (summary is None or summary.upto <= cut)
+                    and fixed + (summary.tokens if summary else 0) + sum(counts[cut:]) <= budget):
+                cut = self._cut(messages, counts, head, int(budget * self.trim_target) - fixed - (summary.tokens if summary else 0))
+                if summary is not None and summary.upto > cut:
+                    summary = None
+                    cut = self._cut(messages, counts, head, int(budget * self.trim_target) - fixed)
+            sent = messages[:head] + ([summary.message] if summary else []) + messages[cut:]
+            sent_tokens = fixed + (summary.tokens if summary else 0) + sum(counts[cut:])
+            if state is not None and self.summarizer is not None:
+                self._schedule(state, model, tokenizer, messages, summary.upto if summary else head, cut, summary)
+            self.trimmed_turns += 1
+            self.messages_dropped += cut - head
+            self.summaries_used += summary is not None
+            CONTEXT_TOKENS_TRIMMED.inc((model_label(model),), total - sent_tokens)
+
+        if state is not None:
+            state.cut = cut
+            state.sent_for = (len(messages), id(messages[-1]))
+            state.sent_tokens = sent_tokens
+        self.turns += 1
+        self.tokens_in += total
+        self.tokens_sent += sent_tokens
+        self.fit_seconds += time.perf_counter() - started
+        return sent, sent_tokens
+
+    def prompt_tokens(self, messages: List[Dict[str, Any]], model: str, tokenizer: Tokenizer, session: Any = None) -> int:
+        """Prompt tokens actually sent for messages, for usage accounting"""
+        state = session.context if session is not None else None
+        if state is not None and state.model == model and state.sent_for == (len(messages), id(messages[-1])):
+            return state.sent_tokens
+        budget = self.budget_for(model)
+        total = tokenizer.count_messages(messages)
+        if budget is None or total <= budget:
+            return total
+        # Not the turn fitted last; recount as a stateless fit would send it
+        head = 0
+        while head < len(messages) - 1 and messages[head].get('role') == 'system':
+            head += 1
+        counts = [tokenizer.count_message(msg) for msg in messages]
+        fixed = sum(counts[:head]) + TOKENS_PER_REPLY
+        return fixed + sum(counts[self._cut(messages, counts, head, int(budget * self.trim_target) - fixed):])
+
+    @staticmethod
+    def _cut(messages: List[Dict[str, Any]], counts: List[int], head: int, available: int) -> int:
+        """Index of the oldest message kept so that messages[cut:] fits in available tokens"""
+        cut = len(messages)
+        used = 0
+        while cut > head and used + counts[cut - 1] <= available:
+            used += counts[cut - 1]
+            cut -= 1
+        # The kept turns start at a user message. When the cut falls inside the current turn (its
+        # tool rounds after the last user message), that turn is sent whole even over the budget,
+        # so tool results always come with the call that requested them
+        cut = max(cut, head)
+        for i in range(cut, len(messages)):
+            if messages[i].get('role') == 'user':
+                return i
+        for i in range(cut - 1, head - 1, -1):
+            if messages[i].get('role') == 'user':
+                return i
+        return head
+
+    def _state(self, session: Any, model: str) -> Optional[ContextState]:
+        if session is None:
+            return None
+        if session.context is None or session.context.model != model:
+            session.context = ContextState(model)
+        return session.context
+
+    def _schedule(self, state: ContextState, model: str, tokenizer: Tokenizer, messages: List[Dict[str, Any]],
+                  start: int, cut: int, previous: Optional[Summary]) -> None:
+        """Summarize messages[start:cut] on top of previous in the background"""
+        if state.pending or start >= cut:
+            return
+        state.pending = True
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='context-summary')
+        self._executor.submit(
+            self._summarize, state, model, tokenizer, messages[start:cut], cut, messages[cut - 1],
+            previous.text if previous else None
+        )
+
+    def _summarize(self, state: ContextState, model: str, tokenizer: Tokenizer, messages: List[Dict[str, Any]],
+                   upto: int, last: Dict[str, Any], previous: Optional[str]) -> None:
+        started = time.perf_counter()
+        try:
+            text = self.summarizer(self.summary_model or model, summary_request(previous, messages, self.summary_max_tokens)).strip()
+            tokens = tokenizer.count_text(text)
+            if tokens > self.summary_max_tokens:
+                text = text[:len(text) * self.summary_max_tokens // tokens]
+            if text:
+                state.summary = Summary(upto, last, text, tokenizer)
+                self.summaries_created += 1
+        except Exception as e:
+            self.summaries_failed += 1
+            logger.warning(f"Context summary failed for model {model}: {e}")
+        finally:
+            self.summary_seconds += time.perf_counter() - started
+            state.pending = False
+
+    def stats(self) -> Dict[str, Any]:
+        turns = self.turns
+        return {
+            'enabled': True,
+            'limits': dict(self.limits),
+            'default_limit': self.default_limit,
+            'reserve_tokens': self.reserve,
+            'trim_target': self.trim_target,
+            'turns': turns,
+            'trimmed_turns': self.trimmed_turns,
+            'messages_dropped': self.messages_dropped,
+            'tokens_in': self.tokens_in,
+            'tokens_sent': self.tokens_sent,
+            'tokens_saved': self.tokens_in - self.tokens_sent,
+            'tokens_saved_per_turn': (self.tokens_in - self.tokens_sent) / turns if turns else None,
+            'fit_us_per_turn': self.fit_seconds / turns * 1e6 if turns else None,
+            'summaries': {
+                'enabled': self.summarizer is not None,
+                'created': self.summaries_created,
+                'failed': self.summaries_failed,
+                'used': self.summaries_used,
+                'seconds_per_summary': self.summary_seconds / (self.summaries_created + self.summaries_failed)
+                if self.summaries_created + self.summaries_failed else None
+            }
+        }
+
+
+def build_context_manager_from_env(summarizer: Optional[Summarizer] = None) -> Optional[ContextManager]:
+    """
+    Return a ContextManager if CONTEXT_WINDOW_LIMITS or CONTEXT_WINDOW_DEFAULT is set, otherwise
+    None. summarizer is used when CONTEXT_SUMMARIZE is true.
+    """
+    limits = []
+    for rule in os.getenv('CONTEXT_WINDOW_LIMITS', '').split(','):
+        prefix, sep, tokens = rule.strip().partition('=')
+        if sep:
+            limits.append((prefix.strip(), int(tokens)))
+    default_limit = int(os.getenv('CONTEXT_WINDOW_DEFAULT', 0))
+    if not limits and default_limit <= 0:
+        return None
+    summarize = os.getenv('CONTEXT_SUMMARIZE', 'False').lower() == 'true'
+    return ContextManager(
+        limits,
+        default_limit=default_limit,
+        reserve=int(os.getenv('CONTEXT_RESERVE_TOKENS', 1024)),
+        trim_target=float(os.getenv('CONTEXT_TRIM_TARGET', 0.75)),
+        summarizer=summarizer if summarize else None,
+        summary_model=os.getenv('CONTEXT_SUMMARY_MODEL') or None,
+        summary_max_tokens=int(os.getenv('CONTEXT_SUMMARY_MAX_TOKENS', 300))
+    )
@@ -1,13 +1,33 @@
 """
 أمثلة على كيفية دمج LLM حقيقي في CustomLLM class
 Examples of how to integrate real LLM services into CustomLLM class
+
+ملاحظة: CustomLLM يستخدم الآن providers.py مع connection pools دائمة.
+Note: CustomLLM now routes through providers.py, which keeps pooled keep-alive clients
+per upstream. These standalone examples create a new client per call and are kept for reference.
 """
 
 import os
 import json
+import time
 from typing import List, Dict, Any
 
 
+def _sse_chunk(model: str, delta: Dict[str, str], finish_reason: str = None) -> str:
+    """
+    إطار SSE بنفس صيغة CustomLLM._stream_response
+    One OpenAI chat.completion.chunk SSE frame, the same shape CustomLLM._stream_response emits
+    """
+    chunk_data = {
+        'id': f"chatcmpl-{int(time.time())}",
+        'object': 'chat.completion.chunk',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]
+    }
+    return f"data: {json.dumps(chunk_data, ensure_ascii=False)}\n\n"
+
+
 # ============================================
 # مثال 1: التكامل مع OpenAI
 # Example 1: OpenAI Integration
@@ -20,9 +40,10 @@ def openai_integration(messages: List[Dict[str, str]], stream: bool = False):
         import openai
         
         client = openai.OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+        model_name = os.getenv('OPENAI_MODEL', 'gpt-4')
         
         response = client.chat.completions.create(
-            model=os.getenv('OPENAI_MODEL', 'gpt-4'),
+            model=model_name,
             messages=messages,
             stream=stream,
             temperature=0.7
@@ -31,7 +52,8 @@ def openai_integration(messages: List[Dict[str, str]], stream: bool = False):
         if stream:
             for chunk in response:
                 if chunk.choices[0].delta.content:
-                    yield f"data: {json.dumps({'content': chunk.choices[0].delta.content}, ensure_ascii=False)}\n\n"
+                    yield _sse_chunk(model_name, {'content': chunk.choices[0].delta.content})
+            yield _sse_chunk(model_name, {}, 'stop')
             yield "data: [DONE]\n\n"
         else:
             return response.choices[0].message.content
@@ -54,6 +76,7 @@ def anthropic_integration(messages: List[Dict[str, str]], stream: bool = False):
         import anthropic
         
         client = anthropic.Anthropic(api_key=os.getenv('ANTHROPIC_API_KEY'))
+        model_name = os.getenv('ANTHROPIC_MODEL', 'claude-3-opus-20240229')
         
         # Convert messages format for Anthropic
         system_message = None
@@ -69,7 +92,7 @@ def anthropic_integration(messages: List[Dict[str, str]], stream: bool = False):
                 })
         
         response = client.messages.create(
-            model=os.getenv('ANTHROPIC_MODEL', 'claude-3-opus-20240229'),
+            model=model_name,
             max_tokens=1024,
             system=system_message,
             messages=conversation_messages,
@@ -80,7 +103,8 @@ def anthropic_integration(messages: List[Dict[str, str]], stream: bool = False):
             for chunk in response:
                 if chunk.type == 'content_block_delta':
                     if chunk.delta.text:
-                        yield f"data: {json.dumps({'content': chunk.delta.text}, ensure_ascii=False)}\n\n"
+                        yield _sse_chunk(model_name, {'content': chunk.delta.text})
+            yield _sse_chunk(model_name, {}, 'stop')
             yield "data: [DONE]\n\n"
         else:
             return response.content[0].text
@@ -120,9 +144,10 @@ def ollama_integration(messages: List[Dict[str, str]], stream: bool = False):
             for line in response.iter_lines():
                 if line:
                     data = json.loads(line)
-                    if 'message' in data and 'content' in data['message']:
-                        yield f"data: {json.dumps({'content': data['message']['content']}, ensure_ascii=False)}\n\n"
+                    if data.get('message', {}).get('content'):
+                        yield _sse_chunk(model_name, {'content': data['message']['content']})
                     if data.get('done', False):
+                        yield _sse_chunk(model_name, {}, 'stop')
                         yield "data: [DONE]\n\n"
         else:
             data = response.json()
@@ -156,9 +181,7 @@ class CustomLLM:
         return ollama_integration(messages, stream)
         
         # Option 4: Multiple providers with fallback
-        try:
-            return openai_integration(messages, stream)
-        except:
-            return ollama_integration(messages, stream)
+        # Use PROVIDER_FALLBACKS instead (routing.py): it falls back before the first token,
+        # skips failing providers (circuit breaker) and can hedge slow requests
 """
 
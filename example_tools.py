@@ -0,0 +1,48 @@
+"""
+Example local tools for a dental clinic receptionist (TOOLS_MODULE=example_tools)
+The lookups stand in for calls to a booking system and sleep like one would; they are
+idempotent and cached for a short while. Booking changes state, so it is never cached.
+"""
+
+import time
+import uuid
+
+from tools import tool
+
+# Simulated round trip to the clinic's booking system
+LOOKUP_SECONDS = 0.3
+
+
+@tool(
+    description='Free appointment slots of the clinic on a date',
+    parameters={
+        'type': 'object',
+        'properties': {'date': {'type': 'string', 'description': 'YYYY-MM-DD, default today'}}
+    },
+    cache_ttl=30
+)
+def check_availability(date=None):
+    time.sleep(LOOKUP_SECONDS)
+    return {'date': date or time.strftime('%Y-%m-%d'), 'slots': ['10:00', '11:30', '16:00']}
+
+
+@tool(description='Opening hours of the clinic', cache_ttl=300)
+def clinic_hours():
+    time.sleep(LOOKUP_SECONDS)
+    return {'saturday-wednesday': '09:00-21:00', 'thursday': '09:00-14:00', 'friday': 'closed'}
+
+
+@tool(
+    description='Book an appointment slot for a patient',
+    parameters={
+        'type': 'object',
+        'properties': {
+            'date': {'type': 'string'},
+            'time': {'type': 'string'},
+            'patient': {'type': 'string'}
+        }
+    },
+    timeout=5.0
+)
+def book_appointment(date=None, time=None, patient=None):
+    return {'booked': True, 'reference': uuid.uuid4().hex[:8], 'date': date, 'time': time, 'patient': patient}
@@ -0,0 +1,170 @@
+"""
+سيرفر Redis بديل محلي
+Local stand-in for Redis, for exercising shared_store.RedisStore without a Redis server
+
+Speaks the RESP2 protocol for the commands the shared store uses (PING, AUTH, SELECT, GET,
+MGET, SET with EX/PX, DEL, EXISTS, DBSIZE, FLUSHDB, plus STATS). --latency-ms delays every
+read from a connection, like a network hop: a pipeline of commands sent in one write pays it
+once, commands sent one by one pay it each time. STATS replies with the commands and round
+trips served so far as a JSON string.
+
+Usage:
+    python fake_redis.py --port 6390 --latency-ms 1
+    SHARED_STORE_URL=redis://127.0.0.1:6390/0 python app.py
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from typing import Dict, List, Optional, Tuple
+
+# Tunables, overridden from the command line
+CONFIG = {'latency': 0.0, 'password': None}
+
+STATS = {'connections': 0, 'commands': 0, 'round_trips': 0}
+
+# db -> key -> (value, expires_at or None)
+DATA: Dict[int, Dict[bytes, Tuple[bytes, Optional[float]]]] = {}
+
+
+def _bulk(value: Optional[bytes]) -> bytes:
+    return b'$-1\r\n' if value is None else b'$%d\r\n%s\r\n' % (len(value), value)
+
+
+def _error(message: str) -> bytes:
+    return f'-ERR {message}\r\n'.encode()
+
+
+def _get(db: Dict[bytes, Tuple[bytes, Optional[float]]], key: bytes) -> Optional[bytes]:
+    entry = db.get(key)
+    if entry is None:
+        return None
+    if entry[1] is not None and entry[1] <= time.time():
+        del db[key]
+        return None
+    return entry[0]
+
+
+class Connection:
+    """State of one client connection"""
+
+    def __init__(self):
+        self.db = 0
+        self.authenticated = CONFIG['password'] is None
+
+    def execute(self, args: List[bytes]) -> bytes:
+        STATS['commands'] += 1
+        name = args[0].upper().decode()
+        if name == 'AUTH':
+            if args[-1].decode() != CONFIG['password']:
+                return _error('invalid password')
+            self.authenticated = True
+            return b'+OK\r\n'
+        if not self.authenticated:
+            return b'-NOAUTH Authentication required.\r\n'
+        db = DATA.setdefault(self.db, {})
+        if name == 'PING':
+            return b'+PONG\r\n'
+        if name == 'SELECT':
+            self.db = int(args[1])
+            return b'+OK\r\n'
+        if name == 'GET':
+            return _bulk(_get(db, args[1]))
+        if name == 'MGET':
+            return b'*%d\r\n' % (len(args) - 1) + b''.join(_bulk(_get(db, key)) for key in args[1:])
+        if name == 'SET':
+            expires = None
+            options = [arg.upper() for arg in args[3:]]
+            for i, option in enumerate(options):
+                if option == b'EX':
+                    expires = time.time() + int(args[4 + i])
+                elif option == b'PX':
+                    expires = time.time() + int(args[4 + i]) / 1000
+            db[args[1]] = (args[2], expires)
+            return b'+OK\r\n'
+        if name == 'DEL':
+            return b':%d\r\n' % sum(1 for key in args[1:] if db.pop(key, None) is not None)
+        if name == 'EXISTS':
+            return b':%d\r\n' % sum(1 for key in args[1:] if _get(db, key) is not None)
+        if name == 'DBSIZE':
+            return b':%d\r\n' % len(db)
+        if name == 'FLUSHDB':
+            db.clear()
+            return b'+OK\r\n'
+        if name == 'STATS':
+            return _bulk(json.dumps(STATS).encode())
+        return _error(f"unknown command '{name}'")
+
+
+def _parse(buffer: bytes) -> Tuple[List[List[bytes]], bytes]:
+    """Complete commands at the start of buffer, and the incomplete rest"""
+    commands = []
+    while buffer:
+        if not buffer.startswith(b'*'):
+            # Inline command (e.g. typed into telnet)
+            line, sep, rest = buffer.partition(b'\r\n')
+            if not sep:
+                break
+            commands.append(line.split())
+            buffer = rest
+            continue
+        end = buffer.find(b'\r\n')
+        if end < 0:
+            break
+        pos = end + 2
+        args = []
+        for _ in range(int(buffer[1:end])):
+            end = buffer.find(b'\r\n', pos)
+            if end < 0:
+                return commands, buffer
+            size = int(buffer[pos + 1:end])
+            pos = end + 2
+            if len(buffer) < pos + size + 2:
+                return commands, buffer
+            args.append(buffer[pos:pos + size])
+            pos += size + 2
+        commands.append(args)
+        buffer = buffer[pos:]
+    return commands, buffer
+
+
+async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    STATS['connections'] += 1
+    conn = Connection()
+    buffer = b''
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            commands, buffer = _parse(buffer + data)
+            if not commands:
+                continue
+            # One simulated network hop per batch of commands that arrived together
+            STATS['round_trips'] += 1
+            if CONFIG['latency']:
+                await asyncio.sleep(CONFIG['latency'])
+            writer.write(b''.join(conn.execute(args) for args in commands if args))
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def main(host: str, port: int):
+    server = await asyncio.start_server(handle, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6390)
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='delay per round trip')
+    parser.add_argument('--password', default=None)
+    args = parser.parse_args()
+    CONFIG.update(latency=args.latency_ms / 1000, password=args.password)
+    asyncio.run(main(args.host, args.port))
@@ -0,0 +1,239 @@
+"""
+سيرفر بديل محلي لمزودي LLM
+Local stand-in upstream for exercising providers.py without real API keys
+
+Speaks enough of the OpenAI (/v1/chat/completions), Anthropic (/v1/messages) and
+Ollama (/api/chat) protocols for the provider backends, streaming and non-streaming,
+with a configurable time-to-first-token and per-token delay. --slow-fraction/--slow-ttft give
+the first token a heavy tail and --fail-fraction answers some requests with HTTP 503, for
+exercising fallback routing and hedged requests (routing.py).
+
+/v1/batch stands in for a local model server behind providers.BatchBackend: it has one
+"accelerator", so batches run one at a time, and a batch of N conversations takes as long
+as a single one (one prefill of --ttft, then one decode step of --token-delay per token).
+
+With tools in an OpenAI request, the streamed reply calls the tools named in the last user
+message (after --ttft, arguments paced by --token-delay); a reply to tool results echoes them.
+
+GET /stats counts requests, the tokens generated for streams and the streams abandoned because
+the client closed the connection before the last token.
+
+Usage:
+    python fake_upstream.py --port 9000 --ttft 0.2 --token-delay 0.02
+    OPENAI_BASE_URL=http://127.0.0.1:9000/v1 MODEL_NAME=gpt-fake python app.py
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+# Tunables, overridden from the command line
+CONFIG = {'ttft': 0.0, 'token_delay': 0.0, 'tokens': 20, 'slow_fraction': 0.0, 'slow_ttft': 0.0, 'fail_fraction': 0.0}
+
+STATS = {'requests': 0, 'batches': 0, 'batched_requests': 0, 'failed': 0, 'tokens_generated': 0, 'streams_abandoned': 0}
+
+# The single simulated accelerator behind /v1/batch
+_accelerator = None
+
+
+def _tokens(body):
+    """Deterministic reply: echo of the last user message (or tool results) padded to CONFIG['tokens'] words"""
+    last = next((m.get('content', '') for m in reversed(body.get('messages', [])) if m.get('role') in ('user', 'tool')), '')
+    words = (str(last).split() or ['ok'])
+    return [words[i % len(words)] + ' ' for i in range(CONFIG['tokens'])]
+
+
+def _ttft():
+    """Time to first token: --slow-ttft for a --slow-fraction of requests, else --ttft"""
+    return CONFIG['slow_ttft'] if random.random() < CONFIG['slow_fraction'] else CONFIG['ttft']
+
+
+def _injected_failure():
+    """A 503 response for a --fail-fraction of requests, else None"""
+    if random.random() < CONFIG['fail_fraction']:
+        STATS['failed'] += 1
+        return JSONResponse({'error': {'message': 'Injected failure', 'type': 'server_error'}}, status_code=503)
+    return None
+
+
+async def _paced(tokens):
+    finished = False
+    try:
+        await asyncio.sleep(_ttft())
+        for i, token in enumerate(tokens):
+            if i:
+                await asyncio.sleep(CONFIG['token_delay'])
+            STATS['tokens_generated'] += 1
+            yield token
+        finished = True
+    finally:
+        if not finished:
+            STATS['streams_abandoned'] += 1
+
+
+def _called_tools(body):
+    """Names of the tools a reply calls: those named in the last message when it is the user's"""
+    messages = body.get('messages') or [{}]
+    if not body.get('tools') or body.get('tool_choice') == 'none' or messages[-1].get('role') != 'user':
+        return []
+    text = str(messages[-1].get('content', ''))
+    return [tool['function']['name'] for tool in body['tools'] if tool['function']['name'] in text]
+
+
+async def _paced_calls(names):
+    """OpenAI tool_calls deltas: the call's id and name, then its arguments in two pieces"""
+    await asyncio.sleep(_ttft())
+    for index, name in enumerate(names):
+        pieces = [{'id': f'call_fake{index}', 'type': 'function', 'function': {'name': name, 'arguments': ''}},
+                  {'function': {'arguments': '{'}}, {'function': {'arguments': '}'}}]
+        for piece in pieces:
+            await asyncio.sleep(CONFIG['token_delay'])
+            STATS['tokens_generated'] += 1
+            yield dict(piece, index=index)
+
+
+async def openai_chat(request: Request):
+    STATS['requests'] += 1
+    failure = _injected_failure()
+    if failure:
+        return failure
+    body = await request.json()
+    tokens = _tokens(body)
+    if not body.get('stream'):
+        await asyncio.sleep(_ttft() + CONFIG['token_delay'] * (len(tokens) - 1))
+        return JSONResponse({
+            'id': 'chatcmpl-fake', 'object': 'chat.completion', 'created': int(time.time()), 'model': body.get('model'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': ''.join(tokens)}, 'finish_reason': 'stop'}]
+        })
+
+    names = _called_tools(body)
+
+    async def events():
+        if names:
+            async for call in _paced_calls(names):
+                chunk = {'object': 'chat.completion.chunk', 'choices': [{'index': 0, 'delta': {'tool_calls': [call]}}]}
+                yield f"data: {json.dumps(chunk)}\n\n"
+            chunk = {'object': 'chat.completion.chunk', 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'tool_calls'}]}
+            yield f"data: {json.dumps(chunk)}\n\n"
+        else:
+            async for token in _paced(tokens):
+                chunk = {'object': 'chat.completion.chunk', 'choices': [{'index': 0, 'delta': {'content': token}}]}
+                yield f"data: {json.dumps(chunk)}\n\n"
+        yield "data: [DONE]\n\n"
+    return StreamingResponse(events(), media_type='text/event-stream')
+
+
+async def anthropic_messages(request: Request):
+    STATS['requests'] += 1
+    failure = _injected_failure()
+    if failure:
+        return failure
+    body = await request.json()
+    tokens = _tokens(body)
+    if not body.get('stream'):
+        await asyncio.sleep(_ttft() + CONFIG['token_delay'] * (len(tokens) - 1))
+        return JSONResponse({'type': 'message', 'content': [{'type': 'text', 'text': ''.join(tokens)}]})
+
+    async def events():
+        yield 'event: message_start\ndata: {"type": "message_start"}\n\n'
+        async for token in _paced(tokens):
+            event = {'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': token}}
+            yield f"event: content_block_delta\ndata: {json.dumps(event)}\n\n"
+        yield 'event: message_stop\ndata: {"type": "message_stop"}\n\n'
+    return StreamingResponse(events(), media_type='text/event-stream')
+
+
+async def ollama_chat(request: Request):
+    STATS['requests'] += 1
+    failure = _injected_failure()
+    if failure:
+        return failure
+    body = await request.json()
+    tokens = _tokens(body)
+    if not body.get('stream', True):
+        await asyncio.sleep(_ttft() + CONFIG['token_delay'] * (len(tokens) - 1))
+        return JSONResponse({'message': {'role': 'assistant', 'content': ''.join(tokens)}, 'done': True})
+
+    async def lines():
+        async for token in _paced(tokens):
+            yield json.dumps({'message': {'role': 'assistant', 'content': token}, 'done': False}) + '\n'
+        yield json.dumps({'message': {'role': 'assistant', 'content': ''}, 'done': True}) + '\n'
+    return StreamingResponse(lines(), media_type='application/x-ndjson')
+
+
+async def batch(request: Request):
+    global _accelerator
+    if _accelerator is None:
+        _accelerator = asyncio.Lock()
+    body = await request.json()
+    requests = body.get('requests', [])
+    STATS['requests'] += 1
+    STATS['batches'] += 1
+    STATS['batched_requests'] += len(requests)
+    replies = [_tokens(item) for item in requests]
+
+    if not body.get('stream'):
+        async with _accelerator:
+            await asyncio.sleep(CONFIG['ttft'] + CONFIG['token_delay'] * (CONFIG['tokens'] - 1))
+        return JSONResponse({'results': [{'index': i, 'content': ''.join(tokens)} for i, tokens in enumerate(replies)]})
+
+    async def lines():
+        finished = False
+        try:
+            async with _accelerator:
+                await asyncio.sleep(CONFIG['ttft'])
+                for step in range(CONFIG['tokens']):
+                    if step:
+                        await asyncio.sleep(CONFIG['token_delay'])
+                    # One decode step produces the next token of every conversation in the batch
+                    STATS['tokens_generated'] += len(replies)
+                    yield ''.join(json.dumps({'index': i, 'delta': tokens[step]}) + '\n' for i, tokens in enumerate(replies))
+            finished = True
+        finally:
+            if not finished:
+                STATS['streams_abandoned'] += 1
+        yield ''.join(json.dumps({'index': i, 'finish_reason': 'stop'}) + '\n' for i in range(len(replies)))
+    return StreamingResponse(lines(), media_type='application/x-ndjson')
+
+
+async def stats(request: Request):
+    return JSONResponse(STATS)
+
+
+app = Starlette(routes=[
+    Route('/v1/chat/completions', openai_chat, methods=['POST']),
+    Route('/v1/messages', anthropic_messages, methods=['POST']),
+    Route('/api/chat', ollama_chat, methods=['POST']),
+    Route('/v1/batch', batch, methods=['POST']),
+    Route('/stats', stats, methods=['GET']),
+])
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--ttft', type=float, default=0.0, help='seconds before the first token')
+    parser.add_argument('--token-delay', type=float, default=0.0, help='seconds between tokens')
+    parser.add_argument('--tokens', type=int, default=20, help='tokens per response')
+    parser.add_argument('--slow-fraction', type=float, default=0.0, help='share of requests with a slow first token')
+    parser.add_argument('--slow-ttft', type=float, default=0.0, help='seconds before the first token of a slow request')
+    parser.add_argument('--fail-fraction', type=float, default=0.0, help='share of requests answered with HTTP 503')
+    parser.add_argument('--seed', type=int, help='random seed for slow and failed requests')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    CONFIG.update(
+        ttft=args.ttft, token_delay=args.token_delay, tokens=args.tokens,
+        slow_fraction=args.slow_fraction, slow_ttft=args.slow_ttft, fail_fraction=args.fail_fraction
+    )
+    uvicorn.run(app, host=args.host, port=args.port, log_level='warning')
@@ -0,0 +1,142 @@
+"""
+Production launcher for the Custom LLM server: gunicorn -c gunicorn.conf.py
+
+The master imports the app once (preload) and forks the workers from it, so CustomLLM, the
+tokenizers and the caches are loaded a single time and shared copy-on-write instead of being
+loaded again in every worker. Background threads the app starts at import (log writer,
+request log writer) are restarted in each worker after the fork.
+
+Shutdown and reload (SIGTERM, SIGHUP, max requests, memory limit) are graceful: a worker
+stops accepting connections and lets in-flight SSE streams finish for up to GRACEFUL_TIMEOUT
+seconds before they are cut. With preloading, SIGHUP restarts the workers but does not pick up
+code changes; restart the master (or USR2 + TERM the old master) for that.
+
+Workers are recycled after MAX_REQUESTS requests (with jitter, so they don't all restart at
+once) or when their private memory exceeds WORKER_MAX_MEMORY_MB. The master replaces a
+recycled worker by forking a fresh one.
+
+Caches, sessions and the /stats and /metrics counters live in each worker: with several
+workers they are per process (route a call to one worker, or use fewer, larger workers).
+
+Configuration (environment variables):
+    SERVER_MODE                  - "asgi" (uvicorn workers, default) or "flask" (threaded workers)
+    HOST, PORT                   - bind address (default: 0.0.0.0:8000)
+    WEB_CONCURRENCY              - worker processes (default: available CPUs)
+    WORKER_THREADS               - threads per worker in flask mode (default: 32)
+    PRELOAD_APP                  - "false" to import the app in every worker instead (default: true)
+    GRACEFUL_TIMEOUT             - seconds in-flight requests get to finish on shutdown (default: 30)
+    MAX_REQUESTS                 - recycle a worker after this many requests, 0 = never (default: 0)
+    MAX_REQUESTS_JITTER          - random extra requests per worker (default: MAX_REQUESTS / 10)
+    WORKER_MAX_MEMORY_MB         - recycle a worker above this private memory, 0 = never (default: 0)
+    WORKER_MEMORY_CHECK_INTERVAL - seconds between memory checks (default: 10)
+"""
+
+import os
+import signal
+import threading
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Gunicorn reads this file before it preloads the app
+_CONFIG_LOADED_AT = time.monotonic()
+
+
+def cpu_count() -> int:
+    """CPUs this process may run on (respects taskset / cpuset limits)"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def private_memory_mb(pid: str = 'self') -> float:
+    """
+    Unique set size (Linux): memory only this process uses, not shared copy-on-write pages.
+    Raises OSError where /proc/<pid>/smaps_rollup is missing (macOS, kernels before 4.14).
+    """
+    total = 0
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            if line.startswith(('Private_Clean:', 'Private_Dirty:')):
+                total += int(line.split()[1])
+    return total / 1024
+
+
+SERVER_MODE = os.getenv('SERVER_MODE', 'asgi').lower()
+if SERVER_MODE not in ('asgi', 'flask'):
+    raise ValueError(f"SERVER_MODE must be 'asgi' or 'flask', got {SERVER_MODE!r}")
+
+bind = f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', 8000)}"
+workers = int(os.getenv('WEB_CONCURRENCY') or cpu_count())
+preload_app = os.getenv('PRELOAD_APP', 'True').lower() == 'true'
+graceful_timeout = int(os.getenv('GRACEFUL_TIMEOUT', 30))
+max_requests = int(os.getenv('MAX_REQUESTS', 0))
+max_requests_jitter = int(os.getenv('MAX_REQUESTS_JITTER', max_requests // 10))
+keepalive = 5
+
+WORKER_MAX_MEMORY_MB = float(os.getenv('WORKER_MAX_MEMORY_MB', 0))
+WORKER_MEMORY_CHECK_INTERVAL = float(os.getenv('WORKER_MEMORY_CHECK_INTERVAL', 10))
+
+if SERVER_MODE == 'asgi':
+    from uvicorn_worker import UvicornWorker
+
+    class DrainingUvicornWorker(UvicornWorker):
+        """Uvicorn worker that gives in-flight streams the graceful timeout, then runs the lifespan shutdown"""
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            # Stop waiting for open connections just before the master would kill the worker,
+            # so pooled upstream clients are still closed
+            self.config.timeout_graceful_shutdown = max(1, self.cfg.graceful_timeout - 1)
+
+    wsgi_app = 'asgi_app:app'
+    worker_class = DrainingUvicornWorker
+else:
+    wsgi_app = 'app:app'
+    worker_class = 'gthread'
+    threads = int(os.getenv('WORKER_THREADS', 32))
+
+
+def when_ready(server):
+    server.log.info(
+        f"Master ready in {time.monotonic() - _CONFIG_LOADED_AT:.2f}s "
+        f"({SERVER_MODE}, {workers} workers, preload={preload_app})"
+    )
+
+
+def post_fork(server, worker):
+    worker._forked_at = time.monotonic()
+
+
+def _watch_memory(worker):
+    while worker.alive:
+        time.sleep(WORKER_MEMORY_CHECK_INTERVAL)
+        try:
+            used = private_memory_mb()
+        except OSError as e:
+            worker.log.warning(f"Worker {worker.pid} memory watchdog stopped: {e}")
+            return
+        if used > WORKER_MAX_MEMORY_MB:
+            worker.log.warning(
+                f"Worker {worker.pid} uses {used:.0f} MB (limit {WORKER_MAX_MEMORY_MB:.0f} MB), recycling"
+            )
+            # The worker's own SIGTERM handling drains in-flight requests before it exits
+            os.kill(worker.pid, signal.SIGTERM)
+            return
+
+
+def post_worker_init(worker):
+    try:
+        memory = f'{private_memory_mb():.1f} MB'
+    except OSError:
+        memory = 'n/a'
+    worker.log.info(
+        f"Worker {worker.pid} ready in {time.monotonic() - worker._forked_at:.2f}s, private memory {memory}"
+    )
+    if WORKER_MAX_MEMORY_MB > 0:
+        if memory == 'n/a':
+            worker.log.warning(f"WORKER_MAX_MEMORY_MB is set but private memory cannot be read here; not watching worker {worker.pid}")
+            return
+        threading.Thread(target=_watch_memory, args=(worker,), name='memory-watchdog', daemon=True).start()
@@ -0,0 +1,365 @@
+"""
+API key store
+Holds SHA-256 hashes of the accepted API keys with per-key metadata (tenant, allowed models,
+limits). A presented key is hashed once and looked up in an in-memory dict, so verification is
+O(1) and its timing depends only on the hash, never on how much of a stored key matched.
+
+Keys come from a JSON file or a SQLite database, plus the single legacy API_KEY if set. The
+source is re-checked at most every API_KEYS_RELOAD_INTERVAL seconds and reloaded when it has
+changed, so keys can be added or revoked without restarting workers.
+
+JSON file format:
+    {"keys": [{"id": "acme-prod", "hash": "<sha256 hex>", "tenant": "acme",
+               "models": ["gpt-4o", "claude-"], "max_concurrent": 8, "rate": 5, "burst": 10}]}
+
+SQLite table (created by `python keystore.py add --db ...`):
+    api_keys(id, hash, tenant, models, max_concurrent, rate, burst, disabled)
+
+Configuration (environment variables):
+    API_KEYS_FILE             - path of the JSON key file
+    API_KEYS_DB               - path of the SQLite key database
+    API_KEY                   - single legacy key, accepted for all models (tenant "default")
+    API_KEY_PEPPER            - optional secret mixed into the hashes (HMAC-SHA256)
+    API_KEYS_RELOAD_INTERVAL  - seconds between change checks (default: 2)
+
+Manage keys:
+    python keystore.py add --file keys.json --id acme-prod --tenant acme --models gpt-4o,claude-
+    python keystore.py revoke --file keys.json --id acme-prod
+    python keystore.py list --db keys.db
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from service import APIError
+
+logger = logging.getLogger(__name__)
+
+
+def hash_key(key: str, pepper: str = '') -> str:
+    """Hex digest stored for a key: SHA-256, or HMAC-SHA256 when a pepper is configured"""
+    if pepper:
+        return hmac.new(pepper.encode('utf-8'), key.encode('utf-8'), hashlib.sha256).hexdigest()
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def generate_key() -> str:
+    return f"sk-{secrets.token_urlsafe(32)}"
+
+
+class KeyRecord:
+    """Metadata of one API key; models holds allowed model-name prefixes (empty = all models)"""
+
+    __slots__ = ('key_id', 'digest', 'tenant', 'models', 'max_concurrent', 'rate', 'burst')
+
+    def __init__(
+        self,
+        key_id: str,
+        digest: str,
+        tenant: str = 'default',
+        models: Tuple[str, ...] = (),
+        max_concurrent: Optional[int] = None,
+        rate: Optional[float] = None,
+        burst: Optional[float] = None
+    ):
+        self.key_id = key_id
+        self.digest = digest
+        self.tenant = tenant
+        self.models = models
+        self.max_concurrent = max_concurrent
+        self.rate = rate
+        self.burst = burst
+
+    @property
+    def limits(self) -> Tuple[Optional[int], Optional[float], Optional[float]]:
+        """(max_concurrent, rate, burst) overrides for admission control"""
+        return self.max_concurrent, self.rate, self.burst
+
+    def allows(self, model: str) -> bool:
+        return not self.models or any(model.startswith(prefix) for prefix in self.models)
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'KeyRecord':
+        models = data.get('models') or ()
+        if isinstance(models, str):
+            models = models.split(',')
+        return cls(
+            key_id=str(data['id']),
+            digest=str(data['hash']).lower(),
+            tenant=data.get('tenant') or 'default',
+            models=tuple(m.strip() for m in models if m.strip()),
+            max_concurrent=int(data['max_concurrent']) if data.get('max_concurrent') else None,
+            rate=float(data['rate']) if data.get('rate') else None,
+            burst=float(data['burst']) if data.get('burst') else None
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'id': self.key_id,
+            'hash': self.digest,
+            'tenant': self.tenant,
+            'models': list(self.models),
+            'max_concurrent': self.max_concurrent,
+            'rate': self.rate,
+            'burst': self.burst
+        }
+
+
+class KeyStore:
+    """
+    In-memory digest -> KeyRecord map with periodic change detection.
+    Subclasses implement _load() and _version(); the base class handles lookup and reloads.
+    """
+
+    source = 'static'
+    reloadable = False
+
+    def __init__(self, static: Iterable[KeyRecord] = (), pepper: str = '', reload_interval: float = 2.0):
+        self.pepper = pepper
+        self.reload_interval = reload_interval
+        self._static = list(static)
+        self._records: Dict[str, KeyRecord] = {}
+        self._lock = threading.Lock()
+        self._version_seen: Any = None
+        self._next_check = 0.0
+        self.reloads = 0
+        self.reload_errors = 0
+        self.reload()
+
+    def _load(self) -> List[KeyRecord]:
+        return []
+
+    def _version(self) -> Any:
+        """Cheap change marker of the source (e.g. file mtime); a different value triggers a reload"""
+        return None
+
+    def reload(self) -> None:
+        """Re-read the source; on failure the previously loaded keys stay active"""
+        with self._lock:
+            try:
+                version = self._version()
+                records = {record.digest: record for record in self._load()}
+            except Exception as e:
+                self.reload_errors += 1
+                logger.error(f"Failed to load API keys from {self.source}: {e}")
+                return
+            for record in self._static:
+                records.setdefault(record.digest, record)
+            # A single reference swap: concurrent lookups see the old or the new map, never a mix
+            self._records = records
+            self._version_seen = version
+            self.reloads += 1
+        logger.info(f"Loaded {len(records)} API keys from {self.source}")
+
+    def _maybe_reload(self) -> None:
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now + self.reload_interval
+        try:
+            changed = self._version() != self._version_seen
+        except Exception as e:
+            logger.error(f"Failed to check API keys in {self.source}: {e}")
+            return
+        if changed:
+            self.reload()
+
+    def verify(self, key: str) -> Optional[KeyRecord]:
+        """The record of a presented key, or None if it is unknown or revoked"""
+        if self.reload_interval >= 0:
+            self._maybe_reload()
+        digest = hash_key(key, self.pepper)
+        record = self._records.get(digest)
+        if record is None or not hmac.compare_digest(record.digest, digest):
+            return None
+        return record
+
+    def stats(self) -> Dict[str, Any]:
+        records = self._records
+        return {
+            'source': self.source,
+            'keys': len(records),
+            'tenants': len({record.tenant for record in records.values()}),
+            'reloads': self.reloads,
+            'reload_errors': self.reload_errors
+        }
+
+
+class FileKeyStore(KeyStore):
+    """Keys from a JSON file, reloaded when its modification time or size changes"""
+
+    reloadable = True
+
+    def __init__(self, path: str, **kwargs: Any):
+        self.path = path
+        self.source = f'file:{path}'
+        super().__init__(**kwargs)
+
+    def _version(self) -> Any:
+        st = os.stat(self.path)
+        return (st.st_mtime_ns, st.st_size)
+
+    def _load(self) -> List[KeyRecord]:
+        with open(self.path, encoding='utf-8') as f:
+            data = json.load(f)
+        return [KeyRecord.from_dict(item) for item in data.get('keys', []) if not item.get('disabled')]
+
+
+class SQLiteKeyStore(KeyStore):
+    """Keys from a SQLite database, reloaded when another connection has committed a change"""
+
+    reloadable = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS api_keys (
+            id TEXT PRIMARY KEY,
+            hash TEXT NOT NULL UNIQUE,
+            tenant TEXT NOT NULL DEFAULT 'default',
+            models TEXT NOT NULL DEFAULT '',
+            max_concurrent INTEGER,
+            rate REAL,
+            burst REAL,
+            disabled INTEGER NOT NULL DEFAULT 0
+        )
+    """
+
+    def __init__(self, path: str, **kwargs: Any):
+        self.path = path
+        self.source = f'sqlite:{path}'
+        self._conn = connect_db(path)
+        self._conn_lock = threading.Lock()
+        super().__init__(**kwargs)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self) -> None:
+        # A SQLite connection must not be used across fork: each worker opens its own
+        self._conn = connect_db(self.path)
+        self._conn_lock = threading.Lock()
+
+    def _version(self) -> Any:
+        # data_version changes whenever another connection commits to the database
+        with self._conn_lock:
+            return self._conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def _load(self) -> List[KeyRecord]:
+        with self._conn_lock:
+            rows = self._conn.execute(
+                'SELECT id, hash, tenant, models, max_concurrent, rate, burst FROM api_keys WHERE disabled = 0'
+            ).fetchall()
+        columns = ('id', 'hash', 'tenant', 'models', 'max_concurrent', 'rate', 'burst')
+        return [KeyRecord.from_dict(dict(zip(columns, row))) for row in rows]
+
+
+def connect_db(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    conn.execute(SQLiteKeyStore.SCHEMA)
+    return conn
+
+
+def authorize_model(record: Optional[KeyRecord], model_name: str) -> None:
+    """Raise a 403 if the authenticated key may not use model_name"""
+    if record is not None and not record.allows(model_name):
+        raise APIError(
+            f'This API key is not allowed to use model {model_name}',
+            'model_not_allowed', type='permission_error', status=403
+        )
+
+
+def build_keystore_from_env() -> Optional[KeyStore]:
+    """None when no keys are configured (authentication disabled)"""
+    pepper = os.getenv('API_KEY_PEPPER', '')
+    static = []
+    if os.getenv('API_KEY'):
+        static.append(KeyRecord('default', hash_key(os.getenv('API_KEY'), pepper)))
+    options = {
+        'static': static,
+        'pepper': pepper,
+        'reload_interval': float(os.getenv('API_KEYS_RELOAD_INTERVAL', 2))
+    }
+    if os.getenv('API_KEYS_DB'):
+        return SQLiteKeyStore(os.getenv('API_KEYS_DB'), **options)
+    if os.getenv('API_KEYS_FILE'):
+        return FileKeyStore(os.getenv('API_KEYS_FILE'), **options)
+    if static:
+        return KeyStore(**options)
+    return None
+
+
+# ----- command line key management -----
+
+def _read_file(path: str) -> Dict[str, Any]:
+    if not os.path.exists(path):
+        return {'keys': []}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _write_file(path: str, data: Dict[str, Any]) -> None:
+    # Write then rename, so a reloading worker never reads a half-written file
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage hashed API keys')
+    parser.add_argument('command', choices=['add', 'revoke', 'list'])
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--file', help='JSON key file')
+    source.add_argument('--db', help='SQLite key database')
+    parser.add_argument('--id', help='key id (add, revoke)')
+    parser.add_argument('--tenant', default='default')
+    parser.add_argument('--models', default='', help='comma-separated allowed model prefixes (default: all)')
+    parser.add_argument('--max-concurrent', type=int)
+    parser.add_argument('--rate', type=float)
+    parser.add_argument('--burst', type=float)
+    args = parser.parse_args()
+
+    pepper = os.getenv('API_KEY_PEPPER', '')
+    if args.command in ('add', 'revoke') and not args.id:
+        parser.error('--id is required')
+
+    if args.command == 'add':
+        key = generate_key()
+        record = KeyRecord(
+            args.id, hash_key(key, pepper), args.tenant,
+            tuple(m.strip() for m in args.models.split(',') if m.strip()),
+            args.max_concurrent, args.rate, args.burst
+        )
+        if args.file:
+            data = _read_file(args.file)
+            data['keys'] = [item for item in data['keys'] if item.get('id') != args.id] + [record.to_dict()]
+            _write_file(args.file, data)
+        else:
+            connect_db(args.db).execute(
+                'INSERT OR REPLACE INTO api_keys (id, hash, tenant, models, max_concurrent, rate, burst) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (record.key_id, record.digest, record.tenant, ','.join(record.models), record.max_concurrent, record.rate, record.burst)
+            )
+        # The plain key is shown once and never stored
+        print(key)
+    elif args.command == 'revoke':
+        if args.file:
+            data = _read_file(args.file)
+            data['keys'] = [item for item in data['keys'] if item.get('id') != args.id]
+            _write_file(args.file, data)
+        else:
+            connect_db(args.db).execute('UPDATE api_keys SET disabled = 1 WHERE id = ?', (args.id,))
+    else:
+        store = FileKeyStore(args.file, reload_interval=-1) if args.file else SQLiteKeyStore(args.db, reload_interval=-1)
+        for record in store._records.values():
+            print(json.dumps({k: v for k, v in record.to_dict().items() if k != 'hash'}, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+"""
+Logging configuration for the Custom LLM server
+Log calls on the request path only append the record to a queue: a writer thread formats and
+writes queued records every LOG_FLUSH_INTERVAL_MS, so a slow stderr, pipe or disk never blocks
+a request. When the bounded queue is full the record is dropped and counted rather than
+waited for.
+
+Every record carries the id of the request it was logged for (X-Request-Id from the client,
+or a generated one, echoed in the response), set per request with set_request_id(). Records
+logged outside a request get "-".
+
+Request bodies are logged through log_body(), which samples them (LOG_BODY_SAMPLE) and defers
+serialization to the writer thread, truncating to about LOG_BODY_MAX_CHARS without
+serializing the part that is cut. With LOG_FORMAT=json
+each line is a JSON object with ts, level, logger, request_id and message, plus exc_info and
+any `extra` fields.
+
+Configuration (environment variables):
+    LOG_LEVEL             - root level (default: INFO)
+    LOG_FORMAT            - "text" (default) or "json"
+    LOG_ASYNC             - "false" to write from the logging thread (default: true)
+    LOG_QUEUE_SIZE        - records buffered for the writer before dropping (default: 10000)
+    LOG_FLUSH_INTERVAL_MS - how often the writer drains the queue (default: 100)
+    LOG_FILE              - append to this file instead of stderr
+    LOG_BODY_SAMPLE       - fraction of request bodies logged (default: 1.0)
+    LOG_BODY_MAX_CHARS    - logged body length before truncation, 0 = unlimited (default: 2000)
+"""
+
+import atexit
+import logging
+import os
+import random
+import secrets
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, Optional
+
+from serialization import dumps
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s'
+
+_request_id: ContextVar[str] = ContextVar('request_id', default='-')
+
+# Attributes every LogRecord has; anything else on a record came from `extra`
+_RECORD_ATTRS = frozenset(logging.makeLogRecord({}).__dict__) | {'message', 'asctime', 'request_id'}
+
+_body_sample = 1.0
+_body_max_chars = 2000
+
+
+def new_request_id() -> str:
+    return secrets.token_hex(8)
+
+
+def set_request_id(request_id: Optional[str]) -> str:
+    """Tag the current request's log records with request_id (or a new id); returns the id"""
+    request_id = request_id[:64] if request_id else new_request_id()
+    _request_id.set(request_id)
+    return request_id
+
+
+def get_request_id() -> str:
+    return _request_id.get()
+
+
+class RequestIdFilter(logging.Filter):
+    """Stamp records with the current request id; runs in the caller's thread, before enqueueing"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = _request_id.get()
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per record"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        line: Dict[str, Any] = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'request_id': getattr(record, 'request_id', '-'),
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS:
+                line[key] = value if isinstance(value, (str, int, float, bool, type(None))) else str(value)
+        if record.exc_info:
+            line['exc_info'] = self.formatException(record.exc_info)
+        return dumps(line)
+
+
+def preview(value: Any, budget: int) -> str:
+    """
+    JSON of value cut to roughly budget characters. What is cut is never serialized, so the
+    cost depends on the budget, not on the conversation length: long strings are shortened,
+    lists keep their last items (the newest turns) after a "... N earlier" marker and objects
+    end with a "... N more" entry.
+    """
+    if isinstance(value, str):
+        return dumps(value if len(value) <= budget else value[:max(budget, 0)] + '...')
+    if isinstance(value, (list, tuple)):
+        parts = []
+        for i, item in enumerate(reversed(value)):
+            if budget <= 0:
+                parts.append(dumps(f'... {len(value) - i} earlier'))
+                break
+            text = preview(item, budget)
+            parts.append(text)
+            budget -= len(text) + 1
+        return '[' + ','.join(reversed(parts)) + ']'
+    if isinstance(value, dict):
+        parts = []
+        for i, (key, item) in enumerate(value.items()):
+            if budget <= 0:
+                parts.append(f'"...":{dumps(f"{len(value) - i} more")}')
+                break
+            text = f'{dumps(str(key))}:{preview(item, budget)}'
+            parts.append(text)
+            budget -= len(text) + 1
+        return '{' + ','.join(parts) + '}'
+    return dumps(value)
+
+
+class _Body:
+    """Request body serialized only when the record is formatted, i.e. on the writer thread"""
+
+    __slots__ = ('data',)
+
+    def __init__(self, data: Any):
+        self.data = data
+
+    def __str__(self) -> str:
+        return preview(self.data, _body_max_chars) if _body_max_chars else dumps(self.data)
+
+
+def log_body(logger: logging.Logger, message: str, data: Any) -> None:
+    """Log a request body at INFO, subject to LOG_BODY_SAMPLE and LOG_BODY_MAX_CHARS"""
+    if not logger.isEnabledFor(logging.INFO) or (_body_sample < 1.0 and random.random() >= _body_sample):
+        return
+    logger.info('%s: %s', message, _Body(data))
+
+
+class BackgroundHandler(logging.Handler):
+    """
+    Queue records for a writer thread that passes them to the target handler. Producers only
+    append to a deque (no lock, no thread wake-up); the writer drains it every flush interval,
+    or as soon as the queue is half full. Records are queued unformatted, so formatting and
+    body serialization happen on the writer thread. A full queue drops the record.
+    A forked child (a gunicorn worker forked after the app was preloaded) starts its own writer.
+    """
+
+    def __init__(self, target: logging.Handler, max_size: int = 10000, flush_interval: float = 0.1):
+        super().__init__()
+        self.target = target
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._queue: Deque[logging.LogRecord] = deque()
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self._thread.start()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self) -> None:
+        # Threads don't survive fork; records still queued are the parent's to write
+        self._queue = deque()
+        self._wake = threading.Event()
+        self.dropped = 0
+        if not self._stopped:
+            self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+            self._thread.start()
+
+    def handle(self, record: logging.LogRecord) -> bool:
+        # No handler lock: deque.append is atomic
+        if not self.filter(record):
+            return False
+        size = len(self._queue)
+        if size >= self.max_size:
+            self.dropped += 1
+            return False
+        self._queue.append(record)
+        if size * 2 == self.max_size:
+            self._wake.set()
+        return True
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.handle(record)
+
+    def _drain(self) -> None:
+        queue = self._queue
+        while queue:
+            self.target.handle(queue.popleft())
+            # Give the GIL back between records, so a request thread waiting for it is not
+            # held up for a whole switch interval while a backlog is written
+            time.sleep(0)
+
+    def _run(self) -> None:
+        while not self._stopped:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self._drain()
+
+    def queued(self) -> int:
+        return len(self._queue)
+
+    def close(self) -> None:
+        """Write out what is still queued and stop the writer thread"""
+        if not self._stopped:
+            self._stopped = True
+            self._wake.set()
+            self._thread.join()
+            self._drain()
+            self.target.close()
+        super().close()
+
+
+_background: Optional[BackgroundHandler] = None
+_configured = False
+
+
+def setup_logging() -> None:
+    """Configure the root logger from the environment; replaces logging.basicConfig"""
+    global _body_sample, _body_max_chars, _background, _configured
+    if _configured:
+        return
+    _configured = True
+    _body_sample = float(os.getenv('LOG_BODY_SAMPLE', 1.0))
+    _body_max_chars = int(os.getenv('LOG_BODY_MAX_CHARS', 2000))
+
+    log_file = os.getenv('LOG_FILE')
+    output = logging.FileHandler(log_file, encoding='utf-8') if log_file else logging.StreamHandler()
+    if os.getenv('LOG_FORMAT', 'text').lower() == 'json':
+        output.setFormatter(JSONFormatter())
+    else:
+        output.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    root = logging.getLogger()
+    root.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+
+    if os.getenv('LOG_ASYNC', 'True').lower() == 'true':
+        _background = BackgroundHandler(
+            output,
+            max_size=int(os.getenv('LOG_QUEUE_SIZE', 10000)),
+            flush_interval=float(os.getenv('LOG_FLUSH_INTERVAL_MS', 100)) / 1000
+        )
+        _background.addFilter(RequestIdFilter())
+        root.addHandler(_background)
+        atexit.register(_background.close)
+    else:
+        output.addFilter(RequestIdFilter())
+        root.addHandler(output)
+
+
+def logging_stats() -> Dict[str, Any]:
+    return {
+        'async': _background is not None,
+        'level': logging.getLevelName(logging.getLogger().level),
+        'queued': _background.queued() if _background else 0,
+        'dropped': _background.dropped if _background else 0,
+        'body_sample': _body_sample,
+        'body_max_chars': _body_max_chars
+    }
@@ -0,0 +1,384 @@
+"""
+Metrics for the Custom LLM server
+Prometheus-style counters, gauges and histograms, rendered in the text exposition format
+on /metrics. Streaming latency histograms are also available as JSON on /stats/latency.
+
+Updates are lock-free: every thread writes to its own shard and a scrape sums the shards.
+Shards of finished threads (Flask's dev server uses a thread per request) are folded into
+a retired total on the next scrape, so the shard list stays bounded.
+
+The model label comes from the request, so it goes through model_label: the first
+METRICS_MAX_MODELS distinct names (default 50) are kept and later ones are reported as "other",
+which bounds the series a client can create with made-up model names.
+"""
+
+import os
+import threading
+import time
+from bisect import bisect_left
+from typing import Any, Dict, List, Optional, Tuple
+
+# Bucket upper bounds in seconds: 0.1 ms .. 10 s
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.0075, 0.01, 0.015, 0.02, 0.025,
+    0.05, 0.075, 0.1, 0.125, 0.15, 0.2, 0.25, 0.3, 0.4, 0.5, 0.75, 1.0, 1.5, 2.5, 5.0, 10.0
+)
+
+# Bucket upper bounds in bytes: 256 B .. 16 MB
+SIZE_BUCKETS = tuple(256 * 4 ** i for i in range(9))
+
+Labels = Tuple[str, ...]
+
+
+class _Metric:
+    """Per-thread sharded storage shared by all metric types"""
+
+    type = 'untyped'
+
+    def __init__(self, name: str, description: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self._local = threading.local()
+        self._shards: List[Tuple[threading.Thread, Dict[Labels, Any]]] = []
+        self._retired: Dict[Labels, Any] = {}
+        self._lock = threading.Lock()  # only taken on a thread's first write and on scrape
+        REGISTRY.append(self)
+
+    def _shard(self) -> Dict[Labels, Any]:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def _merge(self, into: Dict[Labels, Any], shard: Dict[Labels, Any]) -> None:
+        raise NotImplementedError
+
+    def _collect(self) -> Dict[Labels, Any]:
+        """Sum all shards, folding those of finished threads into the retired total"""
+        with self._lock:
+            live = []
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    live.append((thread, shard))
+                else:
+                    self._merge(self._retired, shard)
+            self._shards = live
+            merged: Dict[Labels, Any] = {}
+            self._merge(merged, self._retired)
+            for _, shard in live:
+                # dict() copies under the GIL, so a concurrent writer cannot break iteration
+                self._merge(merged, dict(shard))
+        return merged
+
+    def _label_str(self, labels: Labels, extra: str = '') -> str:
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.label_names, labels)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Monotonic counter"""
+
+    type = 'counter'
+
+    def inc(self, labels: Labels = (), amount: float = 1) -> None:
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def _merge(self, into, shard):
+        for labels, value in shard.items():
+            into[labels] = into.get(labels, 0) + value
+
+    def values(self) -> Dict[Labels, float]:
+        return self._collect()
+
+    def render(self) -> List[str]:
+        return [f'{self.name}{self._label_str(labels)} {_num(value)}' for labels, value in sorted(self._collect().items())]
+
+
+class Gauge(Counter):
+    """Up/down gauge; increments and decrements may happen on different threads"""
+
+    type = 'gauge'
+
+    def dec(self, labels: Labels = (), amount: float = 1) -> None:
+        self.inc(labels, -amount)
+
+
+class Histogram(_Metric):
+    """Cumulative-bucket histogram with quantile estimates"""
+
+    type = 'histogram'
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+        label_names: Tuple[str, ...] = ()
+    ):
+        self.buckets = buckets
+        super().__init__(name, description, label_names)
+
+    def observe(self, value: float, labels: Labels = ()) -> None:
+        shard = self._shard()
+        data = shard.get(labels)
+        if data is None:
+            # bucket counts (last slot is +Inf), then sum, then count
+            data = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        data[bisect_left(self.buckets, value)] += 1
+        data[-2] += value
+        data[-1] += 1
+
+    def _merge(self, into, shard):
+        for labels, data in shard.items():
+            target = into.get(labels)
+            if target is None:
+                into[labels] = list(data)
+            else:
+                for i, value in enumerate(data):
+                    target[i] += value
+
+    def _combined(self) -> List[float]:
+        """All label sets merged into one series"""
+        combined = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        for data in self._collect().values():
+            for i, value in enumerate(data):
+                combined[i] += value
+        return combined
+
+    def quantile(self, q: float, data: Optional[List[float]] = None) -> Optional[float]:
+        """Estimate a quantile by linear interpolation inside the matching bucket"""
+        data = data if data is not None else self._combined()
+        total = data[-1]
+        if total == 0:
+            return None
+        rank = q * total
+        seen = 0
+        lower = 0.0
+        for i, count in enumerate(data[:-2]):
+            upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+            if count and seen + count >= rank:
+                return lower + (upper - lower) * ((rank - seen) / count)
+            seen += count
+            lower = upper
+        return self.buckets[-1]
+
+    def snapshot(self) -> Dict[str, Any]:
+        data = self._combined()
+        total, total_sum = data[-1], data[-2]
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(list(self.buckets) + ['+Inf'], data[:-2]):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return {
+            'description': self.description,
+            'count': total,
+            'sum': total_sum,
+            'mean': total_sum / total if total else None,
+            'p50': self.quantile(0.50, data),
+            'p95': self.quantile(0.95, data),
+            'p99': self.quantile(0.99, data),
+            'buckets': buckets
+        }
+
+    def render(self) -> List[str]:
+        lines = []
+        for labels, data in sorted(self._collect().items()):
+            cumulative = 0
+            for bound, count in zip(list(self.buckets) + ['+Inf'], data[:-2]):
+                cumulative += count
+                le = 'le="+Inf"' if bound == '+Inf' else f'le="{_num(bound)}"'
+                lines.append(f'{self.name}_bucket{self._label_str(labels, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{self._label_str(labels)} {_num(data[-2])}')
+            lines.append(f'{self.name}_count{self._label_str(labels)} {data[-1]}')
+        return lines
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _num(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) and not float(value).is_integer() else str(int(value))
+
+
+REGISTRY: List[_Metric] = []
+
+
+class BoundedLabel:
+    """Values of a client-supplied label: the first `limit` distinct values are kept, later ones become `other`"""
+
+    OTHER = 'other'
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._values = set()
+        self._lock = threading.Lock()
+
+    def reserve(self, value: str) -> None:
+        """Keep value (e.g. the configured default model) whatever else has been seen"""
+        with self._lock:
+            self._values.add(value)
+
+    def __call__(self, value: str) -> str:
+        if value in self._values:
+            return value
+        with self._lock:
+            if len(self._values) < self.limit:
+                self._values.add(value)
+                return value
+        return self.OTHER
+
+
+model_label = BoundedLabel(int(os.getenv('METRICS_MAX_MODELS', 50)))
+
+
+def render_prometheus() -> str:
+    """All registered metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f'# HELP {metric.name} {metric.description}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+# ----- HTTP metrics -----
+
+HTTP_REQUESTS = Counter(
+    'http_requests_total', 'HTTP requests by route, method and status', ('route', 'method', 'status'))
+HTTP_ERRORS = Counter(
+    'http_errors_total', 'Error responses by route and error code', ('route', 'code'))
+HTTP_LATENCY = Histogram(
+    'http_request_duration_seconds', 'Time until the full response was sent, by route', label_names=('route',))
+HTTP_REQUEST_BYTES = Histogram(
+    'http_request_size_bytes', 'Request body size by route', SIZE_BUCKETS, ('route',))
+HTTP_RESPONSE_BYTES = Histogram(
+    'http_response_size_bytes', 'Response body size by route', SIZE_BUCKETS, ('route',))
+STREAMS_IN_FLIGHT = Gauge(
+    'streams_in_flight', 'SSE responses currently being streamed')
+
+ADMISSION_REJECTED = Counter(
+    'admission_rejected_total', 'Requests rejected with 429 by admission control, by reason', ('reason',))
+ADMISSION_QUEUE_WAIT = Histogram(
+    'admission_queue_wait_seconds', 'Time admitted requests spent waiting for a concurrency slot')
+
+# ----- Generation metrics -----
+
+GENERATION_LATENCY = Histogram(
+    'llm_generation_duration_seconds', 'Time to produce a complete response, by model and mode',
+    label_names=('model', 'stream'))
+
+BATCH_SIZE = Histogram(
+    'batch_size', 'Requests per batched upstream call, by backend', (1, 2, 4, 8, 16, 32, 64, 128), ('backend',))
+BATCH_QUEUE_WAIT = Histogram(
+    'batch_queue_wait_seconds', 'Time a request waited for its batch to be dispatched, by backend', label_names=('backend',))
+
+PROVIDER_FALLBACKS = Counter(
+    'provider_fallbacks_total', 'Requests moved to the next backend of a fallback chain, by failed backend', ('backend',))
+HEDGED_REQUESTS = Counter(
+    'hedged_requests_total', 'Hedge requests sent because a backend exceeded its hedge delay, by slow backend', ('backend',))
+HEDGE_WINS = Counter(
+    'hedge_wins_total', 'Hedge requests that answered before the original, by winning backend', ('backend',))
+CIRCUIT_BREAKER_OPENED = Counter(
+    'circuit_breaker_opened_total', 'Times a backend circuit breaker opened', ('backend',))
+SPECULATION_OUTCOMES = Counter(
+    'speculation_outcomes_total', 'Turns that followed a speculative pre-generation, by outcome (hit, late, miss)', ('outcome',))
+SPECULATION_WASTED_SECONDS = Counter(
+    'speculation_wasted_seconds_total', 'Generation time spent on speculative responses that were discarded')
+CONTEXT_TOKENS_TRIMMED = Counter(
+    'context_tokens_trimmed_total', 'Prompt tokens left out to fit the context window, by model', ('model',))
+BATCH_JOB_REQUESTS = Counter(
+    'batch_job_requests_total', 'Requests of offline batches processed, by outcome (completed, failed)', ('outcome',))
+SHARED_STORE_ROUND_TRIPS = Counter(
+    'shared_store_round_trips_total', 'Batches of reads or writes sent to the shared store, by operation', ('op',))
+SHARED_STORE_ERRORS = Counter(
+    'shared_store_errors_total', 'Shared store operations that failed, by operation (read, write)', ('op',))
+STREAM_SEGMENTS = Counter(
+    'stream_segments_total', 'Speakable segments sent by stream chunking, by cut reason (punctuation, length, timer, end)', ('reason',))
+STREAMS_CANCELLED = Counter(
+    'streams_cancelled_total', 'Responses cancelled because the client disconnected, by model and stage (waiting, streaming)', ('model', 'stage'))
+STREAM_CANCELLED_TOKENS = Counter(
+    'stream_cancelled_tokens_total', 'Completion tokens of cancelled responses, by model and whether they were sent before the disconnect', ('model', 'delivery'))
+TOOL_CALLS = Counter(
+    'tool_calls_total', 'Calls to local tools, by tool and outcome (ok, cached, error, timeout)', ('tool', 'outcome'))
+
+STREAM_TTFT = Histogram(
+    'stream_ttft_seconds', 'Time from request handling to the first content frame sent to the client')
+STREAM_UPSTREAM_TTFT = Histogram(
+    'stream_upstream_ttft_seconds', 'Time from opening the upstream stream to its first delta')
+STREAM_INTER_TOKEN = Histogram(
+    'stream_inter_token_seconds', 'Gap between consecutive content frames sent to the client')
+STREAM_FRAME_OVERHEAD = Histogram(
+    'stream_frame_overhead_seconds', 'Server time from receiving an upstream delta to its SSE frame being ready')
+TOOL_LATENCY = Histogram(
+    'tool_call_duration_seconds', 'Time from starting a round of local tool calls to a call returning, by tool', label_names=('tool',))
+
+LATENCY_HISTOGRAMS: List[Histogram] = [STREAM_TTFT, STREAM_UPSTREAM_TTFT, STREAM_INTER_TOKEN, STREAM_FRAME_OVERHEAD]
+
+
+class StreamTimer:
+    """
+    Per-request stream timing. Call upstream_opened() before pulling the first delta, then
+    frame(received) for every frame, where received is the perf_counter() value at which the
+    upstream delta arrived. When deltas are coalesced before framing, upstream_delta(received)
+    is called for each of them so the upstream TTFT is still that of the first delta.
+    """
+
+    def __init__(self, started: Optional[float] = None):
+        self.started = started if started is not None else time.perf_counter()
+        self.upstream_started: Optional[float] = None
+        self.upstream_first: Optional[float] = None
+        self.ttft: Optional[float] = None
+        self.max_gap = 0.0
+        self.frames = 0
+        self._last: Optional[float] = None
+
+    def upstream_opened(self) -> None:
+        self.upstream_started = time.perf_counter()
+
+    def upstream_delta(self, received: float) -> None:
+        if self.upstream_first is None:
+            self.upstream_first = received
+
+    def frame(self, received: float) -> None:
+        now = time.perf_counter()
+        STREAM_FRAME_OVERHEAD.observe(now - received)
+        if self._last is None:
+            self.ttft = now - self.started
+            STREAM_TTFT.observe(self.ttft)
+            if self.upstream_started is not None:
+                STREAM_UPSTREAM_TTFT.observe((self.upstream_first or received) - self.upstream_started)
+        else:
+            gap = now - self._last
+            self.max_gap = max(self.max_gap, gap)
+            STREAM_INTER_TOKEN.observe(gap)
+        self._last = now
+        self.frames += 1
+
+
+def latency_snapshot() -> Dict[str, Any]:
+    """JSON-serializable view of all latency histograms"""
+    return {histogram.name: histogram.snapshot() for histogram in LATENCY_HISTOGRAMS}
+
+
+def error_code_from(body: Any, status: int) -> str:
+    """Error code of an error response body: the envelope's `code`, else the HTTP status"""
+    if isinstance(body, dict):
+        error = body.get('error')
+        if isinstance(error, dict) and error.get('code'):
+            return str(error['code'])
+    return str(status)
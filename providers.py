@@ -0,0 +1,742 @@
+"""
+Provider backends for CustomLLM
+Adapters for OpenAI-compatible, Anthropic and Ollama upstreams, selected by model name.
+
+Each backend owns one long-lived httpx client (and one async client for the ASGI server),
+so connections to an upstream are pooled and kept alive across turns instead of paying
+TCP/TLS setup on every request.
+
+Configuration (environment variables):
+    OPENAI_API_KEY, OPENAI_BASE_URL, OPENAI_MODEL_PREFIXES
+    ANTHROPIC_API_KEY, ANTHROPIC_BASE_URL, ANTHROPIC_MODEL_PREFIXES, ANTHROPIC_MAX_TOKENS
+    OLLAMA_URL, OLLAMA_MODEL_PREFIXES
+    BATCH_BACKEND_URL, BATCH_BACKEND_MODEL_PREFIXES
+    PROVIDER_POOL_SIZE, PROVIDER_TIMEOUT, PROVIDER_CONNECT_TIMEOUT, PROVIDER_KEEPALIVE_EXPIRY
+
+A model can also be routed explicitly with a "<provider>/<model>" name, e.g. "ollama/llama3".
+
+Streams of requests with tools (a tools.ToolOptions) may yield tools.ToolCallDelta items next to
+text deltas; the OpenAI, Anthropic and Ollama adapters convert tool definitions, tool calls and
+tool results to and from their upstream's format. The batch endpoint takes no tools.
+
+max_tokens / max_completion_tokens and stop (a validation.OutputLimits) are forwarded in each
+upstream's format; without them Anthropic requests use ANTHROPIC_MAX_TOKENS.
+
+Message content may be a list of OpenAI content parts. Anthropic gets text and image blocks
+(data: URLs as base64 sources), Ollama the joined text plus base64 `images`; system and tool
+messages are sent as their joined text. A part the upstream cannot take (audio for Anthropic
+and Ollama, image links for Ollama) fails the request with a 400 unsupported_content error.
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+import weakref
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+import httpx
+
+from serialization import dumpb, dumps, loads
+from service import APIError
+from tools import ToolCallDelta, new_call_id
+
+logger = logging.getLogger(__name__)
+
+# Sentinel returned by _parse_line when the upstream signals the end of a stream
+_DONE = object()
+
+# Request bodies are pre-encoded with the serialization backend instead of httpx's json=
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# One conversation of a batched call: (messages, temperature, validation.OutputLimits or None)
+BatchItem = Tuple[List[Dict[str, Any]], float, Any]
+
+
+class ProviderError(APIError):
+    """Raised when an upstream provider fails or returns an unexpected response"""
+
+    def __init__(self, message: str, status: int = 502):
+        super().__init__(message, 'upstream_error', type='server_error', status=status)
+
+
+class UnsupportedContent(ProviderError):
+    """A content part the provider cannot take; raised before anything is sent upstream"""
+
+    def __init__(self, provider: str, problem: str):
+        super().__init__(f'{provider} models do not accept {problem}', status=400)
+        self.code = 'unsupported_content'
+        self.type = 'invalid_request_error'
+
+
+def content_text(content: Any) -> str:
+    """Text of a message content: the string itself, or its text and refusal parts joined"""
+    if type(content) is not list:
+        return content or ''
+    return '\n'.join(part.get('text') or part.get('refusal') or '' for part in content if part.get('type') in ('text', 'refusal'))
+
+
+def _data_url(url: str) -> Optional[Tuple[str, str]]:
+    """(media type, base64 data) of a base64 data: URL, None for any other URL"""
+    if not url.startswith('data:'):
+        return None
+    header, sep, data = url[5:].partition(',')
+    media_type, _, encoding = header.partition(';')
+    if not sep or encoding != 'base64':
+        return None
+    return media_type, data
+
+
+class ProviderBackend:
+    """
+    Base class for provider adapters.
+
+    Subclasses implement _build_request, _parse_completion and _parse_line;
+    the HTTP plumbing (pooling, streaming, error handling) lives here.
+    """
+
+    name = 'base'
+
+    # Backends that accept several conversations in one call set this and implement
+    # complete_batch/stream_batch; batching.BatchScheduler coalesces requests in front of them
+    supports_batching = False
+
+    def __init__(
+        self,
+        base_url: str,
+        api_key: Optional[str] = None,
+        model_prefixes: Tuple[str, ...] = (),
+        pool_size: int = 20,
+        timeout: float = 60.0,
+        connect_timeout: float = 5.0,
+        keepalive_expiry: float = 30.0
+    ):
+        self.base_url = base_url.rstrip('/')
+        self.api_key = api_key
+        self.model_prefixes = model_prefixes
+        self.limits = httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self._client: Optional[httpx.Client] = None
+        self._aclients: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]' = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def matches(self, model: str) -> bool:
+        return any(model.startswith(prefix) for prefix in self.model_prefixes)
+
+    @property
+    def client(self) -> httpx.Client:
+        """Pooled keep-alive client shared by all threads of this worker"""
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = httpx.Client(
+                        base_url=self.base_url, limits=self.limits, timeout=self.timeout, headers=self._headers()
+                    )
+        return self._client
+
+    @property
+    def aclient(self) -> httpx.AsyncClient:
+        """Pooled keep-alive async client; one per event loop since connections are loop-bound"""
+        loop = asyncio.get_running_loop()
+        client = self._aclients.get(loop)
+        if client is None:
+            client = self._aclients[loop] = httpx.AsyncClient(
+                base_url=self.base_url, limits=self.limits, timeout=self.timeout, headers=self._headers()
+            )
+        return client
+
+    def close(self) -> None:
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    async def aclose(self) -> None:
+        client = self._aclients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+    # ----- adapter hooks -----
+
+    def _headers(self) -> Dict[str, str]:
+        return {}
+
+    def _build_request(
+        self, messages: List[Dict[str, Any]], model: str, temperature: float, stream: bool, session: Any = None, tools: Any = None,
+        limits: Any = None
+    ) -> Tuple[str, Dict[str, Any]]:
+        """
+        Return (path, json_body) for the upstream request.
+        session is the caller's sessions.Session (or None); adapters may keep cache handles in session.handles.
+        tools is the request's tools.ToolOptions (or None), limits its validation.OutputLimits (or None).
+        """
+        raise NotImplementedError
+
+    def _parse_completion(self, data: Dict[str, Any]) -> str:
+        """Extract the response text from a non-streaming upstream response"""
+        raise NotImplementedError
+
+    def _parse_line(self, line: str) -> Any:
+        """Return the text delta carried by one stream line, a list of text and ToolCallDelta items, None to skip it, or _DONE"""
+        raise NotImplementedError
+
+    # ----- public API -----
+
+    def complete(self, messages: List[Dict[str, Any]], model: str, temperature: float, session: Any = None, limits: Any = None) -> str:
+        path, body = self._build_request(messages, model, temperature, stream=False, session=session, limits=limits)
+        try:
+            response = self.client.post(path, content=dumpb(body), headers=JSON_HEADERS)
+        except httpx.HTTPError as e:
+            raise ProviderError(f'{self.name} request failed: {e}')
+        self._check_status(response.status_code, response.text)
+        return self._parse_body(response)
+
+    def stream(
+        self, messages: List[Dict[str, Any]], model: str, temperature: float, session: Any = None, tools: Any = None, limits: Any = None
+    ) -> Iterator[str]:
+        path, body = self._build_request(messages, model, temperature, stream=True, session=session, tools=tools, limits=limits)
+        try:
+            with self.client.stream('POST', path, content=dumpb(body), headers=JSON_HEADERS) as response:
+                if response.status_code >= 400:
+                    response.read()
+                    self._check_status(response.status_code, response.text)
+                for line in response.iter_lines():
+                    delta = self._safe_parse_line(line) if line else None
+                    if delta is _DONE:
+                        break
+                    if type(delta) is list:
+                        yield from delta
+                    elif delta:
+                        yield delta
+        except httpx.HTTPError as e:
+            raise ProviderError(f'{self.name} stream failed: {e}')
+
+    async def acomplete(self, messages: List[Dict[str, Any]], model: str, temperature: float, session: Any = None, limits: Any = None) -> str:
+        path, body = self._build_request(messages, model, temperature, stream=False, session=session, limits=limits)
+        try:
+            response = await self.aclient.post(path, content=dumpb(body), headers=JSON_HEADERS)
+        except httpx.HTTPError as e:
+            raise ProviderError(f'{self.name} request failed: {e}')
+        self._check_status(response.status_code, response.text)
+        return self._parse_body(response)
+
+    async def astream(
+        self, messages: List[Dict[str, Any]], model: str, temperature: float, session: Any = None, tools: Any = None, limits: Any = None
+    ) -> AsyncIterator[str]:
+        path, body = self._build_request(messages, model, temperature, stream=True, session=session, tools=tools, limits=limits)
+        try:
+            async with self.aclient.stream('POST', path, content=dumpb(body), headers=JSON_HEADERS) as response:
+                if response.status_code >= 400:
+                    await response.aread()
+                    self._check_status(response.status_code, response.text)
+                async for line in response.aiter_lines():
+                    delta = self._safe_parse_line(line) if line else None
+                    if delta is _DONE:
+                        break
+                    if type(delta) is list:
+                        for item in delta:
+                            yield item
+                    elif delta:
+                        yield delta
+        except httpx.HTTPError as e:
+            raise ProviderError(f'{self.name} stream failed: {e}')
+
+    def _parse_body(self, response: httpx.Response) -> str:
+        try:
+            return self._parse_completion(loads(response.content))
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            raise ProviderError(f'{self.name} returned an unexpected response: {e}')
+
+    def _safe_parse_line(self, line: str) -> Any:
+        try:
+            return self._parse_line(line)
+        except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+            raise ProviderError(f'{self.name} sent an unexpected stream line: {e}')
+
+    def _check_status(self, status: int, text: str) -> None:
+        if status >= 400:
+            raise ProviderError(f'{self.name} returned HTTP {status}: {text[:200]}')
+
+
+class OpenAIBackend(ProviderBackend):
+    """OpenAI and any OpenAI-compatible server (vLLM, llama.cpp, LiteLLM, ...)"""
+
+    name = 'openai'
+
+    def _headers(self) -> Dict[str, str]:
+        return {'Authorization': f'Bearer {self.api_key}'} if self.api_key else {}
+
+    def _build_request(self, messages, model, temperature, stream, session=None, tools=None, limits=None):
+        body = {
+            'model': model,
+            'messages': messages,
+            'temperature': temperature,
+            'stream': stream
+        }
+        if limits is not None:
+            # Sent as the client sent them: older OpenAI-compatible servers only know max_tokens
+            if limits.max_tokens is not None:
+                body['max_tokens'] = limits.max_tokens
+            if limits.max_completion_tokens is not None:
+                body['max_completion_tokens'] = limits.max_completion_tokens
+            if limits.stop:
+                body['stop'] = limits.stop
+        if tools is not None:
+            body['tools'] = tools.tools
+            if tools.choice is not None:
+                body['tool_choice'] = tools.choice
+            if tools.parallel is not None:
+                body['parallel_tool_calls'] = tools.parallel
+        return '/chat/completions', body
+
+    def _parse_completion(self, data):
+        return data['choices'][0]['message'].get('content') or ''
+
+    def _parse_line(self, line):
+        if not line.startswith('data: '):
+            return None
+        payload = line[6:]
+        if payload.strip() == '[DONE]':
+            return _DONE
+        choices = loads(payload).get('choices') or [{}]
+        delta = choices[0].get('delta') or {}
+        calls = delta.get('tool_calls')
+        if not calls:
+            return delta.get('content')
+        items = [delta['content']] if delta.get('content') else []
+        for call in calls:
+            function = call.get('function') or {}
+            items.append(ToolCallDelta(call.get('index', 0), call.get('id'), function.get('name'), function.get('arguments') or ''))
+        return items
+
+
+class AnthropicBackend(ProviderBackend):
+    """Anthropic Messages API"""
+
+    name = 'anthropic'
+
+    def __init__(self, *args, max_tokens: int = 1024, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_tokens = max_tokens
+
+    def _headers(self) -> Dict[str, str]:
+        return {'x-api-key': self.api_key or '', 'anthropic-version': '2023-06-01'}
+
+    def _build_request(self, messages, model, temperature, stream, session=None, tools=None, limits=None):
+        # Convert messages format for Anthropic: system prompt is a top-level field
+        system_messages = []
+        conversation_messages = []
+        for msg in messages:
+            if msg['role'] == 'system':
+                system_messages.append(content_text(msg['content']))
+            elif msg['role'] == 'tool':
+                # Tool results are content blocks of a user message, all results of a turn in one
+                result = {'type': 'tool_result', 'tool_use_id': msg['tool_call_id'], 'content': content_text(msg.get('content'))}
+                previous = conversation_messages[-1] if conversation_messages else None
+                if previous and previous['role'] == 'user' and isinstance(previous['content'], list):
+                    previous['content'].append(result)
+                else:
+                    conversation_messages.append({'role': 'user', 'content': [result]})
+            elif msg.get('tool_calls'):
+                text = content_text(msg.get('content'))
+                blocks = [{'type': 'text', 'text': text}] if text else []
+                blocks += [{
+                    'type': 'tool_use',
+                    'id': call['id'],
+                    'name': call['function']['name'],
+                    'input': loads(call['function']['arguments'] or '{}')
+                } for call in msg['tool_calls']]
+                conversation_messages.append({'role': 'assistant', 'content': blocks})
+            else:
+                conversation_messages.append({'role': msg['role'], 'content': self._blocks(msg['content'])})
+
+        body = {
+            'model': model,
+            'max_tokens': self.max_tokens,
+            'messages': conversation_messages,
+            'temperature': min(temperature, 1.0),  # Anthropic accepts 0.0 to 1.0
+            'stream': stream
+        }
+        if limits is not None:
+            if limits.token_limit is not None:
+                body['max_tokens'] = limits.token_limit
+            if limits.stop:
+                body['stop_sequences'] = limits.stop_sequences
+        if system_messages:
+            if session is not None:
+                # The system prompt is resent on every turn of a call; mark it for Anthropic prompt caching.
+                # Later system messages (e.g. a context summary, which changes) follow the cached block.
+                body['system'] = [{'type': 'text', 'text': system_messages[0], 'cache_control': {'type': 'ephemeral'}}]
+                body['system'] += [{'type': 'text', 'text': text} for text in system_messages[1:]]
+                session.handles['anthropic_prompt_cache'] = True
+            else:
+                body['system'] = '\n\n'.join(system_messages)
+        if tools is not None:
+            body['tools'] = [{
+                'name': tool['function']['name'],
+                'description': tool['function'].get('description', ''),
+                'input_schema': tool['function'].get('parameters') or {'type': 'object', 'properties': {}}
+            } for tool in tools.tools]
+            choice = self._tool_choice(tools.choice)
+            if tools.parallel is False and choice['type'] != 'none':
+                choice['disable_parallel_tool_use'] = True
+            body['tool_choice'] = choice
+        return '/v1/messages', body
+
+    def _blocks(self, content: Any) -> Any:
+        """OpenAI content parts as Anthropic content blocks; string content is sent as it is"""
+        if type(content) is not list:
+            return content
+        blocks = []
+        for part in content:
+            kind = part['type']
+            if kind == 'image_url':
+                url = part['image_url']['url']
+                data = _data_url(url)
+                source = {'type': 'base64', 'media_type': data[0], 'data': data[1]} if data else {'type': 'url', 'url': url}
+                blocks.append({'type': 'image', 'source': source})
+            elif kind in ('text', 'refusal'):
+                if part[kind]:
+                    blocks.append({'type': 'text', 'text': part[kind]})
+            else:
+                raise UnsupportedContent(self.name, f"'{kind}' content parts")
+        return blocks
+
+    @staticmethod
+    def _tool_choice(choice: Any) -> Dict[str, Any]:
+        """OpenAI tool_choice as an Anthropic tool_choice"""
+        if isinstance(choice, dict):
+            return {'type': 'tool', 'name': choice['function']['name']}
+        return {'type': {'required': 'any', 'none': 'none'}.get(choice, 'auto')}
+
+    def _parse_completion(self, data):
+        return ''.join(block.get('text', '') for block in data.get('content', []) if block.get('type') == 'text')
+
+    def _parse_line(self, line):
+        if not line.startswith('data: '):
+            return None
+        event = loads(line[6:])
+        if event.get('type') == 'content_block_delta':
+            delta = event.get('delta', {})
+            if delta.get('type') == 'input_json_delta':
+                return [ToolCallDelta(event['index'], None, None, delta.get('partial_json', ''))]
+            return delta.get('text')
+        if event.get('type') == 'content_block_start':
+            block = event.get('content_block', {})
+            if block.get('type') == 'tool_use':
+                return [ToolCallDelta(event['index'], block['id'], block['name'])]
+            return None
+        if event.get('type') == 'message_stop':
+            return _DONE
+        return None
+
+
+class OllamaBackend(ProviderBackend):
+    """Local models served by Ollama (newline-delimited JSON streaming)"""
+
+    name = 'ollama'
+
+    def _build_request(self, messages, model, temperature, stream, session=None, tools=None, limits=None):
+        body = {
+            'model': model,
+            'messages': [self._message(msg) for msg in messages],
+            'stream': stream,
+            'options': {'temperature': temperature}
+        }
+        if limits is not None:
+            if limits.token_limit is not None:
+                body['options']['num_predict'] = limits.token_limit
+            if limits.stop:
+                body['options']['stop'] = limits.stop_sequences
+        if tools is not None:
+            # Ollama takes OpenAI tool definitions but has no tool_choice
+            body['tools'] = tools.tools
+        return '/api/chat', body
+
+    def _message(self, msg: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Content parts become the joined text plus base64 images, and an assistant message's
+        tool calls carry their arguments as an object in Ollama
+        """
+        content = msg.get('content')
+        if type(content) is list:
+            images = []
+            for part in content:
+                if part['type'] == 'image_url':
+                    data = _data_url(part['image_url']['url'])
+                    if data is None:
+                        raise UnsupportedContent(self.name, 'image links, only base64 data: URLs')
+                    images.append(data[1])
+                elif part['type'] not in ('text', 'refusal'):
+                    raise UnsupportedContent(self.name, f"'{part['type']}' content parts")
+            msg = dict(msg, content=content_text(content))
+            if images:
+                msg['images'] = images
+        if not msg.get('tool_calls'):
+            return msg
+        return {'role': 'assistant', 'content': content_text(msg.get('content')), 'tool_calls': [
+            {'function': {'name': call['function']['name'], 'arguments': loads(call['function']['arguments'] or '{}')}}
+            for call in msg['tool_calls']
+        ]}
+
+    def _parse_completion(self, data):
+        return data.get('message', {}).get('content', '')
+
+    def _parse_line(self, line):
+        data = loads(line)
+        message = data.get('message', {})
+        content = message.get('content')
+        if message.get('tool_calls'):
+            # Ollama sends whole calls, without ids
+            items = [content] if content else []
+            items += [
+                ToolCallDelta(i, new_call_id(), call['function']['name'], dumps(call['function'].get('arguments') or {}))
+                for i, call in enumerate(message['tool_calls'])
+            ]
+            return items
+        if data.get('done', False):
+            # The final Ollama line may still carry content
+            return content or _DONE
+        return content
+
+
+class BatchBackend(ProviderBackend):
+    """
+    Local model server that runs several conversations in one forward pass.
+
+    POST /v1/batch with {"model", "stream", "requests": [{"messages", "temperature"[, "max_tokens", "stop"]}, ...]}.
+    Non-streaming replies are {"results": [{"index", "content"} | {"index", "error"}]};
+    streams are NDJSON lines {"index", "delta"}, {"index", "finish_reason"} or {"index", "error"}.
+    """
+
+    name = 'batch'
+    supports_batching = True
+
+    @staticmethod
+    def _batch_body(model: str, items: List[BatchItem], stream: bool) -> Dict[str, Any]:
+        requests = []
+        for messages, temperature, limits in items:
+            request = {'messages': messages, 'temperature': temperature}
+            if limits is not None:
+                if limits.token_limit is not None:
+                    request['max_tokens'] = limits.token_limit
+                if limits.stop:
+                    request['stop'] = limits.stop_sequences
+            requests.append(request)
+        return {'model': model, 'stream': stream, 'requests': requests}
+
+    def _build_request(self, messages, model, temperature, stream, session=None, tools=None, limits=None):
+        return '/v1/batch', self._batch_body(model, [(messages, temperature, limits)], stream)
+
+    def _parse_completion(self, data):
+        result = data['results'][0]
+        if 'error' in result:
+            raise ProviderError(f"{self.name} failed: {result['error']}")
+        return result['content']
+
+    def _parse_line(self, line):
+        data = loads(line)
+        if 'error' in data:
+            raise ProviderError(f"{self.name} failed: {data['error']}")
+        return data.get('delta')
+
+    def complete_batch(self, model: str, items: List[BatchItem]) -> List[Any]:
+        """One upstream call for all items; returns the text or a ProviderError per item"""
+        try:
+            response = self.client.post('/v1/batch', content=dumpb(self._batch_body(model, items, False)), headers=JSON_HEADERS)
+        except httpx.HTTPError as e:
+            raise ProviderError(f'{self.name} request failed: {e}')
+        self._check_status(response.status_code, response.text)
+        results: List[Any] = [ProviderError(f'{self.name} returned no result')] * len(items)
+        try:
+            for result in loads(response.content)['results']:
+                if 'error' in result:
+                    results[result['index']] = ProviderError(f"{self.name} failed: {result['error']}")
+                else:
+                    results[result['index']] = result['content']
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            raise ProviderError(f'{self.name} returned an unexpected response: {e}')
+        return results
+
+    def stream_batch(self, model: str, items: List[BatchItem]) -> Iterator[Tuple[int, str, Any]]:
+        """
+        One upstream stream for all items, yielding (index, 'delta', text), (index, 'done', None)
+        or (index, 'error', ProviderError) as lines arrive.
+        """
+        try:
+            with self.client.stream('POST', '/v1/batch', content=dumpb(self._batch_body(model, items, True)), headers=JSON_HEADERS) as response:
+                if response.status_code >= 400:
+                    response.read()
+                    self._check_status(response.status_code, response.text)
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    try:
+                        data = loads(line)
+                        index = data['index']
+                    except (ValueError, KeyError, TypeError) as e:
+                        raise ProviderError(f'{self.name} sent an unexpected stream line: {e}')
+                    if 'error' in data:
+                        yield index, 'error', ProviderError(f"{self.name} failed: {data['error']}")
+                    elif data.get('finish_reason'):
+                        yield index, 'done', None
+                    elif data.get('delta'):
+                        yield index, 'delta', data['delta']
+        except httpx.HTTPError as e:
+            raise ProviderError(f'{self.name} stream failed: {e}')
+
+
+class EchoBackend(ProviderBackend):
+    """
+    Demo backend used when no upstream matches the model.
+    Replace by configuring a provider (see module docstring).
+    """
+
+    name = 'echo'
+
+    def __init__(self, stream_delay: float = 0.05):
+        super().__init__('http://localhost')
+        self.stream_delay = stream_delay
+
+    def matches(self, model: str) -> bool:
+        return True
+
+    def _text(self, messages: List[Dict[str, Any]], model: str, temperature: float) -> str:
+        # Extract the last user message for demo purposes
+        user_message = None
+        for msg in messages:
+            if msg.get('role') == 'user':
+                user_message = content_text(msg.get('content'))
+        return f"هذه استجابة تجريبية من Custom LLM (Model: {model}, Temperature: {temperature}). الرسالة المستلمة: {user_message}"
+
+    def _tool_calls(self, messages: List[Dict[str, Any]], tools: Any) -> List[ToolCallDelta]:
+        """Demo tool calls: the tools named in the last user message (or the required ones), unless it was answered"""
+        if tools is None or tools.choice == 'none' or messages[-1].get('role') == 'tool':
+            return []
+        if isinstance(tools.choice, dict):
+            names = [tools.choice['function']['name']]
+        else:
+            text = content_text(messages[-1].get('content'))
+            names = [name for name in tools.names() if name in text]
+            if not names and tools.choice == 'required':
+                names = tools.names()[:1]
+        if tools.parallel is False:
+            names = names[:1]
+        return [ToolCallDelta(i, new_call_id(), name, '{}') for i, name in enumerate(names)]
+
+    def _answer(self, messages: List[Dict[str, Any]], model: str, temperature: float) -> str:
+        if messages[-1].get('role') != 'tool':
+            return self._text(messages, model, temperature)
+        results = []
+        for msg in reversed(messages):
+            if msg.get('role') != 'tool':
+                break
+            results.insert(0, content_text(msg.get('content')))
+        return f"هذه استجابة تجريبية من Custom LLM (Model: {model}). نتائج الأدوات: {' | '.join(results)}"
+
+    def complete(self, messages, model, temperature, session=None, limits=None):
+        return self._answer(messages, model, temperature)
+
+    def stream(self, messages, model, temperature, session=None, tools=None, limits=None):
+        calls = self._tool_calls(messages, tools)
+        if calls:
+            yield from calls
+            return
+        for word in self._answer(messages, model, temperature).split():
+            yield word + ' '
+            time.sleep(self.stream_delay)  # Simulate streaming delay
+
+    async def acomplete(self, messages, model, temperature, session=None, limits=None):
+        return self._answer(messages, model, temperature)
+
+    async def astream(self, messages, model, temperature, session=None, tools=None, limits=None):
+        calls = self._tool_calls(messages, tools)
+        if calls:
+            for call in calls:
+                yield call
+            return
+        for word in self._answer(messages, model, temperature).split():
+            yield word + ' '
+            await asyncio.sleep(self.stream_delay)  # Simulate streaming delay
+
+
+class ProviderRouter:
+    """Selects a backend for a model name and owns the backends' connection pools"""
+
+    def __init__(self, backends: List[ProviderBackend], default: ProviderBackend):
+        self.backends = backends
+        self.default = default
+        self._by_name = {backend.name: backend for backend in backends}
+
+    def select(self, model: str) -> Tuple[ProviderBackend, str]:
+        """
+        Return (backend, upstream_model) for a requested model name.
+        "<provider>/<model>" routes explicitly; otherwise the first backend whose prefixes match wins.
+        """
+        provider, sep, upstream_model = model.partition('/')
+        if sep and provider in self._by_name:
+            return self._by_name[provider], upstream_model
+
+        for backend in self.backends:
+            if backend.matches(model):
+                return backend, model
+        return self.default, model
+
+    def close(self) -> None:
+        for backend in self.backends:
+            backend.close()
+
+
+def _prefixes(env_name: str, default: str) -> Tuple[str, ...]:
+    return tuple(p.strip() for p in os.getenv(env_name, default).split(',') if p.strip())
+
+
+def build_router_from_env(stream_delay: float = 0.05) -> ProviderRouter:
+    """Create the backends configured in the environment"""
+    pool = {
+        'pool_size': int(os.getenv('PROVIDER_POOL_SIZE', 20)),
+        'timeout': float(os.getenv('PROVIDER_TIMEOUT', 60)),
+        'connect_timeout': float(os.getenv('PROVIDER_CONNECT_TIMEOUT', 5)),
+        'keepalive_expiry': float(os.getenv('PROVIDER_KEEPALIVE_EXPIRY', 30)),
+    }
+    backends: List[ProviderBackend] = []
+
+    if os.getenv('OPENAI_API_KEY') or os.getenv('OPENAI_BASE_URL'):
+        backends.append(OpenAIBackend(
+            os.getenv('OPENAI_BASE_URL', 'https://api.openai.com/v1'),
+            api_key=os.getenv('OPENAI_API_KEY'),
+            model_prefixes=_prefixes('OPENAI_MODEL_PREFIXES', 'gpt-,o1,o3,o4,chatgpt-'),
+            **pool
+        ))
+
+    if os.getenv('ANTHROPIC_API_KEY') or os.getenv('ANTHROPIC_BASE_URL'):
+        backends.append(AnthropicBackend(
+            os.getenv('ANTHROPIC_BASE_URL', 'https://api.anthropic.com'),
+            api_key=os.getenv('ANTHROPIC_API_KEY'),
+            model_prefixes=_prefixes('ANTHROPIC_MODEL_PREFIXES', 'claude-'),
+            max_tokens=int(os.getenv('ANTHROPIC_MAX_TOKENS', 1024)),
+            **pool
+        ))
+
+    if os.getenv('OLLAMA_URL'):
+        backends.append(OllamaBackend(
+            os.getenv('OLLAMA_URL'),
+            model_prefixes=_prefixes('OLLAMA_MODEL_PREFIXES', 'llama,mistral,qwen,gemma,phi'),
+            **pool
+        ))
+
+    if os.getenv('BATCH_BACKEND_URL'):
+        backends.append(BatchBackend(
+            os.getenv('BATCH_BACKEND_URL'),
+            model_prefixes=_prefixes('BATCH_BACKEND_MODEL_PREFIXES', 'local-'),
+            **pool
+        ))
+
+    for backend in backends:
+        logger.info(f"Provider backend enabled: {backend.name} -> {backend.base_url}")
+
+    return ProviderRouter(backends, default=EchoBackend(stream_delay))
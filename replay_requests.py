@@ -0,0 +1,210 @@
+"""
+إعادة تشغيل الطلبات المسجلة
+Replay a captured request log (request_log.py) against a server
+
+Re-issues the recorded requests with their original spacing, divided by --speed (2 = twice as
+fast, 0 = back to back), so production load shapes can be reproduced locally. Replay is
+open-loop like real traffic: a request is sent at its scheduled time whether or not earlier
+ones have finished (up to --max-in-flight). Logs of several workers and rotated .gz files are
+merged by arrival time. Recorded X-Call-Id headers are kept; Authorization is --api-key.
+
+The JSON report has the same shape as bench_load.py's, per path: throughput, p50/p95/p99
+latency, time-to-first-token for streams and error rates, plus how late requests were sent
+and how many got a different status than when recorded. --compare works as in bench_load.py.
+
+Usage:
+    REQUEST_LOG_PATH=logs/requests.jsonl python app.py      # record
+    python replay_requests.py logs/requests*.jsonl* --url http://localhost:8000 --speed 2
+    python replay_requests.py logs/requests.jsonl --server asgi --compare baseline.json
+"""
+
+import argparse
+import asyncio
+import heapq
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+from dotenv import load_dotenv
+
+from bench_concurrency import SERVERS, _wait_ready
+from bench_load import _Stats, _error_code, _git_commit, _ms, _percentile, compare
+from request_log import read_records
+
+
+def load_records(paths: List[str], limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Records of all files merged by arrival time"""
+    merged = heapq.merge(*(sorted(read_records(path), key=lambda r: r['ts']) for path in paths), key=lambda r: r['ts'])
+    records = []
+    for record in merged:
+        if limit is not None and len(records) >= limit:
+            break
+        records.append(record)
+    return records
+
+
+async def _send(client: httpx.AsyncClient, record: Dict[str, Any], headers: Dict[str, str], stats: _Stats) -> Optional[int]:
+    """Issue one recorded request and record its latency; returns the response status"""
+    body = record.get('body')
+    content = record['raw_body'].encode('utf-8') if 'raw_body' in record else (json.dumps(body).encode('utf-8') if body is not None else b'')
+    headers = {**record.get('headers', {}), **headers}
+    stream = isinstance(body, dict) and body.get('stream') is True
+    stats.requests += 1
+    start = time.perf_counter()
+    try:
+        async with client.stream(record['method'], record['path'], content=content, headers=headers) as response:
+            if response.status_code >= 400:
+                await response.aread()
+                stats.error(_error_code(response))
+                return response.status_code
+            if stream and response.headers.get('content-type', '').startswith('text/event-stream'):
+                first_token = True
+                async for line in response.aiter_lines():
+                    if not line.startswith('data: ') or line == 'data: [DONE]':
+                        continue
+                    chunk = json.loads(line[6:])
+                    if 'error' in chunk:
+                        stats.error(f"stream_{chunk['error'].get('code') or 'error'}")
+                        return response.status_code
+                    if first_token and chunk.get('choices') and chunk['choices'][0]['delta'].get('content'):
+                        stats.ttfts.append(time.perf_counter() - start)
+                        first_token = False
+            else:
+                await response.aread()
+        stats.latencies.append(time.perf_counter() - start)
+        return response.status_code
+    except httpx.TimeoutException:
+        stats.error('timeout')
+    except httpx.HTTPError:
+        stats.error('connection_error')
+    except (ValueError, KeyError, IndexError, TypeError):
+        stats.error('invalid_response')
+    return None
+
+
+async def replay(base_url: str, records: List[Dict[str, Any]], args: argparse.Namespace) -> Dict[str, Any]:
+    stats: Dict[str, _Stats] = {}
+    lateness: List[float] = []
+    mismatches = [0]
+    in_flight = asyncio.Semaphore(args.max_in_flight)
+    limits = httpx.Limits(max_connections=args.max_in_flight, max_keepalive_connections=args.max_in_flight)
+
+    async def run(record, path_stats):
+        try:
+            status = await _send(client, record, args.headers, path_stats)
+            if record.get('status') is not None and status != record['status']:
+                mismatches[0] += 1
+        finally:
+            in_flight.release()
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=args.timeout) as client:
+        tasks = []
+        first = records[0]['ts'] if records else 0.0
+        start = time.perf_counter()
+        for record in records:
+            if args.speed > 0:
+                scheduled = start + (record['ts'] - first) / args.speed
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            else:
+                scheduled = time.perf_counter()
+            await in_flight.acquire()
+            lateness.append(time.perf_counter() - scheduled)
+            path_stats = stats.setdefault(record['path'], _Stats())
+            tasks.append(asyncio.create_task(run(record, path_stats)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+
+    total = _Stats()
+    for s in stats.values():
+        total.requests += s.requests
+        total.latencies += s.latencies
+        total.ttfts += s.ttfts
+        for code, count in s.errors.items():
+            total.errors[code] = total.errors.get(code, 0) + count
+    report = {
+        'elapsed_seconds': round(elapsed, 2),
+        'recorded_seconds': round(records[-1]['ts'] - first, 2) if records else 0.0,
+        'send_lateness_p50_ms': _ms(_percentile(lateness, 0.50)),
+        'send_lateness_p99_ms': _ms(_percentile(lateness, 0.99)),
+        'send_lateness_max_ms': _ms(max(lateness)) if lateness else None,
+        'status_mismatches': mismatches[0],
+        'all': total.report(elapsed),
+    }
+    report.update((path, s.report(elapsed)) for path, s in sorted(stats.items()))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('logs', nargs='+', help='request log files (.jsonl or .jsonl.gz)')
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument('--url', default=None, help='running server (default: http://localhost:8000)')
+    target.add_argument('--server', choices=list(SERVERS), help='start this server locally for the replay')
+    parser.add_argument('--port', type=int, default=8766, help='port for --server')
+    parser.add_argument('--speed', type=float, default=1.0, help='time scale: 2 = twice as fast, 0 = no pauses')
+    parser.add_argument('--max-in-flight', type=int, default=1000, help='cap on concurrent requests')
+    parser.add_argument('--limit', type=int, default=None, help='replay only the first N requests')
+    parser.add_argument('--api-key', default=None, help='default: API_KEY from .env')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--output', help='write the JSON report here as well')
+    parser.add_argument('--compare', help='baseline report to compare against')
+    parser.add_argument('--max-regression', type=float, default=10, help='allowed regression in percent')
+    args = parser.parse_args()
+
+    load_dotenv()
+    api_key = args.api_key if args.api_key is not None else os.getenv('API_KEY', '')
+    args.headers = {'Authorization': f'Bearer {api_key}'} if api_key else {}
+    records = load_records(args.logs, args.limit)
+    if not records:
+        raise SystemExit('No records to replay')
+
+    proc = None
+    base_url = args.url or 'http://localhost:8000'
+    if args.server:
+        base_url = f'http://127.0.0.1:{args.port}'
+        # The replaying server must not record the replay into the log being read
+        env = dict(os.environ, PORT=str(args.port), HOST='127.0.0.1', API_KEY=api_key, REQUEST_LOG_PATH='')
+        cmd = SERVERS[args.server] + (['--port', str(args.port)] if args.server == 'asgi' else [])
+        proc = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        _wait_ready(base_url)
+        results = {f'replay_speed_{args.speed:g}': asyncio.run(replay(base_url, records, args))}
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+    report = {
+        'meta': {
+            'commit': _git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'target': args.server or base_url,
+            'logs': args.logs,
+            'requests': len(records),
+            'speed': args.speed,
+        },
+        'results': results,
+    }
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        print(f"\nCompared with {args.compare} (commit {baseline.get('meta', {}).get('commit')}):", file=sys.stderr)
+        regressions = compare(baseline, report, args.max_regression)
+        if regressions:
+            print(f'{len(regressions)} regressions over {args.max_regression}%', file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+"""
+Request log capture
+Records incoming API requests with their arrival time to an append-only JSONL file, so that
+production traffic can be replayed against another build with replay_requests.py.
+
+The request path only puts (arrival time, method, path, headers, raw body, status) on a
+bounded queue; parsing, redaction, serialization and file I/O run on a background writer
+thread. When the queue is full the record is dropped and counted instead of blocking.
+
+Only state-changing requests (POST, PUT, PATCH, DELETE) are recorded. Headers are reduced to
+an allow-list, so Authorization and cookies are never written. With REQUEST_LOG_REDACT=content
+message texts are masked as well: every non-space character becomes "x", which keeps the
+word and character counts that drive the load while dropping what was said. That covers string
+contents, the text and refusal of content parts, and tool-call arguments; arguments stay valid
+JSON, with their strings masked and their numbers zeroed.
+
+When the file exceeds REQUEST_LOG_MAX_BYTES it is renamed with a timestamp suffix (and
+gzip-compressed with REQUEST_LOG_COMPRESS=true) and a new file is started; only the newest
+REQUEST_LOG_BACKUPS rotated files are kept. With several worker processes put "{pid}" in
+REQUEST_LOG_PATH so that each worker writes and rotates its own file; replay merges them.
+
+Record format (one JSON object per line):
+    {"ts": 1760000000.123, "method": "POST", "path": "/v1/chat/completions",
+     "headers": {"content-type": "application/json", "x-call-id": "..."}, "body": {...}, "status": 200}
+
+Configuration (environment variables):
+    REQUEST_LOG_PATH        - JSONL file to record to, "{pid}" is replaced by the worker's process
+                              id (unset: recording disabled)
+    REQUEST_LOG_REDACT      - "headers" (default) or "content" (also mask message texts)
+    REQUEST_LOG_SAMPLE      - fraction of requests to record (default: 1.0)
+    REQUEST_LOG_MAX_BYTES   - size at which the file is rotated (default: 100 MB)
+    REQUEST_LOG_BACKUPS     - rotated files to keep (default: 10)
+    REQUEST_LOG_COMPRESS    - "true" to gzip rotated files (default: false)
+    REQUEST_LOG_QUEUE_SIZE  - records buffered for the writer before dropping (default: 10000)
+"""
+
+import atexit
+import glob
+import gzip
+import json
+import logging
+import os
+import queue
+import random
+import re
+import shutil
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Tuple
+
+from serialization import dumpb, loads
+
+logger = logging.getLogger(__name__)
+
+RECORDED_METHODS = frozenset(('POST', 'PUT', 'PATCH', 'DELETE'))
+
+# Request headers written to the log (lower-case); everything else, Authorization included, is dropped
+RECORDED_HEADERS = ('content-type', 'x-call-id', 'user-agent')
+
+_NON_SPACE = re.compile(r'\S')
+
+# Fields holding what was said: message and part texts, refusals, tool-call arguments
+_MASKED_FIELDS = frozenset(('content', 'text', 'refusal', 'arguments'))
+
+# Queue item: (arrival time, method, path, headers, raw body, status)
+_Record = Tuple[float, str, str, Dict[str, str], bytes, Optional[int]]
+
+
+def mask_text(text: str) -> str:
+    return _NON_SPACE.sub('x', text)
+
+
+def _mask_arguments(text: str) -> str:
+    """Tool-call arguments with their values masked, kept valid JSON so that replays still parse"""
+    try:
+        arguments = loads(text)
+    except ValueError:
+        return mask_text(text)
+    return json.dumps(_mask_values(arguments), ensure_ascii=False)
+
+
+def _mask_values(value: Any) -> Any:
+    if isinstance(value, str):
+        return mask_text(value)
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, (int, float)):
+        return 0
+    if isinstance(value, dict):
+        return {key: _mask_values(item) for key, item in value.items()}
+    return [_mask_values(item) for item in value]
+
+
+def redact_content(value: Any) -> Any:
+    """Copy of a request body with the texts of all content, text, refusal and arguments fields masked"""
+    if isinstance(value, dict):
+        redacted = {}
+        for key, item in value.items():
+            if key in _MASKED_FIELDS and isinstance(item, str):
+                redacted[key] = _mask_arguments(item) if key == 'arguments' else mask_text(item)
+            else:
+                redacted[key] = redact_content(item)
+        return redacted
+    if isinstance(value, list):
+        return [redact_content(item) for item in value]
+    return value
+
+
+class RequestRecorder:
+    """Bounded queue of captured requests drained by a background writer thread into rotating JSONL files"""
+
+    def __init__(
+        self,
+        path: str,
+        redact: str = 'headers',
+        sample: float = 1.0,
+        max_bytes: int = 100 * 1024 * 1024,
+        backups: int = 10,
+        compress: bool = False,
+        queue_size: int = 10000
+    ):
+        if redact not in ('headers', 'content'):
+            raise ValueError(f"REQUEST_LOG_REDACT must be 'headers' or 'content', got {redact!r}")
+        self.template = path
+        self.path = path.replace('{pid}', str(os.getpid()))
+        self.redact = redact
+        self.sample = sample
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.compress = compress
+        self._queue: 'queue.Queue[Optional[_Record]]' = queue.Queue(queue_size)
+        self.recorded = 0
+        self.dropped = 0
+        self.rotations = 0
+        self.write_errors = 0
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        self._open()
+        atexit.register(self.close)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _open(self) -> None:
+        self._file = open(self.path, 'ab')
+        self._size = self._file.tell()
+        self._thread = threading.Thread(target=self._run, name='request-log-writer', daemon=True)
+        self._thread.start()
+
+    def _after_fork(self) -> None:
+        # A worker forked from a preloaded master gets its own file ("{pid}") and writer thread;
+        # requests still queued are the parent's to write
+        if self._file.closed:
+            return
+        self.path = self.template.replace('{pid}', str(os.getpid()))
+        self._queue = queue.Queue(self._queue.maxsize)
+        self.recorded = self.dropped = self.rotations = self.write_errors = 0
+        self._open()
+
+    def record(
+        self,
+        arrived: float,
+        method: str,
+        path: str,
+        headers: Mapping[str, str],
+        body: bytes,
+        status: Optional[int] = None
+    ) -> None:
+        """Queue one request; never blocks. arrived is its time.time() arrival timestamp"""
+        if method not in RECORDED_METHODS or (self.sample < 1.0 and random.random() >= self.sample):
+            return
+        kept = {}
+        for name in RECORDED_HEADERS:
+            value = headers.get(name)
+            if value is not None:
+                kept[name] = value
+        try:
+            self._queue.put_nowait((arrived, method, path, kept, body, status))
+        except queue.Full:
+            self.dropped += 1
+
+    def _encode(self, item: _Record) -> bytes:
+        arrived, method, path, headers, body, status = item
+        line: Dict[str, Any] = {'ts': round(arrived, 6), 'method': method, 'path': path, 'headers': headers}
+        try:
+            data = loads(body) if body else None
+        except ValueError:
+            # Malformed bodies are replayed as sent
+            line['raw_body'] = mask_text(body.decode('utf-8', 'replace')) if self.redact == 'content' else body.decode('utf-8', 'replace')
+        else:
+            line['body'] = redact_content(data) if self.redact == 'content' else data
+        if status is not None:
+            line['status'] = status
+        return dumpb(line) + b'\n'
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            batch = []
+            # Drain whatever else is queued, so a burst costs one write and one flush
+            while item is not None:
+                batch.append(self._encode(item))
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                self._write(b''.join(batch), len(batch))
+            if item is None:
+                return
+
+    def _write(self, data: bytes, count: int) -> None:
+        try:
+            self._file.write(data)
+            self._file.flush()
+        except OSError as e:
+            self.write_errors += 1
+            logger.error(f"Request log write failed: {e}")
+            return
+        self.recorded += count
+        self._size += len(data)
+        if self._size >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self) -> None:
+        self._file.close()
+        stem, ext = os.path.splitext(self.path)
+        rotated = f"{stem}-{time.strftime('%Y%m%d-%H%M%S')}-{self.rotations}{ext}"
+        os.replace(self.path, rotated)
+        if self.compress:
+            with open(rotated, 'rb') as src, gzip.open(f'{rotated}.gz', 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(rotated)
+        self.rotations += 1
+        old = rotated_files(self.path)
+        for name in old[:max(0, len(old) - self.backups)]:
+            os.remove(name)
+        self._file = open(self.path, 'ab')
+        self._size = 0
+
+    def close(self) -> None:
+        """Write out everything queued and stop the writer thread"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+            self._file.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'enabled': True,
+            'path': self.path,
+            'redact': self.redact,
+            'sample': self.sample,
+            'recorded': self.recorded,
+            'queued': self._queue.qsize(),
+            'dropped': self.dropped,
+            'rotations': self.rotations,
+            'write_errors': self.write_errors,
+            'file_bytes': self._size
+        }
+
+
+def rotated_files(path: str) -> List[str]:
+    """Rotated files of a log, oldest first"""
+    stem, ext = os.path.splitext(path)
+    files = glob.glob(f'{glob.escape(stem)}-*{ext}') + glob.glob(f'{glob.escape(stem)}-*{ext}.gz')
+    return sorted(files, key=os.path.getmtime)
+
+
+def read_records(path: str) -> Iterator[Dict[str, Any]]:
+    """Records of one log file, plain or gzip-compressed"""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def build_request_recorder_from_env() -> Optional[RequestRecorder]:
+    """Return a RequestRecorder if REQUEST_LOG_PATH is set, otherwise None"""
+    path = os.getenv('REQUEST_LOG_PATH')
+    if not path:
+        return None
+    return RequestRecorder(
+        path,
+        redact=os.getenv('REQUEST_LOG_REDACT', 'headers'),
+        sample=float(os.getenv('REQUEST_LOG_SAMPLE', 1.0)),
+        max_bytes=int(os.getenv('REQUEST_LOG_MAX_BYTES', 100 * 1024 * 1024)),
+        backups=int(os.getenv('REQUEST_LOG_BACKUPS', 10)),
+        compress=os.getenv('REQUEST_LOG_COMPRESS', 'False').lower() == 'true',
+        queue_size=int(os.getenv('REQUEST_LOG_QUEUE_SIZE', 10000))
+    )
@@ -0,0 +1,641 @@
+"""
+Provider fallback routing
+Puts an ordered chain of backends behind one model name. A request goes to the first backend
+of the chain whose circuit breaker lets it through; if that backend fails before producing any
+text, the next one is tried at once, so a caller only sees an error when the whole chain has
+failed. A stream that has already sent text is never switched to another backend.
+
+Circuit breakers: after CIRCUIT_BREAKER_FAILURES consecutive failures a backend is skipped for
+CIRCUIT_BREAKER_COOLDOWN seconds; then a single trial request decides whether it closes again.
+
+Hedged requests (HEDGE_REQUESTS=true): when the chosen backend has not produced its first token
+(or, for non-streaming requests, its response) within the HEDGE_QUANTILE of its recent
+latencies, the same request is also sent to the next backend. Whichever answers first wins and
+the other is cancelled, trading a few percent of extra upstream calls for a shorter tail.
+
+Configuration (environment variables):
+    PROVIDER_FALLBACKS        - "<model prefix>=<model>,<model>;..." where each fallback model uses
+                                the router syntax, e.g.
+                                "gpt-4o=anthropic/claude-3-5-haiku-latest,ollama/llama3"
+    CIRCUIT_BREAKER_FAILURES  - consecutive failures that open a breaker (default: 5)
+    CIRCUIT_BREAKER_COOLDOWN  - seconds an open breaker skips its backend (default: 30)
+    HEDGE_REQUESTS            - hedge requests on fallback chains (default: false)
+    HEDGE_QUANTILE            - latency quantile used as the hedge delay (default: 0.95)
+    HEDGE_MIN_DELAY_MS        - lower bound of the hedge delay (default: 50)
+    HEDGE_MAX_DELAY_MS        - upper bound, also used until enough latencies are known (default: 1000)
+"""
+
+import asyncio
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+
+from metrics import PROVIDER_FALLBACKS, HEDGED_REQUESTS, HEDGE_WINS, CIRCUIT_BREAKER_OPENED
+from providers import ProviderError, UnsupportedContent
+
+logger = logging.getLogger(__name__)
+
+# Events of one attempt, as seen by the route
+_DELTA, _DONE, _ERROR = 'delta', 'done', 'error'
+
+# Routes cached per requested model name; beyond this, routes are built per request
+MAX_CACHED_ROUTES = 256
+
+
+class CircuitBreaker:
+    """closed -> open after `failures` consecutive errors -> one trial request after `cooldown`"""
+
+    def __init__(self, name: str, failures: int = 5, cooldown: float = 30.0):
+        self.name = name
+        self.failures = failures
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._consecutive = 0
+        self._opened_at: Optional[float] = None
+        self._trial = False
+        self.opened = 0
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return 'closed'
+        return 'half_open' if self._trial or time.monotonic() - self._opened_at >= self.cooldown else 'open'
+
+    def allow(self) -> bool:
+        """Whether a request may go to the backend; in half-open state only one at a time"""
+        if self._opened_at is None:
+            return True
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial or time.monotonic() - self._opened_at < self.cooldown:
+                return False
+            self._trial = True
+            return True
+
+    def success(self) -> None:
+        if self._consecutive or self._opened_at is not None:
+            with self._lock:
+                if self._opened_at is not None:
+                    logger.info(f"Circuit breaker for {self.name} closed")
+                self._consecutive = 0
+                self._opened_at = None
+                self._trial = False
+
+    def failure(self) -> None:
+        with self._lock:
+            self._consecutive += 1
+            if self._trial or (self._opened_at is None and self._consecutive >= self.failures):
+                if not self._trial:
+                    self.opened += 1
+                    CIRCUIT_BREAKER_OPENED.inc((self.name,))
+                    logger.warning(f"Circuit breaker for {self.name} opened after {self._consecutive} consecutive failures")
+                self._opened_at = time.monotonic()
+                self._trial = False
+
+    def cancelled(self) -> None:
+        """The request neither succeeded nor failed (lost a hedge race, client went away)"""
+        if self._trial:
+            with self._lock:
+                self._trial = False
+
+
+class BackendHealth:
+    """Circuit breaker and recent first-token / response latencies of one backend"""
+
+    WINDOW = 200
+    MIN_SAMPLES = 20
+
+    def __init__(self, name: str, breaker: CircuitBreaker):
+        self.name = name
+        self.breaker = breaker
+        # stream -> latencies; deque appends are atomic, so no lock is needed
+        self._latencies = {True: deque(maxlen=self.WINDOW), False: deque(maxlen=self.WINDOW)}
+        self.requests = 0
+        self.errors = 0
+
+    def observe(self, stream: bool, seconds: float) -> None:
+        self._latencies[stream].append(seconds)
+
+    def quantile(self, stream: bool, q: float) -> Optional[float]:
+        samples = sorted(self._latencies[stream])
+        if len(samples) < self.MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+    def stats(self) -> Dict[str, Any]:
+        p95 = self.quantile(True, 0.95)
+        return {
+            'state': self.breaker.state,
+            'requests': self.requests,
+            'errors': self.errors,
+            'breaker_opened': self.breaker.opened,
+            'ttft_p95_ms': round(p95 * 1000, 1) if p95 is not None else None
+        }
+
+
+class HedgePolicy:
+    """Hedge delay for a backend: a quantile of its recent latencies, clamped to [min_delay, max_delay]"""
+
+    def __init__(self, quantile: float = 0.95, min_delay: float = 0.05, max_delay: float = 1.0):
+        self.quantile = quantile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+
+    def delay(self, health: BackendHealth, stream: bool) -> float:
+        observed = health.quantile(stream, self.quantile)
+        if observed is None:
+            return self.max_delay
+        return max(self.min_delay, min(self.max_delay, observed))
+
+
+class _Candidate:
+    __slots__ = ('backend', 'model', 'health')
+
+    def __init__(self, backend: Any, model: str, health: BackendHealth):
+        self.backend = backend
+        self.model = model
+        self.health = health
+
+
+class _Attempt:
+    """One request sent to one candidate; a route runs one or, when hedging, two at a time"""
+
+    __slots__ = ('candidate', 'started', 'cancel', 'task', 'hedge')
+
+    def __init__(self, candidate: _Candidate, hedge: bool):
+        self.candidate = candidate
+        self.started = time.monotonic()
+        self.cancel = threading.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.hedge = hedge
+
+
+def _as_provider_error(candidate: _Candidate, e: Exception) -> ProviderError:
+    return e if isinstance(e, ProviderError) else ProviderError(f'{candidate.health.name} failed: {e}')
+
+
+class FallbackRoute:
+    """
+    Stands in for a backend: complete/stream/acomplete/astream run the request against the
+    chain. The model argument is ignored; each candidate carries its own upstream model.
+    """
+
+    supports_batching = False
+
+    def __init__(self, name: str, candidates: List[_Candidate], hedge: Optional[HedgePolicy] = None):
+        self.name = name
+        self.candidates = candidates
+        self.hedge = hedge
+
+    def _available(self) -> Iterator[_Candidate]:
+        """Candidates in order, skipping those whose breaker is open; evaluated lazily"""
+        for candidate in self.candidates:
+            if candidate.health.breaker.allow():
+                yield candidate
+
+    def _exhausted(self, error: Optional[ProviderError]) -> ProviderError:
+        if error is not None:
+            return error
+        return ProviderError(f'No healthy backend for {self.name}', status=503)
+
+    @staticmethod
+    def _started(candidate: _Candidate, previous: Optional[_Candidate]) -> None:
+        candidate.health.requests += 1
+        if previous is not None:
+            PROVIDER_FALLBACKS.inc((previous.health.name,))
+
+    @staticmethod
+    def _failed(candidate: _Candidate, error: ProviderError) -> None:
+        if isinstance(error, UnsupportedContent):
+            # The request, not the backend, is at fault; the next candidate may take it
+            candidate.health.breaker.cancelled()
+        else:
+            candidate.health.errors += 1
+            candidate.health.breaker.failure()
+        logger.warning(f"{candidate.health.name} failed for route: {error.message}")
+
+    # ----- sequential fallback -----
+
+    def complete(self, messages, model, temperature, session=None, limits=None) -> str:
+        if self.hedge is not None:
+            for kind, value in self._race(False, messages, temperature, session, limits=limits):
+                if kind == _DONE:
+                    return value
+        error, previous = None, None
+        for candidate in self._available():
+            self._started(candidate, previous)
+            started = time.monotonic()
+            try:
+                text = candidate.backend.complete(messages, candidate.model, temperature, session, limits)
+            except Exception as e:
+                error, previous = _as_provider_error(candidate, e), candidate
+                self._failed(candidate, error)
+                continue
+            candidate.health.observe(False, time.monotonic() - started)
+            candidate.health.breaker.success()
+            return text
+        raise self._exhausted(error)
+
+    def stream(self, messages, model, temperature, session=None, tools=None, limits=None) -> Iterator[str]:
+        if self.hedge is not None:
+            for kind, value in self._race(True, messages, temperature, session, tools, limits):
+                if kind == _DELTA:
+                    yield value
+            return
+        error, previous = None, None
+        for candidate in self._available():
+            self._started(candidate, previous)
+            started = time.monotonic()
+            deltas = candidate.backend.stream(messages, candidate.model, temperature, session, tools, limits)
+            try:
+                first = next(deltas, None)
+            except Exception as e:
+                error, previous = _as_provider_error(candidate, e), candidate
+                self._failed(candidate, error)
+                continue
+            candidate.health.observe(True, time.monotonic() - started)
+            yield from self._finish_stream(candidate, first, deltas)
+            return
+        raise self._exhausted(error)
+
+    def _finish_stream(self, candidate: _Candidate, first: Optional[str], deltas: Iterator[str]) -> Iterator[str]:
+        finished = False
+        try:
+            if first is not None:
+                yield first
+                yield from deltas
+            finished = True
+        except Exception as e:
+            self._failed(candidate, _as_provider_error(candidate, e))
+            raise
+        finally:
+            if finished:
+                candidate.health.breaker.success()
+            else:
+                candidate.health.breaker.cancelled()
+                deltas.close()
+
+    async def acomplete(self, messages, model, temperature, session=None, limits=None) -> str:
+        if self.hedge is not None:
+            async for kind, value in self._arace(False, messages, temperature, session, limits=limits):
+                if kind == _DONE:
+                    return value
+        error, previous = None, None
+        for candidate in self._available():
+            self._started(candidate, previous)
+            started = time.monotonic()
+            try:
+                text = await candidate.backend.acomplete(messages, candidate.model, temperature, session, limits)
+            except Exception as e:
+                error, previous = _as_provider_error(candidate, e), candidate
+                self._failed(candidate, error)
+                continue
+            candidate.health.observe(False, time.monotonic() - started)
+            candidate.health.breaker.success()
+            return text
+        raise self._exhausted(error)
+
+    async def astream(self, messages, model, temperature, session=None, tools=None, limits=None) -> AsyncIterator[str]:
+        if self.hedge is not None:
+            async for kind, value in self._arace(True, messages, temperature, session, tools, limits):
+                if kind == _DELTA:
+                    yield value
+            return
+        error, previous = None, None
+        for candidate in self._available():
+            self._started(candidate, previous)
+            started = time.monotonic()
+            deltas = candidate.backend.astream(messages, candidate.model, temperature, session, tools, limits)
+            try:
+                first = await deltas.__anext__()
+            except StopAsyncIteration:
+                first = None
+            except Exception as e:
+                error, previous = _as_provider_error(candidate, e), candidate
+                self._failed(candidate, error)
+                continue
+            candidate.health.observe(True, time.monotonic() - started)
+            finished = False
+            try:
+                if first is not None:
+                    yield first
+                    async for delta in deltas:
+                        yield delta
+                finished = True
+            except Exception as e:
+                self._failed(candidate, _as_provider_error(candidate, e))
+                raise
+            finally:
+                if finished:
+                    candidate.health.breaker.success()
+                else:
+                    candidate.health.breaker.cancelled()
+                    await deltas.aclose()
+            return
+        raise self._exhausted(error)
+
+    # ----- hedged requests -----
+
+    def _launch(self, chain: Iterator[_Candidate], previous: Optional[_Candidate], hedge: bool) -> Optional[_Attempt]:
+        candidate = next(chain, None)
+        if candidate is None:
+            return None
+        if hedge:
+            HEDGED_REQUESTS.inc((previous.health.name,))
+            candidate.health.requests += 1
+        else:
+            self._started(candidate, previous)
+        return _Attempt(candidate, hedge)
+
+    def _won(self, attempt: _Attempt, stream: bool, attempts: List[_Attempt]) -> None:
+        """attempt produced the first output: record its latency and cancel the others"""
+        attempt.candidate.health.observe(stream, time.monotonic() - attempt.started)
+        if attempt.hedge:
+            HEDGE_WINS.inc((attempt.candidate.health.name,))
+        for other in attempts:
+            if other is not attempt:
+                self._cancel(other, stream)
+
+    @staticmethod
+    def _cancel(attempt: _Attempt, stream: bool, observe: bool = True) -> None:
+        if observe:
+            # The loser's latency is at least this long; recording it keeps its tail in the quantile
+            attempt.candidate.health.observe(stream, time.monotonic() - attempt.started)
+        attempt.candidate.health.breaker.cancelled()
+        attempt.cancel.set()
+        if attempt.task is not None:
+            attempt.task.cancel()
+
+    def _run(self, attempt: _Attempt, stream: bool, messages, temperature, session, tools, limits, events: queue.SimpleQueue) -> None:
+        """Thread body of one attempt; stops at the next delta once cancelled"""
+        candidate = attempt.candidate
+        try:
+            if stream:
+                deltas = candidate.backend.stream(messages, candidate.model, temperature, session, tools, limits)
+                try:
+                    for delta in deltas:
+                        if attempt.cancel.is_set():
+                            return
+                        events.put((attempt, _DELTA, delta))
+                finally:
+                    deltas.close()
+                events.put((attempt, _DONE, None))
+            else:
+                events.put((attempt, _DONE, candidate.backend.complete(messages, candidate.model, temperature, session, limits)))
+        except Exception as e:
+            events.put((attempt, _ERROR, _as_provider_error(candidate, e)))
+
+    def _race(self, stream: bool, messages, temperature, session, tools=None, limits=None) -> Iterator[Tuple[str, Any]]:
+        """
+        Run the request with hedging and yield the winning attempt's (kind, value) events.
+        Attempts run on their own threads so the caller can wait on whichever answers first.
+        """
+        events: queue.SimpleQueue = queue.SimpleQueue()
+        chain = self._available()
+        attempts: List[_Attempt] = []
+        winner: Optional[_Attempt] = None
+        error: Optional[ProviderError] = None
+        done = False
+
+        def start(previous: Optional[_Candidate] = None, hedge: bool = False) -> bool:
+            attempt = self._launch(chain, previous, hedge)
+            if attempt is None:
+                return False
+            attempts.append(attempt)
+            threading.Thread(
+                target=self._run, args=(attempt, stream, messages, temperature, session, tools, limits, events),
+                name=f'hedge-{attempt.candidate.health.name}', daemon=True
+            ).start()
+            return True
+
+        if not start():
+            raise self._exhausted(None)
+        hedge_at: Optional[float] = time.monotonic() + self.hedge.delay(attempts[0].candidate.health, stream)
+        try:
+            while True:
+                timeout = max(0.0, hedge_at - time.monotonic()) if winner is None and hedge_at is not None else None
+                try:
+                    attempt, kind, value = events.get(timeout=timeout)
+                except queue.Empty:
+                    hedge_at = None
+                    start(attempts[-1].candidate, hedge=True)
+                    continue
+                if winner is not None and attempt is not winner:
+                    continue  # output of a cancelled attempt
+                if kind == _ERROR:
+                    self._failed(attempt.candidate, value)
+                    if winner is not None:
+                        done = True
+                        raise value
+                    attempts.remove(attempt)
+                    error = value
+                    if not attempts:
+                        if not start(attempt.candidate):
+                            raise self._exhausted(error)
+                        if hedge_at is not None:
+                            hedge_at = time.monotonic() + self.hedge.delay(attempts[0].candidate.health, stream)
+                    continue
+                if winner is None:
+                    winner = attempt
+                    self._won(attempt, stream, attempts)
+                if kind == _DONE:
+                    done = True
+                    attempt.candidate.health.breaker.success()
+                    yield kind, value
+                    return
+                yield kind, value
+        finally:
+            # Losers were cancelled when the winner was picked; this stops the winner when the
+            # caller went away mid-stream, or everything when no attempt answered
+            for attempt in attempts:
+                if not attempt.cancel.is_set() and not (attempt is winner and done):
+                    self._cancel(attempt, stream, observe=attempt is not winner)
+
+    async def _arun(self, attempt: _Attempt, stream: bool, messages, temperature, session, tools, limits, events: asyncio.Queue) -> None:
+        candidate = attempt.candidate
+        try:
+            if stream:
+                async for delta in candidate.backend.astream(messages, candidate.model, temperature, session, tools, limits):
+                    events.put_nowait((attempt, _DELTA, delta))
+                events.put_nowait((attempt, _DONE, None))
+            else:
+                events.put_nowait((attempt, _DONE, await candidate.backend.acomplete(messages, candidate.model, temperature, session, limits)))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            events.put_nowait((attempt, _ERROR, _as_provider_error(candidate, e)))
+
+    async def _arace(self, stream: bool, messages, temperature, session, tools=None, limits=None) -> AsyncIterator[Tuple[str, Any]]:
+        """Async version of _race; the losing attempt's task is cancelled, closing its upstream stream"""
+        events: asyncio.Queue = asyncio.Queue()
+        chain = self._available()
+        attempts: List[_Attempt] = []
+        winner: Optional[_Attempt] = None
+        error: Optional[ProviderError] = None
+        done = False
+
+        def start(previous: Optional[_Candidate] = None, hedge: bool = False) -> bool:
+            attempt = self._launch(chain, previous, hedge)
+            if attempt is None:
+                return False
+            attempts.append(attempt)
+            attempt.task = asyncio.ensure_future(self._arun(attempt, stream, messages, temperature, session, tools, limits, events))
+            return True
+
+        if not start():
+            raise self._exhausted(None)
+        hedge_at: Optional[float] = time.monotonic() + self.hedge.delay(attempts[0].candidate.health, stream)
+        try:
+            while True:
+                timeout = max(0.0, hedge_at - time.monotonic()) if winner is None and hedge_at is not None else None
+                try:
+                    attempt, kind, value = await asyncio.wait_for(events.get(), timeout)
+                except asyncio.TimeoutError:
+                    hedge_at = None
+                    start(attempts[-1].candidate, hedge=True)
+                    continue
+                if winner is not None and attempt is not winner:
+                    continue
+                if kind == _ERROR:
+                    self._failed(attempt.candidate, value)
+                    if winner is not None:
+                        done = True
+                        raise value
+                    attempts.remove(attempt)
+                    error = value
+                    if not attempts:
+                        if not start(attempt.candidate):
+                            raise self._exhausted(error)
+                        if hedge_at is not None:
+                            hedge_at = time.monotonic() + self.hedge.delay(attempts[0].candidate.health, stream)
+                    continue
+                if winner is None:
+                    winner = attempt
+                    self._won(attempt, stream, attempts)
+                if kind == _DONE:
+                    done = True
+                    attempt.candidate.health.breaker.success()
+                    yield kind, value
+                    return
+                yield kind, value
+        finally:
+            # Losers were cancelled when the winner was picked; this stops the winner when the
+            # caller went away mid-stream, or everything when no attempt answered
+            for attempt in attempts:
+                if not attempt.cancel.is_set() and not (attempt is winner and done):
+                    self._cancel(attempt, stream, observe=attempt is not winner)
+
+    def close(self) -> None:
+        pass  # candidates' backends are owned by the router
+
+    async def aclose(self) -> None:
+        pass
+
+
+class FallbackRoutes:
+    """Fallback chains by model prefix, with one health record (breaker, latencies) per backend"""
+
+    def __init__(
+        self,
+        chains: List[Tuple[str, Tuple[str, ...]]],
+        failures: int = 5,
+        cooldown: float = 30.0,
+        hedge: Optional[HedgePolicy] = None
+    ):
+        self.chains = chains
+        self.failures = failures
+        self.cooldown = cooldown
+        self.hedge = hedge
+        self._health: Dict[int, BackendHealth] = {}
+        self._routes: Dict[str, FallbackRoute] = {}
+        self._lock = threading.Lock()
+
+    def _chain(self, model_name: str) -> Optional[Tuple[str, ...]]:
+        for prefix, fallbacks in self.chains:
+            if model_name.startswith(prefix):
+                return fallbacks
+        return None
+
+    def health(self, backend: Any) -> BackendHealth:
+        health = self._health.get(id(backend))
+        if health is None:
+            with self._lock:
+                health = self._health.get(id(backend))
+                if health is None:
+                    # Two backends of the same type (e.g. two OpenAI-compatible servers) get distinct names
+                    name = backend.name
+                    if any(h.name == name for h in self._health.values()):
+                        name = f'{name}-{len(self._health)}'
+                    health = self._health[id(backend)] = BackendHealth(name, CircuitBreaker(name, self.failures, self.cooldown))
+        return health
+
+    def wrap(
+        self,
+        model_name: str,
+        backend: Any,
+        upstream_model: str,
+        resolve: Callable[[str], Tuple[Any, str]]
+    ) -> Tuple[Any, str]:
+        """
+        The model's FallbackRoute, or (backend, upstream_model) unchanged if it has no chain.
+        resolve maps a fallback model name to its (backend, upstream_model).
+        """
+        route = self._routes.get(model_name)
+        if route is None:
+            fallbacks = self._chain(model_name)
+            if fallbacks is None:
+                return backend, upstream_model
+            candidates = [_Candidate(backend, upstream_model, self.health(backend))]
+            for fallback in fallbacks:
+                fallback_backend, fallback_model = resolve(fallback)
+                candidates.append(_Candidate(fallback_backend, fallback_model, self.health(fallback_backend)))
+            route = FallbackRoute(model_name, candidates, self.hedge)
+            if len(self._routes) < MAX_CACHED_ROUTES:
+                self._routes[model_name] = route
+        return route, upstream_model
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'backends': {health.name: health.stats() for health in list(self._health.values())},
+            'routes': {name: [c.health.name for c in route.candidates] for name, route in list(self._routes.items())},
+            'hedge_quantile': self.hedge.quantile if self.hedge else None
+        }
+
+
+def parse_fallbacks(spec: str) -> List[Tuple[str, Tuple[str, ...]]]:
+    """"gpt-4o=anthropic/claude-3-5-haiku-latest,ollama/llama3;claude-=gpt-4o-mini" -> [(prefix, fallbacks)]"""
+    chains = []
+    for entry in spec.split(';'):
+        prefix, sep, targets = entry.partition('=')
+        fallbacks = tuple(t.strip() for t in targets.split(',') if t.strip())
+        if not sep or not prefix.strip() or not fallbacks:
+            if entry.strip():
+                logger.warning(f"Ignoring malformed PROVIDER_FALLBACKS entry: {entry!r}")
+            continue
+        chains.append((prefix.strip(), fallbacks))
+    return chains
+
+
+def build_routing_from_env() -> Optional[FallbackRoutes]:
+    """None unless PROVIDER_FALLBACKS defines at least one chain"""
+    chains = parse_fallbacks(os.getenv('PROVIDER_FALLBACKS', ''))
+    if not chains:
+        return None
+    hedge = None
+    if os.getenv('HEDGE_REQUESTS', 'false').lower() == 'true':
+        hedge = HedgePolicy(
+            quantile=float(os.getenv('HEDGE_QUANTILE', 0.95)),
+            min_delay=float(os.getenv('HEDGE_MIN_DELAY_MS', 50)) / 1000,
+            max_delay=float(os.getenv('HEDGE_MAX_DELAY_MS', 1000)) / 1000
+        )
+    return FallbackRoutes(
+        chains,
+        failures=int(os.getenv('CIRCUIT_BREAKER_FAILURES', 5)),
+        cooldown=float(os.getenv('CIRCUIT_BREAKER_COOLDOWN', 30)),
+        hedge=hedge
+    )
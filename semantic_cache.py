@@ -0,0 +1,325 @@
+"""
+Semantic response cache for CustomLLM
+Answers near-duplicate user turns ("what are your hours" / "when are you open") from earlier
+responses. The last user message is embedded and compared by cosine similarity against the
+cached questions that share the request's model, system prompt and the conversation before that
+message; the best match at or above SEMANTIC_CACHE_THRESHOLD is returned. Checked after the
+exact-match cache (cache.py). A short reply such as "yes" means something else after each
+question, so answers are only shared between calls at the same point of the conversation: in
+practice, the opening questions of calls. Sampled requests (temperature > 0) are skipped.
+
+Each scope keeps its vectors in one contiguous NumPy matrix, so a lookup is a single
+vectorized scan of that scope. Entries expire after SEMANTIC_CACHE_TTL seconds and
+the least recently used are evicted beyond SEMANTIC_CACHE_MAX_ENTRIES. Requires numpy.
+
+Embedders (SEMANTIC_CACHE_EMBEDDER):
+    hashing[:<dim>]                - dependency-free hashed word and character n-grams (default,
+                                     dim 256); matches rewordings that share most of their words
+    sentence-transformers:<model>  - a local sentence-transformers model via the optional package,
+                                     e.g. paraphrase-multilingual-MiniLM-L12-v2; matches paraphrases
+    callable:<module>.<function>   - any function taking a list of texts and returning an
+                                     (n, dim) array
+
+Configuration (environment variables):
+    SEMANTIC_CACHE_ENABLED      - "true" to enable (default: false)
+    SEMANTIC_CACHE_EMBEDDER     - embedder spec, see above (default: hashing)
+    SEMANTIC_CACHE_THRESHOLD    - minimum cosine similarity for a hit (default: 0.9)
+    SEMANTIC_CACHE_MAX_ENTRIES  - maximum cached answers over all scopes (default: 10000)
+    SEMANTIC_CACHE_TTL          - seconds before an entry expires (default: 3600)
+    SEMANTIC_CACHE_ALLOW_SAMPLED - "true" to also cache requests with temperature > 0 (default: false)
+"""
+
+import hashlib
+import importlib
+import itertools
+import json
+import os
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+Embedder = Callable[[List[str]], Any]
+
+# Arabic diacritics and tatweel, dropped before embedding
+_TASHKEEL = re.compile('[\u0610-\u061a\u064b-\u065f\u0670\u0640]')
+_ARABIC_FOLD = str.maketrans({'\u0623': '\u0627', '\u0625': '\u0627', '\u0622': '\u0627', '\u0649': '\u064a', '\u0629': '\u0647'})
+_WORD = re.compile(r'\w+')
+
+
+def normalize_text(text: str) -> str:
+    """Lowercase, strip punctuation and Arabic diacritics, fold common Arabic letter variants"""
+    return ' '.join(_WORD.findall(_TASHKEEL.sub('', text.lower()).translate(_ARABIC_FOLD)))
+
+
+class HashingEmbedder:
+    """Signed feature hashing of words, word pairs and character trigrams into a fixed-size vector"""
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+        self.name = f'hashing:{dim}'
+
+    def _features(self, text: str) -> List[str]:
+        words = normalize_text(text).split()
+        features = words + [f'{a} {b}' for a, b in zip(words, words[1:])]
+        for word in words:
+            padded = f' {word} '
+            features.extend(padded[i:i + 3] for i in range(len(padded) - 2))
+        return features
+
+    def __call__(self, texts: List[str]) -> Any:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                h = zlib.crc32(feature.encode('utf-8'))
+                vectors[row, h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        return vectors
+
+
+class SentenceTransformerEmbedder:
+    """Local sentence-transformers model through the optional package"""
+
+    def __init__(self, model: str):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            raise ImportError("Please install sentence-transformers: pip install sentence-transformers")
+        self._model = SentenceTransformer(model)
+        self.name = f'sentence-transformers:{model}'
+
+    def __call__(self, texts: List[str]) -> Any:
+        return self._model.encode(texts, convert_to_numpy=True)
+
+
+def build_embedder(spec: str) -> Embedder:
+    """Build an embedder from a spec such as "hashing", "hashing:512" or "callable:mypkg.embed" """
+    kind, _, arg = spec.partition(':')
+    if kind == 'hashing':
+        return HashingEmbedder(int(arg) if arg else 256)
+    if kind == 'sentence-transformers':
+        return SentenceTransformerEmbedder(arg or 'paraphrase-multilingual-MiniLM-L12-v2')
+    if kind == 'callable':
+        module, _, function = arg.rpartition('.')
+        return getattr(importlib.import_module(module), function)
+    raise ValueError(f"Unknown semantic cache embedder: {spec}")
+
+
+def _history(messages: List[Dict[str, Any]]) -> str:
+    """The turns before the last user message, whitespace-normalized"""
+    last = max((i for i, msg in enumerate(messages) if msg.get('role') == 'user'), default=len(messages))
+    turns = [
+        [msg.get('role'), ' '.join(msg['content'].split()) if isinstance(msg.get('content'), str) else msg.get('content'),
+         msg.get('name'), msg.get('tool_calls'), msg.get('tool_call_id')]
+        for msg in messages[:last] if msg.get('role') != 'system'
+    ]
+    return json.dumps(turns, ensure_ascii=False, separators=(',', ':'), default=str) if turns else ''
+
+
+def scope_of(model: str, messages: List[Dict[str, Any]], limits: Any = None) -> str:
+    """
+    Answers are only shared between requests with the same model, system prompt, output limits
+    and conversation before the last user message
+    """
+    system = '\n'.join(str(msg.get('content')) for msg in messages if msg.get('role') == 'system')
+    if limits is not None:
+        system += f'\x00{limits.key()!r}'
+    return hashlib.sha256(f'{model}\x00{system}\x00{_history(messages)}'.encode('utf-8')).hexdigest()
+
+
+def last_user_text(messages: List[Dict[str, Any]]) -> Optional[str]:
+    for msg in reversed(messages):
+        if msg.get('role') == 'user':
+            content = msg.get('content')
+            return content if isinstance(content, str) and content.strip() else None
+    return None
+
+
+class SemanticLookup:
+    """Result of a lookup; pass it back to SemanticCache.put to cache the response on a miss"""
+
+    __slots__ = ('scope', 'vector', 'answer', 'similarity')
+
+    def __init__(self, scope: str, vector: Any, answer: Optional[str] = None, similarity: Optional[float] = None):
+        self.scope = scope
+        self.vector = vector
+        self.answer = answer
+        self.similarity = similarity
+
+
+class _ScopeIndex:
+    """
+    Unit vectors of one scope, stored one matrix row per dimension (dim x capacity) so that a
+    sparse query (the hashing embedder sets ~20% of dimensions) only reads the rows of its
+    non-zero dimensions. Removal moves the last column into the hole.
+    """
+
+    # Below this many entries a dense matrix-vector product is cheaper than the sparse loop
+    SPARSE_MIN_SIZE = 8192
+
+    def __init__(self, dim: int, capacity: int = 64):
+        self.vectors = np.empty((dim, capacity), dtype=np.float32)
+        self.ids = np.empty(capacity, dtype=np.int64)
+        self.size = 0
+        self.rows: Dict[int, int] = {}  # entry id -> column
+
+    def add(self, entry_id: int, vector: Any) -> None:
+        if self.size == len(self.ids):
+            self.vectors = np.concatenate([self.vectors, np.empty_like(self.vectors)], axis=1)
+            self.ids = np.concatenate([self.ids, np.empty_like(self.ids)])
+        self.vectors[:, self.size] = vector
+        self.ids[self.size] = entry_id
+        self.rows[entry_id] = self.size
+        self.size += 1
+
+    def remove(self, entry_id: int) -> None:
+        column = self.rows.pop(entry_id)
+        last = self.size - 1
+        if column != last:
+            self.vectors[:, column] = self.vectors[:, last]
+            moved = int(self.ids[last])
+            self.ids[column] = moved
+            self.rows[moved] = column
+        self.size = last
+
+    def best(self, vector: Any) -> Tuple[int, float]:
+        """(entry id, cosine similarity) of the closest vector"""
+        size = self.size
+        nonzero = np.flatnonzero(vector)
+        if size >= self.SPARSE_MIN_SIZE and len(nonzero) * 4 < len(vector):
+            scores = self.vectors[nonzero[0], :size] * vector[nonzero[0]]
+            for d in nonzero[1:]:
+                scores += vector[d] * self.vectors[d, :size]
+        else:
+            scores = vector @ self.vectors[:, :size]
+        column = int(scores.argmax())
+        return int(self.ids[column]), float(scores[column])
+
+
+class SemanticCache:
+    """Thread-safe nearest-neighbour answer cache with LRU/TTL eviction and hit/miss counters"""
+
+    def __init__(
+        self,
+        embedder: Embedder,
+        threshold: float = 0.9,
+        max_entries: int = 10000,
+        ttl: float = 3600.0,
+        allow_sampled: bool = False
+    ):
+        if np is None:
+            raise ImportError("Please install numpy: pip install numpy")
+        self.embedder = embedder
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.allow_sampled = allow_sampled
+        self._scopes: Dict[str, _ScopeIndex] = {}
+        self._entries: 'OrderedDict[int, Tuple[str, str, float]]' = OrderedDict()  # id -> (scope, answer, expires_at)
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.bypassed = 0
+
+    def cacheable(self, temperature: float) -> bool:
+        """Sampled (temperature > 0) responses are not deterministic, so skip them unless allowed"""
+        if temperature > 0 and not self.allow_sampled:
+            with self._lock:
+                self.bypassed += 1
+            return False
+        return True
+
+    def embed(self, text: str) -> Any:
+        vector = np.asarray(self.embedder([text]), dtype=np.float32)[0]
+        norm = float(np.linalg.norm(vector))
+        return vector / norm if norm else vector
+
+    def lookup(self, model: str, messages: List[Dict[str, Any]], limits: Any = None) -> Optional[SemanticLookup]:
+        """The closest cached answer for the last user message, or None if the request has no user text"""
+        text = last_user_text(messages)
+        if text is None:
+            return None
+        result = SemanticLookup(scope_of(model, messages, limits), self.embed(text))
+        with self._lock:
+            index = self._scopes.get(result.scope)
+            if index is not None and index.size:
+                entry_id, similarity = index.best(result.vector)
+                result.similarity = similarity
+                if similarity >= self.threshold:
+                    scope, answer, expires_at = self._entries[entry_id]
+                    if expires_at >= time.monotonic():
+                        self._entries.move_to_end(entry_id)
+                        self.hits += 1
+                        result.answer = answer
+                        return result
+                    self._remove(entry_id)
+                    self.expirations += 1
+            self.misses += 1
+        return result
+
+    def put(self, lookup: SemanticLookup, answer: str) -> None:
+        """Cache answer for the question of a missed lookup"""
+        if not answer or not lookup.vector.any():
+            return
+        with self._lock:
+            index = self._scopes.get(lookup.scope)
+            if index is None:
+                index = self._scopes[lookup.scope] = _ScopeIndex(len(lookup.vector))
+            entry_id = next(self._ids)
+            index.add(entry_id, lookup.vector)
+            self._entries[entry_id] = (lookup.scope, answer, time.monotonic() + self.ttl)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, entry_id: int) -> None:
+        scope, _, _ = self._entries.pop(entry_id)
+        index = self._scopes[scope]
+        index.remove(entry_id)
+        if not index.size:
+            del self._scopes[scope]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._scopes.clear()
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'enabled': True,
+            'embedder': getattr(self.embedder, 'name', repr(self.embedder)),
+            'entries': len(self._entries),
+            'scopes': len(self._scopes),
+            'max_entries': self.max_entries,
+            'threshold': self.threshold,
+            'ttl_seconds': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else None,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'bypassed': self.bypassed
+        }
+
+
+def build_semantic_cache_from_env() -> Optional[SemanticCache]:
+    """Return a SemanticCache if SEMANTIC_CACHE_ENABLED is set, otherwise None"""
+    if os.getenv('SEMANTIC_CACHE_ENABLED', 'False').lower() != 'true':
+        return None
+    return SemanticCache(
+        build_embedder(os.getenv('SEMANTIC_CACHE_EMBEDDER', 'hashing')),
+        threshold=float(os.getenv('SEMANTIC_CACHE_THRESHOLD', 0.9)),
+        max_entries=int(os.getenv('SEMANTIC_CACHE_MAX_ENTRIES', 10000)),
+        ttl=float(os.getenv('SEMANTIC_CACHE_TTL', 3600)),
+        allow_sampled=os.getenv('SEMANTIC_CACHE_ALLOW_SAMPLED', 'False').lower() == 'true'
+    )
@@ -0,0 +1,109 @@
+"""
+JSON serialization for requests and SSE frames
+Uses orjson when it is installed (pip install orjson) and the standard library otherwise.
+Streamed chunks are rendered from a per-completion template, so each token only costs one
+string escape instead of building and encoding a full chunk dict.
+"""
+
+import json
+import time
+import uuid
+from json.encoder import encode_basestring
+from typing import Any, Dict, Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_BACKEND = 'orjson' if orjson is not None else 'stdlib'
+
+
+def _std_dumps(obj: Any) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+
+if orjson is not None:
+    def dumpb(obj: Any) -> bytes:
+        """Compact UTF-8 JSON bytes"""
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            # orjson rejects some values the stdlib accepts (e.g. integers over 64 bits)
+            return _std_dumps(obj).encode('utf-8')
+
+    def dumps(obj: Any) -> str:
+        """Compact JSON text, non-ASCII characters kept as-is"""
+        return dumpb(obj).decode('utf-8')
+
+    def loads(data: Any) -> Any:
+        """Parse JSON from str or bytes; raises ValueError on malformed input"""
+        return orjson.loads(data)
+else:
+    dumps = _std_dumps
+
+    def dumpb(obj: Any) -> bytes:
+        """Compact UTF-8 JSON bytes"""
+        return _std_dumps(obj).encode('utf-8')
+
+    def loads(data: Any) -> Any:
+        """Parse JSON from str or bytes; raises ValueError on malformed input"""
+        return json.loads(data)
+
+
+def new_completion_id() -> str:
+    return f"chatcmpl-{uuid.uuid4().hex[:24]}"
+
+
+def sse_frame(obj: Any) -> str:
+    """Render any JSON payload as an SSE data frame"""
+    return f"data: {dumps(obj)}\n\n"
+
+
+class ChunkRenderer:
+    """
+    Renders the chat.completion.chunk frames of one streamed completion. The id and created
+    timestamp are fixed for the whole stream; content frames splice the escaped delta text
+    into a pre-rendered template.
+    """
+
+    _MARK = '\x00delta\x00'
+
+    def __init__(self, model_name: str, completion_id: Optional[str] = None, created: Optional[int] = None):
+        self.model_name = model_name
+        self.id = completion_id or new_completion_id()
+        self.created = created if created is not None else int(time.time())
+        template = sse_frame(self._body({'content': self._MARK}, None))
+        self._prefix, self._suffix = template.split(encode_basestring(self._MARK))
+
+    def _body(self, delta: Dict[str, Any], finish_reason: Optional[str]) -> Dict[str, Any]:
+        return {
+            'id': self.id,
+            'object': 'chat.completion.chunk',
+            'created': self.created,
+            'model': self.model_name,
+            'choices': [{
+                'index': 0,
+                'delta': delta,
+                'finish_reason': finish_reason
+            }]
+        }
+
+    def content(self, text: str) -> str:
+        """Frame carrying one content delta"""
+        return f"{self._prefix}{encode_basestring(text)}{self._suffix}"
+
+    def tool_call(self, call: Any) -> str:
+        """Frame carrying one tools.ToolCallDelta; id, type and name only come with a call's first piece"""
+        if call.id is None:
+            entry = {'index': call.index, 'function': {'arguments': call.arguments}}
+        else:
+            entry = {'index': call.index, 'id': call.id, 'type': 'function', 'function': {'name': call.name, 'arguments': call.arguments}}
+        return sse_frame(self._body({'tool_calls': [entry]}, None))
+
+    def chunk(self, delta: Dict[str, Any], finish_reason: Optional[str] = None, usage: Optional[Dict[str, int]] = None) -> str:
+        """Frame with an arbitrary delta, e.g. the final stop chunk carrying usage"""
+        body = self._body(delta, finish_reason)
+        if usage is not None:
+            body['usage'] = usage
+        return sse_frame(body)
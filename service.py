@@ -0,0 +1,107 @@
+"""
+Framework-neutral request handling shared by the Flask (app.py) and ASGI (asgi_app.py) servers.
+Route functions in both servers are thin adapters around the helpers in this module.
+"""
+
+import time
+from typing import Any, Dict, List, Optional
+
+from serialization import new_completion_id
+
+
+# Headers sent with every Server-Sent Events response
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'Connection': 'keep-alive',
+    'X-Accel-Buffering': 'no'
+}
+
+HEALTH_BODY = {
+    'status': 'healthy',
+    'service': 'custom-llm-server',
+    'version': '1.0.0'
+}
+
+
+class APIError(Exception):
+    """
+    Error raised by request handlers and rendered in the OpenAI-style error envelope:
+    {"error": {"message": ..., "type": ..., "code": ...}}
+    """
+
+    def __init__(
+        self,
+        message: str,
+        code: str,
+        type: str = 'invalid_request_error',
+        status: int = 400,
+        headers: Optional[Dict[str, str]] = None
+    ):
+        super().__init__(message)
+        self.message = message
+        self.code = code
+        self.type = type
+        self.status = status
+        self.headers = headers or {}
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'error': {
+                'message': self.message,
+                'type': self.type,
+                'code': self.code
+            }
+        }
+
+
+def completion_body(
+    model_name: str, response_text: str, usage: Dict[str, int], tool_calls: Optional[List[Dict[str, Any]]] = None
+) -> Dict[str, Any]:
+    """Build a non-streaming response in Chat Completions format; with tool_calls the model is waiting for their results"""
+    message = {
+        'role': 'assistant',
+        'content': response_text
+    }
+    if tool_calls:
+        message['content'] = response_text or None
+        message['tool_calls'] = tool_calls
+    return {
+        'id': new_completion_id(),
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': model_name,
+        'choices': [{
+            'index': 0,
+            'message': message,
+            'finish_reason': 'tool_calls' if tool_calls else 'stop'
+        }],
+        'usage': usage
+    }
+
+
+def vapi_body(model_name: str, response_text: str, temperature: float) -> Dict[str, Any]:
+    """Build a Vapi-compatible response"""
+    return {
+        'response': response_text,
+        'model': model_name,
+        'temperature': temperature,
+        'timestamp': int(time.time())
+    }
+
+
+def models_body(model_name: str) -> Dict[str, Any]:
+    """List available models (OpenAI-compatible)"""
+    return {
+        'object': 'list',
+        'data': [{
+            'id': model_name,
+            'object': 'model',
+            'created': int(time.time()),
+            'owned_by': 'custom-llm'
+        }]
+    }
+
+
+def internal_error(e: Exception) -> APIError:
+    """Wrap an unexpected exception in the 500 error envelope"""
+    return APIError(f'Internal server error: {str(e)}', 'internal_error', type='server_error', status=500)
@@ -0,0 +1,232 @@
+"""
+Per-call session state for CustomLLM
+Vapi resends the full `messages` history on every turn. A Session remembers the prefix that
+was already validated and the per-message prompt token counts, so each turn only processes
+the new tail. Backends may keep their own cache handles in Session.handles.
+
+Sessions are keyed by call id and evicted when the call ends or after an idle timeout. With
+API keys, the call id is namespaced by the tenant of the caller's key, so a key of one tenant
+cannot read, continue or end the session of another tenant's call.
+
+With a shared store (shared_store.py) the state of each turn is also written there, so the next
+turn of the call can land on another replica: a replica without the call, or with an older
+turn of it, loads the latest state from the store (validated prefix, token counts, context
+window cut and summary). A replica checks the store for a newer turn at most once per
+SHARED_STORE_NEAR_TTL seconds. Speculative responses and backend cache handles stay in the
+process that made them.
+
+Configuration (environment variables):
+    SESSION_IDLE_TIMEOUT  - seconds without a turn before a session is dropped (default: 900)
+    SESSION_MAX           - maximum number of live sessions per worker (default: 10000)
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Mapping, Optional
+from urllib.parse import quote
+
+from context_window import ContextState
+from serialization import dumpb, loads
+
+
+class Session:
+    """State kept for one call between turns"""
+
+    def __init__(self, call_id: str):
+        self.call_id = call_id
+        self.tenant = tenant_of(call_id)
+        self.model: Optional[str] = None  # model the prefix was counted for
+        self.prefix: List[Dict[str, Any]] = []  # messages already validated
+        self.token_counts: List[int] = []  # prompt tokens per message in prefix
+        self.prompt_tokens = 0
+        self.handles: Dict[str, Any] = {}  # backend-side cache handles
+        self.context: Any = None  # context window state (context_window.py)
+        self.speculation: Any = None  # responses prepared for the next turn (speculation.py)
+        self.turns = 0
+        self.created = time.monotonic()
+        self.last_seen = self.created
+        self.synced = 0.0  # when this copy was last written to or checked against the shared store
+
+    def matched_prefix(self, messages: List[Dict[str, Any]]) -> int:
+        """Number of leading messages identical to the stored prefix (0 if the history was rewritten)"""
+        n = len(self.prefix)
+        if n and len(messages) >= n and messages[n - 1] == self.prefix[n - 1] and messages[:n] == self.prefix:
+            return n
+        return 0
+
+    def extend(self, messages: List[Dict[str, Any]], start: int, count_tokens: Callable[[Dict[str, Any]], int]) -> None:
+        """Record messages[start:] as validated and count their tokens"""
+        if start == 0:
+            self.token_counts = []
+            self.prompt_tokens = 0
+        new_counts = [count_tokens(msg) for msg in messages[start:]]
+        self.token_counts.extend(new_counts)
+        self.prompt_tokens += sum(new_counts)
+        self.prefix = list(messages)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """State other replicas can continue the call with"""
+        return {
+            'model': self.model,
+            'prefix': self.prefix,
+            'token_counts': self.token_counts,
+            'prompt_tokens': self.prompt_tokens,
+            'turns': self.turns,
+            'context': self.context.snapshot() if self.context is not None else None
+        }
+
+    def restore(self, data: Dict[str, Any]) -> None:
+        self.model = data['model']
+        self.prefix = data['prefix']
+        self.token_counts = data['token_counts']
+        self.prompt_tokens = data['prompt_tokens']
+        self.turns = data['turns']
+        self.context = ContextState.restore(data['context']) if data.get('context') else None
+
+
+class SessionStore:
+    """Thread-safe map of call id -> Session with idle-timeout and LRU eviction"""
+
+    # How often (seconds) an access also sweeps idle sessions
+    SWEEP_INTERVAL = 30.0
+
+    def __init__(self, idle_timeout: float = 900.0, max_sessions: int = 10000, shared: Any = None):
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.shared = shared  # shared_store.SharedTier; this store is its near-cache
+        self._sessions: 'OrderedDict[str, Session]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+        self.ended = 0
+        self.expired = 0
+        self.evicted = 0
+        self.loaded = 0
+
+    def get(self, call_id: str) -> Session:
+        """Return the session for call_id, creating it if needed"""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_sweep > self.SWEEP_INTERVAL:
+                self._sweep(now)
+            session = self._sessions.get(call_id)
+        if self.shared is not None and (session is None or now - session.synced > self.shared.near_ttl):
+            # Outside the lock: this may be a round trip to the store
+            session = self._load(call_id, session, now)
+        with self._lock:
+            current = self._sessions.get(call_id)
+            if current is None:
+                current = self._sessions[call_id] = session or Session(call_id)
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+                    self.evicted += 1
+            else:
+                self._sessions.move_to_end(call_id)
+            current.last_seen = now
+            return current
+
+    def _load(self, call_id: str, session: Optional[Session], now: float) -> Optional[Session]:
+        """session updated from the shared store if it holds a later turn of the call"""
+        key = 'session:' + call_id
+        data, turns = self.shared.get_many([key, key + ':turns'])
+        if session is not None and (turns is None or not turns.isdigit() or int(turns) <= session.turns):
+            # The snapshot is only parsed when the store is ahead of this copy
+            session.synced = now
+            return session
+        if data is not None:
+            try:
+                snapshot = loads(data)
+                session = session or Session(call_id)
+                session.restore(snapshot)
+                self.loaded += 1
+            except (ValueError, TypeError, KeyError):
+                pass
+        if session is not None:
+            session.synced = now
+        return session
+
+    def save(self, session: Session) -> None:
+        """Write the session's state to the shared store in the background, after a turn"""
+        if self.shared is None:
+            return
+        key = 'session:' + session.call_id
+        self.shared.set(key, dumpb(session.snapshot()), self.idle_timeout)
+        self.shared.set(key + ':turns', str(session.turns).encode(), self.idle_timeout)
+        session.synced = time.monotonic()
+
+    def peek(self, call_id: str) -> Optional[Session]:
+        with self._lock:
+            return self._sessions.get(call_id)
+
+    def end(self, call_id: str) -> bool:
+        """Drop a session when its call ends; returns False if it was unknown"""
+        with self._lock:
+            known = self._sessions.pop(call_id, None) is not None
+        if self.shared is not None:
+            key = 'session:' + call_id
+            known = known or self.shared.get(key + ':turns') is not None
+            self.shared.delete(key)
+            self.shared.delete(key + ':turns')
+        if known:
+            with self._lock:
+                self.ended += 1
+        return known
+
+    def _sweep(self, now: float) -> None:
+        # Sessions are kept in access order, so idle ones are at the front
+        while self._sessions:
+            call_id, session = next(iter(self._sessions.items()))
+            if now - session.last_seen <= self.idle_timeout:
+                break
+            del self._sessions[call_id]
+            self.expired += 1
+        self._last_sweep = now
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'active': len(self._sessions),
+            'max_sessions': self.max_sessions,
+            'idle_timeout_seconds': self.idle_timeout,
+            'ended': self.ended,
+            'expired': self.expired,
+            'evicted': self.evicted,
+            'loaded_from_shared_store': self.loaded
+        }
+
+
+def tenant_of(session_id: str) -> str:
+    """Tenant namespace of a scoped session id; '' without authentication (ids are not scoped then)"""
+    tenant, sep, _ = session_id.partition('/')
+    return tenant if sep else ''
+
+
+def scoped_session_id(call_id: str, record: Any = None) -> str:
+    """call_id in the namespace of the key's tenant; unchanged when authentication is disabled"""
+    if record is None:
+        return call_id
+    return f"{quote(record.tenant, safe='')}/{call_id}"
+
+
+def session_id_from(data: Any, headers: Mapping[str, str], record: Any = None) -> Optional[str]:
+    """
+    Find the call/conversation id of a request: Vapi's `call.id`, `metadata.call_id`
+    or the `X-Call-Id` header, scoped to the tenant of record (the caller's KeyRecord).
+    """
+    call_id = headers.get('X-Call-Id') or None
+    if isinstance(data, dict):
+        call = data.get('call')
+        metadata = data.get('metadata')
+        if isinstance(call, dict) and call.get('id'):
+            call_id = str(call['id'])
+        elif isinstance(metadata, dict) and metadata.get('call_id'):
+            call_id = str(metadata['call_id'])
+    return scoped_session_id(call_id, record) if call_id else None
+
+
+def build_session_store_from_env(shared: Any = None) -> SessionStore:
+    return SessionStore(
+        idle_timeout=float(os.getenv('SESSION_IDLE_TIMEOUT', 900)),
+        max_sessions=int(os.getenv('SESSION_MAX', 10000)),
+        shared=shared
+    )
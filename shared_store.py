@@ -0,0 +1,534 @@
+"""
+Shared store for CustomLLM replicas
+Response cache entries and per-call session state live in each process. Behind a load balancer
+(several containers from docker-compose.yml, or several gunicorn workers) consecutive turns of
+one call land on different processes, which then miss the cache and rebuild the call's state.
+With SHARED_STORE_URL set, both are also kept in a store all replicas share:
+
+    memory://                        - dict in this process (a single process; for tests)
+    sqlite:///path/to/store.db       - SQLite file shared by the processes of one host
+    redis://[:password@]host:port/db - Redis, or any server speaking its protocol (Valkey,
+                                       KeyDB, Dragonfly); fake_redis.py is a local stand-in
+
+The in-process cache and session store stay in front of it as a near-cache, so a replica that
+already holds an entry answers without a round trip. The request path never waits for a
+write: writes are queued, coalesced per key and sent by a background thread as one pipelined
+batch. Reads that arrive while another read is in flight are sent together as the next batch
+(one MGET). The store is best-effort: when it is down or slow a request loses at most its
+timeout, the error is counted and the request carries on with the in-process state; after a
+failure reads skip the store for a second rather than each waiting for the timeout.
+
+GET /stats/shared-store reports round trips, batch sizes and errors.
+
+Configuration (environment variables):
+    SHARED_STORE_URL         - store URL as above (default: unset, nothing is shared)
+    SHARED_STORE_PREFIX      - prefix of every key (default: "custom-llm:")
+    SHARED_STORE_TIMEOUT_MS  - Redis connect and reply timeout (default: 250)
+    SHARED_STORE_FLUSH_MS    - time writes are collected before a batch is sent (default: 2)
+    SHARED_STORE_NEAR_TTL    - seconds a process trusts its own copy of a call's state before
+                               checking the store for a newer turn (default: 0, always check)
+"""
+
+import atexit
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import unquote, urlparse
+
+from metrics import SHARED_STORE_ERRORS, SHARED_STORE_ROUND_TRIPS
+
+logger = logging.getLogger(__name__)
+
+# (key, value, ttl seconds)
+Item = Tuple[str, bytes, float]
+
+_MISSING = object()
+
+
+class StoreError(Exception):
+    """The shared store could not be reached or rejected a command"""
+
+
+class ErrorReply(StoreError):
+    """Error reply to a command (the connection stays usable)"""
+
+
+class Store:
+    """Key/value backend of a SharedTier: values are bytes, every entry has a TTL"""
+
+    name = 'store'
+
+    def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        """Values of keys in one round trip, None for missing or expired keys"""
+        raise NotImplementedError
+
+    def write(self, sets: List[Item], deletes: List[str]) -> None:
+        """Apply sets and deletes in one round trip"""
+        raise NotImplementedError
+
+
+class MemoryStore(Store):
+    """Process-local dict; shares nothing between processes"""
+
+    name = 'memory'
+
+    # Writes between sweeps of expired entries
+    SWEEP_EVERY = 1000
+
+    def __init__(self):
+        self._data: Dict[str, Tuple[bytes, float]] = {}  # key -> (value, expires_at)
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        now = time.time()
+        values = []
+        with self._lock:
+            for key in keys:
+                entry = self._data.get(key)
+                values.append(entry[0] if entry is not None and entry[1] > now else None)
+        return values
+
+    def write(self, sets: List[Item], deletes: List[str]) -> None:
+        now = time.time()
+        with self._lock:
+            for key, value, ttl in sets:
+                self._data[key] = (value, now + ttl)
+            for key in deletes:
+                self._data.pop(key, None)
+            self._writes += len(sets)
+            if self._writes >= self.SWEEP_EVERY:
+                self._writes = 0
+                self._data = {key: entry for key, entry in self._data.items() if entry[1] > now}
+
+
+class SQLiteStore(Store):
+    """Table in a SQLite file (WAL mode), shared by the processes of one host"""
+
+    name = 'sqlite'
+    SCHEMA = 'CREATE TABLE IF NOT EXISTS shared (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL)'
+    SWEEP_EVERY = 1000
+    # Keys per SELECT, below SQLite's bound parameter limit
+    MAX_KEYS = 500
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connect()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._connect)
+
+    def _connect(self) -> None:
+        # A SQLite connection must not be used across fork: each worker opens its own
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(self.SCHEMA)
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        now = time.time()
+        found: Dict[str, bytes] = {}
+        with self._lock:
+            for i in range(0, len(keys), self.MAX_KEYS):
+                part = keys[i:i + self.MAX_KEYS]
+                found.update(self._conn.execute(
+                    f"SELECT key, value FROM shared WHERE key IN ({','.join('?' * len(part))}) AND expires > ?",
+                    (*part, now)
+                ).fetchall())
+        return [found.get(key) for key in keys]
+
+    def write(self, sets: List[Item], deletes: List[str]) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.executemany('INSERT OR REPLACE INTO shared VALUES (?, ?, ?)',
+                                       [(key, value, now + ttl) for key, value, ttl in sets])
+                self._conn.executemany('DELETE FROM shared WHERE key = ?', [(key,) for key in deletes])
+                self._writes += len(sets)
+                if self._writes >= self.SWEEP_EVERY:
+                    self._writes = 0
+                    self._conn.execute('DELETE FROM shared WHERE expires <= ?', (now,))
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+
+
+def _encode(command: List[Any]) -> bytes:
+    parts = [part if isinstance(part, bytes) else str(part).encode('utf-8') for part in command]
+    return b'*%d\r\n' % len(parts) + b''.join(b'$%d\r\n%s\r\n' % (len(part), part) for part in parts)
+
+
+class _Connection:
+    """One RESP connection; execute() writes a pipeline of commands at once and reads all replies"""
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.reader = sock.makefile('rb')
+        self.pid = os.getpid()
+
+    def execute(self, commands: List[List[Any]]) -> List[Any]:
+        self.sock.sendall(b''.join(_encode(command) for command in commands))
+        replies = [self._reply() for _ in commands]
+        for reply in replies:
+            if isinstance(reply, ErrorReply):
+                raise reply
+        return replies
+
+    def _reply(self) -> Any:
+        line = self.reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise StoreError('Connection closed by the store')
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest
+        if kind == b'-':
+            # Returned, not raised, so the rest of the pipeline's replies are still read
+            return ErrorReply(rest.decode('utf-8', 'replace'))
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            size = int(rest)
+            if size < 0:
+                return None
+            data = self.reader.read(size + 2)
+            if len(data) != size + 2:
+                raise StoreError('Connection closed by the store')
+            return data[:-2]
+        if kind == b'*':
+            size = int(rest)
+            return None if size < 0 else [self._reply() for _ in range(size)]
+        raise StoreError(f'Unexpected reply from the store: {line[:32]!r}')
+
+    def close(self) -> None:
+        try:
+            self.reader.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class RedisStore(Store):
+    """Client for the Redis protocol (RESP2) with a small connection pool and pipelining"""
+
+    name = 'redis'
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 6379, db: int = 0, password: Optional[str] = None,
+                 timeout: float = 0.25, pool_size: int = 8):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._pool: List[_Connection] = []
+        self._lock = threading.Lock()
+
+    def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        return self.pipeline([['MGET', *keys]])[0]
+
+    def write(self, sets: List[Item], deletes: List[str]) -> None:
+        commands: List[List[Any]] = [['SET', key, value, 'PX', max(1, int(ttl * 1000))] for key, value, ttl in sets]
+        if deletes:
+            commands.append(['DEL', *deletes])
+        self.pipeline(commands)
+
+    def pipeline(self, commands: List[List[Any]]) -> List[Any]:
+        """Send commands in one write and return their replies; raises StoreError"""
+        conn = self._acquire()
+        try:
+            replies = conn.execute(commands)
+        except ErrorReply:
+            self._release(conn)
+            raise
+        except (StoreError, OSError, ValueError) as e:
+            # Timeout, closed or garbled connection: its replies can no longer be matched up
+            conn.close()
+            raise StoreError(f'redis://{self.host}:{self.port}: {e}') from e
+        self._release(conn)
+        return replies
+
+    def _acquire(self) -> _Connection:
+        pid = os.getpid()
+        with self._lock:
+            while self._pool:
+                conn = self._pool.pop()
+                # Sockets inherited over fork are shared with the parent: never reuse them
+                if conn.pid == pid:
+                    return conn
+        return self._connect()
+
+    def _release(self, conn: _Connection) -> None:
+        with self._lock:
+            if len(self._pool) < self.pool_size:
+                self._pool.append(conn)
+                return
+        conn.close()
+
+    def _connect(self) -> _Connection:
+        try:
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        except OSError as e:
+            raise StoreError(f'Cannot connect to redis://{self.host}:{self.port}: {e}') from e
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = _Connection(sock)
+        setup: List[List[Any]] = []
+        if self.password:
+            setup.append(['AUTH', self.password])
+        if self.db:
+            setup.append(['SELECT', self.db])
+        if setup:
+            try:
+                conn.execute(setup)
+            except (StoreError, OSError) as e:
+                conn.close()
+                raise StoreError(f'redis://{self.host}:{self.port}: {e}') from e
+        return conn
+
+
+class _Read:
+    """Keys one caller is waiting for; the thread with lead set sends the next batch"""
+
+    __slots__ = ('keys', 'values', 'done', 'lead')
+
+    def __init__(self, keys: List[str]):
+        self.keys = keys
+        self.values: List[Optional[bytes]] = []
+        self.done = threading.Event()
+        self.lead = False
+
+
+class SharedTier:
+    """
+    Best-effort front of a Store: batched reads, write-behind batched writes, error accounting.
+    Keys are given without the prefix.
+    """
+
+    # After a failure, reads skip the store for this many seconds instead of each paying the timeout
+    RETRY_INTERVAL = 1.0
+
+    def __init__(self, store: Store, prefix: str = 'custom-llm:', flush_interval: float = 0.002,
+                 near_ttl: float = 0.0, max_pending: int = 10000):
+        self.store = store
+        self.prefix = prefix
+        self.flush_interval = flush_interval
+        self.near_ttl = near_ttl
+        self.max_pending = max_pending
+        self.reads = 0
+        self.read_round_trips = 0
+        self.keys_read = 0
+        self.keys_found = 0
+        self.writes = 0
+        self.writes_coalesced = 0
+        self.writes_dropped = 0
+        self.write_round_trips = 0
+        self.keys_written = 0
+        self.errors = 0
+        self.reads_skipped = 0
+        self._down = False
+        self._retry_at = 0.0
+        self._start()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._start)
+        atexit.register(self.flush, 1.0)
+
+    def _start(self) -> None:
+        # Also runs in a forked worker: the parent's queue and writer thread did not come along
+        self._cond = threading.Condition()
+        self._pending: Dict[str, Optional[Tuple[bytes, float]]] = {}  # key -> (value, ttl), None = delete
+        self._writing: Dict[str, Optional[Tuple[bytes, float]]] = {}
+        self._read_lock = threading.Lock()
+        self._read_queue: List[_Read] = []
+        self._reading = False
+        threading.Thread(target=self._write_loop, name='shared-store-writer', daemon=True).start()
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.get_many([key])[0]
+
+    def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        """Values of keys, None when missing or when the store fails; this process's queued writes are seen"""
+        full = [self.prefix + key for key in keys]
+        with self._cond:
+            local = [self._pending.get(key, self._writing.get(key, _MISSING)) for key in full]
+        missing = [key for key, value in zip(full, local) if value is _MISSING]
+        if missing and self._down and time.monotonic() < self._retry_at:
+            self.reads_skipped += 1
+            missing = []
+        fetched = dict(zip(missing, self._fetch(missing))) if missing else {}
+        self.reads += 1
+        return [fetched.get(key) if value is _MISSING else (value[0] if value else None) for key, value in zip(full, local)]
+
+    def set(self, key: str, value: bytes, ttl: float) -> None:
+        """Queue a write; it is sent with the next batch"""
+        self._queue(self.prefix + key, (value, ttl))
+
+    def delete(self, key: str) -> None:
+        self._queue(self.prefix + key, None)
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """Wait until every queued write has been sent; False on timeout"""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending and not self._writing, timeout)
+
+    def _fetch(self, keys: List[str]) -> List[Optional[bytes]]:
+        # Natural batching: with no read in flight this one goes out at once; reads arriving
+        # meanwhile queue up and go out together as the next batch
+        read = _Read(keys)
+        with self._read_lock:
+            if self._reading:
+                self._read_queue.append(read)
+            else:
+                self._reading = read.lead = True
+        if not read.lead:
+            read.done.wait()
+            if not read.lead:
+                return read.values
+            # Woken to send the reads queued behind the previous batch, this one among them
+        with self._read_lock:
+            batch, self._read_queue = self._read_queue, []
+        if read not in batch:
+            batch.append(read)
+        self._send_reads(batch)
+        with self._read_lock:
+            if self._read_queue:
+                following = self._read_queue[0]
+                following.lead = True
+                following.done.set()
+            else:
+                self._reading = False
+        return read.values
+
+    def _send_reads(self, batch: List[_Read]) -> None:
+        keys = list(dict.fromkeys(key for read in batch for key in read.keys))
+        try:
+            found = dict(zip(keys, self.store.get_many(keys)))
+            self._available()
+        except Exception as e:
+            found = {}
+            self._failed('read', e)
+        self.read_round_trips += 1
+        self.keys_read += len(keys)
+        self.keys_found += sum(1 for value in found.values() if value is not None)
+        SHARED_STORE_ROUND_TRIPS.inc(('read',))
+        for read in batch:
+            read.values = [found.get(key) for key in read.keys]
+            if not read.lead:
+                read.done.set()
+
+    def _queue(self, key: str, op: Optional[Tuple[bytes, float]]) -> None:
+        with self._cond:
+            if key in self._pending:
+                self.writes_coalesced += 1
+            elif len(self._pending) >= self.max_pending:
+                # The store is not keeping up; it is a cache, so drop rather than grow
+                self.writes_dropped += 1
+                return
+            self._pending[key] = op
+            self.writes += 1
+            self._cond.notify_all()
+
+    def _write_loop(self) -> None:
+        cond = self._cond
+        while True:
+            with cond:
+                cond.wait_for(lambda: self._pending)
+            if self.flush_interval:
+                # Let writes of concurrent requests join this batch
+                time.sleep(self.flush_interval)
+            with cond:
+                batch, self._pending = self._pending, {}
+                self._writing = batch
+            self._send_writes(batch)
+            with cond:
+                self._writing = {}
+                cond.notify_all()
+
+    def _send_writes(self, batch: Dict[str, Optional[Tuple[bytes, float]]]) -> None:
+        sets = [(key, op[0], op[1]) for key, op in batch.items() if op is not None]
+        deletes = [key for key, op in batch.items() if op is None]
+        try:
+            self.store.write(sets, deletes)
+            self._available()
+        except Exception as e:
+            self._failed('write', e)
+        self.write_round_trips += 1
+        self.keys_written += len(batch)
+        SHARED_STORE_ROUND_TRIPS.inc(('write',))
+
+    def _available(self) -> None:
+        if self._down:
+            self._down = False
+            logger.info(f"Shared store ({self.store.name}) is reachable again")
+
+    def _failed(self, op: str, error: Exception) -> None:
+        self.errors += 1
+        self._retry_at = time.monotonic() + self.RETRY_INTERVAL
+        SHARED_STORE_ERRORS.inc((op,))
+        if not self._down:
+            # Logged once per outage, not once per request
+            self._down = True
+            logger.warning(f"Shared store ({self.store.name}) {op} failed, using in-process state only: {error}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'enabled': True,
+            'store': self.store.name,
+            'available': not self._down,
+            'near_ttl_seconds': self.near_ttl,
+            'reads': self.reads,
+            'read_round_trips': self.read_round_trips,
+            'reads_per_round_trip': self.reads / self.read_round_trips if self.read_round_trips else None,
+            'keys_read': self.keys_read,
+            'keys_found': self.keys_found,
+            'writes': self.writes,
+            'writes_coalesced': self.writes_coalesced,
+            'writes_dropped': self.writes_dropped,
+            'write_round_trips': self.write_round_trips,
+            'keys_per_write_round_trip': self.keys_written / self.write_round_trips if self.write_round_trips else None,
+            'pending_writes': len(self._pending),
+            'errors': self.errors,
+            'reads_skipped_while_down': self.reads_skipped
+        }
+
+
+def store_from_url(url: str, timeout: float = 0.25) -> Store:
+    """Store for a SHARED_STORE_URL (memory://, sqlite:///path, redis://host:port/db)"""
+    parsed = urlparse(url)
+    if parsed.scheme == 'memory':
+        return MemoryStore()
+    if parsed.scheme == 'sqlite':
+        path = url[len('sqlite://'):]
+        if not path.strip('/'):
+            raise ValueError('SHARED_STORE_URL sqlite:// needs a file path, e.g. sqlite:///data/shared.db')
+        # sqlite:///abs/path -> /abs/path, sqlite://rel/path -> rel/path
+        return SQLiteStore(path)
+    if parsed.scheme == 'redis':
+        db = parsed.path.strip('/')
+        return RedisStore(
+            host=parsed.hostname or '127.0.0.1',
+            port=parsed.port or 6379,
+            db=int(db) if db else 0,
+            password=unquote(parsed.password) if parsed.password else None,
+            timeout=timeout
+        )
+    raise ValueError(f"Unsupported SHARED_STORE_URL scheme {parsed.scheme!r} (memory, sqlite or redis)")
+
+
+def build_shared_store_from_env() -> Optional[SharedTier]:
+    """Return a SharedTier if SHARED_STORE_URL is set, otherwise None"""
+    url = os.getenv('SHARED_STORE_URL')
+    if not url:
+        return None
+    store = store_from_url(url, timeout=float(os.getenv('SHARED_STORE_TIMEOUT_MS', 250)) / 1000)
+    return SharedTier(
+        store,
+        prefix=os.getenv('SHARED_STORE_PREFIX', 'custom-llm:'),
+        flush_interval=float(os.getenv('SHARED_STORE_FLUSH_MS', 2)) / 1000,
+        near_ttl=float(os.getenv('SHARED_STORE_NEAR_TTL', 0))
+    )
@@ -0,0 +1,327 @@
+"""
+Speculative pre-generation for CustomLLM
+Scripted voice calls are predictable: after the assistant says "Can I book that for you
+tomorrow at 10?", most callers answer "yes" or "no". After a turn of a call has been answered,
+the likely next user turns are answered in advance on background threads; when the caller's
+next turn matches one of them, its response is served at once (streamed through the normal SSE
+path like a cache hit). Responses for the turns that did not come are discarded.
+
+Likely next turns come from two sources:
+    learned  - the user turns that followed the same assistant reply (under the same system
+               prompt and model) in earlier calls of the same tenant, most frequent first, once
+               seen SPECULATION_MIN_COUNT times; what one tenant's callers said is never sent
+               upstream in another tenant's calls
+    static   - SPECULATION_CANDIDATES, e.g. "نعم,لا,yes,no", tried after every reply
+
+A turn matches when the history is the predicted one (same length, the caller heard the reply
+that was generated) and the user message is equal to the candidate after normalization
+(case, punctuation, Arabic diacritics and letter variants). Requires a call id (see
+sessions.py). A speculative response that is still being generated when its turn arrives is
+not waited for; the turn is generated normally and counted as late.
+
+Every speculative generation costs an upstream call: GET /stats/speculation reports the hit
+rate and the compute spent on discarded responses.
+
+Configuration (environment variables):
+    SPECULATION_ENABLED         - "true" to enable (default: false)
+    SPECULATION_CANDIDATES      - comma-separated user turns always speculated on (default: none)
+    SPECULATION_LEARNED         - learned next turns speculated on per reply (default: 2)
+    SPECULATION_MIN_COUNT       - times a next turn must have followed a reply (default: 2)
+    SPECULATION_MAX_CANDIDATES  - speculative generations per turn (default: 3)
+    SPECULATION_WORKERS         - background generation threads (default: 2)
+    SPECULATION_MAX_STATES      - learned assistant replies kept (default: 10000)
+"""
+
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from metrics import SPECULATION_OUTCOMES, SPECULATION_WASTED_SECONDS
+from semantic_cache import normalize_text
+
+logger = logging.getLogger(__name__)
+
+# (model name, messages, temperature, validation.OutputLimits or None) -> response text
+Generator = Callable[[str, List[Dict[str, Any]], float, Any], str]
+
+# (model name, text) -> tokens
+TokenCounter = Callable[[str, str], int]
+
+StateKey = Tuple[str, str, str, str]
+
+
+def _text(content: Any) -> str:
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return ' '.join(part.get('text', '') for part in content if isinstance(part, dict))
+    return '' if content is None else str(content)
+
+
+def _limits_key(limits: Any) -> Any:
+    return limits.key() if limits is not None else None
+
+
+def state_key(model: str, messages: List[Dict[str, Any]], tenant: str = '') -> Optional[StateKey]:
+    """(tenant, model, system prompt digest, normalized reply) for a history ending in an assistant reply"""
+    if not messages or messages[-1].get('role') != 'assistant':
+        return None
+    system = '\n'.join(_text(msg.get('content')) for msg in messages if msg.get('role') == 'system')
+    digest = hashlib.blake2b(system.encode('utf-8'), digest_size=8).hexdigest()
+    return tenant, model, digest, normalize_text(_text(messages[-1].get('content')))
+
+
+class NextTurnModel:
+    """Counts which user turns followed each assistant reply; bounded LRU over replies"""
+
+    def __init__(self, max_states: int = 10000, max_turns: int = 16):
+        self.max_states = max_states
+        self.max_turns = max_turns
+        # state -> normalized user turn -> [count, first raw text]
+        self._states: 'OrderedDict[StateKey, Dict[str, List[Any]]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def observe(self, model: str, messages: List[Dict[str, Any]], tenant: str = '') -> None:
+        """Learn from a request of tenant whose history ends in [assistant reply, user turn]"""
+        if len(messages) < 2 or messages[-1].get('role') != 'user':
+            return
+        key = state_key(model, messages[:-1], tenant)
+        if key is None:
+            return
+        text = _text(messages[-1].get('content'))
+        normalized = normalize_text(text)
+        if not normalized:
+            return
+        with self._lock:
+            turns = self._states.get(key)
+            if turns is None:
+                turns = self._states[key] = {}
+                while len(self._states) > self.max_states:
+                    self._states.popitem(last=False)
+            else:
+                self._states.move_to_end(key)
+            entry = turns.get(normalized)
+            if entry is not None:
+                entry[0] += 1
+            elif len(turns) < self.max_turns:
+                turns[normalized] = [1, text]
+
+    def predict(self, key: StateKey, limit: int, min_count: int) -> List[str]:
+        """Most frequent user turns after this reply, as first seen"""
+        with self._lock:
+            turns = self._states.get(key)
+            if not turns:
+                return []
+            ranked = sorted(turns.values(), key=lambda entry: -entry[0])
+        return [text for count, text in ranked[:limit] if count >= min_count]
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+
+class _Candidate:
+    """One speculative generation"""
+
+    __slots__ = ('text', 'future', 'elapsed', 'tokens', 'discarded')
+
+    def __init__(self, text: str):
+        self.text = text
+        self.future: Optional[Future] = None
+        self.elapsed: Optional[float] = None
+        self.tokens = 0
+        self.discarded = False
+
+
+class Speculation:
+    """Speculative responses prepared for the next turn of one call, kept on Session.speculation"""
+
+    __slots__ = ('model', 'temperature', 'limits', 'history_len', 'reply', 'candidates')
+
+    def __init__(self, model: str, temperature: float, limits: Any, history_len: int, reply: str):
+        self.model = model
+        self.temperature = temperature
+        self.limits = limits  # validation.OutputLimits of the turn, used for the speculative ones too
+        self.history_len = history_len  # messages up to and including the reply
+        self.reply = reply
+        self.candidates: Dict[str, _Candidate] = {}  # normalized user turn -> candidate
+
+
+class Speculator:
+    """Starts speculative generations after each answered turn and serves them on a match"""
+
+    def __init__(
+        self,
+        generate: Generator,
+        count_tokens: TokenCounter,
+        static_candidates: Optional[List[str]] = None,
+        learned: int = 2,
+        min_count: int = 2,
+        max_candidates: int = 3,
+        workers: int = 2,
+        max_states: int = 10000
+    ):
+        self.generate = generate
+        self.count_tokens = count_tokens
+        self.static_candidates = [text for text in (static_candidates or []) if normalize_text(text)]
+        self.learned = learned
+        self.min_count = min_count
+        self.max_candidates = max_candidates
+        self.workers = workers
+        self.next_turns = NextTurnModel(max_states=max_states)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='speculation')
+        self._lock = threading.Lock()
+        self._queued = 0
+        self.started = 0
+        self.skipped = 0
+        self.failed = 0
+        self.hits = 0
+        self.late = 0
+        self.misses = 0
+        self.used_seconds = 0.0
+        self.wasted = 0
+        self.wasted_seconds = 0.0
+        self.wasted_tokens = 0
+
+    def take(self, session: Any, messages: List[Dict[str, Any]], model: str, temperature: float, limits: Any = None) -> Optional[str]:
+        """
+        The speculative response for this turn of the session's call, or None. Called once per
+        turn: speculations for other turns are discarded and the turn is learned from.
+        """
+        self.next_turns.observe(model, messages, session.tenant)
+        speculation = session.speculation
+        if speculation is None:
+            return None
+        session.speculation = None
+
+        candidate = None
+        if (speculation.model == model and speculation.temperature == temperature
+                and _limits_key(speculation.limits) == _limits_key(limits)
+                and len(messages) == speculation.history_len + 1 and messages[-1].get('role') == 'user'
+                and messages[-2].get('role') == 'assistant'
+                and normalize_text(_text(messages[-2].get('content'))) == normalize_text(speculation.reply)):
+            candidate = speculation.candidates.get(normalize_text(_text(messages[-1].get('content'))))
+
+        result = None
+        if candidate is None or (candidate.future.done() and candidate.future.exception() is not None):
+            outcome = 'miss'
+        elif not candidate.future.done():
+            outcome = 'late'
+        else:
+            outcome = 'hit'
+            result = candidate.future.result()
+        with self._lock:
+            if outcome == 'hit':
+                self.hits += 1
+                self.used_seconds += candidate.elapsed
+            elif outcome == 'late':
+                self.late += 1
+            else:
+                self.misses += 1
+        SPECULATION_OUTCOMES.inc((outcome,))
+        for other in speculation.candidates.values():
+            if other is not candidate or result is None:
+                self._discard(other)
+        return result
+
+    def after_response(
+        self, session: Any, messages: List[Dict[str, Any]], model: str, temperature: float, reply: str, limits: Any = None
+    ) -> None:
+        """Start speculative generations for the likely next user turns after reply"""
+        history = messages + [{'role': 'assistant', 'content': reply}]
+        key = state_key(model, history, session.tenant)
+        texts = self.next_turns.predict(key, self.learned, self.min_count) if self.learned else []
+        speculation = Speculation(model, temperature, limits, len(history), reply)
+        for text in texts + self.static_candidates:
+            if len(speculation.candidates) >= self.max_candidates:
+                break
+            speculation.candidates.setdefault(normalize_text(text), _Candidate(text))
+        if not speculation.candidates:
+            return
+        with self._lock:
+            # Don't queue more than the workers can start right away; speculation is best-effort
+            if self._queued + len(speculation.candidates) > self.workers * 2:
+                self.skipped += len(speculation.candidates)
+                return
+            self._queued += len(speculation.candidates)
+            self.started += len(speculation.candidates)
+        for candidate in speculation.candidates.values():
+            prompt = history + [{'role': 'user', 'content': candidate.text}]
+            candidate.future = self._executor.submit(self._run, candidate, model, prompt, temperature, limits)
+        session.speculation = speculation
+
+    def _run(self, candidate: _Candidate, model: str, prompt: List[Dict[str, Any]], temperature: float, limits: Any) -> str:
+        started = time.perf_counter()
+        try:
+            if candidate.discarded:
+                return ''
+            text = self.generate(model, prompt, temperature, limits)
+            candidate.tokens = self.count_tokens(model, text)
+            return text
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+            logger.warning(f"Speculative generation failed for model {model}: {e}")
+            raise
+        finally:
+            with self._lock:
+                self._queued -= 1
+                candidate.elapsed = time.perf_counter() - started
+                if candidate.discarded:
+                    self._waste(candidate)
+
+    def _discard(self, candidate: _Candidate) -> None:
+        with self._lock:
+            if candidate.discarded:
+                return
+            candidate.discarded = True
+            if candidate.elapsed is not None:
+                self._waste(candidate)
+
+    def _waste(self, candidate: _Candidate) -> None:
+        # Called with the lock held, once per discarded candidate that ran
+        self.wasted += 1
+        self.wasted_seconds += candidate.elapsed
+        self.wasted_tokens += candidate.tokens
+        SPECULATION_WASTED_SECONDS.inc((), candidate.elapsed)
+
+    def stats(self) -> Dict[str, Any]:
+        served = self.hits + self.late + self.misses
+        spent = self.used_seconds + self.wasted_seconds
+        return {
+            'enabled': True,
+            'static_candidates': self.static_candidates,
+            'learned_states': len(self.next_turns),
+            'started': self.started,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'queued': self._queued,
+            'hits': self.hits,
+            'late': self.late,
+            'misses': self.misses,
+            'hit_rate': self.hits / served if served else None,
+            'wasted_generations': self.wasted,
+            'wasted_seconds': self.wasted_seconds,
+            'wasted_completion_tokens': self.wasted_tokens,
+            'wasted_compute_ratio': self.wasted_seconds / spent if spent else None
+        }
+
+
+def build_speculator_from_env(generate: Generator, count_tokens: TokenCounter) -> Optional[Speculator]:
+    """Return a Speculator if SPECULATION_ENABLED is set, otherwise None"""
+    if os.getenv('SPECULATION_ENABLED', 'False').lower() != 'true':
+        return None
+    return Speculator(
+        generate,
+        count_tokens,
+        static_candidates=[text.strip() for text in os.getenv('SPECULATION_CANDIDATES', '').split(',') if text.strip()],
+        learned=int(os.getenv('SPECULATION_LEARNED', 2)),
+        min_count=int(os.getenv('SPECULATION_MIN_COUNT', 2)),
+        max_candidates=int(os.getenv('SPECULATION_MAX_CANDIDATES', 3)),
+        workers=int(os.getenv('SPECULATION_WORKERS', 2)),
+        max_states=int(os.getenv('SPECULATION_MAX_STATES', 10000))
+    )
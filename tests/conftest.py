@@ -0,0 +1,68 @@
+"""
+Shared test setup: a fixed API key, no streaming delay, and no upstream provider or optional
+feature picked up from the environment, so every test runs against the demo echo backend.
+"""
+
+import os
+
+API_KEY = 'test-key'
+
+for _name in list(os.environ):
+    if _name.startswith(('OPENAI_', 'ANTHROPIC_', 'OLLAMA_', 'BATCH_', 'TOOL', 'SHARED_STORE_', 'RESPONSE_CACHE_',
+                         'SEMANTIC_CACHE_', 'SPECULATION_', 'CONTEXT_', 'STREAM_', 'ADMISSION_', 'API_KEYS_',
+                         'PROVIDER_', 'HEDGE_', 'REQUEST_LOG_')):
+        del os.environ[_name]
+os.environ.update(API_KEY=API_KEY, STREAM_DELAY='0', LOG_LEVEL='WARNING', LOG_ASYNC='false')
+
+AUTH = {'Authorization': f'Bearer {API_KEY}'}
+
+import pytest  # noqa: E402
+
+
+@pytest.fixture
+def auth():
+    return dict(AUTH)
+
+
+class _FlaskResponse:
+    def __init__(self, response):
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.text = response.get_data(as_text=True)
+        self._response = response
+        response.close()  # runs call_on_close callbacks, e.g. the admission slot release
+
+    def json(self):
+        return self._response.get_json()
+
+
+class _FlaskClient:
+    """Flask test client with the httpx-style .json() / .text accessors of Starlette's TestClient"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def request(self, method, url, **kwargs):
+        return _FlaskResponse(self.client.open(url, method=method, **kwargs))
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+
+@pytest.fixture(params=['flask', 'asgi'])
+def client(request):
+    """A test client of each server mode"""
+    if request.param == 'flask':
+        import app
+        yield _FlaskClient(app.app.test_client())
+    else:
+        from starlette.testclient import TestClient
+        import asgi_app
+        with TestClient(asgi_app.app) as test_client:
+            yield test_client
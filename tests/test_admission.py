@@ -0,0 +1,134 @@
+"""Admission control: queue handoff, deadlines, cancellation while queued and per-key limits"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+import app
+import asgi_app
+from admission import AdmissionController
+from service import APIError
+
+
+def _acquire_in_thread(controller, key, results):
+    def run():
+        try:
+            results.append((key, controller.acquire(key)))
+        except APIError as e:
+            results.append((key, e))
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def _wait_queued(controller, count):
+    deadline = time.monotonic() + 2
+    while controller.stats()['queued'] < count:
+        assert time.monotonic() < deadline, 'request was not queued'
+        time.sleep(0.001)
+
+
+def test_release_hands_the_slot_to_the_oldest_waiter():
+    controller = AdmissionController(max_concurrent=1, queue_size=2, queue_timeout=2)
+    ticket = controller.acquire('a')
+    results = []
+    first = _acquire_in_thread(controller, 'b', results)
+    _wait_queued(controller, 1)
+    second = _acquire_in_thread(controller, 'c', results)
+    _wait_queued(controller, 2)
+    # The queue is full: a newcomer is rejected at once
+    with pytest.raises(APIError):
+        controller.acquire('d')
+    ticket.release()
+    first.join(1)
+    assert [key for key, _ in results] == ['b'] and controller.stats()['active'] == 1
+    results[0][1].release()
+    second.join(1)
+    assert [key for key, _ in results] == ['b', 'c'] and controller.stats()['queued'] == 0
+    results[1][1].release()
+    results[1][1].release()  # idempotent
+    assert controller.stats()['active'] == 0
+
+
+def test_waiting_past_the_deadline_is_a_429_with_retry_after():
+    controller = AdmissionController(max_concurrent=1, queue_size=1, queue_timeout=0.05)
+    controller.acquire('a')
+    started = time.monotonic()
+    with pytest.raises(APIError) as error:
+        controller.acquire('b')
+    assert time.monotonic() - started >= 0.05
+    assert error.value.status == 429 and error.value.code == 'concurrency_limit_exceeded'
+    assert error.value.headers == {'Retry-After': '1'}
+    assert controller.stats()['queued'] == 0 and controller.stats()['active'] == 1
+
+
+def test_full_queue_and_deadline_over_http(client, auth, monkeypatch):
+    controller = AdmissionController(max_concurrent=1, queue_size=1, queue_timeout=0.05)
+    monkeypatch.setattr(app, 'admission', controller)
+    monkeypatch.setattr(asgi_app, 'admission', controller)
+    ticket = controller.acquire('default')
+    body = {'messages': [{'role': 'user', 'content': 'Hello'}]}
+    response = client.post('/v1/chat/completions', json=body, headers=auth)
+    assert response.status_code == 429 and response.headers['Retry-After'] == '1'
+    assert response.json()['error']['code'] == 'concurrency_limit_exceeded'
+    ticket.release()
+    assert client.post('/v1/chat/completions', json=body, headers=auth).status_code == 200
+    assert controller.stats()['active'] == 0
+
+
+def test_cancelled_while_queued_returns_its_slot():
+    controller = AdmissionController(max_concurrent=1, queue_size=1, queue_timeout=2)
+
+    async def run():
+        ticket = controller.acquire('a')
+        waiting = asyncio.ensure_future(controller.aacquire('b'))
+        await asyncio.sleep(0.01)
+        assert controller.stats()['queued'] == 1
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert controller.stats()['queued'] == 0
+        # Granted by the release, cancelled before the waiter got to run: the slot comes back
+        waiting = asyncio.ensure_future(controller.aacquire('b'))
+        await asyncio.sleep(0.01)
+        ticket.release()
+        assert controller.stats()['active'] == 1
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert controller.stats()['active'] == 0
+        (await controller.aacquire('c')).release()
+
+    asyncio.run(run())
+
+
+def test_token_bucket_refills_at_the_rate():
+    controller = AdmissionController(rate=20, burst=1)
+    controller.acquire('a').release()
+    with pytest.raises(APIError) as error:
+        controller.acquire('a')
+    assert error.value.code == 'rate_limit_exceeded' and error.value.headers == {'Retry-After': '1'}
+    controller.acquire('b').release()  # buckets are per key
+    time.sleep(0.06)
+    controller.acquire('a').release()
+
+
+def test_key_limits_override_the_defaults():
+    controller = AdmissionController(max_per_key=1)
+    tickets = [controller.acquire('big', (3, None, None)) for _ in range(3)]
+    with pytest.raises(APIError):
+        controller.acquire('big', (3, None, None))
+    controller.acquire('small')
+    with pytest.raises(APIError):
+        controller.acquire('small')
+    controller.acquire('metered', (None, 1, 1)).release()
+    with pytest.raises(APIError) as error:
+        controller.acquire('metered', (None, 1, 1))
+    assert error.value.code == 'rate_limit_exceeded'
+    # Without its override the key falls back to the defaults (no rate limit)
+    controller.acquire('metered').release()
+    for ticket in tickets:
+        ticket.release()
+    assert controller.stats()['active'] == 1
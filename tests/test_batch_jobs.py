@@ -0,0 +1,80 @@
+"""Batch jobs: input validation, processing and resume after a crash"""
+
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from batch_jobs import BatchJobs
+from service import APIError
+
+
+def _line(custom_id, text):
+    body = {'model': 'echo', 'messages': [{'role': 'user', 'content': text}]}
+    return json.dumps({'custom_id': custom_id, 'method': 'POST', 'url': '/v1/chat/completions', 'body': body})
+
+
+def _jobs(tmp_path, processed):
+    def process(body):
+        processed.append(body['messages'][0]['content'])
+        return 200, {'answer': body['messages'][0]['content']}
+
+    jobs = BatchJobs(str(tmp_path), process, 'echo', workers=2)
+    jobs.start = lambda: None  # the test drives the dispatcher steps itself
+    jobs._executor = ThreadPoolExecutor(2)
+    return jobs
+
+
+def _results(jobs, batch_id):
+    with open(os.path.join(jobs.directory, batch_id, 'output.jsonl'), 'rb') as f:
+        return [json.loads(line) for line in f.read().splitlines()]
+
+
+def test_rejects_invalid_input(tmp_path):
+    jobs = _jobs(tmp_path, [])
+    with pytest.raises(APIError, match='Line 2'):
+        jobs.submit(f"{_line('a', 'x')}\nnot json\n".encode())
+    with pytest.raises(APIError, match='duplicate'):
+        jobs.submit(f"{_line('a', 'x')}\n{_line('a', 'y')}\n".encode())
+    with pytest.raises(APIError):
+        jobs.submit(b'\n')
+
+
+def test_processes_every_request(tmp_path):
+    processed = []
+    jobs = _jobs(tmp_path, processed)
+    batch = jobs.submit('\n'.join(_line(str(i), f'q{i}') for i in range(5)).encode())
+    jobs._work(jobs._claim())
+    assert sorted(processed) == [f'q{i}' for i in range(5)]
+    state = jobs.get(batch['id'])
+    assert state['status'] == 'completed'
+    assert state['request_counts'] == {'total': 5, 'completed': 5, 'failed': 0}
+    assert sorted(r['custom_id'] for r in _results(jobs, batch['id'])) == [str(i) for i in range(5)]
+    assert jobs._claim() is None
+
+
+def test_resume_skips_finished_requests_and_drops_a_partial_line(tmp_path):
+    processed = []
+    jobs = _jobs(tmp_path, processed)
+    batch = jobs.submit('\n'.join(_line(str(i), f'q{i}') for i in range(4)).encode())
+    # A crash after request 0 was written and while request 1 was being written
+    done = {'custom_id': '0', 'response': {'status_code': 200, 'body': {}}, 'error': None}
+    with open(os.path.join(jobs.directory, batch['id'], 'output.jsonl'), 'w') as f:
+        f.write(json.dumps(done) + '\n' + '{"custom_id": "1", "resp')
+
+    jobs._work(jobs._claim())
+    assert sorted(processed) == ['q1', 'q2', 'q3']
+    results = _results(jobs, batch['id'])
+    assert sorted(r['custom_id'] for r in results) == ['0', '1', '2', '3']
+    assert jobs.get(batch['id'])['request_counts'] == {'total': 4, 'completed': 4, 'failed': 0}
+
+
+def test_cancelled_batch_stops(tmp_path):
+    processed = []
+    jobs = _jobs(tmp_path, processed)
+    batch = jobs.submit('\n'.join(_line(str(i), f'q{i}') for i in range(3)).encode())
+    jobs.cancel(batch['id'])
+    jobs._work(jobs._claim())
+    assert processed == []
+    assert jobs.get(batch['id'])['status'] == 'cancelled'
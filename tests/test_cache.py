@@ -0,0 +1,115 @@
+"""Response cache keys and eviction"""
+
+import time
+
+import app
+from cache import ResponseCache, make_key, replay
+from providers import EchoBackend
+from validation import OutputLimits
+
+MESSAGES = [{'role': 'system', 'content': 'Be brief.'}, {'role': 'user', 'content': 'Hello  there\n'}]
+
+
+def test_key_ignores_whitespace_differences():
+    spaced = [{'role': 'system', 'content': ' Be   brief. '}, {'role': 'user', 'content': 'Hello there'}]
+    assert make_key('m', 0, MESSAGES) == make_key('m', 0, spaced)
+
+
+def test_key_covers_model_temperature_role_and_name():
+    key = make_key('m', 0, MESSAGES)
+    assert make_key('other', 0, MESSAGES) != key
+    assert make_key('m', 0.5, MESSAGES) != key
+    assert make_key('m', 0, [MESSAGES[0], dict(MESSAGES[1], role='assistant')]) != key
+    assert make_key('m', 0, [MESSAGES[0], dict(MESSAGES[1], name='ali')]) != key
+    assert make_key('m', 0.00001, MESSAGES) == key
+
+
+def test_key_covers_tool_calls_and_results():
+    def history(function, call_id='call-1'):
+        call = {'id': call_id, 'type': 'function', 'function': {'name': function, 'arguments': '{}'}}
+        return MESSAGES + [
+            {'role': 'assistant', 'content': None, 'tool_calls': [call]},
+            {'role': 'tool', 'tool_call_id': call_id, 'content': 'done'}
+        ]
+    key = make_key('m', 0, history('book_appointment'))
+    assert make_key('m', 0, history('cancel_appointment')) != key
+    assert make_key('m', 0, history('book_appointment', 'call-2')) != key
+    assert make_key('m', 0, history('book_appointment')) == key
+
+
+def test_key_covers_output_limits():
+    key = make_key('m', 0, MESSAGES)
+    assert make_key('m', 0, MESSAGES, OutputLimits(max_tokens=10)) != key
+    assert make_key('m', 0, MESSAGES, OutputLimits(max_tokens=10)) != make_key('m', 0, MESSAGES, OutputLimits(max_tokens=20))
+    assert make_key('m', 0, MESSAGES, OutputLimits(stop='.')) == make_key('m', 0, MESSAGES, OutputLimits(stop=['.']))
+    assert make_key('m', 0, MESSAGES, OutputLimits(stop='.')) != make_key('m', 0, MESSAGES, OutputLimits(stop='!'))
+
+
+class RecordingBackend(EchoBackend):
+    """Echo backend that records the output limits of each upstream call"""
+
+    def __init__(self):
+        super().__init__(stream_delay=0)
+        self.limits = []
+
+    def complete(self, messages, model, temperature, session=None, limits=None):
+        self.limits.append(limits and limits.key())
+        return super().complete(messages, model, temperature, session, limits)
+
+    def stream(self, messages, model, temperature, session=None, tools=None, limits=None):
+        self.limits.append(limits and limits.key())
+        return super().stream(messages, model, temperature, session, tools, limits)
+
+    async def acomplete(self, messages, model, temperature, session=None, limits=None):
+        return self.complete(messages, model, temperature, session, limits)
+
+    def astream(self, messages, model, temperature, session=None, tools=None, limits=None):
+        self.limits.append(limits and limits.key())
+        return super().astream(messages, model, temperature, session, tools, limits)
+
+
+def test_requests_with_other_limits_are_not_served_from_the_cache(client, auth, monkeypatch):
+    backend = RecordingBackend()
+    monkeypatch.setattr(app.llm, 'cache', ResponseCache())
+    monkeypatch.setattr(app.llm, '_select', lambda model_name: (backend, model_name))
+    body = {'messages': MESSAGES, 'temperature': 0}
+    for extra in ({'max_tokens': 5, 'stop': ['\n']}, {'max_tokens': 5, 'stop': '\n'}, {'max_tokens': 6}, {}, {'stream': True, 'max_tokens': 6}):
+        assert client.post('/v1/chat/completions', json=dict(body, **extra), headers=auth).status_code == 200
+    assert backend.limits == [(5, None, ('\n',)), (6, None, ()), None]
+
+
+def test_sampled_requests_bypass_unless_allowed():
+    assert not ResponseCache().cacheable(0.7)
+    assert ResponseCache().cacheable(0)
+    assert ResponseCache(allow_sampled=True).cacheable(0.7)
+
+
+def test_lru_eviction_by_entries_and_bytes():
+    cache = ResponseCache(max_entries=2)
+    cache.put('a', 'A')
+    cache.put('b', 'B')
+    assert cache.get('a') == 'A'
+    cache.put('c', 'C')
+    assert cache.get('b') is None
+    assert cache.get('a') == 'A' and cache.get('c') == 'C'
+
+    cache = ResponseCache(max_bytes=10)
+    cache.put('a', 'x' * 6)
+    cache.put('b', 'y' * 6)
+    assert cache.get('a') is None and cache.get('b') == 'y' * 6
+    cache.put('big', 'z' * 11)
+    assert cache.get('big') is None
+    assert cache.stats()['evictions'] == 1
+
+
+def test_entries_expire():
+    cache = ResponseCache(ttl=0.05)
+    cache.put('a', 'A')
+    time.sleep(0.1)
+    assert cache.get('a') is None
+    assert cache.stats()['expirations'] == 1
+
+
+def test_replay_keeps_the_text():
+    text = 'مرحباً،  كيف\nحالك؟ '
+    assert ''.join(replay(text)) == text
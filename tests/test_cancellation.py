@@ -0,0 +1,70 @@
+"""Client disconnects stop the upstream stream"""
+
+import asyncio
+
+import pytest
+
+from cancellation import CancellationStats, ClientDisconnected, awatch, watch
+
+
+def _upstream(closed):
+    try:
+        for word in ('one ', 'two ', 'three ', 'four '):
+            yield word
+    finally:
+        closed.append(True)
+
+
+def test_watch_stops_and_closes_the_upstream_on_disconnect():
+    closed, generated = [], []
+    polls = iter([False, False, True])
+    with pytest.raises(ClientDisconnected):
+        for _ in watch(_upstream(closed), generated, lambda: next(polls)):
+            pass
+    assert generated == ['one ', 'two ', 'three ']
+    assert closed == [True]
+
+
+def test_closing_watch_closes_the_upstream():
+    closed, generated = [], []
+    deltas = watch(_upstream(closed), generated)
+    assert next(deltas) == 'one '
+    deltas.close()
+    assert closed == [True]
+
+
+def test_awatch_cancellation_closes_the_upstream():
+    closed, generated = [], []
+
+    async def upstream():
+        try:
+            for word in ('one ', 'two '):
+                yield word
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(10)
+        finally:
+            closed.append(True)
+
+    async def consume():
+        async for _ in awatch(upstream(), generated):
+            pass
+
+    async def run():
+        task = asyncio.ensure_future(consume())
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert generated == ['one ', 'two ']
+    assert closed == [True]
+
+
+def test_stats_count_cancelled_streams():
+    stats = CancellationStats()
+    stats.record('gpt-4o', sent_tokens=3, unsent_tokens=2, started=True)
+    stats.record('gpt-4o')
+    assert stats.stats() == {
+        'cancelled': 2, 'cancelled_waiting': 1, 'cancelled_streaming': 1, 'sent_tokens': 3, 'unsent_tokens': 2
+    }
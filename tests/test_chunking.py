@@ -0,0 +1,75 @@
+"""Coalescing of stream deltas into speakable segments"""
+
+import asyncio
+
+from chunking import Chunker, StreamChunking
+
+
+def _segments(chunking, deltas):
+    return list(chunking.wrap(iter(deltas)))
+
+
+def test_phrase_cuts_after_clause_punctuation():
+    chunking = StreamChunking('phrase', min_chars=5, max_delay=0)
+    segments = _segments(chunking, ['Hello there, ', 'how are', ' you? Fine'])
+    assert segments == ['Hello there, ', 'how are you? ', 'Fine']
+
+
+def test_sentence_mode_ignores_clauses():
+    chunking = StreamChunking('sentence', min_chars=5, max_delay=0)
+    assert _segments(chunking, ['Hello there, how', ' are you? Fine']) == ['Hello there, how are you? ', 'Fine']
+
+
+def test_numbers_and_times_are_not_cut():
+    chunking = StreamChunking('phrase', min_chars=1, max_delay=0)
+    assert _segments(chunking, ['It costs 3.5 at 10:30', ' today']) == ['It costs 3.5 at 10:30 today']
+
+
+def test_arabic_and_cjk_marks_cut_at_once():
+    chunking = StreamChunking('phrase', min_chars=1, max_delay=0)
+    assert _segments(chunking, ['مرحباً،', 'كيف ', 'حالك؟', 'جيد']) == ['مرحباً،', 'كيف حالك؟', 'جيد']
+    assert _segments(chunking, ['你好。我', '很好']) == ['你好。', '我很好']
+
+
+def test_short_clauses_wait_for_min_chars():
+    chunking = StreamChunking('phrase', min_chars=12, max_delay=0)
+    assert _segments(chunking, ['Yes, ', 'of course, ', 'sure']) == ['Yes, of course, ', 'sure']
+
+
+def test_long_segments_are_cut_at_a_space():
+    chunking = StreamChunking('phrase', max_chars=10, max_delay=0)
+    segments = _segments(chunking, ['one ', 'two ', 'three ', 'four ', 'five ', 'six'])
+    assert segments == ['one two ', 'three ', 'four five ', 'six']
+    assert all(len(segment) <= 10 for segment in segments)
+    assert _segments(chunking, ['one two three four five six']) == segments
+
+
+def test_timer_sends_held_text_up_to_the_last_space():
+    chunker = Chunker('phrase', min_chars=12, max_chars=160, max_delay=0.3)
+    assert chunker.feed('Hello wor', 0.0) == []
+    assert chunker.time_left(0.1) > 0
+    assert chunker.feed('ld again', 0.5) == ['Hello world ']
+    assert chunker.flush() == 'again'
+
+
+def test_non_text_items_flush_and_pass_through():
+    marker = object()
+    chunking = StreamChunking('phrase', max_delay=0)
+    assert _segments(chunking, ['held text', marker, 'more']) == ['held text', marker, 'more']
+
+
+def test_awrap_timer_fires_while_upstream_is_silent():
+    chunking = StreamChunking('phrase', max_delay=0.05)
+
+    async def deltas():
+        yield 'Hello wor'
+        yield 'ld and '
+        await asyncio.sleep(0.3)
+        yield 'more'
+
+    async def collect():
+        return [segment async for segment in chunking.awrap(deltas())]
+
+    segments = asyncio.run(collect())
+    assert ''.join(segments) == 'Hello world and more'
+    assert segments[0] == 'Hello world and '
@@ -0,0 +1,96 @@
+"""Context window: where histories are cut, cut stability across turns, and prompt token counts"""
+
+import pytest
+
+from context_window import ContextManager
+from sessions import Session
+from tokenizer import TOKENS_PER_REPLY, Tokenizer
+
+
+class WordTokenizer(Tokenizer):
+    """One token per word, so budgets are easy to reason about"""
+
+    name = 'words'
+
+    def _count(self, text):
+        return len(text.split())
+
+
+TOKENIZER = WordTokenizer()
+SYSTEM = {'role': 'system', 'content': 'You are the receptionist of a dental clinic.'}
+
+
+def _turn(i, words=10):
+    return [
+        {'role': 'user', 'content': ' '.join([f'question{i}'] * words)},
+        {'role': 'assistant', 'content': ' '.join([f'answer{i}'] * words)}
+    ]
+
+
+def _call(turns, words=10):
+    messages = [SYSTEM]
+    for i in range(turns):
+        messages += _turn(i, words)
+    return messages + [{'role': 'user', 'content': 'And on Friday?'}]
+
+
+def _roles(messages):
+    return [msg['role'] for msg in messages]
+
+
+@pytest.mark.parametrize('limit', range(60, 400, 17))
+def test_kept_turns_start_with_a_user_message(limit):
+    manager = ContextManager([('m', limit)], reserve=0)
+    messages = _call(12)
+    sent, tokens = manager.fit(messages, 'm', TOKENIZER)
+    assert sent[0] is SYSTEM and sent[-1] is messages[-1]
+    assert sent[1]['role'] == 'user'
+    assert tokens == TOKENIZER.count_messages(sent) <= limit
+
+
+def test_the_cut_is_kept_across_turns_until_it_no_longer_fits():
+    manager = ContextManager([('m', 300)], reserve=0)
+    session = Session('call')
+    messages, cuts, previous = _call(8)[:-1], [], None
+    for i in range(8, 30):
+        messages = messages + [_turn(i)[0]]
+        sent, tokens = manager.fit(messages, 'm', TOKENIZER, session)
+        assert tokens <= 300 and sent[1]['role'] == 'user'
+        if previous is not None and session.context.cut == cuts[-1]:
+            # Same cut: the prompt is the previous one extended, so upstream prefix caches hit
+            assert sent[:len(previous)] == previous
+        cuts.append(session.context.cut)
+        previous = sent
+        messages = messages + [_turn(i)[1]]
+    assert len(set(cuts)) < len(cuts) / 2
+
+
+def test_tool_results_are_sent_with_their_call():
+    call = {'id': 'call-1', 'type': 'function', 'function': {'name': 'clinic_hours', 'arguments': '{}'}}
+    tool_round = [
+        {'role': 'assistant', 'content': None, 'tool_calls': [call]},
+        {'role': 'tool', 'tool_call_id': 'call-1', 'content': ' '.join(['open'] * 40)}
+    ]
+    manager = ContextManager([('m', 120)], reserve=0)
+    # A finished tool round in the history is dropped or kept together with its user turn
+    messages = _call(2) + tool_round + [{'role': 'assistant', 'content': 'We are open.'}] + _turn(5) + [_call(0)[-1]]
+    sent, _ = manager.fit(messages, 'm', TOKENIZER)
+    assert _roles(sent)[:2] == ['system', 'user'] and 'tool' not in _roles(sent)
+    # The current turn's tool round alone exceeds the budget: the turn is sent whole
+    messages = _call(3) + tool_round + tool_round
+    sent, _ = manager.fit(messages, 'm', TOKENIZER)
+    assert _roles(sent) == ['system', 'user', 'assistant', 'tool', 'assistant', 'tool']
+
+
+def test_prompt_tokens_match_what_fit_sent():
+    manager = ContextManager([('m', 200)], reserve=0)
+    session = Session('call')
+    messages = _call(10)
+    sent, tokens = manager.fit(messages, 'm', TOKENIZER, session)
+    assert manager.prompt_tokens(messages, 'm', TOKENIZER, session) == tokens == TOKENIZER.count_messages(sent)
+    # Without the session's state the count is that of a stateless fit
+    assert manager.prompt_tokens(messages, 'm', TOKENIZER) == manager.fit(messages, 'm', TOKENIZER)[1]
+    short = _call(1)
+    assert manager.prompt_tokens(short, 'm', TOKENIZER) == TOKENIZER.count_messages(short)
+    assert ContextManager([]).prompt_tokens(messages, 'm', TOKENIZER) == TOKENIZER.count_messages(messages)
+    assert TOKENIZER.count_messages([]) == TOKENS_PER_REPLY
@@ -0,0 +1,81 @@
+"""Endpoint smoke tests for the Flask and ASGI servers against the demo echo backend"""
+
+import json
+
+MESSAGES = [
+    {'role': 'system', 'content': 'أنت مساعد ذكي ومفيد. تحدث بالعربية.'},
+    {'role': 'user', 'content': 'مرحباً، كيف حالك؟'}
+]
+
+
+def _frames(body):
+    return [json.loads(line[6:]) for line in body.splitlines() if line.startswith('data: {')]
+
+
+def test_health(client):
+    response = client.get('/health')
+    assert response.status_code == 200
+    assert response.json()['status'] == 'healthy'
+
+
+def test_chat_completion(client, auth):
+    response = client.post('/v1/chat/completions', json={'messages': MESSAGES, 'temperature': 0.5}, headers=auth)
+    assert response.status_code == 200
+    body = response.json()
+    assert body['object'] == 'chat.completion'
+    assert 'مرحباً، كيف حالك؟' in body['choices'][0]['message']['content']
+    assert body['choices'][0]['finish_reason'] == 'stop'
+    assert body['usage']['total_tokens'] == body['usage']['prompt_tokens'] + body['usage']['completion_tokens']
+
+
+def test_chat_completion_stream(client, auth):
+    response = client.post('/v1/chat/completions', json={'messages': MESSAGES, 'stream': True}, headers=auth)
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/event-stream')
+    assert response.text.rstrip().endswith('data: [DONE]')
+    frames = _frames(response.text)
+    text = ''.join(frame['choices'][0]['delta'].get('content', '') for frame in frames)
+    assert 'مرحباً، كيف حالك؟' in text
+    assert len({frame['id'] for frame in frames}) == 1
+    assert frames[-1]['choices'][0]['finish_reason'] == 'stop'
+    assert frames[-1]['usage']['completion_tokens'] > 0
+
+
+def test_missing_api_key(client):
+    response = client.post('/v1/chat/completions', json={'messages': MESSAGES})
+    assert response.status_code == 401
+
+
+def test_invalid_request(client, auth):
+    response = client.post('/v1/chat/completions', json={'messages': MESSAGES, 'temperature': 5}, headers=auth)
+    assert response.status_code == 400
+    assert response.json()['error']['code'] == 'invalid_temperature'
+    response = client.post('/v1/chat/completions', json={'messages': []}, headers=auth)
+    assert response.status_code == 400
+
+
+def test_content_parts(client, auth):
+    messages = [
+        {'role': 'system', 'content': [{'type': 'text', 'text': 'Be brief.'}]},
+        {'role': 'user', 'content': [{'type': 'text', 'text': 'What is this?'}, {'type': 'image_url', 'image_url': {'url': 'https://example.com/a.png'}}]}
+    ]
+    response = client.post('/v1/chat/completions', json={'messages': messages}, headers=auth)
+    assert response.status_code == 200
+    assert 'What is this?' in response.json()['choices'][0]['message']['content']
+    response = client.post('/v1/chat/completions', json={'messages': messages, 'stream': True}, headers=auth)
+    assert 'What is this?' in ''.join(frame['choices'][0]['delta'].get('content', '') for frame in _frames(response.text))
+
+
+def test_vapi_custom_llm(client, auth):
+    response = client.post('/vapi/custom-llm', json={'conversation': MESSAGES}, headers=auth)
+    assert response.status_code == 200
+    assert 'مرحباً، كيف حالك؟' in response.json()['response']
+    response = client.post('/vapi/custom-llm', json={'messages': [{'role': 'bad', 'content': 'x'}]}, headers=auth)
+    assert response.status_code == 400
+
+
+def test_models_and_unknown_route(client):
+    response = client.get('/v1/models')
+    assert response.status_code == 200
+    assert response.json()['data'][0]['id']
+    assert client.get('/nope').status_code == 404
@@ -0,0 +1,49 @@
+"""gunicorn.conf.py hooks on hosts without /proc/self/smaps_rollup"""
+
+import importlib.util
+import logging
+import os
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture
+def conf(monkeypatch):
+    monkeypatch.setenv('SERVER_MODE', 'flask')
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'gunicorn.conf.py')
+    spec = importlib.util.spec_from_file_location('gunicorn_conf', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    def unreadable(pid='self'):
+        raise FileNotFoundError(2, 'No such file or directory', f'/proc/{pid}/smaps_rollup')
+
+    monkeypatch.setattr(module, 'private_memory_mb', unreadable)
+    return module
+
+
+class Worker:
+    pid = 4242
+    alive = True
+    log = logging.getLogger('gunicorn.test')
+
+    def __init__(self):
+        self._forked_at = time.monotonic()
+
+
+def test_worker_boots_without_smaps_rollup(conf, monkeypatch, caplog):
+    monkeypatch.setattr(conf, 'WORKER_MAX_MEMORY_MB', 512.0)
+    threads = threading.active_count()
+    with caplog.at_level(logging.INFO, 'gunicorn.test'):
+        conf.post_worker_init(Worker())
+    assert 'private memory n/a' in caplog.text and 'not watching' in caplog.text
+    assert threading.active_count() == threads
+
+
+def test_memory_watchdog_stops_when_memory_cannot_be_read(conf, monkeypatch, caplog):
+    monkeypatch.setattr(conf, 'WORKER_MEMORY_CHECK_INTERVAL', 0)
+    with caplog.at_level(logging.WARNING, 'gunicorn.test'):
+        conf._watch_memory(Worker())
+    assert 'memory watchdog stopped' in caplog.text
@@ -0,0 +1,22 @@
+"""Prometheus metrics: label values taken from requests stay bounded"""
+
+import app
+from metrics import BoundedLabel
+
+
+def test_bounded_label_keeps_reserved_and_first_values():
+    label = BoundedLabel(2)
+    label.reserve('custom-llm')
+    assert label('gpt-4o') == 'gpt-4o'
+    assert label('made-up-1') == 'other' and label('made-up-2') == 'other'
+    assert label('custom-llm') == 'custom-llm' and label('gpt-4o') == 'gpt-4o'
+
+
+def test_made_up_models_do_not_add_series(client, auth, monkeypatch):
+    monkeypatch.setattr(app, 'model_label', BoundedLabel(1))
+    for i in range(20):
+        body = {'model': f'made-up-{i}', 'messages': [{'role': 'user', 'content': 'Hello'}]}
+        assert client.post('/v1/chat/completions', json=body, headers=auth).status_code == 200
+    series = [line for line in client.get('/metrics').text.splitlines() if line.startswith('llm_generation_duration_seconds_count')]
+    assert any('model="made-up-0"' in line for line in series) and any('model="other"' in line for line in series)
+    assert not any(f'model="made-up-{i}"' in line for line in series for i in range(1, 20))
@@ -0,0 +1,115 @@
+"""Request bodies the provider adapters build"""
+
+import pytest
+
+from providers import AnthropicBackend, BatchBackend, OllamaBackend, OpenAIBackend, UnsupportedContent, content_text
+from sessions import Session
+from validation import OutputLimits, output_limits_from
+
+IMAGE = 'data:image/png;base64,iVBORw0KGgo='
+PARTS = [
+    {'role': 'system', 'content': [{'type': 'text', 'text': 'Be brief.'}, {'type': 'text', 'text': 'Answer in Arabic.'}]},
+    {'role': 'user', 'content': [
+        {'type': 'text', 'text': 'What is in these pictures?'},
+        {'type': 'image_url', 'image_url': {'url': IMAGE}},
+        {'type': 'image_url', 'image_url': {'url': 'https://example.com/cat.jpg', 'detail': 'low'}}
+    ]},
+    {'role': 'assistant', 'content': [{'type': 'text', 'text': 'A cat.'}]},
+    {'role': 'user', 'content': 'And now?'}
+]
+AUDIO = {'role': 'user', 'content': [{'type': 'input_audio', 'input_audio': {'data': 'AAAA', 'format': 'wav'}}]}
+
+
+def test_content_text():
+    assert content_text('plain') == 'plain'
+    assert content_text(None) == ''
+    assert content_text(PARTS[0]['content']) == 'Be brief.\nAnswer in Arabic.'
+    assert content_text(PARTS[1]['content']) == 'What is in these pictures?'
+
+
+def test_openai_passes_parts_through():
+    _, body = OpenAIBackend('http://upstream')._build_request(PARTS + [AUDIO], 'gpt-4o', 0.5, False)
+    assert body['messages'] == PARTS + [AUDIO]
+
+
+def test_anthropic_converts_parts_to_blocks():
+    _, body = AnthropicBackend('http://upstream')._build_request(PARTS, 'claude', 0.5, False)
+    assert body['system'] == 'Be brief.\nAnswer in Arabic.'
+    assert body['messages'] == [
+        {'role': 'user', 'content': [
+            {'type': 'text', 'text': 'What is in these pictures?'},
+            {'type': 'image', 'source': {'type': 'base64', 'media_type': 'image/png', 'data': 'iVBORw0KGgo='}},
+            {'type': 'image', 'source': {'type': 'url', 'url': 'https://example.com/cat.jpg'}}
+        ]},
+        {'role': 'assistant', 'content': [{'type': 'text', 'text': 'A cat.'}]},
+        {'role': 'user', 'content': 'And now?'}
+    ]
+
+
+def test_anthropic_session_system_blocks_are_text():
+    session = Session('call')
+    _, body = AnthropicBackend('http://upstream')._build_request(PARTS, 'claude', 0.5, False, session)
+    assert body['system'] == [{'type': 'text', 'text': 'Be brief.\nAnswer in Arabic.', 'cache_control': {'type': 'ephemeral'}}]
+
+
+def test_ollama_flattens_text_and_moves_images():
+    messages = PARTS[:1] + [dict(PARTS[1], content=PARTS[1]['content'][:2])] + PARTS[2:]
+    _, body = OllamaBackend('http://upstream')._build_request(messages, 'llama3', 0.5, False)
+    assert body['messages'] == [
+        {'role': 'system', 'content': 'Be brief.\nAnswer in Arabic.'},
+        {'role': 'user', 'content': 'What is in these pictures?', 'images': ['iVBORw0KGgo=']},
+        {'role': 'assistant', 'content': 'A cat.'},
+        {'role': 'user', 'content': 'And now?'}
+    ]
+    assert body['messages'][3] is PARTS[3]
+
+
+@pytest.mark.parametrize('backend, messages', [
+    (AnthropicBackend('http://upstream'), [AUDIO]),
+    (OllamaBackend('http://upstream'), [AUDIO]),
+    (OllamaBackend('http://upstream'), PARTS),  # image link
+])
+def test_unsupported_parts_are_a_client_error(backend, messages):
+    with pytest.raises(UnsupportedContent) as info:
+        backend._build_request(messages, 'model', 0.5, False)
+    assert info.value.status == 400
+    assert info.value.code == 'unsupported_content'
+
+
+LIMITS = OutputLimits(max_tokens=50, stop='\n')
+
+
+def test_openai_forwards_output_limits_as_sent():
+    backend = OpenAIBackend('http://upstream')
+    _, body = backend._build_request(PARTS, 'gpt-4o', 0.5, False, limits=LIMITS)
+    assert (body['max_tokens'], body['stop']) == (50, '\n')
+    assert 'max_completion_tokens' not in body
+    _, body = backend._build_request(PARTS, 'gpt-4o', 0.5, False, limits=OutputLimits(max_completion_tokens=20))
+    assert body['max_completion_tokens'] == 20 and 'max_tokens' not in body and 'stop' not in body
+
+
+def test_anthropic_output_limits_override_the_default():
+    backend = AnthropicBackend('http://upstream', max_tokens=1024)
+    _, body = backend._build_request(PARTS, 'claude', 0.5, False)
+    assert body['max_tokens'] == 1024 and 'stop_sequences' not in body
+    _, body = backend._build_request(PARTS, 'claude', 0.5, False, limits=OutputLimits(80, 40, ['END', 'STOP']))
+    assert body['max_tokens'] == 40
+    assert body['stop_sequences'] == ['END', 'STOP']
+
+
+def test_ollama_output_limits_are_options():
+    _, body = OllamaBackend('http://upstream')._build_request(PARTS[:1], 'llama3', 0.5, False, limits=LIMITS)
+    assert body['options'] == {'temperature': 0.5, 'num_predict': 50, 'stop': ['\n']}
+
+
+def test_batch_output_limits_are_per_request():
+    body = BatchBackend._batch_body('local', [(PARTS[:1], 0.5, LIMITS), (PARTS[:1], 0.7, None)], False)
+    assert body['requests'][0] == {'messages': PARTS[:1], 'temperature': 0.5, 'max_tokens': 50, 'stop': ['\n']}
+    assert body['requests'][1] == {'messages': PARTS[:1], 'temperature': 0.7}
+
+
+def test_output_limits_from_body():
+    assert output_limits_from({'messages': []}) is None
+    assert output_limits_from({'stop': []}) is None
+    limits = output_limits_from({'max_tokens': 10, 'max_completion_tokens': 5, 'stop': 'x'})
+    assert (limits.token_limit, limits.stop_sequences) == (5, ['x'])
@@ -0,0 +1,43 @@
+"""Request log: nothing a caller said is written with REQUEST_LOG_REDACT=content"""
+
+import json
+import time
+
+from request_log import RequestRecorder, redact_content
+
+CARD = '4111 1111 1111 1111'
+
+BODY = {
+    'model': 'gpt-4o',
+    'messages': [
+        {'role': 'system', 'content': 'You take payments.'},
+        {'role': 'user', 'content': [
+            {'type': 'text', 'text': f'My card is {CARD}'},
+            {'type': 'image_url', 'image_url': {'url': 'https://example.com/card.png'}}
+        ]},
+        {'role': 'assistant', 'content': None, 'refusal': f'I cannot store {CARD}', 'tool_calls': [
+            {'id': 'call-1', 'type': 'function', 'function': {'name': 'charge', 'arguments': json.dumps({'card': CARD, 'cvv': 123})}}
+        ]},
+        {'role': 'tool', 'tool_call_id': 'call-1', 'content': 'declined'}
+    ]
+}
+
+
+def test_texts_refusals_and_arguments_are_masked():
+    redacted = redact_content(BODY)
+    assert '1111' not in json.dumps(redacted) and '123' not in json.dumps(redacted)
+    user, assistant = redacted['messages'][1], redacted['messages'][2]
+    assert user['content'][0] == {'type': 'text', 'text': 'xx xxxx xx xxxx xxxx xxxx xxxx'}
+    assert user['content'][1] == BODY['messages'][1]['content'][1]
+    assert assistant['refusal'] == 'x xxxxxx xxxxx xxxx xxxx xxxx xxxx'
+    function = assistant['tool_calls'][0]['function']
+    assert function['name'] == 'charge' and json.loads(function['arguments']) == {'card': 'xxxx xxxx xxxx xxxx', 'cvv': 0}
+    assert redacted['messages'][3]['tool_call_id'] == 'call-1' and redacted['messages'][3]['content'] == 'xxxxxxxx'
+
+
+def test_recorded_file_holds_no_card_number(tmp_path):
+    recorder = RequestRecorder(str(tmp_path / 'requests.jsonl'), redact='content')
+    recorder.record(time.time(), 'POST', '/v1/chat/completions', {}, json.dumps(BODY).encode(), 200)
+    recorder.close()
+    written = (tmp_path / 'requests.jsonl').read_text()
+    assert '"path":"/v1/chat/completions"' in written.replace(' ', '') and '1111' not in written
@@ -0,0 +1,155 @@
+"""Fallback chains, circuit breakers and hedged requests with in-process fake backends"""
+
+import asyncio
+import time
+
+import pytest
+
+from providers import ProviderError
+from routing import BackendHealth, CircuitBreaker, FallbackRoute, HedgePolicy, _Candidate, parse_fallbacks
+
+
+class FakeBackend:
+    """Answers `text` after `delay` seconds, or raises before the first token when `fail` is set"""
+
+    def __init__(self, name, text='ok', delay=0.0, fail=False):
+        self.name = name
+        self.text = text
+        self.delay = delay
+        self.fail = fail
+        self.calls = 0
+        self.closed = 0
+
+    def complete(self, messages, model, temperature, session=None, limits=None):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.fail:
+            raise ProviderError(f'{self.name} is down')
+        return self.text
+
+    def stream(self, messages, model, temperature, session=None, tools=None, limits=None):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.fail:
+            raise ProviderError(f'{self.name} is down')
+        try:
+            for word in self.text.split(' '):
+                yield word + ' '
+        finally:
+            self.closed += 1
+
+    async def acomplete(self, messages, model, temperature, session=None, limits=None):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise ProviderError(f'{self.name} is down')
+        return self.text
+
+    async def astream(self, messages, model, temperature, session=None, tools=None, limits=None):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise ProviderError(f'{self.name} is down')
+        for word in self.text.split(' '):
+            yield word + ' '
+
+
+def _route(*backends, failures=5, cooldown=30.0, hedge=None):
+    candidates = [
+        _Candidate(backend, 'model', BackendHealth(backend.name, CircuitBreaker(backend.name, failures, cooldown)))
+        for backend in backends
+    ]
+    return FallbackRoute('route', candidates, hedge)
+
+
+def test_falls_back_to_the_next_backend():
+    primary, secondary = FakeBackend('primary', fail=True), FakeBackend('secondary', text='from secondary')
+    route = _route(primary, secondary)
+    assert route.complete([], 'model', 0) == 'from secondary'
+    assert ''.join(route.stream([], 'model', 0)) == 'from secondary '
+    assert primary.calls == 2 and secondary.calls == 2
+
+
+def test_async_falls_back_to_the_next_backend():
+    route = _route(FakeBackend('primary', fail=True), FakeBackend('secondary', text='from secondary'))
+
+    async def run():
+        text = await route.acomplete([], 'model', 0)
+        deltas = [delta async for delta in route.astream([], 'model', 0)]
+        return text, ''.join(deltas)
+
+    assert asyncio.run(run()) == ('from secondary', 'from secondary ')
+
+
+def test_whole_chain_failing_raises_the_last_error():
+    route = _route(FakeBackend('primary', fail=True), FakeBackend('secondary', fail=True))
+    with pytest.raises(ProviderError, match='secondary is down'):
+        route.complete([], 'model', 0)
+
+
+def test_breaker_opens_skips_and_half_opens():
+    primary, secondary = FakeBackend('primary', fail=True), FakeBackend('secondary')
+    route = _route(primary, secondary, failures=2, cooldown=0.1)
+    route.complete([], 'model', 0)
+    route.complete([], 'model', 0)
+    assert route.candidates[0].health.breaker.state == 'open'
+    route.complete([], 'model', 0)
+    assert primary.calls == 2
+
+    time.sleep(0.15)
+    primary.fail = False
+    primary.text = 'recovered'
+    assert route.complete([], 'model', 0) == 'recovered'
+    assert route.candidates[0].health.breaker.state == 'closed'
+
+
+def test_failed_trial_reopens_the_breaker():
+    breaker = CircuitBreaker('b', failures=1, cooldown=0.05)
+    breaker.failure()
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert not breaker.allow()  # one trial at a time
+    breaker.failure()
+    assert breaker.state == 'open'
+
+
+def test_no_healthy_backend_is_a_503():
+    route = _route(FakeBackend('primary'), failures=1)
+    route.candidates[0].health.breaker.failure()
+    with pytest.raises(ProviderError) as info:
+        route.complete([], 'model', 0)
+    assert info.value.status == 503
+
+
+def test_hedge_delay_uses_the_latency_quantile():
+    policy = HedgePolicy(quantile=0.5, min_delay=0.01, max_delay=1.0)
+    health = BackendHealth('b', CircuitBreaker('b'))
+    assert policy.delay(health, True) == 1.0  # too few samples
+    for _ in range(BackendHealth.MIN_SAMPLES):
+        health.observe(True, 0.2)
+    assert policy.delay(health, True) == 0.2
+    assert policy.delay(health, False) == 1.0
+
+
+def test_hedged_stream_takes_the_faster_backend():
+    slow, fast = FakeBackend('slow', text='slow answer', delay=0.5), FakeBackend('fast', text='fast answer')
+    route = _route(slow, fast, hedge=HedgePolicy(min_delay=0.05, max_delay=0.05))
+    started = time.monotonic()
+    assert ''.join(route.stream([], 'model', 0)) == 'fast answer '
+    assert time.monotonic() - started < 0.4
+    assert slow.calls == 1 and fast.calls == 1
+
+
+def test_async_hedged_complete_takes_the_faster_backend():
+    slow, fast = FakeBackend('slow', text='slow', delay=0.5), FakeBackend('fast', text='fast')
+    route = _route(slow, fast, hedge=HedgePolicy(min_delay=0.05, max_delay=0.05))
+    assert asyncio.run(route.acomplete([], 'model', 0)) == 'fast'
+
+
+def test_parse_fallbacks():
+    spec = 'gpt-4o=anthropic/claude-3-5-haiku-latest, ollama/llama3;broken;claude-=gpt-4o-mini'
+    assert parse_fallbacks(spec) == [
+        ('gpt-4o', ('anthropic/claude-3-5-haiku-latest', 'ollama/llama3')),
+        ('claude-', ('gpt-4o-mini',))
+    ]
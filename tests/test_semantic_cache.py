@@ -0,0 +1,40 @@
+"""Semantic cache: which requests may share an answer"""
+
+import pytest
+
+import app
+from semantic_cache import HashingEmbedder, SemanticCache, scope_of
+
+SYSTEM = {'role': 'system', 'content': 'You are the receptionist of a dental clinic.'}
+
+
+def _call(*turns):
+    roles = ['user', 'assistant'] * len(turns)
+    return [SYSTEM] + [{'role': role, 'content': text} for role, text in zip(roles, turns)]
+
+
+def test_a_reply_is_not_answered_from_another_question():
+    cache = SemanticCache(HashingEmbedder())
+    booking = _call('Hi', 'Shall I book 10am tomorrow?', 'yes')
+    miss = cache.lookup('m', booking)
+    cache.put(miss, 'Great, you are booked for 10am tomorrow.')
+    assert cache.lookup('m', booking).answer == 'Great, you are booked for 10am tomorrow.'
+    assert cache.lookup('m', _call('Hi', 'Shall I cancel your appointment?', 'yes')).answer is None
+
+
+def test_opening_questions_are_shared_across_calls():
+    cache = SemanticCache(HashingEmbedder(), threshold=0.8)
+    cache.put(cache.lookup('m', _call('what are your opening hours')), 'From 9 to 9.')
+    assert cache.lookup('m', _call('what are your opening hours?')).answer == 'From 9 to 9.'
+    assert scope_of('m', _call('a')) == scope_of('m', _call('b'))
+    assert scope_of('m', _call('a', 'b', 'c')) != scope_of('m', _call('a', 'x', 'c'))
+
+
+@pytest.mark.parametrize('temperature, hits', [(0, 1), (0.7, 0)])
+def test_sampled_requests_bypass_the_cache(client, auth, monkeypatch, temperature, hits):
+    monkeypatch.setattr(app.llm, 'semantic_cache', SemanticCache(HashingEmbedder()))
+    body = {'messages': _call('When are you open?'), 'temperature': temperature}
+    for _ in range(2):
+        assert client.post('/v1/chat/completions', json=body, headers=auth).status_code == 200
+    stats = app.llm.semantic_cache.stats()
+    assert stats['hits'] == hits and stats['bypassed'] == (2 if hits == 0 else 0)
@@ -0,0 +1,87 @@
+"""Per-call sessions: prefix reuse and isolation between tenants"""
+
+import asyncio
+import time
+
+import pytest
+
+import app
+from keystore import KeyRecord, KeyStore, hash_key
+from sessions import SessionStore, scoped_session_id, session_id_from
+from shared_store import MemoryStore, SharedTier
+
+MESSAGES = [{'role': 'system', 'content': 'Be brief.'}, {'role': 'user', 'content': 'Hello'}]
+
+
+@pytest.fixture
+def tenants(monkeypatch):
+    """Keys of two tenants, acme and globex"""
+    records = [KeyRecord('acme-prod', hash_key('acme-key'), 'acme'), KeyRecord('globex-prod', hash_key('globex-key'), 'globex')]
+    monkeypatch.setattr(app, 'keystore', KeyStore(records))
+    return {'acme': {'Authorization': 'Bearer acme-key'}, 'globex': {'Authorization': 'Bearer globex-key'}}
+
+
+def test_session_id_sources_and_scope():
+    record = KeyRecord('k', 'digest', 'acme/eu')
+    assert session_id_from({'call': {'id': 'c1'}, 'metadata': {'call_id': 'c2'}}, {'X-Call-Id': 'c3'}) == 'c1'
+    assert session_id_from({'metadata': {'call_id': 'c2'}}, {'X-Call-Id': 'c3'}) == 'c2'
+    assert session_id_from({}, {'X-Call-Id': 'c3'}) == 'c3'
+    assert session_id_from({}, {}) is None
+    assert session_id_from({}, {'X-Call-Id': 'c3'}, record) == 'acme%2Feu/c3'
+    assert scoped_session_id('c3') == 'c3'
+
+
+def test_turns_reuse_the_validated_prefix():
+    store = SessionStore()
+    session = store.get('call')
+    session.extend(MESSAGES, 0, lambda msg: 1)
+    assert store.get('call').matched_prefix(MESSAGES + [{'role': 'assistant', 'content': 'Hi'}]) == 2
+    assert session.matched_prefix([dict(MESSAGES[0], content='Rewritten'), MESSAGES[1]]) == 0
+    assert store.end('call') and not store.end('call')
+
+
+def test_tenants_cannot_reach_each_others_sessions(client, tenants):
+    body = {'messages': MESSAGES}
+    assert client.post('/v1/chat/completions', json=body, headers=dict(tenants['acme'], **{'X-Call-Id': 'call-1'})).status_code == 200
+    assert app.llm.sessions.peek('acme/call-1') is not None
+    assert app.llm.sessions.peek('call-1') is None
+
+    # The same call id under another tenant is another session
+    assert client.post('/v1/chat/completions', json=body, headers=dict(tenants['globex'], **{'X-Call-Id': 'call-1'})).status_code == 200
+    assert app.llm.sessions.peek('globex/call-1') is not app.llm.sessions.peek('acme/call-1')
+
+    assert client.delete('/v1/sessions/call-1', headers=tenants['globex']).status_code == 200
+    assert client.delete('/v1/sessions/call-1', headers=tenants['globex']).status_code == 404
+    assert app.llm.sessions.peek('acme/call-1') is not None
+
+    webhook = {'message': {'type': 'end-of-call-report', 'call': {'id': 'call-1'}}}
+    assert client.post('/vapi/webhook', json=webhook, headers=tenants['acme']).status_code == 200
+    assert app.llm.sessions.peek('acme/call-1') is None
+
+
+class SlowStore(MemoryStore):
+    """Shared store whose reads take a slow network round trip"""
+
+    def get_many(self, keys):
+        time.sleep(0.3)
+        return super().get_many(keys)
+
+
+def test_slow_shared_store_reads_do_not_block_concurrent_streams(monkeypatch):
+    shared = SharedTier(SlowStore())
+    monkeypatch.setattr(app.llm, 'shared', shared)
+    monkeypatch.setattr(app.llm, 'sessions', SessionStore(shared=shared))
+
+    async def run():
+        loading = asyncio.ensure_future(app.llm.agenerate_response(MESSAGES, session_id='call-1'))
+        await asyncio.sleep(0.01)
+        started = time.perf_counter()
+        stream = await app.llm.agenerate_response(MESSAGES, stream=True)
+        frames = [frame async for frame in stream]
+        elapsed = time.perf_counter() - started
+        assert not loading.done()
+        assert await loading
+        return frames, elapsed
+
+    frames, elapsed = asyncio.run(run())
+    assert frames and elapsed < 0.2
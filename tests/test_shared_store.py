@@ -0,0 +1,95 @@
+"""RedisStore against fake_redis.py: RESP parsing, AUTH/SELECT, connection reuse and failures"""
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+from shared_store import ErrorReply, RedisStore, SharedTier, StoreError, store_from_url
+
+PASSWORD = 'secret'
+
+FAKE_REDIS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fake_redis.py')
+
+
+@pytest.fixture(scope='module')
+def redis_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    server = subprocess.Popen([sys.executable, FAKE_REDIS, '--port', str(port), '--password', PASSWORD])
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+                break
+            except OSError:
+                assert time.monotonic() < deadline, 'fake_redis did not start'
+                time.sleep(0.05)
+        yield port
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def _connections(store):
+    return json.loads(store.pipeline([['STATS']])[0])['connections']
+
+
+def test_reads_writes_and_deletes_through_the_shared_tier(redis_port):
+    tier = SharedTier(store_from_url(f'redis://:{PASSWORD}@127.0.0.1:{redis_port}/2', timeout=2))
+    binary = b'\x00line one\r\n$5\r\n*2\r\n\xff'
+    tier.set('a', b'alpha', 60)
+    tier.set('b', binary, 60)
+    tier.set('gone', b'soon deleted', 60)
+    tier.set('short', b'expires', 0.05)
+    assert tier.flush(2)
+    tier.delete('gone')
+    assert tier.flush(2)
+    time.sleep(0.1)
+    assert tier.get_many(['a', 'b', 'gone', 'short', 'missing']) == [b'alpha', binary, None, None, None]
+    assert tier.stats()['errors'] == 0 and tier.stats()['available']
+    # SELECT: database 0 does not see the keys of database 2
+    other = RedisStore(port=redis_port, password=PASSWORD, timeout=2)
+    assert other.get_many(['custom-llm:a']) == [None]
+    assert tier.store.get_many(['custom-llm:a']) == [b'alpha']
+
+
+def test_connections_are_reused_but_not_after_a_fork(redis_port):
+    store = RedisStore(port=redis_port, password=PASSWORD, timeout=2)
+    before = _connections(store)
+    for i in range(5):
+        store.write([(f'k{i}', b'v', 60)], [])
+        assert store.get_many([f'k{i}']) == [b'v']
+    assert _connections(store) == before
+    for conn in store._pool:
+        conn.pid = -1  # as if inherited by a forked worker
+    assert _connections(store) == before + 1
+
+
+def test_error_replies_keep_the_connection_usable(redis_port):
+    store = RedisStore(port=redis_port, password=PASSWORD, timeout=2)
+    with pytest.raises(ErrorReply):
+        store.pipeline([['SET', 'x', b'1'], ['NOSUCHCOMMAND']])
+    assert len(store._pool) == 1
+    assert store.get_many(['x']) == [b'1']
+
+
+def test_a_bad_password_fails_soft_in_the_shared_tier(redis_port):
+    store = RedisStore(port=redis_port, password='wrong', timeout=2)
+    with pytest.raises(StoreError):
+        store.get_many(['a'])
+    assert not store._pool
+    tier = SharedTier(store)
+    assert tier.get('a') is None
+    tier.set('a', b'alpha', 60)
+    assert tier.flush(2)
+    stats = tier.stats()
+    assert stats['errors'] == 2 and not stats['available']
+    # Reads skip the store for RETRY_INTERVAL instead of each paying for the failure
+    assert tier.get('a') is None and tier.stats()['reads_skipped_while_down'] == 1
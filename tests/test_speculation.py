@@ -0,0 +1,61 @@
+"""Speculative responses for the next turn of a call"""
+
+from sessions import Session
+from speculation import Speculator
+from validation import OutputLimits
+
+HISTORY = [{'role': 'system', 'content': 'Booking assistant'}, {'role': 'user', 'content': 'Book me tomorrow'}]
+REPLY = 'Can I book that for you tomorrow at 10?'
+
+
+def _speculated(limits, generated):
+    speculator = Speculator(
+        lambda model, messages, temperature, limits: generated.append(limits) or f"answer to {messages[-1]['content']}",
+        lambda model, text: len(text.split()),
+        static_candidates=['yes', 'no']
+    )
+    session = Session('call')
+    speculator.after_response(session, HISTORY, 'm', 0.0, REPLY, limits)
+    for candidate in session.speculation.candidates.values():
+        candidate.future.result()
+    return speculator, session
+
+
+def test_matching_turn_is_served():
+    generated = []
+    speculator, session = _speculated(OutputLimits(max_tokens=40), generated)
+    turn = HISTORY + [{'role': 'assistant', 'content': REPLY}, {'role': 'user', 'content': 'Yes!'}]
+    assert speculator.take(session, turn, 'm', 0.0, OutputLimits(max_tokens=40)) == 'answer to yes'
+    assert [limits.max_tokens for limits in generated] == [40, 40]
+    assert speculator.stats()['hits'] == 1
+
+
+def test_other_turns_and_other_limits_miss():
+    speculator, session = _speculated(OutputLimits(max_tokens=40), [])
+    turn = HISTORY + [{'role': 'assistant', 'content': REPLY}, {'role': 'user', 'content': 'yes'}]
+    assert speculator.take(session, turn, 'm', 0.0, OutputLimits(max_tokens=400)) is None
+
+    speculator, session = _speculated(None, [])
+    assert speculator.take(session, turn[:-1] + [{'role': 'user', 'content': 'maybe later'}], 'm', 0.0) is None
+    assert speculator.stats()['misses'] == 1
+
+
+def test_learned_turns_stay_within_their_tenant():
+    generated = []
+    speculator = Speculator(
+        lambda model, messages, temperature, limits: generated.append(messages[-1]['content']) or 'ok',
+        lambda model, text: 1,
+        min_count=1
+    )
+    turn = HISTORY + [{'role': 'assistant', 'content': REPLY}, {'role': 'user', 'content': 'Yes, my card is 4111 1111'}]
+    speculator.take(Session('acme/call-1'), turn, 'm', 0.0)
+
+    other_tenant = Session('globex/call-2')
+    speculator.after_response(other_tenant, HISTORY, 'm', 0.0, REPLY)
+    assert other_tenant.speculation is None and generated == []
+
+    same_tenant = Session('acme/call-3')
+    speculator.after_response(same_tenant, HISTORY, 'm', 0.0, REPLY)
+    for candidate in same_tenant.speculation.candidates.values():
+        candidate.future.result()
+    assert generated == ['Yes, my card is 4111 1111']
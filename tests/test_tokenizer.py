@@ -0,0 +1,27 @@
+"""Tokenizer selection: the default never needs the network"""
+
+import tokenizer
+from tokenizer import TokenizerRegistry
+
+
+def test_default_is_regex_without_a_tiktoken_cache_dir(monkeypatch):
+    monkeypatch.delenv('TIKTOKEN_CACHE_DIR', raising=False)
+    loaded = []
+    monkeypatch.setattr(tokenizer, 'create_tokenizer', lambda spec, cache_size: loaded.append(spec) or tokenizer.RegexTokenizer())
+    assert TokenizerRegistry([]).default.name == 'regex'
+    assert loaded == ['regex']
+
+
+def test_default_falls_back_to_regex_when_tiktoken_fails(monkeypatch, tmp_path):
+    monkeypatch.setenv('TIKTOKEN_CACHE_DIR', str(tmp_path))
+    real = tokenizer.create_tokenizer
+
+    def create(spec, cache_size):
+        if spec.startswith('tiktoken:'):
+            raise ImportError('no tiktoken')
+        return real(spec, cache_size)
+
+    monkeypatch.setattr(tokenizer, 'create_tokenizer', create)
+    registry = TokenizerRegistry([('llama', 'vocab:/missing/vocab.txt')])
+    assert registry.default.name == 'regex'
+    assert registry.for_model('llama3').name == 'regex'
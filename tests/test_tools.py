@@ -0,0 +1,63 @@
+"""Local tool execution: results and failures handed back to the model"""
+
+import asyncio
+
+import pytest
+
+import app
+from cache import ResponseCache
+from serialization import loads
+from tools import Tool, ToolRuntime
+
+
+def clinic_hours(day):
+    return {'day': day, 'open': '09:00'}
+
+
+async def aclinic_hours(day):
+    return {'day': day, 'open': '09:00'}
+
+
+def _runtime(fn):
+    return ToolRuntime({'clinic_hours': Tool('clinic_hours', fn, 'Opening hours', {'type': 'object'}, None, 0)})
+
+
+def _call(arguments):
+    return {'id': 'call-1', 'type': 'function', 'function': {'name': 'clinic_hours', 'arguments': arguments}}
+
+
+def _run(runtime, calls, mode):
+    return runtime.run(calls) if mode == 'sync' else asyncio.run(runtime.arun(calls))
+
+
+@pytest.mark.parametrize('mode', ['sync', 'async'])
+@pytest.mark.parametrize('fn', [clinic_hours, aclinic_hours], ids=['plain', 'coroutine'])
+def test_results_answer_the_calls(fn, mode):
+    runtime = _runtime(fn)
+    [message] = _run(runtime, [_call('{"day": "sunday"}')], mode)
+    assert message['role'] == 'tool' and message['tool_call_id'] == 'call-1'
+    assert loads(message['content']) == {'day': 'sunday', 'open': '09:00'}
+
+
+@pytest.mark.parametrize('mode', ['sync', 'async'])
+@pytest.mark.parametrize('fn', [clinic_hours, aclinic_hours], ids=['plain', 'coroutine'])
+def test_arguments_the_tool_does_not_accept_are_a_tool_error(fn, mode):
+    runtime = _runtime(fn)
+    calls = [_call('{"weekday": "sunday"}'), dict(_call('{"day": "monday"}'), id='call-2')]
+    failed, answered = _run(runtime, calls, mode)
+    assert failed['tool_call_id'] == 'call-1' and 'clinic_hours failed' in loads(failed['content'])['error']
+    assert loads(answered['content'])['day'] == 'monday'
+    assert runtime.errors == 1 and runtime.rounds == 1
+
+
+@pytest.mark.parametrize('models, hits', [((), 1), (('*',), 0)])
+def test_requests_offered_no_tools_keep_the_response_cache(client, auth, monkeypatch, models, hits):
+    runtime = _runtime(clinic_hours)
+    runtime.models = models
+    monkeypatch.setattr(app.llm, 'tools', runtime)
+    monkeypatch.setattr(app.llm, 'cache', ResponseCache())
+    body = {'messages': [{'role': 'user', 'content': 'When are you open?'}], 'temperature': 0}
+    for _ in range(2):
+        assert client.post('/v1/chat/completions', json=body, headers=auth).status_code == 200
+    assert app.llm.cache.stats()['hits'] == hits
+    assert runtime.offers('gpt-4o') == bool(models)
@@ -0,0 +1,208 @@
+"""
+Tokenizers for usage accounting
+Pluggable per-model token counters with memoized counts, so messages that are unchanged
+between turns are never re-tokenized.
+
+Available tokenizers:
+    tiktoken:<encoding>  - OpenAI BPE via the optional `tiktoken` package. Set TIKTOKEN_CACHE_DIR
+                           to a directory holding the encoding files to run fully offline.
+    vocab:<path>         - Greedy longest-match WordPiece over an offline vocab file
+                           (one token per line, "##" marks word continuations, e.g. BERT vocab.txt)
+    regex                - Dependency-free approximation of BPE counts for English and Arabic text
+
+Configuration (environment variables):
+    TOKENIZER_MAP         - comma-separated "<model prefix>=<tokenizer>" rules, first match wins,
+                            e.g. "gpt-4o=tiktoken:o200k_base,llama=vocab:/models/llama/vocab.txt"
+    TOKENIZER_DEFAULT     - tokenizer for unmatched models (default: tiktoken:cl100k_base when
+                            TIKTOKEN_CACHE_DIR is set and tiktoken is installed, else regex)
+    TOKENIZER_CACHE_SIZE  - memoized texts per tokenizer (default: 65536)
+"""
+
+import logging
+import math
+import os
+import re
+import threading
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Tokens added per message for role and separators, and once per request to prime the reply
+# (the accounting OpenAI documents for chat models)
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+# Pieces similar to GPT pre-tokenization: letter runs, digit groups, punctuation runs
+_PIECES = re.compile(r"[^\W\d_]+|\d{1,3}|[^\w\s]+|_+", re.UNICODE)
+
+
+class Tokenizer:
+    """Base class; subclasses implement _count"""
+
+    name = 'base'
+
+    def __init__(self, cache_size: int = 65536):
+        self.count_text = lru_cache(maxsize=cache_size)(self._count)
+
+    def _count(self, text: str) -> int:
+        raise NotImplementedError
+
+    def count_content(self, content: Any) -> int:
+        """Count a message content: a string or a list of multi-part content blocks"""
+        if content is None:
+            return 0
+        if isinstance(content, str):
+            return self.count_text(content)
+        if isinstance(content, list):
+            return sum(self.count_text(part.get('text', '')) for part in content if isinstance(part, dict))
+        return self.count_text(str(content))
+
+    def count_message(self, msg: Dict[str, Any]) -> int:
+        tokens = TOKENS_PER_MESSAGE + self.count_text(str(msg.get('role', ''))) + self.count_content(msg.get('content'))
+        if msg.get('name'):
+            tokens += self.count_text(str(msg['name'])) + 1
+        for call in msg.get('tool_calls') or ():
+            function = call.get('function') or {}
+            tokens += self.count_text(str(function.get('name', ''))) + self.count_text(str(function.get('arguments', '')))
+        return tokens
+
+    def count_messages(self, messages: List[Dict[str, Any]]) -> int:
+        return sum(self.count_message(msg) for msg in messages) + TOKENS_PER_REPLY
+
+    def cache_info(self) -> Dict[str, int]:
+        info = self.count_text.cache_info()
+        return {'hits': info.hits, 'misses': info.misses, 'size': info.currsize}
+
+
+class RegexTokenizer(Tokenizer):
+    """
+    Approximate BPE token counts without a vocabulary. Latin-script words average about
+    four characters per token; Arabic and other non-Latin scripts about two.
+    """
+
+    name = 'regex'
+
+    def _count(self, text: str) -> int:
+        tokens = 0
+        for piece in _PIECES.findall(text):
+            chars_per_token = 4 if piece.isascii() else 2
+            tokens += max(1, math.ceil(len(piece) / chars_per_token))
+        return tokens
+
+
+class TiktokenTokenizer(Tokenizer):
+    """OpenAI BPE encodings through the optional tiktoken package"""
+
+    def __init__(self, encoding: str, cache_size: int = 65536):
+        try:
+            import tiktoken
+        except ImportError:
+            raise ImportError("Please install tiktoken: pip install tiktoken")
+        self._encoding = tiktoken.get_encoding(encoding)
+        self.name = f'tiktoken:{encoding}'
+        super().__init__(cache_size)
+
+    def _count(self, text: str) -> int:
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+
+class VocabTokenizer(Tokenizer):
+    """Greedy longest-match WordPiece tokenizer over an offline vocab file"""
+
+    def __init__(self, path: str, cache_size: int = 65536, unknown_ratio: int = 2):
+        with open(path, encoding='utf-8') as f:
+            self.vocab = frozenset(line.rstrip('\n') for line in f if line.strip())
+        self.max_piece = max((len(token) for token in self.vocab), default=1)
+        self.unknown_ratio = unknown_ratio
+        self.name = f'vocab:{os.path.basename(path)}'
+        super().__init__(cache_size)
+
+    def _count(self, text: str) -> int:
+        tokens = 0
+        for word in _PIECES.findall(text):
+            start = 0
+            while start < len(word):
+                end = min(len(word), start + self.max_piece)
+                prefix = '##' if start else ''
+                while end > start and prefix + word[start:end] not in self.vocab:
+                    end -= 1
+                if end == start:
+                    # No vocab entry covers this character: count the rest of the word as unknown pieces
+                    tokens += max(1, math.ceil((len(word) - start) / self.unknown_ratio))
+                    break
+                tokens += 1
+                start = end
+        return tokens
+
+
+def create_tokenizer(spec: str, cache_size: int = 65536) -> Tokenizer:
+    """Build a tokenizer from a spec such as "regex", "tiktoken:cl100k_base" or "vocab:/path/vocab.txt" """
+    kind, _, arg = spec.partition(':')
+    if kind == 'regex':
+        return RegexTokenizer(cache_size)
+    if kind == 'tiktoken':
+        return TiktokenTokenizer(arg or 'cl100k_base', cache_size)
+    if kind == 'vocab':
+        return VocabTokenizer(arg, cache_size)
+    raise ValueError(f"Unknown tokenizer spec: {spec}")
+
+
+class TokenizerRegistry:
+    """Maps model names to tokenizers; tokenizers are built once and shared by all requests"""
+
+    def __init__(self, rules: List[Tuple[str, str]], default_spec: Optional[str] = None, cache_size: int = 65536):
+        self.rules = rules
+        self.cache_size = cache_size
+        self._tokenizers: Dict[str, Tokenizer] = {}
+        self._by_model: Dict[str, Tokenizer] = {}
+        self._lock = threading.Lock()
+        self.default = self._load(default_spec) if default_spec else self._default()
+
+    def _default(self) -> Tokenizer:
+        # Without a cache dir tiktoken downloads its encoding at startup, which stalls offline hosts
+        if os.getenv('TIKTOKEN_CACHE_DIR'):
+            try:
+                return self._load('tiktoken:cl100k_base')
+            except Exception as e:
+                logger.warning(f"Tokenizer tiktoken:cl100k_base unavailable ({e}); using regex")
+        return self._load('regex')
+
+    def _load(self, spec: str) -> Tokenizer:
+        tokenizer = self._tokenizers.get(spec)
+        if tokenizer is None:
+            tokenizer = self._tokenizers[spec] = create_tokenizer(spec, self.cache_size)
+            logger.info(f"Loaded tokenizer {tokenizer.name}")
+        return tokenizer
+
+    def for_model(self, model: str) -> Tokenizer:
+        tokenizer = self._by_model.get(model)
+        if tokenizer is not None:
+            return tokenizer
+        with self._lock:
+            tokenizer = self.default
+            for prefix, spec in self.rules:
+                if model.startswith(prefix):
+                    try:
+                        tokenizer = self._load(spec)
+                    except Exception as e:
+                        logger.warning(f"Tokenizer {spec} for model {model} unavailable ({e}); using {self.default.name}")
+                    break
+            self._by_model[model] = tokenizer
+        return tokenizer
+
+    def stats(self) -> Dict[str, Any]:
+        return {tokenizer.name: tokenizer.cache_info() for tokenizer in self._tokenizers.values()}
+
+
+def build_tokenizers_from_env() -> TokenizerRegistry:
+    rules = []
+    for rule in os.getenv('TOKENIZER_MAP', '').split(','):
+        prefix, sep, spec = rule.strip().partition('=')
+        if sep:
+            rules.append((prefix.strip(), spec.strip()))
+    return TokenizerRegistry(
+        rules,
+        default_spec=os.getenv('TOKENIZER_DEFAULT') or None,
+        cache_size=int(os.getenv('TOKENIZER_CACHE_SIZE', 65536))
+    )
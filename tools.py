@@ -0,0 +1,407 @@
+"""
+Tool (function) calling
+The tools, tool_choice and parallel_tool_calls fields of a chat request are forwarded to the
+upstream (converted for Anthropic and Ollama), and the tool calls the model makes are streamed
+to the client as OpenAI tool_calls deltas, or returned in message.tool_calls.
+
+Tools can also run in this server: functions registered with @tool in the module named by
+TOOLS_MODULE are offered to the model next to the client's tools, and on every request for the
+models in TOOLS_MODELS. Requests that are offered no tools at all keep the response caches and
+speculation; a turn with tools bypasses them, as its answer depends on the tool results. When every
+call of a turn is to a registered tool, the calls run concurrently on a thread pool (coroutine
+functions on the event loop of the ASGI server), each with its own timeout, and the model is
+asked again with the results; the client only receives the final answer. A tool registered with
+cache_ttl is idempotent: its results are cached per arguments for that long. A turn that calls
+any tool the server does not have is returned to the client, which runs the tools itself.
+
+    # my_tools.py, with TOOLS_MODULE=my_tools
+    from tools import tool
+
+    @tool(description='Free appointment slots on a date', cache_ttl=30,
+          parameters={'type': 'object', 'properties': {'date': {'type': 'string'}}, 'required': ['date']})
+    def check_availability(date):
+        return {'date': date, 'slots': ['10:00', '11:30']}
+
+A call's timeout runs from the start of its round, including any wait for a free pool worker. A
+tool that times out is reported to the model as an error; its thread cannot be interrupted and
+finishes in the background, so a hanging tool keeps a pool worker until it returns.
+
+Configuration (environment variables):
+    TOOLS_MODULE      - module registering local tools, e.g. example_tools (default: none)
+    TOOLS_MODELS      - comma-separated model name prefixes whose requests are always offered the
+                        local tools, * for all models (default: none, only requests with tools)
+    TOOL_TIMEOUT_MS   - default timeout of a tool call (default: 2000)
+    TOOL_WORKERS      - threads running tool calls (default: 8)
+    TOOL_CACHE_SIZE   - cached results of cache_ttl tools; 0 disables the cache (default: 1024)
+    TOOL_MAX_ROUNDS   - tool rounds per turn before the model must answer (default: 3)
+"""
+
+import asyncio
+import functools
+import importlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from metrics import TOOL_CALLS, TOOL_LATENCY
+from serialization import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+
+def new_call_id() -> str:
+    return f"call_{uuid.uuid4().hex[:24]}"
+
+
+class ToolCallDelta:
+    """
+    A piece of a tool call in a stream: the call's id and name come with its first piece, the
+    arguments JSON in fragments. index identifies the call within the response; upstream
+    adapters pass their own index (e.g. Anthropic's content block) and ToolCalls renumbers it.
+    """
+
+    __slots__ = ('index', 'id', 'name', 'arguments')
+
+    def __init__(self, index: int, call_id: Optional[str], name: Optional[str], arguments: str = ''):
+        self.index = index
+        self.id = call_id
+        self.name = name
+        self.arguments = arguments
+
+
+class ToolCalls:
+    """Assembles the tool calls of one response from its deltas"""
+
+    def __init__(self):
+        self.calls: List[Dict[str, Any]] = []
+        self._by_index: Dict[Any, int] = {}
+
+    def add(self, delta: ToolCallDelta) -> ToolCallDelta:
+        """Add a delta; returns it numbered for the client (0, 1, ... in call order)"""
+        position = self._by_index.get(delta.index) if delta.id is None else None
+        if position is None:
+            position = self._by_index[delta.index] = len(self.calls)
+            call_id = delta.id or new_call_id()
+            self.calls.append({'id': call_id, 'type': 'function', 'function': {'name': delta.name or '', 'arguments': delta.arguments}})
+            return ToolCallDelta(position, call_id, delta.name or '', delta.arguments)
+        self.calls[position]['function']['arguments'] += delta.arguments
+        return ToolCallDelta(position, None, None, delta.arguments)
+
+    def complete(self) -> List[Dict[str, Any]]:
+        """The assembled calls in the assistant message format; missing arguments become {}"""
+        for call in self.calls:
+            if not call['function']['arguments']:
+                call['function']['arguments'] = '{}'
+        return self.calls
+
+    def deltas(self) -> List[ToolCallDelta]:
+        """One delta per complete call, for sending buffered calls to the client"""
+        return [
+            ToolCallDelta(i, call['id'], call['function']['name'], call['function']['arguments'])
+            for i, call in enumerate(self.complete())
+        ]
+
+
+def call_text(calls: List[Dict[str, Any]]) -> str:
+    """The generated part of tool calls (names and arguments), for counting completion tokens"""
+    return ''.join(call['function']['name'] + call['function']['arguments'] for call in calls)
+
+
+class ToolOptions:
+    """The tool fields of a request: OpenAI tool definitions, tool_choice and parallel_tool_calls"""
+
+    __slots__ = ('tools', 'choice', 'parallel')
+
+    def __init__(self, tools: List[Dict[str, Any]], choice: Any = None, parallel: Optional[bool] = None):
+        self.tools = tools
+        self.choice = choice
+        self.parallel = parallel
+
+    def names(self) -> List[str]:
+        return [tool['function']['name'] for tool in self.tools]
+
+    def answer_only(self) -> 'ToolOptions':
+        """The same tools with tool_choice 'none', so the model has to answer in text"""
+        return ToolOptions(self.tools, 'none', self.parallel)
+
+
+def tool_options_from(data: Dict[str, Any]) -> Optional[ToolOptions]:
+    """ToolOptions of a validated request body, None when it has no tools"""
+    tools = data.get('tools')
+    if not tools:
+        return None
+    return ToolOptions(tools, data.get('tool_choice'), data.get('parallel_tool_calls'))
+
+
+class ToolReply:
+    """Non-streamed response to a request with tools: text and the calls for the client to run"""
+
+    __slots__ = ('text', 'tool_calls')
+
+    def __init__(self, text: str, tool_calls: Optional[List[Dict[str, Any]]] = None):
+        self.text = text
+        self.tool_calls = tool_calls or None
+
+
+class Tool:
+    """A function registered with @tool"""
+
+    __slots__ = ('name', 'fn', 'description', 'parameters', 'timeout', 'cache_ttl', 'is_async')
+
+    def __init__(self, name, fn, description, parameters, timeout, cache_ttl):
+        self.name = name
+        self.fn = fn
+        self.description = description
+        self.parameters = parameters
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self.is_async = asyncio.iscoroutinefunction(fn)
+
+    def definition(self) -> Dict[str, Any]:
+        return {'type': 'function', 'function': {
+            'name': self.name, 'description': self.description, 'parameters': self.parameters
+        }}
+
+
+# Tools registered by @tool, by name
+REGISTRY: Dict[str, Tool] = {}
+
+
+def tool(
+    name: Optional[str] = None,
+    description: str = '',
+    parameters: Optional[Dict[str, Any]] = None,
+    timeout: Optional[float] = None,
+    cache_ttl: float = 0.0
+) -> Callable[[Callable], Callable]:
+    """
+    Register a function (plain or async) as a local tool. It is called with the arguments the
+    model produced as keyword arguments and returns a string or a JSON-serializable value.
+    timeout is in seconds (default TOOL_TIMEOUT_MS); cache_ttl > 0 marks it idempotent.
+    """
+    def register(fn: Callable) -> Callable:
+        tool_name = name or fn.__name__
+        REGISTRY[tool_name] = Tool(
+            tool_name, fn, description or (fn.__doc__ or '').strip(),
+            parameters or {'type': 'object', 'properties': {}}, timeout, cache_ttl
+        )
+        return fn
+    return register
+
+
+def _arguments(call: Dict[str, Any]) -> Dict[str, Any]:
+    arguments = loads(call['function']['arguments'] or '{}')
+    if not isinstance(arguments, dict):
+        raise ValueError('arguments must be a JSON object')
+    return arguments
+
+
+def _content(result: Any) -> str:
+    return result if isinstance(result, str) else dumps(result)
+
+
+class ToolRuntime:
+    """Runs calls to the registered tools concurrently, with per-tool timeouts and a result cache"""
+
+    def __init__(
+        self,
+        tools: Dict[str, Tool],
+        timeout: float = 2.0,
+        workers: int = 8,
+        cache_size: int = 1024,
+        max_rounds: int = 3,
+        models: Tuple[str, ...] = ()
+    ):
+        self.tools = dict(tools)
+        self.timeout = timeout
+        self.workers = workers
+        self.cache_size = cache_size
+        self.max_rounds = max_rounds
+        self.models = models  # model name prefixes offered the local tools on every request; '*' = all
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix='tool')
+        self._cache: 'OrderedDict[Tuple[str, str], Tuple[str, float]]' = OrderedDict()  # -> (content, expires_at)
+        self._lock = threading.Lock()
+        self._definitions = [tool.definition() for tool in self.tools.values()]
+        self.rounds = 0
+        self.calls = 0
+        self.cache_hits = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.handed_to_client = 0
+
+    def offers(self, model_name: str) -> bool:
+        """Whether requests for model_name that carry no tools are offered the local tools"""
+        return any(prefix == '*' or model_name.startswith(prefix) for prefix in self.models)
+
+    def offer(self, options: Optional[ToolOptions]) -> ToolOptions:
+        """The request's tool options with the local tools added (a client tool of the same name wins)"""
+        if options is None:
+            return ToolOptions(self._definitions)
+        names = set(options.names())
+        local = [definition for definition in self._definitions if definition['function']['name'] not in names]
+        return ToolOptions(options.tools + local, options.choice, options.parallel)
+
+    def handles(self, calls: List[Dict[str, Any]]) -> bool:
+        """Whether every call is to a local tool; otherwise the client has to run them"""
+        if all(call['function']['name'] in self.tools for call in calls):
+            return True
+        with self._lock:
+            self.handed_to_client += 1
+        return False
+
+    # ----- execution -----
+
+    def run(self, calls: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Run the calls concurrently; returns the tool messages answering them, in order"""
+        started = time.monotonic()
+        pending = [self._start(call) for call in calls]
+        messages = []
+        for call, (tool, key, outcome) in zip(calls, pending):
+            if not isinstance(outcome, str):
+                remaining = started + self._timeout(tool) - time.monotonic()
+                try:
+                    outcome = self._finish(tool, key, outcome.result(timeout=max(0.0, remaining)), started)
+                except FutureTimeout:
+                    outcome = self._failed(tool, 'timeout', f'{tool.name} timed out after {self._timeout(tool):g}s')
+                except Exception as e:
+                    outcome = self._failed(tool, 'error', f'{tool.name} failed: {e}')
+            messages.append({'role': 'tool', 'tool_call_id': call['id'], 'content': outcome})
+        with self._lock:
+            self.rounds += 1
+        return messages
+
+    async def arun(self, calls: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Async version of run; coroutine tools run on the event loop, plain ones on the pool"""
+        started = time.monotonic()
+        contents = await asyncio.gather(*(self._acall(call, started) for call in calls))
+        with self._lock:
+            self.rounds += 1
+        return [{'role': 'tool', 'tool_call_id': call['id'], 'content': content} for call, content in zip(calls, contents)]
+
+    async def _acall(self, call: Dict[str, Any], started: float) -> str:
+        tool, key, outcome = self._start(call, submit=False)
+        if isinstance(outcome, str):
+            return outcome
+        try:
+            # Calling the tool is inside the try: arguments it does not accept are a TypeError
+            if tool.is_async:
+                work = tool.fn(**outcome)
+            else:
+                work = asyncio.get_running_loop().run_in_executor(self._pool, functools.partial(tool.fn, **outcome))
+            return self._finish(tool, key, await asyncio.wait_for(work, self._timeout(tool)), started)
+        except asyncio.TimeoutError:
+            return self._failed(tool, 'timeout', f'{tool.name} timed out after {self._timeout(tool):g}s')
+        except Exception as e:
+            return self._failed(tool, 'error', f'{tool.name} failed: {e}')
+
+    def _start(self, call: Dict[str, Any], submit: bool = True) -> Tuple[Tool, Any, Any]:
+        """
+        (tool, cache key, outcome): outcome is the content when the call is answered already
+        (cached, or unusable arguments), else a future (submit) or the parsed arguments
+        """
+        name = call['function']['name']
+        tool = self.tools[name]
+        with self._lock:
+            self.calls += 1
+        try:
+            arguments = _arguments(call)
+        except ValueError as e:
+            return tool, None, self._failed(tool, 'error', f'invalid arguments for {name}: {e}')
+        key = None
+        if tool.cache_ttl > 0 and self.cache_size > 0:
+            key = (name, json.dumps(arguments, sort_keys=True))
+            cached = self._cached(key)
+            if cached is not None:
+                TOOL_CALLS.inc((name, 'cached'))
+                return tool, key, cached
+        if submit:
+            if tool.is_async:
+                # The coroutine is created in the worker, so a bad call fails the future like any other error
+                return tool, key, self._pool.submit(lambda: asyncio.run(tool.fn(**arguments)))
+            return tool, key, self._pool.submit(tool.fn, **arguments)
+        return tool, key, arguments
+
+    def _finish(self, tool: Tool, key: Any, result: Any, started: float) -> str:
+        content = _content(result)
+        TOOL_CALLS.inc((tool.name, 'ok'))
+        TOOL_LATENCY.observe(time.monotonic() - started, (tool.name,))
+        if key is not None:
+            self._store(key, content, tool.cache_ttl)
+        return content
+
+    def _failed(self, tool: Tool, outcome: str, message: str) -> str:
+        TOOL_CALLS.inc((tool.name, outcome))
+        logger.warning(f"Tool call failed: {message}")
+        with self._lock:
+            if outcome == 'timeout':
+                self.timeouts += 1
+            else:
+                self.errors += 1
+        # The model sees the failure as the tool's result and can tell the caller
+        return dumps({'error': message})
+
+    def _timeout(self, tool: Tool) -> float:
+        return tool.timeout if tool.timeout is not None else self.timeout
+
+    # ----- result cache -----
+
+    def _cached(self, key: Tuple[str, str]) -> Optional[str]:
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            self.cache_hits += 1
+            return entry[0]
+
+    def _store(self, key: Tuple[str, str], content: str, ttl: float) -> None:
+        with self._lock:
+            self._cache[key] = (content, time.monotonic() + ttl)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'enabled': True,
+            'tools': sorted(self.tools),
+            'workers': self.workers,
+            'timeout_ms': self.timeout * 1000,
+            'max_rounds': self.max_rounds,
+            'rounds': self.rounds,
+            'calls': self.calls,
+            'cache_hits': self.cache_hits,
+            'cached_results': len(self._cache),
+            'errors': self.errors,
+            'timeouts': self.timeouts,
+            'handed_to_client': self.handed_to_client
+        }
+
+
+def build_tools_from_env() -> Optional[ToolRuntime]:
+    """Import TOOLS_MODULE and return a ToolRuntime for the tools it registered; None when unset"""
+    module = os.getenv('TOOLS_MODULE')
+    if not module:
+        return None
+    importlib.import_module(module)
+    if not REGISTRY:
+        logger.warning(f"TOOLS_MODULE={module} registered no tools")
+        return None
+    logger.info(f"Local tools enabled: {', '.join(sorted(REGISTRY))}")
+    return ToolRuntime(
+        REGISTRY,
+        timeout=float(os.getenv('TOOL_TIMEOUT_MS', 2000)) / 1000,
+        workers=int(os.getenv('TOOL_WORKERS', 8)),
+        cache_size=int(os.getenv('TOOL_CACHE_SIZE', 1024)),
+        max_rounds=int(os.getenv('TOOL_MAX_ROUNDS', 3)),
+        models=tuple(m.strip() for m in os.getenv('TOOLS_MODELS', '').split(',') if m.strip())
+    )
@@ -0,0 +1,393 @@
+"""
+Request validation
+One validator for the chat request shape, shared by /v1/chat/completions and /vapi/custom-llm.
+The schema below is declared once and compiled at import into nested check functions, so a
+request is validated in a single pass: each field present is looked up in a dict and checked,
+and each message is dispatched on its role to the checks for that role. The route parsers
+check the top-level fields; CustomLLM checks the messages, skipping a session's known prefix.
+Errors are raised as APIError in the existing envelope, with code invalid_<field>
+(invalid_messages for messages).
+
+Validated shape (OpenAI Chat Completions; unknown fields are ignored, null means "not set"):
+    model, temperature (0-2), top_p (0-1), max_tokens / max_completion_tokens (>= 1),
+    stop (string or up to 4 strings), stream, presence_penalty / frequency_penalty (-2 to 2),
+    tools (function definitions), tool_choice, parallel_tool_calls, user
+    messages: system / user / assistant / tool messages; content is a string or
+    an array of content parts (text, image_url, input_audio); assistant messages may carry
+    tool_calls instead of content; tool messages need tool_call_id
+
+max_tokens, max_completion_tokens and stop are forwarded to the upstream as an OutputLimits
+(output_limits_from); they are part of the response cache key.
+
+Bodies larger than MAX_REQUEST_BYTES are rejected with 413 from their Content-Length,
+before they are read or parsed.
+
+Configuration (environment variables):
+    MAX_REQUEST_BYTES  - largest accepted request body (default: 4194304)
+"""
+
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from service import APIError
+
+MAX_REQUEST_BYTES = int(os.getenv('MAX_REQUEST_BYTES', 4 * 1024 * 1024))
+
+Check = Callable[[Any], None]
+
+_MISSING = object()
+
+
+class _Invalid(Exception):
+    """A check failed; path is filled in while the error travels up the nested checks"""
+
+    def __init__(self, problem: str):
+        super().__init__(problem)
+        self.problem = problem
+        self.path = ''
+
+    def at(self, segment: str) -> '_Invalid':
+        self.path = segment + self.path
+        return self
+
+
+# ----- schema building blocks, each compiled to a check function -----
+
+def string() -> Check:
+    def check(value):
+        if type(value) is not str:
+            raise _Invalid('must be a string')
+    return check
+
+
+def number(low: float, high: float) -> Check:
+    def check(value):
+        if type(value) not in (int, float):
+            raise _Invalid('must be a number')
+        if not low <= value <= high:
+            raise _Invalid(f'must be between {low} and {high}, got {value}')
+    return check
+
+
+def integer(low: int) -> Check:
+    def check(value):
+        if type(value) is not int:
+            raise _Invalid('must be an integer')
+        if value < low:
+            raise _Invalid(f'must be at least {low}, got {value}')
+    return check
+
+
+def boolean() -> Check:
+    def check(value):
+        if type(value) is not bool:
+            raise _Invalid('must be a boolean')
+    return check
+
+
+def one_of(*values: str) -> Check:
+    allowed = frozenset(values)
+    expected = ', '.join(repr(v) for v in values)
+
+    def check(value):
+        if type(value) is not str or value not in allowed:
+            raise _Invalid(f'must be one of {expected}')
+    return check
+
+
+def array(item: Check, max_items: Optional[int] = None, min_items: int = 0) -> Check:
+    def check(value):
+        if type(value) is not list:
+            raise _Invalid('must be an array')
+        if len(value) < min_items:
+            raise _Invalid(f'must have at least {min_items} items')
+        if max_items is not None and len(value) > max_items:
+            raise _Invalid(f'must have at most {max_items} items')
+        for i, element in enumerate(value):
+            try:
+                item(element)
+            except _Invalid as e:
+                raise e.at(f'[{i}]')
+    return check
+
+
+def obj(fields: Dict[str, Check], required: Tuple[str, ...] = ()) -> Check:
+    def check(value):
+        if type(value) is not dict:
+            raise _Invalid('must be an object')
+        for key in required:
+            if key not in value:
+                raise _Invalid(f"is missing '{key}'")
+        for key, field in value.items():
+            field_check = fields.get(key)
+            if field_check is not None:
+                try:
+                    field_check(field)
+                except _Invalid as e:
+                    raise e.at(f'.{key}')
+    return check
+
+
+def any_of(problem: str, *checks: Check) -> Check:
+    """Passes if one of checks passes, else fails with problem"""
+    def check(value):
+        for option in checks:
+            try:
+                option(value)
+                return
+            except _Invalid:
+                continue
+        raise _Invalid(problem)
+    return check
+
+
+def parts(kinds: Dict[str, Check]) -> Check:
+    """Array of content parts dispatched on their `type`"""
+    expected = ', '.join(repr(kind) for kind in kinds)
+
+    def check(value):
+        if type(value) is not list:
+            raise _Invalid('must be a string or an array of content parts')
+        for i, part in enumerate(value):
+            kind = part.get('type') if type(part) is dict else None
+            part_check = kinds.get(kind)
+            if part_check is None:
+                raise _Invalid(f'type must be one of {expected}').at(f'[{i}]')
+            try:
+                part_check(part)
+            except _Invalid as e:
+                raise e.at(f'[{i}]')
+    return check
+
+
+# ----- the chat request schema -----
+
+TEXT_PART = obj({'text': string()}, required=('text',))
+IMAGE_PART = obj({'image_url': obj({'url': string(), 'detail': one_of('auto', 'low', 'high')}, required=('url',))}, required=('image_url',))
+AUDIO_PART = obj({'input_audio': obj({'data': string(), 'format': string()}, required=('data', 'format'))}, required=('input_audio',))
+REFUSAL_PART = obj({'refusal': string()}, required=('refusal',))
+
+TEXT_CONTENT = parts({'text': TEXT_PART})
+USER_CONTENT = parts({'text': TEXT_PART, 'image_url': IMAGE_PART, 'input_audio': AUDIO_PART})
+ASSISTANT_CONTENT = parts({'text': TEXT_PART, 'refusal': REFUSAL_PART})
+
+TOOL_CALL = obj({
+    'id': string(),
+    'type': one_of('function'),
+    'function': obj({'name': string(), 'arguments': string()}, required=('name', 'arguments'))
+}, required=('id', 'type', 'function'))
+
+TOOL = obj({
+    'type': one_of('function'),
+    'function': obj({
+        'name': string(),
+        'description': string(),
+        'parameters': obj({}),
+        'strict': boolean()
+    }, required=('name',))
+}, required=('type', 'function'))
+
+TOOL_CHOICE = any_of(
+    "must be 'none', 'auto', 'required' or {\"type\": \"function\", \"function\": {\"name\": ...}}",
+    one_of('none', 'auto', 'required'),
+    obj({'type': one_of('function'), 'function': obj({'name': string()}, required=('name',))}, required=('type', 'function'))
+)
+
+# role -> (content check, content required, checks of the other fields)
+MESSAGE_SCHEMA: Dict[str, Tuple[Check, bool, Dict[str, Check]]] = {
+    'system': (TEXT_CONTENT, True, {'name': string()}),
+    'user': (USER_CONTENT, True, {'name': string()}),
+    'assistant': (ASSISTANT_CONTENT, False, {'name': string(), 'tool_calls': array(TOOL_CALL, min_items=1), 'refusal': string()}),
+    'tool': (TEXT_CONTENT, True, {'tool_call_id': string()}),
+}
+
+ROLES = "'system', 'user', 'assistant' or 'tool'"
+
+REQUEST_SCHEMA: Dict[str, Check] = {
+    'model': string(),
+    'temperature': number(0.0, 2.0),
+    'top_p': number(0.0, 1.0),
+    'max_tokens': integer(1),
+    'max_completion_tokens': integer(1),
+    'stop': any_of('must be a string or an array of up to 4 strings', string(), array(string(), max_items=4)),
+    'stream': boolean(),
+    'presence_penalty': number(-2.0, 2.0),
+    'frequency_penalty': number(-2.0, 2.0),
+    'tools': array(TOOL, max_items=128),
+    'tool_choice': TOOL_CHOICE,
+    'parallel_tool_calls': boolean(),
+    'user': string(),
+}
+
+
+def _compile_message(content_check: Check, content_required: bool, fields: Dict[str, Check]) -> Callable[[int, Dict[str, Any]], None]:
+    def check(i: int, msg: Dict[str, Any]) -> None:
+        content = msg.get('content', _MISSING)
+        if type(content) is not str:
+            if content is _MISSING or content is None:
+                if content_required or 'tool_calls' not in msg:
+                    raise APIError(f"Message {i} must have 'role' and 'content' fields", 'invalid_messages')
+            else:
+                try:
+                    content_check(content)
+                except _Invalid as e:
+                    raise _message_error(i, e.at('.content'))
+        if len(msg) > 2:
+            for key, value in msg.items():
+                field_check = fields.get(key)
+                if field_check is not None:
+                    try:
+                        field_check(value)
+                    except _Invalid as e:
+                        raise _message_error(i, e.at(f'.{key}'))
+        if 'tool_call_id' in fields and 'tool_call_id' not in msg:
+            raise APIError(f"Message {i} with role 'tool' must have a 'tool_call_id' field", 'invalid_messages')
+    return check
+
+
+_MESSAGE_CHECKS = {role: _compile_message(*spec) for role, spec in MESSAGE_SCHEMA.items()}
+
+# Roles for which a string content and no other field is a complete, valid message
+_PLAIN_ROLES = frozenset(role for role, (_, _, fields) in MESSAGE_SCHEMA.items() if 'tool_call_id' not in fields)
+
+
+def _message_error(i: int, e: _Invalid) -> APIError:
+    return APIError(f"Invalid 'messages[{i}]{e.path}': {e.problem}", 'invalid_messages')
+
+
+def validate_messages(messages: Any, start: int = 0) -> None:
+    """
+    Check a messages array against MESSAGE_SCHEMA, from index start on (earlier messages were
+    checked on a previous turn of the same session). Raises APIError(code='invalid_messages').
+    """
+    if type(messages) is not list or not messages:
+        raise APIError('Messages must be a non-empty list', 'invalid_messages')
+    checks = _MESSAGE_CHECKS
+    plain = _PLAIN_ROLES
+    for i, msg in enumerate(messages[start:] if start else messages, start):
+        if type(msg) is not dict:
+            raise APIError(f"Message {i} must be a dictionary", 'invalid_messages')
+        role = msg.get('role')
+        # Fast path for the common {"role": ..., "content": "..."} message
+        if type(role) is str and len(msg) == 2 and role in plain and type(msg.get('content')) is str:
+            continue
+        check = checks.get(role) if type(role) is str else None
+        if check is None:
+            if 'role' not in msg:
+                raise APIError(f"Message {i} must have 'role' and 'content' fields", 'invalid_messages')
+            raise APIError(f"Message {i} has invalid role: {msg['role']}. Must be {ROLES}", 'invalid_messages')
+        check(i, msg)
+
+
+def _validate_fields(data: Dict[str, Any], skip: Tuple[str, ...] = ()) -> None:
+    for key, value in data.items():
+        check = REQUEST_SCHEMA.get(key)
+        if check is None or value is None or key in skip:
+            continue
+        try:
+            check(value)
+        except _Invalid as e:
+            raise APIError(f"Invalid '{key}{e.path}': {e.problem}", f'invalid_{key}')
+
+
+def check_content_length(length: Optional[int], limit: int = MAX_REQUEST_BYTES) -> None:
+    """Reject a request body over limit (MAX_REQUEST_BYTES) before reading it"""
+    if length is not None and length > limit:
+        raise APIError(
+            f'Request body too large: {length} bytes (limit {limit})',
+            'request_too_large', status=413
+        )
+
+
+def parse_chat_request(data: Any) -> Tuple[List[Dict[str, Any]], Optional[str], float, bool]:
+    """
+    Validate the top-level fields of a /v1/chat/completions request body. The messages are
+    checked by validate_messages() when the response is generated, where the session's
+    already-validated prefix is known.
+
+    Returns:
+        (messages, model, temperature, stream)
+
+    Raises:
+        APIError: if the body is missing or does not match the chat request schema
+    """
+    if not data:
+        raise APIError('No JSON data provided', 'missing_json')
+    if type(data) is not dict:
+        raise APIError('Request body must be a JSON object', 'invalid_json')
+
+    messages = data.get('messages')
+    if not messages:
+        raise APIError('No messages provided. Messages must be a non-empty array.', 'missing_messages')
+
+    # Numeric strings such as "0.5" have always been accepted for temperature
+    temperature = data.get('temperature')
+    if temperature is None:
+        temperature = 0.7
+    else:
+        try:
+            temperature = float(temperature)
+        except (ValueError, TypeError):
+            raise APIError(f'Invalid temperature value: {temperature}', 'invalid_temperature')
+        if not (0.0 <= temperature <= 2.0):
+            raise APIError(f'Temperature must be between 0.0 and 2.0, got {temperature}', 'invalid_temperature')
+
+    _validate_fields(data, skip=('temperature',))
+    return messages, data.get('model'), temperature, bool(data.get('stream'))
+
+
+class OutputLimits:
+    """The output fields of a request: max_tokens, max_completion_tokens and stop sequences"""
+
+    __slots__ = ('max_tokens', 'max_completion_tokens', 'stop')
+
+    def __init__(self, max_tokens: Optional[int] = None, max_completion_tokens: Optional[int] = None, stop: Any = None):
+        self.max_tokens = max_tokens
+        self.max_completion_tokens = max_completion_tokens
+        self.stop = stop
+
+    @property
+    def token_limit(self) -> Optional[int]:
+        """Most tokens to generate; max_completion_tokens supersedes max_tokens as in OpenAI's API"""
+        return self.max_completion_tokens if self.max_completion_tokens is not None else self.max_tokens
+
+    @property
+    def stop_sequences(self) -> List[str]:
+        return [self.stop] if type(self.stop) is str else list(self.stop or ())
+
+    def key(self) -> Tuple[Any, ...]:
+        """Hashable identity, for cache keys and speculation matches"""
+        return self.max_tokens, self.max_completion_tokens, tuple(self.stop_sequences)
+
+
+def output_limits_from(data: Dict[str, Any]) -> Optional[OutputLimits]:
+    """OutputLimits of a validated request body, None when it sets none of the fields"""
+    max_tokens, max_completion_tokens, stop = data.get('max_tokens'), data.get('max_completion_tokens'), data.get('stop')
+    if max_tokens is None and max_completion_tokens is None and not stop:
+        return None
+    return OutputLimits(max_tokens, max_completion_tokens, stop or None)
+
+
+def parse_vapi_request(data: Any) -> Tuple[List[Dict[str, Any]], Optional[str], float]:
+    """
+    Validate the top-level fields of a /vapi/custom-llm request body and return
+    (messages, model, temperature).
+    Accepts either 'messages' or 'conversation' and clamps temperature instead of rejecting it.
+    """
+    if not data:
+        raise APIError('No JSON data provided', 'missing_json')
+    if type(data) is not dict:
+        raise APIError('Request body must be a JSON object', 'invalid_json')
+
+    # Extract conversation data (supports both formats)
+    messages = data.get('messages') or data.get('conversation')
+    if not messages:
+        raise APIError('No messages or conversation found', 'missing_messages')
+
+    try:
+        temperature = max(0.0, min(2.0, float(data.get('temperature', 0.7))))
+    except (ValueError, TypeError):
+        temperature = 0.7
+
+    _validate_fields(data, skip=('temperature',))
+    return messages, data.get('model'), temperature